@@ -0,0 +1,14 @@
+# Configuração lida automaticamente pelo Gunicorn quando iniciado nesta pasta
+# (gunicorn servidor:app). As tarefas em segundo plano (lixeira, cache,
+# metadados, cotas, verificação, armazenamento frio, replicação) sobem em um
+# único processo: o primeiro que conseguir a trava em .vyrex/tarefas.lock.
+# Com mais de um processo (-w N), as vagas do controle de admissão passam a
+# ser contadas em .vyrex/admissao.db, somando todos eles.
+
+
+def post_worker_init(worker):
+    import servidor
+    if worker.cfg.workers > 1:
+        servidor.admission_controller.share()
+    if servidor.start_background_workers():
+        worker.log.info('Tarefas em segundo plano iniciadas neste processo (pid %s)', worker.pid)
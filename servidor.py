@@ -1,21 +1,79 @@
-from flask import Flask, render_template_string, request, url_for, send_file, jsonify, abort
+from flask import Flask, render_template_string, request, url_for, send_file, jsonify, abort, g, redirect, stream_with_context, has_request_context
 import os
+import sys
+import stat
 import shutil
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import FileWrapper, ClosingIterator
 import psutil
 from datetime import datetime
 import mimetypes
 from base64 import b64encode
+import time
+import json
+import uuid
+import errno
+import threading
+import hashlib
+import random
+import codecs
+import zipfile
+import subprocess
+import importlib.util
+import xml.etree.ElementTree as ET
+import posixpath
+import re
+import struct
+import mmap
+import bisect
+import contextlib
+import zlib
+import gzip
+import sqlite3
+import socket
+import hmac
+import http.client
+import ssl
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from urllib.parse import quote, unquote, urlsplit
+from email.utils import formatdate, parsedate_to_datetime
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional; sem ele o preview usa a imagem original
+    Image = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard é opcional; sem ele o armazenamento frio usa gzip
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem vários processos, as tarefas de fundo sobem sem trava
+    fcntl = None
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max por arquivo
 
 # --- CONFIGURAÇÃO E FUNÇÕES AUXILIARES ---
 
-# Pasta DADOS no mesmo diretório do script
-DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DADOS')
+# Pasta DADOS no mesmo diretório do script (VYREX_DADOS muda o local, ex: duas
+# instâncias na mesma máquina)
+DATA_FOLDER = os.environ.get('VYREX_DADOS') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DADOS')
 os.makedirs(DATA_FOLDER, exist_ok=True)
 
+# Estado interno do servidor (caches, índices), fora da pasta DADOS
+STATE_FOLDER = os.environ.get('VYREX_ESTADO') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.vyrex')
+CACHE_FOLDER = os.path.join(STATE_FOLDER, 'cache')
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Acima disso os arquivos menos usados saem do cache
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+
 def get_drives():
     """Retorna uma lista de caminhos de drives disponíveis no sistema."""
     drives = []
@@ -30,27 +88,184 @@ def get_drives():
                 pass
     return drives
 
-def safe_path(base, path):
+# Tabela de drives com as raízes já resolvidas (realpath), recalculada a cada
+# DRIVE_TABLE_TTL segundos em vez de consultar o psutil a cada requisição
+DRIVE_TABLE_TTL = 30
+# Por quanto tempo um diretório verificado como livre de symlinks é confiável
+PATH_CACHE_TTL = 5.0
+PATH_CACHE_MAX = 50000
+# A partir de quantos itens na mesma pasta vale ler a pasta inteira de uma vez
+BATCH_SCANDIR_MIN = 32
+
+_drive_table = {'expires': 0.0, 'roots': {}, 'mounts': []}
+_drive_table_lock = threading.Lock()
+_clean_dirs = {}
+
+def _refresh_drive_table():
+    # A consulta ao psutil (que toca cada disco) é feita por um processo e reaproveitada pelos outros
+    mounts = shared_get('drives')
+    if mounts is None:
+        mounts = get_drives()
+        shared_put('drives', mounts, DRIVE_TABLE_TTL)
+    roots = {'DADOS': os.path.realpath(DATA_FOLDER)}
+    for mount in mounts:
+        real = os.path.realpath(mount)
+        roots[mount] = real
+        # Aceita tanto 'C:\' quanto 'C:' (formato usado nas URLs)
+        roots[mount.rstrip(os.sep) or mount] = real
+    _drive_table.update(roots=roots, mounts=mounts, expires=time.monotonic() + DRIVE_TABLE_TTL)
+
+def available_drives():
+    """Lista de drives de get_drives(), em cache por DRIVE_TABLE_TTL segundos."""
+    with _drive_table_lock:
+        if time.monotonic() >= _drive_table['expires']:
+            _refresh_drive_table()
+        return _drive_table['mounts']
+
+def resolve_drive(raw_drive):
     """
-    Valida e retorna um caminho de arquivo seguro, prevenindo ataques de Path Traversal.
+    Converte o identificador de drive recebido ('DADOS', 'C:', '/media/usb') na
+    raiz real correspondente. Retorna None se não for um drive conhecido.
+    """
+    with _drive_table_lock:
+        if time.monotonic() >= _drive_table['expires']:
+            _refresh_drive_table()
+        return _drive_table['roots'].get(raw_drive or 'DADOS')
+
+def drive_root_or_abort(raw_drive):
+    root = resolve_drive(raw_drive)
+    if root is None:
+        abort(400, 'Drive inválido')
+    return root
+
+def forget_resolved_paths(*paths):
+    """
+    Descarta, em todos os processos, os caches de diretórios verificados e de
+    listagens dos itens informados (caminhos completos), das subpastas deles e
+    das pastas que os contêm. Chamar após renomear/mover/apagar. Sem argumentos,
+    descarta tudo.
     """
-    base = os.path.realpath(os.path.abspath(base))
+    if not paths:
+        publish_invalidation(trees=[''])
+        return
+    publish_invalidation(exact={os.path.dirname(path) for path in paths}, trees=set(paths))
+
+def _is_within(root, path):
+    root = os.path.normcase(root)
+    path = os.path.normcase(path)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def _is_link(st):
+    # Symlinks e, no Windows, junções/reparse points (0x400)
+    return stat.S_ISLNK(st.st_mode) or bool(getattr(st, 'st_file_attributes', 0) & 0x400)
+
+def _join_relative(root, path):
     # Normaliza o caminho relativo, removendo barras extras e caracteres inválidos
     path = path.strip('/').strip('\\').replace('/', os.sep).replace('\\', os.sep)
-    
     if not path:
-        return base
-    
-    # Junta o caminho base com o caminho relativo de forma segura
-    full_path = os.path.normpath(os.path.join(base, path))
-    full_path = os.path.realpath(os.path.abspath(full_path))
-    
-    # Verifica se o caminho final ainda está dentro do caminho base permitido
-    if not full_path.startswith(base):
-        print(f"SECURITY: Path traversal blocked! base={base}, requested={path}, full={full_path}")
+        return root
+    return os.path.normpath(os.path.join(root, path))
+
+def _dir_is_clean(root, directory, now):
+    """Confere, com cache, que nenhum componente entre root e directory é symlink."""
+    if directory == root:
+        return True
+    expires = _clean_dirs.get(directory)
+    if expires is not None and expires > now:
+        return True
+
+    parent = os.path.dirname(directory)
+    if parent == directory or not _dir_is_clean(root, parent, now):
+        return False
+    try:
+        if _is_link(os.lstat(directory)):
+            return False
+    except FileNotFoundError:
+        # Ainda não existe (ex: pasta a criar); vale agora, mas não entra no cache
+        return True
+    except OSError:
+        return False
+
+    if len(_clean_dirs) >= PATH_CACHE_MAX:
+        _clean_dirs.clear()
+    _clean_dirs[directory] = now + PATH_CACHE_TTL
+    return True
+
+def _resolve_slow(root, full_path, requested):
+    # O caminho passa por um symlink: resolve de verdade e confere o destino
+    real = os.path.realpath(full_path)
+    if not _is_within(root, real):
+        print(f"SECURITY: Path traversal blocked! base={root}, requested={requested}, full={real}")
+        return None
+    return real
+
+def _check_path(root, path, is_link=None):
+    full_path = _join_relative(root, path)
+    if not _is_within(root, full_path):
+        print(f"SECURITY: Path traversal blocked! base={root}, requested={path}, full={full_path}")
+        return None
+    if full_path == root:
+        return root
+
+    if _dir_is_clean(root, os.path.dirname(full_path), time.monotonic()):
+        if is_link is None:
+            try:
+                is_link = _is_link(os.lstat(full_path))
+            except OSError:
+                is_link = False
+        if not is_link:
+            return full_path
+    return _resolve_slow(root, full_path, path)
+
+def resolve_path(root, path):
+    """
+    Valida e retorna um caminho seguro dentro de root, prevenindo Path Traversal.
+    root deve vir de resolve_drive() (já resolvida). Diretórios sem symlinks ficam
+    em cache, então o caso comum custa um único lstat no item final.
+    """
+    full_path = _check_path(root, path)
+    if full_path is None:
         abort(403)
     return full_path
 
+def resolve_paths(root, paths, strict=True):
+    """
+    Versão em lote de resolve_path para operações com muitos itens. Itens da
+    mesma pasta compartilham a verificação da pasta, e pastas com muitos itens
+    selecionados são lidas uma única vez com os.scandir em vez de um lstat por
+    item. Com strict=False, caminhos bloqueados viram None em vez de abortar.
+    """
+    groups = {}
+    for index, path in enumerate(paths):
+        full_path = _join_relative(root, path)
+        groups.setdefault(os.path.dirname(full_path), []).append(index)
+
+    results = [None] * len(paths)
+    for directory, indexes in groups.items():
+        links = None
+        if len(indexes) >= BATCH_SCANDIR_MIN and _is_within(root, directory):
+            try:
+                with os.scandir(directory) as entries:
+                    links = {entry.name for entry in entries
+                             if entry.is_symlink() or getattr(entry, 'is_junction', lambda: False)()}
+            except OSError:
+                links = None
+
+        for index in indexes:
+            is_link = None
+            if links is not None:
+                is_link = os.path.basename(_join_relative(root, paths[index])) in links
+            results[index] = _check_path(root, paths[index], is_link)
+            if results[index] is None and strict:
+                abort(403)
+    return results
+
+def safe_path(base, path):
+    """
+    Valida e retorna um caminho de arquivo seguro, prevenindo ataques de Path Traversal.
+    """
+    return resolve_path(os.path.realpath(os.path.abspath(base)), path)
+
 # --- CONSTANTES E FUNÇÕES DE UTILIDADE ---
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'mp4', 'avi', 'mov', 'mkv', 'zip', 'rar', 'doc', 'docx', 'xls', 'xlsx', 'mp3', 'wav', 'webp', 'bmp'}
@@ -87,1226 +302,9516 @@ def is_video(filename):
     ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
     return ext in {'mp4', 'avi', 'mov', 'mkv'}
 
-# --- TEMPLATE HTML ---
+# Tipos que o navegador pode abrir na própria página; o resto (HTML, SVG, texto...)
+# vai sempre como anexo, para não rodar conteúdo de terceiros na origem do servidor
+INLINE_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/avif',
+                     'video/mp4', 'video/webm', 'video/quicktime', 'video/x-matroska'}
 
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="pt-BR">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Gerenciamento Local - {{ current_path if current_path else 'Raiz' }}</title>
-    <style>
-        :root {
-            --bg-color: #1a1a1a;
-            --text-color: #ffffff;
-            --secondary-text: #a0a0a0;
-            --accent-color: #0061ff;
-            --card-bg: #2a2a2a;
-            --border-color: #404040;
-            --hover-bg: #3a3a3a;
+def download_headers(name, as_attachment=True):
+    """Tipo MIME e cabeçalhos de um arquivo enviado por streaming próprio."""
+    mime = mimetypes.guess_type(name)[0]
+    disposition = 'attachment'
+    if mime not in INLINE_MIME_TYPES:
+        mime = 'application/octet-stream'
+    elif not as_attachment:
+        disposition = 'inline'
+    return mime, {'Content-Disposition': f"{disposition}; filename*=UTF-8''{quote(name)}",
+                  'X-Content-Type-Options': 'nosniff'}
+
+TEXT_EXTENSIONS = {'txt', 'csv', 'log', 'md', 'json', 'xml', 'ini', 'cfg', 'conf', 'yml', 'yaml', 'py', 'js', 'css', 'html', 'sql'}
+
+def is_text(filename):
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return ext in TEXT_EXTENSIONS
+
+def is_document(filename):
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return ext in TEXT_EXTENSIONS or ext in {'pdf', 'docx', 'xlsx'}
+
+# --- CACHE COMPARTILHADO ENTRE PROCESSOS ---
+
+# Com vários processos atendendo (ex: Gunicorn com -w 4), cada um teria seus
+# próprios caches, duplicados e desatualizados depois de uma alteração feita
+# por outro processo. Os resultados caros (listagens, lista de drives) também
+# vão para um SQLite em modo WAL, reaproveitado por todos. Cada alteração
+# registra as pastas afetadas com um número de sequência: cada processo
+# descarta só essas pastas dos seus caches locais, e uma entrada compartilhada
+# vale enquanto nenhuma invalidação posterior a ela atingir a pasta dela (ou,
+# para as de árvore, uma pasta acima). O caminho '' representa tudo.
+SHARED_CACHE_DB = os.path.join(STATE_FOLDER, 'cache-compartilhado.db')
+SHARED_CACHE_MAX_VALUE = 4 * 1024 * 1024   # Valores maiores ficam só no cache local
+SHARED_CACHE_PRUNE_EVERY = 500             # Gravações entre limpezas de entradas vencidas
+SHARED_CACHE_SYNC_INTERVAL = 0.5           # Segundos entre leituras das invalidações por processo
+SHARED_CACHE_INVALIDATIONS_MAX = 5000      # Pastas invalidadas lembradas antes de uma limpeza geral
+SQLITE_POOL_SIZE = 8                       # Conexões ociosas mantidas por banco
+
+class SQLitePool:
+    """
+    Conexões SQLite reaproveitadas entre threads (o servidor de desenvolvimento
+    cria uma thread por requisição). O esquema é criado uma vez, pela primeira
+    conexão a cada arquivo; as seguintes só aplicam os PRAGMAs de conexão.
+    path é uma função, para acompanhar o caminho configurado.
+    """
+
+    def __init__(self, path, schema, pragmas=(), **options):
+        self.path = path
+        self.schema = schema
+        self.pragmas = pragmas
+        self.options = options
+        self._idle = []
+        self._ready = None
+        self._lock = threading.Lock()
+        self._schema_lock = threading.Lock()
+
+    def _connect(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False, **self.options)
+        try:
+            for pragma in self.pragmas:
+                conn.execute(pragma)
+            with self._schema_lock:
+                if self._ready != path:
+                    self.schema(conn)
+                    self._ready = path
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Empresta uma conexão durante o bloco with."""
+        path = self.path()
+        conn = None
+        with self._lock:
+            while self._idle and conn is None:
+                idle_path, idle = self._idle.pop()
+                if idle_path == path:
+                    conn = idle
+                else:
+                    idle.close()
+        if conn is None:
+            conn = self._connect(path)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()  # Bloco interrompido antes do commit
+            with self._lock:
+                if len(self._idle) < SQLITE_POOL_SIZE:
+                    self._idle.append((path, conn))
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+def _shared_cache_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO generation VALUES (0, 0)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY, generation INTEGER NOT NULL,
+        expires REAL NOT NULL, value TEXT NOT NULL)''')
+    # seq: última invalidação da pasta; tree_seq: a última que vale também para as subpastas
+    conn.execute('''CREATE TABLE IF NOT EXISTS invalidations (
+        path TEXT PRIMARY KEY, seq INTEGER NOT NULL, tree_seq INTEGER NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS invalidations_seq ON invalidations (seq)')
+
+# É só cache: perder as últimas gravações numa queda de energia não importa
+_shared_connections = SQLitePool(lambda: SHARED_CACHE_DB, _shared_cache_schema, ('PRAGMA synchronous=OFF',),
+                          timeout=5, isolation_level=None)
+# seq: última invalidação já aplicada aos caches locais; drops: quantas vezes
+# eles perderam entradas (quem lista confere que nada mudou no meio)
+_shared_state = {'seq': None, 'checked': 0.0, 'puts': 0, 'drops': 0}
+_shared_lock = threading.Lock()
+
+def shared_cache_db():
+    """Conexão do pool, para usar num bloco with."""
+    return _shared_connections.connection()
+
+def _forget_local(exact=(), trees=()):
+    """
+    Descarta o que este processo guardou sobre as pastas de exact (só a
+    listagem) e de trees (também as subpastas e os diretórios verificados).
+    '' em trees descarta tudo.
+    """
+    if '' in trees:
+        _clean_dirs.clear()
+        with _listing_lock:
+            _listing_cache.clear()
+            _tree_cache.clear()
+            _shared_state['drops'] += 1
+        return
+    prefixes = tuple(path.rstrip(os.sep) + os.sep for path in trees)
+    with _listing_lock:
+        for cache in (_listing_cache, _tree_cache):
+            for path in (*exact, *trees):
+                cache.pop(path, None)
+            if prefixes:
+                for key in [key for key in cache if key.startswith(prefixes)]:
+                    del cache[key]
+        _shared_state['drops'] += 1
+    if prefixes:
+        # list() copia as chaves de uma vez; outras threads seguem gravando no dict
+        for key in list(_clean_dirs):
+            if key in trees or key.startswith(prefixes):
+                _clean_dirs.pop(key, None)
+
+def current_sequence():
+    """
+    Última invalidação vista por este processo. As pastas que outro processo
+    alterou desde a consulta anterior saem dos caches locais. O banco é lido no
+    máximo a cada SHARED_CACHE_SYNC_INTERVAL segundos. Retorna None se ele
+    estiver indisponível (os caches locais seguem valendo).
+    """
+    now = time.monotonic()
+    seen = _shared_state['seq']
+    if seen is not None and now - _shared_state['checked'] < SHARED_CACHE_SYNC_INTERVAL:
+        return seen
+    try:
+        with shared_cache_db() as conn:
+            conn.execute('BEGIN')
+            seq = conn.execute('SELECT value FROM generation').fetchone()[0]
+            changes = []
+            if seen is not None and seq != seen:
+                changes = conn.execute(
+                    'SELECT path, tree_seq > ? FROM invalidations WHERE seq > ?', (seen, seen)).fetchall()
+            conn.execute('COMMIT')
+    except sqlite3.Error as e:
+        print(f"Erro ao ler o cache compartilhado: {e}")
+        return None
+    with _shared_lock:
+        _shared_state['checked'] = now
+        if _shared_state['seq'] is not None and seq <= _shared_state['seq']:
+            return _shared_state['seq']  # Outra thread já aplicou
+        if changes:
+            _forget_local({path for path, tree in changes if not tree},
+                          {path for path, tree in changes if tree})
+        _shared_state['seq'] = seq
+    return seq
+
+def publish_invalidation(exact=(), trees=()):
+    """
+    Invalida, neste e nos outros processos, as listagens das pastas de exact e
+    tudo o que estiver em cache sobre as pastas de trees e suas subpastas
+    (caminhos completos; '' em trees invalida tudo).
+    """
+    _forget_local(exact, trees)
+    try:
+        with shared_cache_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE generation SET value = value + 1')
+            seq = conn.execute('SELECT value FROM generation').fetchone()[0]
+            conn.executemany('''INSERT INTO invalidations VALUES (?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET seq = excluded.seq, tree_seq = max(tree_seq, excluded.tree_seq)''',
+                [(path, seq, 0) for path in exact if path not in trees] + [(path, seq, seq) for path in trees])
+            if seq % SHARED_CACHE_PRUNE_EVERY == 0:
+                _prune_invalidations(conn)
+            conn.execute('COMMIT')
+    except sqlite3.Error as e:
+        print(f"Erro ao invalidar o cache compartilhado: {e}")
+    _shared_state['checked'] = 0.0  # A próxima consulta já vê a invalidação
+
+def _prune_invalidations(conn):
+    # As mais antigas viram uma invalidação geral: quem ainda não as tinha
+    # visto descarta tudo, e as entradas compartilhadas anteriores deixam de valer
+    row = conn.execute('SELECT seq FROM invalidations ORDER BY seq DESC LIMIT 1 OFFSET ?',
+                       (SHARED_CACHE_INVALIDATIONS_MAX,)).fetchone()
+    if row is None:
+        return
+    conn.execute("DELETE FROM invalidations WHERE seq <= ? AND path != ''", row)
+    conn.execute('''INSERT INTO invalidations VALUES ('', ?1, ?1)
+        ON CONFLICT (path) DO UPDATE SET seq = max(seq, ?1), tree_seq = max(tree_seq, ?1)''', row)
+
+def _invalidation_scope(full_path):
+    # A própria pasta, as que estão acima dela e '' (tudo)
+    scope = ['']
+    while True:
+        scope.append(full_path)
+        parent = os.path.dirname(full_path)
+        if parent == full_path:
+            return scope
+        full_path = parent
+
+def shared_get(key, full_path=None):
+    """
+    Valor (já decodificado) gravado por qualquer processo, ou None se ausente ou
+    vencido. Com full_path, também None se a pasta foi invalidada depois da
+    gravação.
+    """
+    scope = _invalidation_scope(full_path) if full_path is not None else []
+    try:
+        with shared_cache_db() as conn:
+            row = conn.execute(
+                f'''SELECT generation, expires, value,
+                    (SELECT max(CASE WHEN path = ? THEN seq ELSE tree_seq END) FROM invalidations
+                     WHERE path IN ({', '.join('?' * len(scope))}))
+                FROM entries WHERE key = ?''', (full_path, *scope, key)).fetchone()
+    except sqlite3.Error as e:
+        print(f"Erro ao ler o cache compartilhado: {e}")
+        return None
+    if row is None or row[1] <= time.time() or (row[3] is not None and row[3] > row[0]):
+        return None
+    return json.loads(row[2])
+
+def shared_put(key, value, ttl, seq=None):
+    """Grava um valor serializável em JSON para os outros processos (seq: a lida antes de calculá-lo)."""
+    data = json.dumps(value, separators=(',', ':'))
+    if len(data) > SHARED_CACHE_MAX_VALUE:
+        return
+    with _shared_lock:
+        _shared_state['puts'] += 1
+        prune = _shared_state['puts'] % SHARED_CACHE_PRUNE_EVERY == 0
+    try:
+        with shared_cache_db() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                         (key, seq if seq is not None else -1, time.time() + ttl, data))
+            if prune:
+                conn.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+    except sqlite3.Error as e:
+        print(f"Erro ao gravar no cache compartilhado: {e}")
+
+@app.before_request
+def sync_shared_caches():
+    # Descarta o que este processo sabe sobre pastas que outro processo alterou
+    # (consulta o banco no máximo a cada SHARED_CACHE_SYNC_INTERVAL)
+    current_sequence()
+
+# --- LISTAGEM DE DIRETÓRIOS ---
+
+# Listagens em cache, validadas pelo mtime do diretório. O TTL cobre arquivos
+# alterados no lugar (que não mudam o mtime da pasta) e relógios de baixa resolução.
+LISTING_CACHE_TTL = 10.0
+LISTING_CACHE_MAX = 2000
+# Árvore de pastas (/api/tree): só nomes de subpastas, então cabem bem mais entradas
+TREE_CACHE_TTL = 300.0
+TREE_CACHE_MAX = 20000
+TREE_MAX_DEPTH = 4
+TREE_MAX_FOLDERS = 2000   # Subpastas devolvidas por pasta
+
+_listing_cache = {}
+_tree_cache = {}
+_listing_lock = threading.Lock()
+
+def _entry_info(name, st, is_link=False):
+    is_dir = stat.S_ISDIR(st.st_mode)
+    return {
+        'name': name,
+        'is_dir': is_dir,
+        'is_link': is_link,
+        'size': 0 if is_dir else st.st_size,
+        'mtime': st.st_mtime,
+        'mtime_ns': st.st_mtime_ns,
+        'ctime': st.st_ctime,
+    }
+
+def list_directory(full_path):
+    """
+    Lista o conteúdo de uma pasta com um único scandir (sem stat por item no
+    Windows). O resultado é compartilhado entre chamadas (e entre processos,
+    pelo cache compartilhado) e não deve ser alterado.
+    """
+    dir_mtime = os.stat(full_path).st_mtime_ns
+    seq = current_sequence()
+    now = time.monotonic()
+    with _listing_lock:
+        cached = _listing_cache.get(full_path)
+        if cached and cached[0] == dir_mtime and cached[1] > now:
+            return cached[2]
+        drops = _shared_state['drops']
+
+    shared = shared_get('ls:' + full_path, full_path) if seq is not None else None
+    if shared is not None and shared['mtime_ns'] == dir_mtime:
+        entries = shared['entries']
+    else:
+        entries = []
+        with os.scandir(full_path) as it:
+            for entry in it:
+                try:
+                    info = _entry_info(entry.name, entry.stat(), entry.is_symlink())
+                    if not info['is_dir'] and cold_suffix(entry.name):
+                        info['logical_size'] = cold_logical_size(entry.path)
+                    entries.append(info)
+                except OSError as e:
+                    print(f"Erro ao processar {entry.name}: {e}")
+        if seq is not None:
+            shared_put('ls:' + full_path, {'mtime_ns': dir_mtime, 'entries': entries},
+                       LISTING_CACHE_TTL, seq)
+
+    with _listing_lock:
+        if _shared_state['drops'] != drops:
+            # Alguma pasta foi invalidada enquanto esta thread listava
+            return entries
+        if len(_listing_cache) >= LISTING_CACHE_MAX:
+            # Descarta a entrada mais antiga (dicts mantêm a ordem de inserção)
+            _listing_cache.pop(next(iter(_listing_cache)))
+        _listing_cache.pop(full_path, None)
+        _listing_cache[full_path] = (dir_mtime, now + LISTING_CACHE_TTL, entries)
+    return entries
+
+def forget_listing(full_path=None):
+    """Descarta a listagem em cache de uma pasta (ou de todas), neste e nos outros processos."""
+    if full_path is None:
+        publish_invalidation(trees=[''])
+    else:
+        publish_invalidation(exact=[full_path])
+
+def list_subdirectories(full_path):
+    """
+    Nomes das subpastas de uma pasta, em ordem alfabética, com um scandir que não
+    faz stat nos arquivos. Criar, apagar ou renomear uma subpasta muda o mtime da
+    pasta, então o cache vale enquanto ele não mudar. Symlinks ficam de fora.
+    """
+    dir_mtime = os.stat(full_path).st_mtime_ns
+    now = time.monotonic()
+    with _listing_lock:
+        cached = _tree_cache.get(full_path)
+        if cached and cached[0] == dir_mtime and cached[1] > now:
+            return cached[2]
+
+    names = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False) and not getattr(entry, 'is_junction', lambda: False)():
+                    names.append(entry.name)
+            except OSError:
+                pass
+    names.sort(key=str.lower)
+
+    with _listing_lock:
+        if len(_tree_cache) >= TREE_CACHE_MAX:
+            _tree_cache.pop(next(iter(_tree_cache)))
+        _tree_cache.pop(full_path, None)
+        _tree_cache[full_path] = (dir_mtime, now + TREE_CACHE_TTL, names)
+    return names
+
+# --- ARQUIVOS ZIP ---
+
+# Navegação dentro de .zip sem extrair: só o diretório central é lido (e fica em
+# cache por caminho+mtime); cada membro é enviado direto do arquivo, com seek
+# para entradas armazenadas e descompressão em fluxo para as comprimidas.
+ARCHIVE_EXTENSIONS = ('.zip',)
+ARCHIVE_CACHE_MAX = 64         # Diretórios centrais mantidos em memória
+ARCHIVE_CHUNK = 256 * 1024
+_ZIP_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+_archive_cache = {}
+_archive_lock = threading.Lock()
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def split_archive_path(root, full_path):
+    """
+    Separa um caminho que atravessa um .zip em (caminho do .zip, caminho interno).
+    Retorna None se o caminho não passar por nenhum arquivo .zip.
+    """
+    inner = []
+    candidate = full_path
+    while _is_within(root, candidate):
+        if os.path.isfile(candidate):
+            if not is_archive(candidate):
+                return None
+            return candidate, '/'.join(reversed(inner))
+        if os.path.exists(candidate):
+            return None
+        inner.append(os.path.basename(candidate))
+        parent = os.path.dirname(candidate)
+        if parent == candidate:
+            break
+        candidate = parent
+    return None
+
+def _zip_mtime(date_time):
+    try:
+        return time.mktime(date_time + (0, 0, -1))
+    except (OverflowError, ValueError):
+        return 0.0
+
+def archive_index(zip_path):
+    """
+    Diretório central de um .zip, em cache enquanto mtime e tamanho não mudarem:
+    {'members': {caminho: membro}, 'dirs': {pasta: {nome: entrada}}}.
+    Pastas sem entrada própria no .zip são deduzidas dos caminhos dos arquivos.
+    """
+    st = os.stat(zip_path)
+    key = (st.st_mtime_ns, st.st_size)
+    with _archive_lock:
+        cached = _archive_cache.get(zip_path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = zf.infolist()
+
+    members = {}
+    dirs = {'': {}}
+
+    def add_dir(parts):
+        for i in range(len(parts)):
+            parent = '/'.join(parts[:i])
+            path = '/'.join(parts[:i + 1])
+            if path not in dirs:
+                dirs[path] = {}
+                dirs[parent][parts[i]] = {'name': parts[i], 'is_dir': True, 'is_link': False, 'size': 0,
+                                          'mtime': st.st_mtime, 'mtime_ns': st.st_mtime_ns}
+
+    for info in infos:
+        # Nomes com '..' ou absolutos não saem do .zip: viram só mais um nível
+        parts = [p for p in info.filename.replace('\\', '/').split('/') if p not in ('', '.', '..')]
+        if not parts:
+            continue
+        if info.is_dir():
+            add_dir(parts)
+            continue
+        add_dir(parts[:-1])
+        path = '/'.join(parts)
+        mtime = _zip_mtime(info.date_time)
+        member = {
+            'name': parts[-1], 'is_dir': False, 'is_link': False,
+            'size': info.file_size, 'mtime': mtime, 'mtime_ns': int(mtime * 1e9),
+            'zip_name': info.filename, 'offset': info.header_offset,
+            'compressed': info.compress_size, 'method': info.compress_type,
+            'crc': info.CRC, 'encrypted': bool(info.flag_bits & 0x1),
         }
-        
-        body.light {
-            --bg-color: #f0f4f8;
-            --text-color: #1e293b;
-            --secondary-text: #64748b;
-            --accent-color: #0061ff;
-            --card-bg: #ffffff;
-            --border-color: #e2e8f0;
-            --hover-bg: #f8fafc;
+        members[path] = member
+        dirs['/'.join(parts[:-1])][parts[-1]] = member
+
+    index = {'members': members, 'dirs': dirs}
+    with _archive_lock:
+        if len(_archive_cache) >= ARCHIVE_CACHE_MAX:
+            _archive_cache.pop(next(iter(_archive_cache)))
+        _archive_cache.pop(zip_path, None)
+        _archive_cache[zip_path] = (key, index)
+    return index
+
+def archive_listing(zip_path, inner):
+    """Entradas de uma pasta dentro do .zip (no formato de list_directory), ou None se ela não existir."""
+    entries = archive_index(zip_path)['dirs'].get(inner.strip('/'))
+    return None if entries is None else list(entries.values())
+
+def _member_data_offset(f, member):
+    f.seek(member['offset'])
+    header = f.read(_ZIP_LOCAL_HEADER.size)
+    if len(header) < _ZIP_LOCAL_HEADER.size or header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f"Cabeçalho local inválido em {member['zip_name']}")
+    fields = _ZIP_LOCAL_HEADER.unpack(header)
+    # O tamanho do nome e do extra do cabeçalho local pode diferir do diretório central
+    return member['offset'] + _ZIP_LOCAL_HEADER.size + fields[9] + fields[10]
+
+def stream_archive_member(zip_path, member, start=0, stop=None):
+    """
+    Gera o conteúdo de um membro. Entradas armazenadas aceitam um intervalo
+    [start, stop) lido com seek; as deflate são descomprimidas em fluxo e as
+    demais (bzip2, lzma) passam pelo zipfile.
+    """
+    stop = member['size'] if stop is None else stop
+    if member['method'] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(zip_path) as zf, zf.open(member['zip_name']) as f:
+            while True:
+                chunk = f.read(ARCHIVE_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+    with open(zip_path, 'rb') as f:
+        data_start = _member_data_offset(f, member)
+        if member['method'] == zipfile.ZIP_STORED:
+            f.seek(data_start + start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(ARCHIVE_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            return
+
+        f.seek(data_start)
+        inflater = zlib.decompressobj(-15)
+        remaining = member['compressed']
+        crc = 0
+        while remaining > 0:
+            chunk = f.read(min(ARCHIVE_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            data = inflater.decompress(chunk)
+            if data:
+                crc = zlib.crc32(data, crc)
+                yield data
+        data = inflater.flush()
+        if data:
+            crc = zlib.crc32(data, crc)
+            yield data
+        if crc != member['crc']:
+            # Os cabeçalhos já foram enviados: resta registrar o problema
+            print(f"Erro de CRC em {zip_path}:{member['zip_name']}")
+
+# --- CACHE EM DISCO ---
+
+def cache_file_path(kind, full_path, st, *extra, ext=''):
+    """
+    Caminho no cache para um artefato derivado de um arquivo (miniatura,
+    preview...). A chave inclui mtime e tamanho, então qualquer alteração
+    no original gera uma entrada nova e a antiga expira sozinha.
+    """
+    key = '|'.join([full_path, str(st.st_mtime_ns), str(st.st_size)] + [str(x) for x in extra])
+    digest = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+    folder = os.path.join(CACHE_FOLDER, kind, digest[:2])
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, digest + ext)
+
+def prune_cache():
+    """Remove os arquivos de cache usados há mais tempo até caber em CACHE_MAX_BYTES."""
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(CACHE_FOLDER):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+            total += st.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def cache_pruner_loop():
+    while True:
+        try:
+            prune_cache()
+        except Exception as e:
+            print(f"Erro ao limpar cache: {e}")
+        time.sleep(3600)
+
+# --- MINIATURAS E PREVIEWS DE IMAGEM ---
+
+# Larguras fixas aumentam o reaproveitamento do cache entre telas parecidas
+RENDITION_WIDTHS = (160, 320, 640, 960, 1280, 1920, 2560)
+RENDITION_QUALITY = 82
+RENDITION_MIMES = {'webp': 'image/webp', 'avif': 'image/avif', 'jpeg': 'image/jpeg'}
+
+# Decodificar fotos grandes consome muita memória; limita quantas ao mesmo tempo
+_rendition_slots = threading.BoundedSemaphore(2)
+
+def rendition_formats():
+    """Formatos de saída suportados pelo Pillow instalado, em ordem de preferência."""
+    if Image is None:
+        return []
+    try:
+        from PIL import features
+        supported = [fmt for fmt in ('webp', 'avif') if features.check(fmt)]
+    except Exception:
+        supported = []
+    return supported + ['jpeg']
+
+def choose_rendition_format(accept_header):
+    """Escolhe o formato pelo cabeçalho Accept do navegador (JPEG é o fallback)."""
+    accept = (accept_header or '').lower()
+    for fmt in rendition_formats():
+        if fmt == 'jpeg' or RENDITION_MIMES[fmt] in accept:
+            return fmt
+    return None
+
+def choose_rendition_width(requested):
+    for width in RENDITION_WIDTHS:
+        if width >= requested:
+            return width
+    return RENDITION_WIDTHS[-1]
+
+def render_image(full_path, width, fmt):
+    """
+    Gera (ou reaproveita do cache) uma versão da imagem com a largura pedida,
+    já rotacionada conforme o EXIF. Retorna o caminho do arquivo gerado.
+    """
+    st = os.stat(full_path)
+    target = cache_file_path('renditions', full_path, st, width, fmt, ext='.' + fmt)
+    if os.path.exists(target):
+        return target
+
+    with _rendition_slots:
+        # Outra requisição pode ter gerado a mesma versão enquanto esperávamos
+        if os.path.exists(target):
+            return target
+
+        with Image.open(full_path) as img:
+            # Em JPEG isso decodifica já reduzido, sem montar a foto inteira na memória.
+            # Quadrado para continuar valendo depois da rotação do EXIF.
+            img.draft('RGB', (width, width))
+            img = ImageOps.exif_transpose(img)
+            if img.width > width:
+                height = max(1, round(img.height * width / img.width))
+                img = img.resize((width, height), Image.LANCZOS)
+
+            if fmt == 'jpeg':
+                img = img.convert('RGB')
+            elif img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+
+            tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+            img.save(tmp_path, format=fmt.upper(), quality=RENDITION_QUALITY)
+            os.replace(tmp_path, target)
+
+    return target
+
+# --- PREVIEW DE DOCUMENTOS ---
+
+# Só o começo do arquivo é lido, então abrir um documento enorme custa poucos KB
+DOC_PREVIEW_BYTES = 256 * 1024
+XLSX_PREVIEW_ROWS = 200
+PDF_RENDER_WIDTH = 1200
+PDF_RENDER_TIMEOUT = 20                   # Segundos até o renderizador ser encerrado
+PDF_RENDER_MEMORY = 512 * 1024 * 1024     # Limite de memória do processo renderizador (POSIX)
+
+_document_slots = threading.BoundedSemaphore(2)
+
+# Executado em um processo separado quando o PyMuPDF está instalado
+_PYMUPDF_SCRIPT = '''
+import sys, fitz
+doc = fitz.open(sys.argv[1])
+page = doc[0]
+zoom = int(sys.argv[3]) / page.rect.width
+page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).save(sys.argv[2])
+'''
+
+def detect_text_encoding(sample):
+    """Detecta a codificação pelo BOM, depois tenta UTF-8 e por fim cp1252."""
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'),
+                          (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # O trecho pode terminar no meio de um caractere; final=False tolera isso
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if importlib.util.find_spec('charset_normalizer'):
+        from charset_normalizer import from_bytes
+        best = from_bytes(sample).best()
+        if best is not None:
+            return best.encoding
+    return 'cp1252'
+
+def read_text_preview(full_path):
+    if cold_suffix(full_path):
+        size = cold_logical_size(full_path) or 0
+        opener = open_cold
+    else:
+        size = os.path.getsize(full_path)
+        opener = lambda path: open(path, 'rb')
+    with opener(full_path) as f:
+        sample = f.read(DOC_PREVIEW_BYTES)
+
+    encoding = detect_text_encoding(sample)
+    if b'\x00' in sample and not encoding.startswith('utf-16'):
+        return {'kind': 'unsupported', 'error': 'Arquivo binário', 'size': size}
+
+    text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample, final=len(sample) >= size)
+    return {'kind': 'text', 'text': text, 'encoding': encoding, 'truncated': len(sample) < size, 'size': size}
+
+def _xml_local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def read_docx_preview(full_path):
+    """Extrai o texto do início de um .docx, lendo o XML em streaming."""
+    parts = []
+    length = 0
+    truncated = False
+    with zipfile.ZipFile(full_path) as zf, zf.open('word/document.xml') as xml_file:
+        for event, elem in ET.iterparse(xml_file, events=('end',)):
+            tag = _xml_local(elem.tag)
+            if tag == 't' and elem.text:
+                parts.append(elem.text)
+                length += len(elem.text)
+            elif tag == 'p':
+                parts.append('\n')
+                elem.clear()
+            if length >= DOC_PREVIEW_BYTES:
+                truncated = True
+                break
+    return {'kind': 'text', 'text': ''.join(parts), 'encoding': 'utf-8', 'truncated': truncated,
+            'size': os.path.getsize(full_path)}
+
+def read_xlsx_preview(full_path):
+    """Primeiras linhas da primeira planilha de um .xlsx, separadas por tabulação."""
+    rows = []
+    shared_needed = set()
+    truncated = False
+    with zipfile.ZipFile(full_path) as zf:
+        names = zf.namelist()
+        sheets = sorted(n for n in names if n.startswith('xl/worksheets/sheet') and n.endswith('.xml'))
+        if not sheets:
+            return {'kind': 'unsupported', 'error': 'Planilha vazia', 'size': os.path.getsize(full_path)}
+
+        with zf.open(sheets[0]) as xml_file:
+            row = []
+            cell_type = None
+            for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+                tag = _xml_local(elem.tag)
+                if event == 'start':
+                    if tag == 'c':
+                        cell_type = elem.get('t')
+                    continue
+                if tag == 'v':
+                    value = elem.text or ''
+                    if cell_type == 's':
+                        shared_needed.add(int(value))
+                        row.append(('s', int(value)))
+                    else:
+                        row.append(('v', value))
+                elif tag == 't' and cell_type == 'inlineStr':
+                    row.append(('v', elem.text or ''))
+                elif tag == 'row':
+                    rows.append(row)
+                    row = []
+                    elem.clear()
+                    if len(rows) >= XLSX_PREVIEW_ROWS:
+                        truncated = True
+                        break
+
+        # Só resolve as strings compartilhadas realmente usadas nas linhas lidas
+        shared = {}
+        if shared_needed and 'xl/sharedStrings.xml' in names:
+            last_needed = max(shared_needed)
+            index = 0
+            with zf.open('xl/sharedStrings.xml') as xml_file:
+                text = []
+                for event, elem in ET.iterparse(xml_file, events=('end',)):
+                    tag = _xml_local(elem.tag)
+                    if tag == 't':
+                        text.append(elem.text or '')
+                    elif tag == 'si':
+                        if index in shared_needed:
+                            shared[index] = ''.join(text)
+                        text = []
+                        index += 1
+                        elem.clear()
+                        if index > last_needed:
+                            break
+
+    lines = ['\t'.join(shared.get(v, '') if k == 's' else v for k, v in row) for row in rows]
+    return {'kind': 'text', 'text': '\n'.join(lines), 'encoding': 'utf-8', 'truncated': truncated,
+            'size': os.path.getsize(full_path)}
+
+def _limit_render_memory():
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (PDF_RENDER_MEMORY, PDF_RENDER_MEMORY))
+
+def pdf_renderer_available():
+    return bool(shutil.which('pdftoppm') or importlib.util.find_spec('fitz'))
+
+def render_pdf_first_page(full_path):
+    """
+    Renderiza a primeira página do PDF em PNG num processo separado, com tempo e
+    memória limitados, para que um PDF malformado não derrube o servidor.
+    """
+    st = os.stat(full_path)
+    target = cache_file_path('documents', full_path, st, 'page1', PDF_RENDER_WIDTH, ext='.png')
+    if os.path.exists(target):
+        return target
+
+    with _document_slots:
+        if os.path.exists(target):
+            return target
+
+        tmp_base = f"{target}.{uuid.uuid4().hex[:8]}"
+        if shutil.which('pdftoppm'):
+            cmd = ['pdftoppm', '-f', '1', '-l', '1', '-png', '-singlefile',
+                   '-scale-to-x', str(PDF_RENDER_WIDTH), '-scale-to-y', '-1', full_path, tmp_base]
+        else:
+            cmd = [sys.executable, '-c', _PYMUPDF_SCRIPT, full_path, tmp_base + '.png', str(PDF_RENDER_WIDTH)]
+
+        preexec = _limit_render_memory if os.name == 'posix' else None
+        try:
+            subprocess.run(cmd, check=True, timeout=PDF_RENDER_TIMEOUT, preexec_fn=preexec,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            os.replace(tmp_base + '.png', target)
+        finally:
+            if os.path.exists(tmp_base + '.png'):
+                os.remove(tmp_base + '.png')
+
+    return target
+
+def document_preview(full_path):
+    """Preview de texto de um documento, guardado no cache por caminho+mtime."""
+    st = os.stat(full_path)
+    cached = cache_file_path('documents', full_path, st, DOC_PREVIEW_BYTES, ext='.json')
+    if os.path.exists(cached):
+        with open(cached, encoding='utf-8') as f:
+            return json.load(f)
+
+    ext = (cold_logical_name(full_path) or full_path).rsplit('.', 1)[-1].lower()
+    if ext == 'docx':
+        result = read_docx_preview(full_path)
+    elif ext == 'xlsx':
+        result = read_xlsx_preview(full_path)
+    else:
+        result = read_text_preview(full_path)
+
+    _write_json_atomic(cached, result)
+    return result
+
+# --- PÔSTERES E PRÉVIAS DE VÍDEO ---
+
+# Com o ffmpeg instalado, cada vídeo ganha um pôster e uma tira com
+# VIDEO_SPRITE_FRAMES quadros espaçados, usada para "passar" o vídeo com o mouse
+# na listagem. Cada quadro vem de um seek direto no arquivo, sem decodificar o
+# vídeo inteiro. Os jobs rodam num pool pequeno (no máximo VIDEO_PREVIEW_WORKERS
+# processos do ffmpeg ao mesmo tempo), com prioridade baixa e tempo e memória
+# limitados; o resultado fica no cache por caminho+mtime.
+VIDEO_POSTER_WIDTH = 480
+VIDEO_SPRITE_FRAMES = 16
+VIDEO_FRAME_WIDTH = 160
+VIDEO_FRAME_HEIGHT = 90
+VIDEO_PREVIEW_WORKERS = 2
+VIDEO_PREVIEW_TIMEOUT = 120                # Segundos por execução do ffmpeg
+VIDEO_RENDER_MEMORY = 1024 * 1024 * 1024   # Limite de memória do ffmpeg (POSIX)
+
+_video_pool = ThreadPoolExecutor(max_workers=VIDEO_PREVIEW_WORKERS, thread_name_prefix='videos')
+_video_pending = set()
+_video_pending_lock = threading.Lock()
+
+def video_previews_available():
+    return bool(shutil.which('ffmpeg'))
+
+def video_preview_paths(full_path, st):
+    """Caminhos no cache do pôster, da tira de quadros e da marca de falha (não tentar de novo)."""
+    return (cache_file_path('videos', full_path, st, 'poster', VIDEO_POSTER_WIDTH, ext='.jpg'),
+            cache_file_path('videos', full_path, st, 'sprite', VIDEO_SPRITE_FRAMES, VIDEO_FRAME_WIDTH, ext='.jpg'),
+            cache_file_path('videos', full_path, st, 'erro', ext='.txt'))
+
+def cached_video_poster(full_path):
+    """Pôster já extraído, ou None (não agenda nada)."""
+    try:
+        poster = video_preview_paths(full_path, os.stat(full_path))[0]
+    except OSError:
+        return None
+    return poster if os.path.exists(poster) else None
+
+def _limit_video_process():
+    import resource
+    os.nice(10)
+    resource.setrlimit(resource.RLIMIT_AS, (VIDEO_RENDER_MEMORY, VIDEO_RENDER_MEMORY))
+
+def _run_video_tool(cmd):
+    if os.name == 'posix':
+        options = {'preexec_fn': _limit_video_process}
+    else:
+        options = {'creationflags': subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+    return subprocess.run(cmd, check=True, timeout=VIDEO_PREVIEW_TIMEOUT, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, **options)
+
+def video_duration(full_path):
+    """Duração em segundos pelo ffprobe; sem ele, pelos cabeçalhos já lidos para os metadados."""
+    if shutil.which('ffprobe'):
+        try:
+            result = _run_video_tool(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                      '-of', 'default=nw=1:nk=1', 'file:' + full_path])
+            return float(result.stdout.strip())
+        except (subprocess.SubprocessError, OSError, ValueError):
+            pass
+    return extract_media_metadata(full_path).get('duration')
+
+def render_video_previews(full_path):
+    """Gera o pôster e a tira de quadros (a tira é gravada por último e marca o job como concluído)."""
+    st = os.stat(full_path)
+    poster, sprite, failed = video_preview_paths(full_path, st)
+    if os.path.exists(sprite) or os.path.exists(failed):
+        return
+
+    source = 'file:' + full_path
+    suffix = f".{uuid.uuid4().hex[:8]}.tmp.jpg"
+    try:
+        duration = video_duration(full_path) or 0
+        if not os.path.exists(poster):
+            # Um pouco depois do início, para fugir de vinhetas e quadros pretos
+            _run_video_tool(['ffmpeg', '-nostdin', '-v', 'error', '-threads', '1',
+                             '-ss', f'{duration * 0.1:.3f}', '-i', source,
+                             '-frames:v', '1', '-vf', f'scale={VIDEO_POSTER_WIDTH}:-2', '-q:v', '4',
+                             '-y', poster + suffix])
+            os.replace(poster + suffix, poster)
+
+        if duration <= 0:
+            raise ValueError('duração desconhecida; só o pôster foi gerado')
+        # Um input por quadro, cada um com seek antes da leitura, lado a lado numa imagem só
+        cmd = ['ffmpeg', '-nostdin', '-v', 'error']
+        for i in range(VIDEO_SPRITE_FRAMES):
+            cmd += ['-threads', '1', '-ss', f'{duration * (i + 0.5) / VIDEO_SPRITE_FRAMES:.3f}', '-i', source]
+        fit = (f'scale={VIDEO_FRAME_WIDTH}:{VIDEO_FRAME_HEIGHT}:force_original_aspect_ratio=decrease,'
+               f'pad={VIDEO_FRAME_WIDTH}:{VIDEO_FRAME_HEIGHT}:(ow-iw)/2:(oh-ih)/2,setsar=1')
+        graph = ';'.join(f'[{i}:v:0]{fit}[q{i}]' for i in range(VIDEO_SPRITE_FRAMES))
+        graph += ';' + ''.join(f'[q{i}]' for i in range(VIDEO_SPRITE_FRAMES)) + f'hstack=inputs={VIDEO_SPRITE_FRAMES}'
+        _run_video_tool(cmd + ['-filter_complex', graph, '-frames:v', '1', '-q:v', '5', '-y', sprite + suffix])
+        os.replace(sprite + suffix, sprite)
+    except (subprocess.SubprocessError, OSError, ValueError) as e:
+        detail = (getattr(e, 'stderr', None) or b'').decode('utf-8', 'replace').strip()
+        print(f"Erro ao gerar prévias de {full_path}: {detail.splitlines()[-1] if detail else e}")
+        with open(failed, 'w', encoding='utf-8') as f:
+            f.write(f"{e}\n{detail}")
+    finally:
+        for leftover in (poster + suffix, sprite + suffix):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+def _video_job(full_path):
+    try:
+        render_video_previews(full_path)
+    except Exception as e:
+        print(f"Erro ao gerar prévias de {full_path}: {e}")
+    finally:
+        with _video_pending_lock:
+            _video_pending.discard(full_path)
+
+def schedule_video_previews(full_path):
+    """Enfileira a geração das prévias de um vídeo, sem duplicar jobs."""
+    if not video_previews_available():
+        return
+    with _video_pending_lock:
+        if full_path in _video_pending:
+            return
+        _video_pending.add(full_path)
+    _video_pool.submit(_video_job, full_path)
+
+# --- VISUALIZADOR DE TEXTO ---
+
+# Logs e CSVs de vários GB são lidos por trechos via mmap. Um índice esparso
+# guarda, a cada TEXT_INDEX_STEP bytes, o número da linha que começa ali: pular
+# para qualquer linha é uma busca binária no índice mais a leitura de no máximo
+# um bloco. O índice fica em memória e no cache em disco (por caminho+mtime) e,
+# se o arquivo só cresceu (log sendo escrito), é estendido a partir do fim.
+TEXT_INDEX_STEP = 256 * 1024
+TEXT_INDEX_CACHE_MAX = 32
+TEXT_LINES_MAX = 5000              # Linhas por pedido em /text/lines e /text/tail
+TEXT_LINE_MAX_CHARS = 64 * 1024    # Linhas maiores são cortadas na resposta
+TEXT_GREP_MAX = 1000               # Resultados por busca (a busca pode continuar de onde parou)
+TEXT_SCAN_CHUNK = 16 * 1024 * 1024 # Bytes procurados entre um aviso de progresso e outro
+# A busca é só por texto literal: uma regex do usuário pode levar um tempo
+# exponencial numa única linha e o re do Python não tem como ser interrompido
+
+_text_indexes = {}
+_text_index_lock = threading.Lock()
+_text_index_building = {}
+
+class LineIndex:
+    """offsets[i] é onde começa a linha lines[i] (contadas a partir de 0)."""
+    __slots__ = ('ino', 'size', 'mtime_ns', 'encoding', 'offsets', 'lines', 'total')
+
+    def __init__(self, st, size, encoding, offsets, lines, total):
+        self.ino = st.st_ino
+        self.size = size
+        self.mtime_ns = st.st_mtime_ns
+        self.encoding = encoding
+        self.offsets = offsets
+        self.lines = lines
+        self.total = total
+
+    def line_offset(self, mm, line):
+        """Offset do começo da linha (ou o tamanho do arquivo, se ela não existe)."""
+        i = bisect.bisect_right(self.lines, line) - 1
+        pos, current = self.offsets[i], self.lines[i]
+        while current < line:
+            newline = mm.find(b'\n', pos, self.size)
+            if newline < 0:
+                return self.size
+            pos = newline + 1
+            current += 1
+        return pos
+
+def _text_encoding(mm):
+    """Codificação do arquivo, ou None se o visualizador não consegue lê-lo (binário, UTF-16)."""
+    sample = mm[:DOC_PREVIEW_BYTES]
+    encoding = detect_text_encoding(sample)
+    if encoding.startswith('utf-16') or b'\x00' in sample:
+        return None
+    return 'utf-8' if encoding == 'utf-8-sig' else encoding
+
+def _extend_line_index(mm, size, offsets, lines):
+    """Acrescenta checkpoints a partir do último até o fim; retorna o total de linhas."""
+    pos, line = offsets[-1], lines[-1]
+    while pos + TEXT_INDEX_STEP < size:
+        newline = mm.find(b'\n', pos + TEXT_INDEX_STEP, size)
+        if newline < 0:
+            break
+        line += mm[pos:newline + 1].count(b'\n')
+        pos = newline + 1
+        if pos < size:
+            offsets.append(pos)
+            lines.append(line)
+    # A última linha conta mesmo sem quebra de linha no fim
+    line += mm[pos:size].count(b'\n')
+    return line + (1 if size and mm[size - 1] != 0x0a else 0)
+
+def _save_line_index(full_path, st, index):
+    cached = cache_file_path('text-index', full_path, st, TEXT_INDEX_STEP, ext='.json')
+    _write_json_atomic(cached, {'size': index.size, 'encoding': index.encoding, 'total': index.total,
+                                'offsets': index.offsets.tolist(), 'lines': index.lines.tolist()})
+
+def _load_line_index(full_path, st):
+    cached = cache_file_path('text-index', full_path, st, TEXT_INDEX_STEP, ext='.json')
+    try:
+        with open(cached, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return LineIndex(st, data['size'], data['encoding'], array('Q', data['offsets']),
+                     array('Q', data['lines']), data['total'])
+
+def text_line_index(full_path, st, mm):
+    """Índice de linhas do arquivo aberto em mm (st: fstat do mesmo arquivo). None se não for texto."""
+    size = len(mm)
+    with _text_index_lock:
+        index = _text_indexes.get(full_path)
+        if index is not None and (index.ino, index.size, index.mtime_ns) == (st.st_ino, size, st.st_mtime_ns):
+            return index
+        building = _text_index_building.setdefault(full_path, threading.Lock())
+
+    # Só uma thread indexa cada arquivo; as outras esperam e reaproveitam
+    with building:
+        try:
+            return _build_line_index(full_path, st, mm, size)
+        finally:
+            with _text_index_lock:
+                if _text_index_building.get(full_path) is building:
+                    del _text_index_building[full_path]
+
+def _build_line_index(full_path, st, mm, size):
+    """Monta (ou estende) o índice; chamada com a trava de construção do arquivo."""
+    with _text_index_lock:
+        index = _text_indexes.get(full_path)
+    if index is not None and (index.ino, index.size, index.mtime_ns) == (st.st_ino, size, st.st_mtime_ns):
+        return index
+
+    # O último checkpoint precisa continuar sendo começo de linha
+    grown = (index is not None and index.ino == st.st_ino and index.size < size
+             and (index.offsets[-1] == 0 or mm[index.offsets[-1] - 1] == 0x0a))
+    if grown:
+        # Arquivo só cresceu: continua do último checkpoint, sem reler o começo
+        offsets, lines = array('Q', index.offsets), array('Q', index.lines)
+        total = _extend_line_index(mm, size, offsets, lines)
+        index = LineIndex(st, size, index.encoding, offsets, lines, total)
+    else:
+        index = _load_line_index(full_path, st) if size == st.st_size else None
+        if index is None:
+            encoding = _text_encoding(mm)
+            if encoding is None:
+                return None
+            offsets, lines = array('Q', [0]), array('Q', [0])
+            total = _extend_line_index(mm, size, offsets, lines)
+            index = LineIndex(st, size, encoding, offsets, lines, total)
+            if size == st.st_size:
+                _save_line_index(full_path, st, index)
+
+    with _text_index_lock:
+        if full_path not in _text_indexes and len(_text_indexes) >= TEXT_INDEX_CACHE_MAX:
+            _text_indexes.pop(next(iter(_text_indexes)))
+        _text_indexes.pop(full_path, None)
+        _text_indexes[full_path] = index
+    return index
+
+def _decode_line(raw, encoding):
+    text = raw.decode(encoding, errors='replace')
+    if text.endswith('\r'):
+        text = text[:-1]
+    if len(text) > TEXT_LINE_MAX_CHARS:
+        return text[:TEXT_LINE_MAX_CHARS] + ' […]'
+    return text
+
+def text_file_source(full_path):
+    """
+    Arquivo que o visualizador de texto mapeia: o próprio arquivo ou, se ele está
+    no armazenamento frio, uma cópia descomprimida no cache (o original continua
+    comprimido e a cópia expira com o resto do cache). None se não existir.
+    """
+    if os.path.isfile(full_path):
+        return full_path
+    cold = cold_copy(full_path)
+    if cold is None:
+        return None
+    target = cache_file_path('text-cold', cold, os.stat(cold))
+    if not os.path.exists(target):
+        tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open_cold(cold) as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COLD_CHUNK)
+            os.replace(tmp_path, target)
+        except BaseException:
+            _remove_path(tmp_path)
+            raise
+    return target
+
+@contextlib.contextmanager
+def open_text_map(full_path):
+    """Abre o arquivo em mmap somente leitura; gera (stat, mapa). Arquivos vazios viram b''."""
+    with open(full_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if not st.st_size:
+            yield st, b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield st, mm
+
+def read_text_lines(full_path, start, count, tail=False):
+    """
+    Linhas start..start+count-1 (contadas a partir de 1), ou as count últimas
+    com tail=True. Retorna None se o arquivo não for texto legível.
+    """
+    with open_text_map(full_path) as (st, mm):
+        index = text_line_index(full_path, st, mm) if mm else \
+            LineIndex(st, 0, 'utf-8', array('Q', [0]), array('Q', [0]), 0)
+        if index is None:
+            return None
+        if tail:
+            start = index.total - count + 1
+        start = max(1, min(start, index.total or 1))
+        count = max(0, min(count, TEXT_LINES_MAX, index.total - start + 1))
+        lines = []
+        if count:
+            pos = index.line_offset(mm, start - 1)
+            for _ in range(count):
+                newline = mm.find(b'\n', pos, index.size)
+                end = index.size if newline < 0 else newline
+                lines.append(_decode_line(mm[pos:end], index.encoding))
+                pos = end + 1
+        return {
+            'start': start,
+            'lines': lines,
+            'total_lines': index.total,
+            'size': index.size,
+            'encoding': index.encoding,
+            # Sem quebra no fim, a última linha ainda pode estar sendo escrita
+            'partial': bool(index.size) and mm[index.size - 1] != 0x0a,
         }
-        
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: var(--bg-color);
-            color: var(--text-color);
+
+def text_search_pattern(query, encoding, ignore_case=False):
+    """Compila a busca literal em bytes, na codificação do arquivo."""
+    flags = re.IGNORECASE if ignore_case else 0
+    return re.compile(re.escape(query).encode(encoding, errors='strict'), flags)
+
+def grep_text(full_path, query, ignore_case=False, start=1, limit=TEXT_GREP_MAX):
+    """
+    Gera as linhas que contêm a busca, uma por linha do arquivo, lendo em blocos;
+    entre os blocos gera avisos de progresso. O último item diz onde continuar.
+    """
+    with open_text_map(full_path) as (st, mm):
+        if not mm:
+            yield {'done': True, 'matches': 0, 'next_line': None}
+            return
+        index = text_line_index(full_path, st, mm)
+        if index is None:
+            yield {'error': 'Arquivo binário ou em codificação não suportada'}
+            return
+        try:
+            pattern = text_search_pattern(query, index.encoding, ignore_case)
+        except UnicodeEncodeError:
+            yield {'error': f'A busca tem caracteres que não existem na codificação do arquivo ({index.encoding})'}
+            return
+        size = index.size
+        line = max(0, start - 1)
+        pos = counted = index.line_offset(mm, line)
+        found = 0
+        while pos < size:
+            chunk_end = mm.find(b'\n', min(pos + TEXT_SCAN_CHUNK, size), size)
+            chunk_end = size if chunk_end < 0 else chunk_end + 1
+            match = pattern.search(mm, pos, chunk_end)
+            while match:
+                hit = match.start()
+                line += mm[counted:hit].count(b'\n')
+                counted = hit
+                line_start = mm.rfind(b'\n', 0, hit) + 1
+                line_end = mm.find(b'\n', hit, size)
+                line_end = size if line_end < 0 else line_end
+                yield {'line': line + 1, 'text': _decode_line(mm[line_start:line_end], index.encoding)}
+                found += 1
+                if found >= limit:
+                    yield {'done': True, 'matches': found, 'next_line': line + 2 if line + 2 <= index.total else None}
+                    return
+                if line_end + 1 >= chunk_end:
+                    break
+                match = pattern.search(mm, line_end + 1, chunk_end)
+            line += mm[counted:chunk_end].count(b'\n')
+            counted = pos = chunk_end
+            yield {'progress': round(pos / size, 4)}
+        yield {'done': True, 'matches': found, 'next_line': None}
+
+# --- METADADOS DE MÍDIA ---
+
+# Data de captura, dimensões, GPS e duração extraídos só dos cabeçalhos dos
+# arquivos (sem decodificar imagem/vídeo) e guardados em SQLite por caminho+mtime
+METADATA_DB = os.path.join(STATE_FOLDER, 'metadados.db')
+METADATA_WORKERS = 2
+METADATA_SCAN_INTERVAL = 60 * 60  # Segundos entre varreduras da pasta DADOS
+METADATA_HEADER_BYTES = 512 * 1024  # Máximo lido do começo de um MKV
+
+_metadata_pool = ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix='metadados')
+_metadata_pending = set()
+_metadata_pending_lock = threading.Lock()
+
+_EXIF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+_QUICKTIME_EPOCH = 2082844800  # Segundos entre 1904-01-01 e 1970-01-01
+_MATROSKA_EPOCH = 978307200    # 2001-01-01 em segundos Unix
+
+def _metadata_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS media (
+        path TEXT PRIMARY KEY, dir TEXT, name TEXT, kind TEXT,
+        mtime_ns INTEGER, size INTEGER, taken_at REAL,
+        width INTEGER, height INTEGER, duration REAL,
+        lat REAL, lon REAL, extracted_at REAL, sort_at REAL)''')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(media)')}
+    if 'sort_at' not in columns:
+        # Índices criados antes da galeria: data usada na linha do tempo
+        try:
+            conn.execute('ALTER TABLE media ADD COLUMN sort_at REAL')
+            conn.execute('UPDATE media SET sort_at = COALESCE(taken_at, mtime_ns / 1e9)')
+            conn.commit()
+        except sqlite3.OperationalError:
+            pass  # Outro processo migrou primeiro
+    conn.execute('CREATE INDEX IF NOT EXISTS media_dir ON media(dir)')
+    conn.execute('CREATE INDEX IF NOT EXISTS media_taken ON media(taken_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS media_timeline ON media(sort_at DESC, path DESC)')
+    conn.commit()
+
+_metadata_connections = SQLitePool(lambda: METADATA_DB, _metadata_schema, ('PRAGMA synchronous=NORMAL',),
+                                   timeout=30)
+
+def metadata_db():
+    """Conexão do pool, para usar num bloco with."""
+    return _metadata_connections.connection()
+
+def _parse_exif(data):
+    """Lê orientação, data de captura, dimensões e GPS de um bloco TIFF/EXIF."""
+    endian = '<' if data[:2] == b'II' else '>'
+    result = {}
+
+    def read_ifd(offset):
+        entries = {}
+        count = struct.unpack_from(endian + 'H', data, offset)[0]
+        for i in range(count):
+            pos = offset + 2 + 12 * i
+            tag, typ, cnt = struct.unpack_from(endian + 'HHI', data, pos)
+            if _EXIF_TYPE_SIZES.get(typ, 0) * cnt > 4:
+                pos = struct.unpack_from(endian + 'I', data, pos + 8)[0]
+            else:
+                pos += 8
+            entries[tag] = (typ, cnt, pos)
+        return entries
+
+    def value(entry):
+        typ, cnt, pos = entry
+        if typ == 2:
+            return data[pos:pos + cnt].split(b'\x00', 1)[0].decode('ascii', 'replace')
+        if typ in (5, 10):
+            fmt = endian + ('II' if typ == 5 else 'ii')
+            values = []
+            for i in range(cnt):
+                num, den = struct.unpack_from(fmt, data, pos + 8 * i)
+                values.append(num / den if den else 0.0)
+            return values
+        fmt = {1: 'B', 3: 'H', 4: 'I', 7: 'B', 9: 'i'}[typ]
+        return struct.unpack_from(endian + fmt, data, pos)[0]
+
+    try:
+        ifd0 = read_ifd(struct.unpack_from(endian + 'I', data, 4)[0])
+        if 0x0112 in ifd0:
+            result['orientation'] = value(ifd0[0x0112])
+        taken = None
+        if 0x8769 in ifd0:
+            exif = read_ifd(value(ifd0[0x8769]))
+            for tag in (0x9003, 0x9004):  # DateTimeOriginal, DateTimeDigitized
+                if tag in exif:
+                    taken = value(exif[tag])
+                    break
+            if 0xA002 in exif and 0xA003 in exif:
+                result['width'] = value(exif[0xA002])
+                result['height'] = value(exif[0xA003])
+        if taken is None and 0x0132 in ifd0:
+            taken = value(ifd0[0x0132])
+        if taken:
+            result['taken_at'] = datetime.strptime(taken.strip()[:19], '%Y:%m:%d %H:%M:%S').timestamp()
+        if 0x8825 in ifd0:
+            gps = read_ifd(value(ifd0[0x8825]))
+            if all(tag in gps for tag in (1, 2, 3, 4)):
+                lat = sum(v / 60 ** i for i, v in enumerate(value(gps[2])))
+                lon = sum(v / 60 ** i for i, v in enumerate(value(gps[4])))
+                result['lat'] = -lat if value(gps[1]).upper().startswith('S') else lat
+                result['lon'] = -lon if value(gps[3]).upper().startswith('W') else lon
+    except (struct.error, IndexError, KeyError, ValueError, TypeError):
+        pass
+    return result
+
+def _jpeg_metadata(f):
+    result = {}
+    if f.read(2) != b'\xff\xd8':
+        return result
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        code = marker[1]
+        if code in (0xD9, 0xDA):  # Fim da imagem ou início dos dados comprimidos
+            break
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if code == 0xE1:
+            segment = f.read(length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                exif = _parse_exif(segment[6:])
+                exif.pop('width', None)
+                exif.pop('height', None)
+                result.update({k: v for k, v in exif.items() if k not in result})
+            continue
+        if code in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            height, width = struct.unpack('>xHH', f.read(5))
+            result['width'], result['height'] = width, height
+            f.seek(length - 7, 1)
+            continue
+        f.seek(length - 2, 1)
+
+    # Fotos giradas pelo EXIF (5 a 8) têm largura e altura trocadas na tela
+    if result.get('orientation', 1) in (5, 6, 7, 8) and 'width' in result:
+        result['width'], result['height'] = result['height'], result['width']
+    return result
+
+def _image_metadata(full_path):
+    ext = full_path.rsplit('.', 1)[-1].lower()
+    with open(full_path, 'rb') as f:
+        if ext in ('jpg', 'jpeg'):
+            return _jpeg_metadata(f)
+        head = f.read(30)
+    if ext == 'png' and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+    elif ext == 'gif' and head[:3] == b'GIF':
+        width, height = struct.unpack('<HH', head[6:10])
+    elif ext == 'bmp' and head[:2] == b'BM':
+        width, height = struct.unpack('<ii', head[18:26])
+        height = abs(height)
+    elif ext == 'webp' and head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            width, height = (v & 0x3FFF for v in struct.unpack('<HH', head[26:30]))
+        elif chunk == b'VP8L':
+            bits = struct.unpack('<I', head[21:25])[0]
+            width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        elif chunk == b'VP8X':
+            width = int.from_bytes(head[24:27], 'little') + 1
+            height = int.from_bytes(head[27:30], 'little') + 1
+        else:
+            return {}
+    else:
+        return {}
+    return {'width': width, 'height': height}
+
+def _mp4_atoms(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            break
+        yield kind, pos + header, pos + size
+        pos += size
+
+def _mp4_metadata(f, file_size):
+    result = {}
+    for kind, start, end in _mp4_atoms(f, 0, file_size):
+        if kind != b'moov':
+            continue
+        for child, cstart, cend in _mp4_atoms(f, start, end):
+            f.seek(cstart)
+            if child == b'mvhd':
+                version = f.read(4)[0]
+                if version == 1:
+                    created, _, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+                else:
+                    created, _, timescale, duration = struct.unpack('>IIII', f.read(16))
+                if timescale:
+                    result['duration'] = duration / timescale
+                # Muitas câmeras gravam 0 ou uma data sem relógio acertado
+                if created > _QUICKTIME_EPOCH + 365 * 24 * 3600:
+                    result['taken_at'] = created - _QUICKTIME_EPOCH
+            elif child == b'trak':
+                for tchild, tstart, tend in _mp4_atoms(f, cstart, cend):
+                    if tchild == b'tkhd':
+                        f.seek(tstart)
+                        version = f.read(1)[0]
+                        f.seek(tstart + (88 if version == 1 else 76))
+                        width, height = (v >> 16 for v in struct.unpack('>II', f.read(8)))
+                        if width and height and width * height > result.get('width', 0) * result.get('height', 0):
+                            result['width'], result['height'] = width, height
+            elif child == b'udta':
+                for uchild, ustart, uend in _mp4_atoms(f, cstart, cend):
+                    if uchild == b'\xa9xyz':
+                        f.seek(ustart + 4)
+                        text = f.read(min(64, uend - ustart - 4)).decode('ascii', 'ignore')
+                        match = re.match(r'([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)', text)
+                        if match:
+                            result['lat'], result['lon'] = float(match.group(1)), float(match.group(2))
+        break
+    return result
+
+def _avi_metadata(f):
+    head = f.read(12 + 12 + 8 + 56)
+    if head[:4] != b'RIFF' or head[8:12] != b'AVI ' or head[24:28] != b'avih':
+        return {}
+    us_per_frame, = struct.unpack_from('<I', head, 32)
+    total_frames, = struct.unpack_from('<I', head, 48)
+    width, height = struct.unpack_from('<II', head, 64)
+    return {'duration': us_per_frame * total_frames / 1e6, 'width': width, 'height': height}
+
+def _ebml_elements(data, start, end):
+    """Percorre elementos EBML (Matroska) de um buffer: (id, início, fim)."""
+    pos = start
+    while pos < end:
+        first = data[pos]
+        id_len = 8 - first.bit_length() + 1
+        if id_len > 4 or pos + id_len > end:
+            return
+        element_id = int.from_bytes(data[pos:pos + id_len], 'big')
+        pos += id_len
+        first = data[pos]
+        size_len = 8 - first.bit_length() + 1
+        if size_len > 8 or pos + size_len > end:
+            return
+        size = int.from_bytes(data[pos:pos + size_len], 'big') & ((1 << (7 * size_len)) - 1)
+        pos += size_len
+        if size == (1 << (7 * size_len)) - 1:  # Tamanho desconhecido
+            size = end - pos
+        yield element_id, pos, min(pos + size, end)
+        pos += size
+
+def _mkv_metadata(f):
+    data = f.read(METADATA_HEADER_BYTES)
+    result = {}
+    timecode_scale = 1000000
+    duration = None
+    for element_id, start, end in _ebml_elements(data, 0, len(data)):
+        if element_id != 0x18538067:  # Segment
+            continue
+        for child_id, cstart, cend in _ebml_elements(data, start, end):
+            if child_id == 0x1F43B675:  # Cluster: daqui em diante só há dados de mídia
+                break
+            if child_id == 0x1549A966:  # Info
+                for info_id, istart, iend in _ebml_elements(data, cstart, cend):
+                    raw = data[istart:iend]
+                    if info_id == 0x2AD7B1:
+                        timecode_scale = int.from_bytes(raw, 'big')
+                    elif info_id == 0x4489:
+                        duration = struct.unpack('>f' if len(raw) == 4 else '>d', raw)[0]
+                    elif info_id == 0x4461 and len(raw) == 8:
+                        result['taken_at'] = _MATROSKA_EPOCH + struct.unpack('>q', raw)[0] / 1e9
+            elif child_id == 0x1654AE6B:  # Tracks
+                for track_id, tstart, tend in _ebml_elements(data, cstart, cend):
+                    for video_id, vstart, vend in _ebml_elements(data, tstart, tend):
+                        if video_id != 0xE0:
+                            continue
+                        for dim_id, dstart, dend in _ebml_elements(data, vstart, vend):
+                            if dim_id == 0xB0:
+                                result['width'] = int.from_bytes(data[dstart:dend], 'big')
+                            elif dim_id == 0xBA:
+                                result['height'] = int.from_bytes(data[dstart:dend], 'big')
+        break
+    if duration is not None:
+        result['duration'] = duration * timecode_scale / 1e9
+    return result
+
+def extract_media_metadata(full_path):
+    """Extrai os metadados lendo apenas os cabeçalhos. Campos ausentes ficam de fora."""
+    name = os.path.basename(full_path)
+    try:
+        if is_image(name):
+            return _image_metadata(full_path)
+        ext = name.rsplit('.', 1)[-1].lower()
+        with open(full_path, 'rb') as f:
+            if ext in ('mp4', 'mov'):
+                return _mp4_metadata(f, os.fstat(f.fileno()).st_size)
+            if ext == 'avi':
+                return _avi_metadata(f)
+            if ext == 'mkv':
+                return _mkv_metadata(f)
+    except (struct.error, IndexError, ValueError, OSError) as e:
+        print(f"Erro ao ler metadados de {full_path}: {e}")
+    return {}
+
+def store_media_metadata(full_path):
+    st = os.stat(full_path)
+    meta = extract_media_metadata(full_path)
+    name = os.path.basename(full_path)
+    taken_at = meta.get('taken_at')
+    with metadata_db() as conn:
+        conn.execute(
+            '''INSERT OR REPLACE INTO media (path, dir, name, kind, mtime_ns, size, taken_at, width, height,
+                                             duration, lat, lon, extracted_at, sort_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (full_path, os.path.dirname(full_path), name, 'image' if is_image(name) else 'video',
+             st.st_mtime_ns, st.st_size, taken_at, meta.get('width'), meta.get('height'),
+             meta.get('duration'), meta.get('lat'), meta.get('lon'), time.time(),
+             taken_at if taken_at else st.st_mtime))
+        conn.commit()
+
+def _metadata_job(full_path):
+    try:
+        store_media_metadata(full_path)
+        if is_video(full_path):
+            schedule_video_previews(full_path)
+    except Exception as e:
+        print(f"Erro ao indexar {full_path}: {e}")
+    finally:
+        with _metadata_pending_lock:
+            _metadata_pending.discard(full_path)
+
+def schedule_metadata(full_paths):
+    """Enfileira a extração no pool de workers, sem duplicar arquivos já na fila."""
+    with _metadata_pending_lock:
+        for full_path in full_paths:
+            if full_path not in _metadata_pending:
+                _metadata_pending.add(full_path)
+                _metadata_pool.submit(_metadata_job, full_path)
+
+def media_metadata_for_dir(directory, entries):
+    """
+    Metadados já conhecidos dos arquivos de mídia de uma pasta ({nome: linha}).
+    entries é uma lista de (nome, mtime_ns); os ausentes ou desatualizados vão
+    para a fila de extração.
+    """
+    with metadata_db() as conn:
+        rows = conn.execute(
+            'SELECT name, mtime_ns, taken_at, width, height, duration, lat, lon FROM media WHERE dir = ?',
+            (directory,)).fetchall()
+    known = {row[0]: row for row in rows}
+
+    found = {}
+    missing = []
+    for name, mtime_ns in entries:
+        row = known.get(name)
+        if row is not None and row[1] == mtime_ns:
+            found[name] = dict(zip(('taken_at', 'width', 'height', 'duration', 'lat', 'lon'), row[2:]))
+        else:
+            missing.append(os.path.join(directory, name))
+    if missing:
+        schedule_metadata(missing)
+    return found
+
+def scan_media_tree(root):
+    """Percorre uma árvore enfileirando mídias novas/alteradas e removendo entradas órfãs."""
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d not in (TRASH_DIRNAME,) and not d.startswith('.')]
+        entries = []
+        for name in files:
+            if is_image(name) or is_video(name):
+                try:
+                    entries.append((name, os.stat(os.path.join(directory, name)).st_mtime_ns))
+                except OSError:
+                    pass
+        media_metadata_for_dir(directory, entries)
+
+    prefix = root.rstrip(os.sep) + os.sep
+    with metadata_db() as conn:
+        stale = [path for (path,) in conn.execute(
+            "SELECT path FROM media WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+            if not os.path.exists(path)]
+        conn.executemany('DELETE FROM media WHERE path = ?', [(p,) for p in stale])
+        conn.commit()
+
+def metadata_scanner_loop():
+    while True:
+        try:
+            scan_media_tree(os.path.realpath(DATA_FOLDER))
+        except Exception as e:
+            print(f"Erro ao varrer metadados: {e}")
+        time.sleep(METADATA_SCAN_INTERVAL)
+
+# --- GALERIA ---
+
+# Linha do tempo servida direto do índice de metadados (coluna sort_at: data de
+# captura ou, na falta dela, a de modificação), com paginação por cursor
+GALLERY_PAGE_SIZE = 100
+GALLERY_TILE = 160
+SPRITE_COLUMNS = 10
+
+def gallery_page(root, cursor=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Uma página da linha do tempo, da mídia mais recente para a mais antiga.
+    cursor é (sort_at, caminho) do último item da página anterior.
+    """
+    prefix = root.rstrip(os.sep) + os.sep
+    query = '''SELECT rowid, path, kind, sort_at, taken_at, width, height, duration, mtime_ns
+               FROM media WHERE substr(path, 1, ?) = ?'''
+    params = [len(prefix), prefix]
+    if cursor is not None:
+        query += ' AND (sort_at < ? OR (sort_at = ? AND path < ?))'
+        params += [cursor[0], cursor[0], cursor[1]]
+    query += ' ORDER BY sort_at DESC, path DESC LIMIT ?'
+    params.append(limit)
+    with metadata_db() as conn:
+        return conn.execute(query, params).fetchall()
+
+def render_sprite(rows, tile):
+    """
+    Monta uma folha (sprite) com as miniaturas quadradas de várias mídias, para
+    que a galeria busque uma página inteira de miniaturas em uma só requisição.
+    rows: lista de (caminho, mtime_ns, tipo). Retorna o caminho do JPEG no cache.
+    """
+    # Pôsteres de vídeo extraídos depois entram na chave, gerando uma folha nova
+    posters = {path: cached_video_poster(path) for path, mtime_ns, kind in rows if kind == 'video'}
+    key = '|'.join(f"{path}:{mtime_ns}" + (':p' if posters.get(path) else '') for path, mtime_ns, kind in rows) + f"|{tile}"
+    digest = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+    folder = os.path.join(CACHE_FOLDER, 'sprites', digest[:2])
+    target = os.path.join(folder, digest + '.jpg')
+    if os.path.exists(target):
+        return target
+
+    columns = min(SPRITE_COLUMNS, len(rows))
+    lines = (len(rows) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * tile, lines * tile), (42, 42, 42))
+    for i, (path, mtime_ns, kind) in enumerate(rows):
+        if kind != 'image' and not posters.get(path):
+            if kind == 'video':
+                schedule_video_previews(path)
+            continue  # Sem pôster ainda: fundo neutro, e a interface sobrepõe o ícone
+        try:
+            # Reaproveita as miniaturas individuais do cache de renditions (ou o pôster do vídeo)
+            thumb = posters.get(path) or render_image(path, choose_rendition_width(tile * 2), 'jpeg')
+            with Image.open(thumb) as img:
+                square = ImageOps.fit(img.convert('RGB'), (tile, tile), Image.LANCZOS)
+            sheet.paste(square, ((i % columns) * tile, (i // columns) * tile))
+        except Exception as e:
+            print(f"Erro na miniatura de {path}: {e}")
+
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    sheet.save(tmp_path, format='JPEG', quality=80)
+    os.replace(tmp_path, target)
+    return target
+
+# --- COTAS DE ARMAZENAMENTO ---
+
+# Formato de cotas.json (tamanhos em bytes ou com unidade, ex: "50GB"):
+#   {"DADOS": {"limit": "100GB", "folders": {"Fotos": "40GB"}}}
+# Só os drives e pastas com cota são contabilizados; a lixeira fica de fora
+# (tem o próprio limite em TRASH_MAX_BYTES).
+QUOTAS_FILE = os.path.join(STATE_FOLDER, 'cotas.json')
+QUOTA_DB = os.path.join(STATE_FOLDER, 'cotas.db')
+QUOTA_SCAN_INTERVAL = 6 * 3600       # Reconciliação completa dos contadores
+QUOTA_DIRTY_DELAY = 5                # Espera para agrupar pastas marcadas antes de recontar
+QUOTA_CONFIG_CHECK = 5               # Segundos entre conferências do cotas.json em cada processo
+QUOTA_RESERVATION_TTL = 2 * 3600     # Reserva esquecida (processo travado) expira depois disso
+QUOTA_WHOLE_DRIVE = '/'              # Marca de "drive inteiro" na tabela dirty (não é nome de pasta)
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+def parse_size(value):
+    """Converte 1234, "500MB" ou "1.5 TB" em bytes."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', str(value).upper())
+    if not match:
+        raise ValueError(f'Tamanho inválido: {value}')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+def _quota_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS usage (root TEXT, top TEXT, bytes INTEGER NOT NULL, PRIMARY KEY (root, top))')
+    conn.execute('CREATE TABLE IF NOT EXISTS dirty (root TEXT, top TEXT, PRIMARY KEY (root, top))')
+    conn.execute('CREATE TABLE IF NOT EXISTS scopes (root TEXT PRIMARY KEY, folders TEXT)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS reservations (
+        pid INTEGER, path TEXT, root TEXT, top TEXT, bytes INTEGER NOT NULL, created REAL NOT NULL,
+        PRIMARY KEY (pid, path))''')
+
+_quota_connections = SQLitePool(lambda: QUOTA_DB, _quota_schema, ('PRAGMA synchronous=NORMAL',),
+                                timeout=30, isolation_level=None)
+
+def quota_db():
+    """Conexão do pool, para usar num bloco with."""
+    return _quota_connections.connection()
+
+class QuotaTracker:
+    """
+    Uso por drive e por pasta de primeiro nível, mantido por contadores
+    atualizados a cada upload/exclusão/movimentação. Operações com pastas
+    inteiras só marcam a pasta afetada, recontada logo depois em segundo
+    plano; uma varredura periódica corrige qualquer desvio. Contadores,
+    pastas marcadas e reservas ficam em QUOTA_DB, compartilhados por todos os
+    processos; cada processo só guarda a configuração lida do cotas.json.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._config_mtime = None
+        self._limits = {}    # (raiz, pasta) -> bytes; pasta '' é o drive inteiro
+        self._scopes = {}    # raiz -> None (todas as pastas) ou conjunto de pastas contadas
+        self._names = {}     # raiz -> identificador do drive no cotas.json
+        self._loaded = False
+        self._checked = 0.0
+        self._started = time.time()
+        self.wakeup = threading.Event()
+
+    def active(self):
+        """Indica se há alguma cota configurada (relendo o cotas.json, se mudou, a cada QUOTA_CONFIG_CHECK)."""
+        now = time.monotonic()
+        if not self._loaded or now - self._checked >= QUOTA_CONFIG_CHECK:
+            self._checked = now
+            try:
+                self.reload(force=not self._loaded)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                print(f"Erro ao ler cotas: {e}")
+                self._loaded = True
+        return bool(self._scopes)
+
+    def reload(self, force=False):
+        """Relê o cotas.json se ele mudou."""
+        try:
+            mtime = os.stat(QUOTAS_FILE).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._config_mtime and not force:
+            return
+        config = {}
+        if mtime is not None:
+            with open(QUOTAS_FILE, encoding='utf-8') as f:
+                config = json.load(f)
+        self.apply_config(config)
+        self._config_mtime = mtime
+        self._loaded = True
+
+    def apply_config(self, config):
+        limits, scopes, names = {}, {}, {}
+        for drive, entry in config.items():
+            root = resolve_drive(drive)
+            if root is None:
+                print(f"Cotas: drive desconhecido ignorado: {drive}")
+                continue
+            names[root] = drive
+            if entry.get('limit') is not None:
+                limits[(root, '')] = parse_size(entry['limit'])
+                scopes[root] = None
+            for folder, limit in (entry.get('folders') or {}).items():
+                folder = folder.strip('/\\')
+                if not folder or '/' in folder or '\\' in folder or folder == TRASH_DIRNAME:
+                    raise ValueError(f'Pasta de cota inválida: {folder}')
+                limits[(root, folder)] = parse_size(limit)
+                if scopes.get(root, set()) is not None:
+                    scopes.setdefault(root, set()).add(folder)
+
+        with self._lock:
+            self._config, self._limits, self._scopes, self._names = config, limits, scopes, names
+        if not scopes and not os.path.exists(QUOTA_DB):
+            return
+
+        # Os escopos gravados no banco dizem o que já foi contado: o primeiro
+        # processo a ver uma configuração nova marca as pastas para recontagem
+        with quota_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            previous = {root: None if folders is None else set(json.loads(folders))
+                        for root, folders in conn.execute('SELECT root, folders FROM scopes')}
+            changed = [(root, scope) for root, scope in scopes.items() if previous.get(root, False) != scope]
+            gone = [(root,) for root in previous if root not in scopes]
+            conn.executemany('DELETE FROM usage WHERE root = ?', gone)
+            conn.executemany('DELETE FROM scopes WHERE root = ?', gone)
+            conn.executemany('INSERT OR REPLACE INTO scopes VALUES (?, ?)',
+                             [(root, None if scope is None else json.dumps(sorted(scope))) for root, scope in changed])
+            conn.executemany('INSERT OR IGNORE INTO dirty VALUES (?, ?)',
+                             [(root, top) for root, scope in changed
+                              for top in (sorted(scope) if scope is not None else [QUOTA_WHOLE_DRIVE])])
+            conn.execute('COMMIT')
+        if changed:
+            self.wakeup.set()
+
+    def config(self):
+        return self._config
+
+    def _locate(self, full_path, is_dir=None):
+        """(raiz, pasta) contabilizada que contém o caminho, ou None."""
+        for root, scope in self._scopes.items():
+            if not _is_within(root, full_path) or full_path == root:
+                continue
+            rel = os.path.relpath(full_path, root)
+            top, sep, _ = rel.partition(os.sep)
+            if not sep:
+                # Item direto na raiz: pastas são o próprio nível, arquivos contam em ''
+                if is_dir is None:
+                    is_dir = os.path.isdir(full_path) and not os.path.islink(full_path)
+                if not is_dir:
+                    top = ''
+            if top == TRASH_DIRNAME or (scope is not None and top not in scope):
+                return None
+            return root, top
+        return None
+
+    def _add(self, location, delta, release=None):
+        """Soma delta ao contador e, na mesma transação, libera a reserva feita para release."""
+        if (location is None or not delta) and release is None:
+            return
+        with quota_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if location is not None and delta:
+                conn.execute('''INSERT INTO usage VALUES (?, ?, max(0, ?))
+                                ON CONFLICT (root, top) DO UPDATE SET bytes = max(0, bytes + ?)''',
+                             (*location, delta, delta))
+            if release is not None:
+                conn.execute('DELETE FROM reservations WHERE pid = ? AND path = ?', (os.getpid(), release))
+            conn.execute('COMMIT')
+
+    def _mark_dirty(self, location):
+        if location is not None:
+            with quota_db() as conn:
+                conn.execute('INSERT OR IGNORE INTO dirty VALUES (?, ?)', location)
+            self.wakeup.set()
+
+    def limit(self, root, top=''):
+        return self._limits.get((root, top)) if self.active() else None
+
+    @staticmethod
+    def _sum(conn, table, root, top=''):
+        query = f'SELECT coalesce(sum(bytes), 0) FROM {table} WHERE root = ?'
+        if top:
+            return conn.execute(query + ' AND top = ?', (root, top)).fetchone()[0]
+        return conn.execute(query, (root,)).fetchone()[0]
+
+    def used(self, root, top=''):
+        if root not in self._scopes:
+            return 0
+        with quota_db() as conn:
+            return self._sum(conn, 'usage', root, top)
+
+    def _expire_reservations(self, conn):
+        """Descarta reservas vencidas, de processos que morreram ou de um processo anterior com o mesmo pid."""
+        now = time.time()
+        dead = [(pid,) for (pid,) in conn.execute('SELECT DISTINCT pid FROM reservations')
+                if pid != os.getpid() and not psutil.pid_exists(pid)]
+        conn.executemany('DELETE FROM reservations WHERE pid = ?', dead)
+        conn.execute('DELETE FROM reservations WHERE created < ? OR (pid = ? AND created < ?)',
+                     (now - QUOTA_RESERVATION_TTL, os.getpid(), self._started))
+
+    def check(self, full_path, incoming, reserve=True):
+        """
+        Mensagem de erro se gravar incoming bytes em full_path estourar uma cota;
+        senão None. Com reserve, os bytes ficam reservados para full_path até
+        added() (ou release()): gravações simultâneas, em qualquer processo,
+        contam com eles.
+        """
+        if incoming <= 0 or not self.active():
+            return None
+        roots = [root for root in self._scopes if _is_within(root, full_path)]
+        if not roots:
+            return None
+
+        checks = [(roots[0], '')]
+        location = self._locate(full_path, is_dir=False)
+        if location is not None and location[1]:
+            checks.append(location)
+        with quota_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._expire_reservations(conn)
+            # A reserva anterior para o mesmo arquivo (ex: PUT chunked) é substituída
+            own = conn.execute('SELECT root, top, bytes FROM reservations WHERE pid = ? AND path = ?',
+                               (os.getpid(), full_path)).fetchone()
+            for key in checks:
+                limit = self._limits.get(key)
+                if limit is None:
+                    continue
+                used = self._sum(conn, 'usage', *key) + self._sum(conn, 'reservations', *key)
+                if own is not None and own[0] == key[0] and (not key[1] or own[1] == key[1]):
+                    used -= own[2]
+                if used + incoming > limit:
+                    conn.execute('ROLLBACK')
+                    name = self._names.get(key[0], key[0]) + (f'/{key[1]}' if key[1] else '')
+                    return (f'Cota excedida em {name}: {format_size(used)} de {format_size(limit)} usados, '
+                            f'{format_size(incoming)} necessários')
+            if reserve and location is not None:
+                conn.execute('INSERT OR REPLACE INTO reservations VALUES (?, ?, ?, ?, ?, ?)',
+                             (os.getpid(), full_path, *location, incoming, time.time()))
+            conn.execute('COMMIT')
+        if reserve and location is not None and has_request_context():
+            # Liberada no fim da requisição se a gravação não chegar a added()
+            g.setdefault('quota_reservations', set()).add(full_path)
+        return None
+
+    def check_copy(self, source, target, move=False):
+        """Como check(), para copiar/mover source para target (mover dentro da mesma pasta não conta)."""
+        if not self.active() or not any(_is_within(root, target) for root in self._scopes):
+            return None
+        location = self._locate(target, os.path.isdir(source))
+        if move and location is not None and location == self._locate(source):
+            return None
+        return self.check(target, _path_size(source))
+
+    def release(self, full_path):
+        """Desfaz a reserva feita por check() para uma gravação que não aconteceu."""
+        if not self._scopes or not os.path.exists(QUOTA_DB):
+            return
+        with quota_db() as conn:
+            conn.execute('DELETE FROM reservations WHERE pid = ? AND path = ?', (os.getpid(), full_path))
+
+    def added(self, full_path, old_size=0):
+        """Contabiliza um arquivo gravado (old_size: tamanho anterior, se foi sobrescrito)."""
+        if not self.active():
+            return
+        if os.path.isdir(full_path):
+            self._mark_dirty(self._locate(full_path, True))
+            self.release(full_path)
+            return
+        try:
+            size = os.path.getsize(full_path)
+        except OSError:
+            self.release(full_path)
+            return
+        self._add(self._locate(full_path, False), size - old_size, release=full_path)
+
+    def removed(self, full_path):
+        """Chamar antes de apagar (ou mandar para a lixeira) um item."""
+        if not self.active():
+            return
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            location = self._locate(full_path, True)
+            if location is not None and location[1] == os.path.basename(full_path) \
+                    and os.path.dirname(full_path) == location[0]:
+                # A própria pasta de primeiro nível sumiu
+                with quota_db() as conn:
+                    conn.execute('DELETE FROM usage WHERE root = ? AND top = ?', location)
+            else:
+                self._mark_dirty(location)
+            return
+        try:
+            size = os.lstat(full_path).st_size
+        except OSError:
+            return
+        self._add(self._locate(full_path, False), -size)
+
+    def moved(self, source, target):
+        """Chamar depois de mover/renomear source para target."""
+        if not self.active():
+            return
+        is_dir = os.path.isdir(target) and not os.path.islink(target)
+        old, new = self._locate(source, is_dir), self._locate(target, is_dir)
+        if old == new:
+            self.release(target)
+            return
+        if is_dir:
+            self._mark_dirty(old)
+            self._mark_dirty(new)
+            self.release(target)
+            return
+        size = os.lstat(target).st_size
+        self._add(old, -size)
+        self._add(new, size, release=target)
+
+    def pending(self):
+        """Indica se há pastas marcadas esperando recontagem (por qualquer processo)."""
+        if not self.active():
+            return False
+        with quota_db() as conn:
+            return conn.execute('SELECT 1 FROM dirty LIMIT 1').fetchone() is not None
+
+    def _store(self, root, counts, replace=False):
+        """Grava contagens de uma raiz ainda contabilizada (replace: as do drive inteiro)."""
+        if root not in self._scopes:
+            return
+        with quota_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if replace:
+                conn.execute('DELETE FROM usage WHERE root = ?', (root,))
+            conn.executemany('INSERT OR REPLACE INTO usage VALUES (?, ?, ?)',
+                             [(root, top, size) for top, size in counts.items()])
+            conn.execute('COMMIT')
+
+    def reconcile(self, only_dirty=False):
+        """Reconta o uso percorrendo as pastas (todas ou só as marcadas)."""
+        if not self._scopes:
+            return
+        with quota_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if only_dirty:
+                targets = [(root, None if top == QUOTA_WHOLE_DRIVE else top)
+                           for root, top in conn.execute('SELECT root, top FROM dirty')]
+            else:
+                targets = [(root, top) for root, scope in self._scopes.items() for top in (scope or [None])]
+            conn.execute('DELETE FROM dirty')
+            conn.execute('COMMIT')
+
+        for root, top in targets:
+            if top is None:
+                # Drive inteiro: cada pasta de primeiro nível é contada separadamente
+                counts = {'': 0}
+                try:
+                    with os.scandir(root) as it:
+                        for entry in it:
+                            if entry.name == TRASH_DIRNAME:
+                                continue
+                            if entry.is_dir(follow_symlinks=False):
+                                counts[entry.name] = _path_size(entry.path)
+                            else:
+                                counts[''] += entry.stat(follow_symlinks=False).st_size
+                except OSError as e:
+                    print(f"Erro ao contar uso de {root}: {e}")
+                    continue
+                self._store(root, counts, replace=True)
+            elif top == '':
+                total = 0
+                with os.scandir(root) as it:
+                    for entry in it:
+                        if not entry.is_dir(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                self._store(root, {'': total})
+            else:
+                size = _path_size(os.path.join(root, top)) if os.path.isdir(os.path.join(root, top)) else 0
+                self._store(root, {top: size})
+
+    def report(self):
+        if not self.active():
+            return []
+        with quota_db() as conn:
+            dirty = {(root, None if top == QUOTA_WHOLE_DRIVE else top)
+                     for root, top in conn.execute('SELECT root, top FROM dirty')}
+        items = []
+        for (root, top), limit in sorted(self._limits.items()):
+            used = self.used(root, top)
+            items.append({
+                'drive': self._names.get(root, root),
+                'folder': top or None,
+                'used': used,
+                'limit': limit,
+                'percent': round(used * 100 / limit, 1) if limit else None,
+                'pending_scan': (root, top) in dirty or (root, None) in dirty,
+            })
+        return items
+
+quota_tracker = QuotaTracker()
+
+@app.teardown_request
+def release_quota_reservations(exc):
+    # Gravações que pararam entre check() e added() (erro, cliente desconectado)
+    for full_path in g.pop('quota_reservations', ()):
+        try:
+            quota_tracker.release(full_path)
+        except sqlite3.Error as e:
+            print(f"Erro ao liberar reserva de cota: {e}")
+
+def disk_space_error(full_path, incoming):
+    """Mensagem de erro se não couberem incoming bytes no disco de full_path; senão None."""
+    try:
+        free = shutil.disk_usage(os.path.dirname(full_path)).free
+    except OSError:
+        return None
+    if incoming > free:
+        return f'Espaço insuficiente em disco: {format_size(free)} livres, {format_size(incoming)} necessários'
+    return None
+
+def quota_reconciler_loop():
+    """Contagem inicial e reconciliações periódicas; pastas marcadas são recontadas logo."""
+    quota_tracker.reload(force=True)
+    quota_tracker.reconcile()
+    last_full = time.monotonic()
+    while True:
+        # As marcas podem vir de outros processos: o banco é consultado a cada QUOTA_DIRTY_DELAY
+        quota_tracker.wakeup.wait(timeout=QUOTA_DIRTY_DELAY)
+        quota_tracker.wakeup.clear()
+        try:
+            quota_tracker.reload()
+            if time.monotonic() - last_full >= QUOTA_SCAN_INTERVAL:
+                quota_tracker.reconcile()
+                last_full = time.monotonic()
+            elif quota_tracker.pending():
+                time.sleep(QUOTA_DIRTY_DELAY)
+                quota_tracker.reconcile(only_dirty=True)
+        except Exception as e:
+            print(f"Erro ao reconciliar cotas: {e}")
+
+# --- LIXEIRA ---
+
+# A lixeira fica na raiz de cada drive (ou da pasta DADOS), assim apagar é só
+# um os.rename dentro do mesmo sistema de arquivos, instantâneo mesmo para
+# pastas com centenas de milhares de arquivos. Se a raiz não aceita escrita
+# (drive somente leitura, ou a raiz do sistema), a lixeira vai para uma pasta
+# por drive em STATE_FOLDER; item que não estiver no mesmo sistema de arquivos
+# da lixeira não é apagado (copiar um disco inteiro para "apagar" não serve).
+TRASH_DIRNAME = '.lixeira'
+TRASH_FALLBACK_FOLDER = os.path.join(STATE_FOLDER, 'lixeira')
+TRASH_PURGING_DIRNAME = '.apagando'
+TRASH_RETENTION_DAYS = 30                # Itens mais antigos que isso são apagados de vez
+TRASH_MAX_BYTES = 20 * 1024 * 1024 * 1024  # Orçamento de espaço da lixeira por drive (20GB)
+TRASH_PURGE_INTERVAL = 10 * 60           # Segundos entre execuções do limpador
+
+_trash_lock = threading.Lock()
+_trash_wakeup = threading.Event()
+
+class TrashError(OSError):
+    """Item que não pode ir para a lixeira; a mensagem vai para o usuário."""
+
+def trash_folder(drive_root):
+    own = os.path.join(drive_root, TRASH_DIRNAME)
+    if os.path.isdir(own):
+        return own
+    key = hashlib.sha1(os.path.abspath(drive_root).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    fallback = os.path.join(TRASH_FALLBACK_FOLDER, key)
+    if os.path.isdir(fallback) or os.path.dirname(drive_root) == drive_root or not os.access(drive_root, os.W_OK):
+        return fallback
+    return own
+
+def is_trash_path(rel_path):
+    """Indica se um caminho relativo aponta para dentro da lixeira."""
+    first = rel_path.replace('\\', '/').strip('/').split('/', 1)[0]
+    return first == TRASH_DIRNAME
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Erro ao remover {path}: {e}")
+
+def _path_size(path):
+    """Tamanho total em bytes de um arquivo ou pasta (percorre a árvore)."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def move_to_trash(drive_root, full_path, rel_path):
+    """
+    Move um item para a lixeira do drive. Retorna o id do item na lixeira.
+    """
+    trash = trash_folder(drive_root)
+    try:
+        os.makedirs(trash, exist_ok=True)
+    except OSError as e:
+        raise TrashError(f'Não foi possível criar a lixeira ({e.strerror}); nada foi apagado')
+
+    trash_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+    target = os.path.join(trash, trash_id)
+    is_dir = os.path.isdir(full_path)
+    info = {
+        'id': trash_id,
+        'name': os.path.basename(full_path),
+        'original_path': rel_path.replace('\\', '/').strip('/'),
+        'deleted_at': time.time(),
+        'is_dir': is_dir,
+        'size': None if is_dir else os.path.getsize(full_path),
+    }
+
+    quota_tracker.removed(full_path)
+
+    # O JSON é gravado antes para que o limpador nunca encontre item sem metadados
+    info_path = target + '.json'
+    _write_json_atomic(info_path, info)
+    try:
+        os.rename(full_path, target)
+    except OSError as e:
+        os.remove(info_path)
+        if e.errno == errno.EXDEV:
+            # Ponto de montagem dentro do drive, ou lixeira em STATE_FOLDER
+            raise TrashError(f"{info['original_path']} está em outro sistema de arquivos que a lixeira; nada foi apagado")
+        raise
+    return trash_id
+
+def list_trash(drive_root):
+    """Lista os itens da lixeira de um drive, do mais recente para o mais antigo."""
+    trash = trash_folder(drive_root)
+    if not os.path.isdir(trash):
+        return []
+
+    entries = []
+    for name in os.listdir(trash):
+        if not name.endswith('.json'):
+            continue
+        info_path = os.path.join(trash, name)
+        try:
+            with open(info_path, encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if os.path.lexists(os.path.join(trash, info.get('id', ''))):
+            entries.append(info)
+    entries.sort(key=lambda x: x['deleted_at'], reverse=True)
+    return entries
+
+def _unique_restore_path(path):
+    if not os.path.lexists(path):
+        return path
+    base, ext = os.path.splitext(path)
+    counter = 1
+    while os.path.lexists(f"{base} ({counter}){ext}"):
+        counter += 1
+    return f"{base} ({counter}){ext}"
+
+def restore_from_trash(drive_root, trash_id):
+    """
+    Devolve um item da lixeira ao caminho original. Se já existir algo com
+    o mesmo nome, restaura como "nome (1)". Retorna o caminho relativo final.
+    """
+    trash = trash_folder(drive_root)
+    if os.path.basename(trash_id) != trash_id or trash_id.startswith('.'):
+        raise ValueError('Id inválido')
+
+    with _trash_lock:
+        info_path = os.path.join(trash, trash_id + '.json')
+        item_path = os.path.join(trash, trash_id)
+        if not os.path.exists(info_path) or not os.path.lexists(item_path):
+            raise FileNotFoundError('Item não encontrado na lixeira')
+
+        with open(info_path, encoding='utf-8') as f:
+            info = json.load(f)
+
+        target = _unique_restore_path(resolve_path(drive_root, info['original_path']))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(item_path, target)
+        os.remove(info_path)
+
+    quota_tracker.added(target)
+    forget_resolved_paths(target)
+    return os.path.relpath(target, drive_root).replace(os.sep, '/')
+
+def discard_from_trash(drive_root, trash_ids):
+    """
+    Tira itens da lixeira para a área de remoção. A remoção física (que pode
+    demorar) fica a cargo do limpador em segundo plano.
+    """
+    trash = trash_folder(drive_root)
+    purging = os.path.join(trash, TRASH_PURGING_DIRNAME)
+    os.makedirs(purging, exist_ok=True)
+
+    discarded = 0
+    with _trash_lock:
+        for trash_id in trash_ids:
+            if os.path.basename(trash_id) != trash_id or trash_id.startswith('.'):
+                continue
+            item_path = os.path.join(trash, trash_id)
+            info_path = item_path + '.json'
+            if os.path.lexists(item_path):
+                os.rename(item_path, os.path.join(purging, trash_id))
+                discarded += 1
+            if os.path.exists(info_path):
+                os.remove(info_path)
+    _trash_wakeup.set()
+    return discarded
+
+def purge_trash(drive_root):
+    """Aplica a retenção e o orçamento de espaço à lixeira de um drive."""
+    trash = trash_folder(drive_root)
+    if not os.path.isdir(trash):
+        return
+
+    entries = list_trash(drive_root)
+    cutoff = time.time() - TRASH_RETENTION_DAYS * 24 * 3600
+    expired = [e['id'] for e in entries if e['deleted_at'] < cutoff]
+    kept = [e for e in entries if e['deleted_at'] >= cutoff]
+
+    # Calcula o tamanho das pastas que ainda não foram medidas
+    for entry in kept:
+        if entry.get('size') is None:
+            entry['size'] = _path_size(os.path.join(trash, entry['id']))
+            try:
+                _write_json_atomic(os.path.join(trash, entry['id'] + '.json'), entry)
+            except OSError:
+                pass
+
+    # Remove os mais antigos até caber no orçamento
+    total = sum(e['size'] for e in kept)
+    for entry in reversed(kept):
+        if total <= TRASH_MAX_BYTES:
+            break
+        expired.append(entry['id'])
+        total -= entry['size']
+
+    if expired:
+        discard_from_trash(drive_root, expired)
+
+    purging = os.path.join(trash, TRASH_PURGING_DIRNAME)
+    if os.path.isdir(purging):
+        for name in os.listdir(purging):
+            _remove_path(os.path.join(purging, name))
+
+def trash_purger_loop():
+    while True:
+        for root in [DATA_FOLDER] + get_drives():
+            try:
+                purge_trash(root)
+            except Exception as e:
+                print(f"Erro ao limpar lixeira de {root}: {e}")
+        _trash_wakeup.wait(TRASH_PURGE_INTERVAL)
+        _trash_wakeup.clear()
+
+# --- OPERAÇÕES EM LOTE ---
+
+BATCH_WORKERS = 4
+BATCH_MAX_OPERATIONS = 10000
+BATCH_OPERATIONS = ('mkdir', 'rename', 'move', 'copy', 'delete')
+
+class OperationError(Exception):
+    """Falha esperada de uma operação em lote; a mensagem vai para o usuário."""
+
+def _normalize_rel(path):
+    path = posixpath.normpath((path or '').replace('\\', '/').strip('/'))
+    return '' if path == '.' else path
+
+def _batch_touched_paths(op):
+    """Caminhos relativos que a operação lê ou altera, para detectar conflitos."""
+    path = _normalize_rel(op.get('path'))
+    kind = op.get('op')
+    if kind == 'rename':
+        return [path, posixpath.join(posixpath.dirname(path), secure_filename(op.get('new_name', '')))]
+    if kind in ('move', 'copy'):
+        return [path, posixpath.join(_normalize_rel(op.get('target')), posixpath.basename(path))]
+    return [path]
+
+def group_batch_operations(operations):
+    """
+    Agrupa operações que dependem umas das outras: duas operações conflitam se
+    algum caminho de uma é igual ou ancestral de um caminho da outra (ex: criar
+    "fotos/2024" e mover algo para dentro dela). Cada grupo roda em ordem; grupos
+    diferentes são independentes e podem rodar em paralelo.
+    """
+    parent = list(range(len(operations)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    exact = {}  # caminho -> operações que tocam exatamente esse caminho
+    below = {}  # caminho -> operações que tocam esse caminho ou algo dentro dele
+    for index, op in enumerate(operations):
+        for path in _batch_touched_paths(op):
+            for other in below.get(path, ()):
+                union(index, other)
+            prefixes = [''] + [path[:i] for i, ch in enumerate(path) if ch == '/'] + [path]
+            for prefix in prefixes[:-1]:
+                for other in exact.get(prefix, ()):
+                    union(index, other)
+            exact.setdefault(path, []).append(index)
+            for prefix in prefixes:
+                below.setdefault(prefix, []).append(index)
+
+    groups = {}
+    for index in range(len(operations)):
+        groups.setdefault(find(index), []).append(index)
+    return list(groups.values())
+
+def _op_mkdir(root, op, full_path):
+    if full_path == root:
+        return {}
+    # O nome da pasta nova passa pelo mesmo filtro de criar pasta e renomear
+    name = secure_filename(os.path.basename(full_path))
+    if not name:
+        raise OperationError('Nome inválido')
+    full_path = os.path.join(os.path.dirname(full_path), name)
+    os.makedirs(full_path, exist_ok=True)
+    return {'path': os.path.relpath(full_path, root).replace(os.sep, '/')}
+
+def _op_rename(root, op, full_path):
+    new_name = secure_filename((op.get('new_name') or '').strip())
+    if not new_name:
+        raise OperationError('Nome inválido')
+    if not os.path.lexists(full_path):
+        raise OperationError('Arquivo ou pasta não encontrado')
+    full_new = os.path.join(os.path.dirname(full_path), new_name + cold_suffix(full_path))
+    if os.path.lexists(full_new) or cold_twins(full_new):
+        raise OperationError('Já existe um item com este nome')
+    shutil.move(full_path, full_new)
+    quota_tracker.moved(full_path, full_new)
+    move_access(full_path, full_new)
+    return {'new_path': os.path.relpath(full_new, root).replace(os.sep, '/')}
+
+def _op_move_or_copy(root, op, full_path):
+    target_rel = _normalize_rel(op.get('target'))
+    if is_trash_path(target_rel):
+        raise OperationError('Destino inválido')
+    if not os.path.lexists(full_path):
+        raise OperationError('Arquivo ou pasta não encontrado')
+
+    target_full = resolve_path(root, target_rel)
+    full_new = os.path.join(target_full, os.path.basename(full_path))
+    if full_new == full_path or _is_within(full_path, target_full):
+        raise OperationError('Destino dentro da própria origem')
+    if os.path.lexists(full_new) or cold_twins(full_new):
+        raise OperationError('Já existe um item com este nome no destino')
+    quota_error = quota_tracker.check_copy(full_path, full_new, move=(op['op'] == 'move'))
+    if quota_error:
+        raise OperationError(quota_error)
+
+    os.makedirs(target_full, exist_ok=True)
+    if op['op'] == 'move':
+        shutil.move(full_path, full_new)
+        quota_tracker.moved(full_path, full_new)
+        move_access(full_path, full_new)
+    else:
+        if os.path.isdir(full_path):
+            shutil.copytree(full_path, full_new, symlinks=True)
+        else:
+            shutil.copy2(full_path, full_new)
+        quota_tracker.added(full_new)
+    return {'new_path': os.path.relpath(full_new, root).replace(os.sep, '/')}
+
+def _op_delete(root, op, full_path):
+    if not os.path.lexists(full_path):
+        raise OperationError('Arquivo ou pasta não encontrado')
+    return {'trash_id': move_to_trash(root, full_path, _normalize_rel(op.get('path')))}
+
+# Como cada operação aparece no diário de replicação
+_BATCH_JOURNAL_OPS = {'mkdir': 'mkdir', 'rename': 'move', 'move': 'move', 'copy': 'copy', 'delete': 'delete'}
+
+_BATCH_HANDLERS = {
+    'mkdir': _op_mkdir,
+    'rename': _op_rename,
+    'move': _op_move_or_copy,
+    'copy': _op_move_or_copy,
+    'delete': _op_delete,
+}
+
+def run_batch(root, operations):
+    """
+    Executa uma lista de operações heterogêneas e devolve um resultado por item,
+    na mesma ordem. Uma falha não interrompe as demais operações.
+    """
+    paths = [_normalize_rel(op.get('path')) for op in operations]
+    full_paths = resolve_paths(root, paths, strict=False)
+    results = [None] * len(operations)
+    touched = []  # Caminhos completos alterados, para invalidar os caches no fim
+
+    def run_one(index):
+        op = operations[index]
+        result = {'index': index, 'op': op.get('op'), 'path': paths[index]}
+        try:
+            if op.get('op') not in _BATCH_HANDLERS:
+                raise OperationError('Operação desconhecida')
+            if full_paths[index] is None:
+                raise OperationError('Acesso negado')
+            if (not paths[index] and op['op'] != 'mkdir') or is_trash_path(paths[index]):
+                raise OperationError('Caminho inválido')
+            path, full_path = paths[index], full_paths[index]
+            cold = cold_copy(full_path) if op['op'] != 'mkdir' else None
+            if cold:
+                # Arquivo frio: a operação vale para a cópia comprimida
+                path, full_path = path + cold_suffix(cold), cold
+            result.update(_BATCH_HANDLERS[op['op']](root, op, full_path))
+            result['success'] = True
+            if op['op'] == 'mkdir':
+                path = result['path']  # Nome saneado
+            journal_change(root, _BATCH_JOURNAL_OPS[op['op']], path, result.get('new_path'))
+            touched.append(_join_relative(root, path) if op['op'] == 'mkdir' else full_path)
+            if 'new_path' in result:
+                touched.append(_join_relative(root, result['new_path']))
+            if cold and 'new_path' in result:
+                result['new_path'] = cold_logical_name(result['new_path'])
+        except OperationError as e:
+            result.update(success=False, error=str(e))
+        except HTTPException as e:
+            result.update(success=False, error=e.description or 'Acesso negado')
+        except Exception as e:
+            print(f"Erro na operação em lote {op}: {e}")
+            result.update(success=False, error=str(e))
+        results[index] = result
+
+    def run_group(indexes):
+        for index in indexes:
+            run_one(index)
+
+    groups = group_batch_operations(operations)
+    if len(groups) == 1:
+        run_group(groups[0])
+    else:
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+            list(pool.map(run_group, groups))
+
+    if touched:
+        forget_resolved_paths(*touched)
+    return results
+
+# --- WEBDAV ---
+
+DAV_PREFIX = '/dav'
+DAV_PUT_CHUNK = 1024 * 1024
+DAV_XML_BATCH = 64              # Respostas do PROPFIND enviadas por bloco
+DAV_MAX_BODY = 1024 * 1024      # Corpo XML máximo aceito (PROPFIND, LOCK, PROPPATCH)
+DAV_LOCK_TIMEOUT = 600
+DAV_LOCK_MAX_TIMEOUT = 3600
+DAV_METHODS = ['OPTIONS', 'PROPFIND', 'PROPPATCH', 'MKCOL', 'GET', 'HEAD', 'PUT',
+               'DELETE', 'COPY', 'MOVE', 'LOCK', 'UNLOCK']
+MS_NAMESPACE = 'urn:schemas-microsoft-com:'
+
+_SUPPORTED_LOCK = ('<D:lockentry><D:lockscope><D:exclusive/></D:lockscope><D:locktype><D:write/></D:locktype></D:lockentry>'
+                   '<D:lockentry><D:lockscope><D:shared/></D:lockscope><D:locktype><D:write/></D:locktype></D:lockentry>')
+
+def dav_drives():
+    """Nomes dos drives como aparecem no WebDAV ('DADOS', 'C', 'media_usb')."""
+    drives = {'DADOS': 'DADOS'}
+    for mount in available_drives():
+        label = mount.strip('/\\').replace(os.sep, '_').replace(':', '') or 'raiz'
+        drives.setdefault(label, mount)
+    return drives
+
+def dav_href(label, rel='', is_dir=False):
+    href = request.script_root + DAV_PREFIX + '/'
+    if label:
+        href += quote(label) + '/'
+        if rel:
+            href += quote(rel.replace(os.sep, '/'))
+            if is_dir:
+                href += '/'
+    return href
+
+def dav_etag(entry):
+    return f'{entry["mtime_ns"]:x}-{entry["size"]:x}'
+
+DAV_LOCKS_DB = os.path.join(STATE_FOLDER, 'travas-webdav.db')
+DAV_LOCKS_SNAPSHOT_TTL = 1.0   # Segundos em que o PROPFIND reaproveita a lista de travas lida
+
+_DAV_LOCK_FIELDS = ('token', 'path', 'href', 'scope', 'depth', 'owner', 'timeout', 'expires')
+
+def _dav_lock_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS locks (
+        token TEXT PRIMARY KEY, path TEXT NOT NULL, href TEXT NOT NULL, scope TEXT NOT NULL,
+        depth TEXT NOT NULL, owner TEXT NOT NULL, timeout INTEGER NOT NULL, expires REAL NOT NULL)''')
+
+_dav_lock_connections = SQLitePool(lambda: DAV_LOCKS_DB, _dav_lock_schema, ('PRAGMA synchronous=NORMAL',),
+                                   timeout=30, isolation_level=None)
+
+class DavLockManager:
+    """
+    Travas de escrita do WebDAV (classe 2). Ficam em DAV_LOCKS_DB, para valer
+    em todos os processos; só a listagem do PROPFIND reaproveita uma cópia
+    recente. Cada trava cobre um caminho e, com depth infinity, tudo abaixo dele.
+    """
+
+    def __init__(self):
+        self._snapshot = (0.0, [])
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(conn):
+        # Travas vigentes; as vencidas são apagadas por quem grava
+        rows = conn.execute(f'SELECT {", ".join(_DAV_LOCK_FIELDS)} FROM locks WHERE expires > ?', (time.time(),))
+        return [dict(zip(_DAV_LOCK_FIELDS, row)) for row in rows]
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with _dav_lock_connections.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM locks WHERE expires <= ?', (time.time(),))
+            yield conn
+            conn.execute('COMMIT')
+        with self._lock:
+            self._snapshot = (0.0, [])
+
+    @staticmethod
+    def _covering(locks, full_path, descendants=False):
+        for lock in locks:
+            if lock['path'] == full_path or (lock['depth'] == 'infinity' and _is_within(lock['path'], full_path)):
+                yield lock
+            elif descendants and _is_within(full_path, lock['path']):
+                yield lock
+
+    def locks_for(self, full_path):
+        now = time.monotonic()
+        with self._lock:
+            expires, locks = self._snapshot
+        if expires <= now:
+            with _dav_lock_connections.connection() as conn:
+                locks = self._read(conn)
+            with self._lock:
+                self._snapshot = (now + DAV_LOCKS_SNAPSHOT_TTL, locks)
+        return list(self._covering(locks, full_path))
+
+    def acquire(self, full_path, href, scope, depth, owner, timeout):
+        """Cria uma trava; retorna None se conflitar com outra existente."""
+        with self._transaction() as conn:
+            for lock in self._covering(self._read(conn), full_path, descendants=(depth == 'infinity')):
+                if scope == 'exclusive' or lock['scope'] == 'exclusive':
+                    return None
+            lock = {
+                'token': f'opaquelocktoken:{uuid.uuid4()}',
+                'path': full_path,
+                'href': href,
+                'scope': scope,
+                'depth': depth,
+                'owner': owner,
+                'timeout': timeout,
+                'expires': time.time() + timeout,
+            }
+            conn.execute(f'INSERT INTO locks VALUES ({", ".join("?" * len(_DAV_LOCK_FIELDS))})',
+                         [lock[field] for field in _DAV_LOCK_FIELDS])
+            return lock
+
+    def refresh(self, full_path, tokens, timeout):
+        with self._transaction() as conn:
+            for lock in self._covering(self._read(conn), full_path):
+                if lock['token'] in tokens:
+                    lock['timeout'] = timeout
+                    lock['expires'] = time.time() + timeout
+                    conn.execute('UPDATE locks SET timeout = ?, expires = ? WHERE token = ?',
+                                 (timeout, lock['expires'], lock['token']))
+                    return lock
+            return None
+
+    def release(self, full_path, token):
+        with self._transaction() as conn:
+            if not any(lock['token'] == token for lock in self._covering(self._read(conn), full_path)):
+                return False
+            conn.execute('DELETE FROM locks WHERE token = ?', (token,))
+            return True
+
+    def allows(self, full_path, tokens, descendants=False):
+        """Indica se a escrita é permitida: sem travas ou com o token de uma delas."""
+        with _dav_lock_connections.connection() as conn:
+            covering = list(self._covering(self._read(conn), full_path, descendants))
+        return not covering or any(lock['token'] in tokens for lock in covering)
+
+    def drop_tree(self, full_path):
+        """Remove as travas de um item apagado ou movido (travas não acompanham o MOVE)."""
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM locks WHERE token = ?',
+                             [(lock['token'],) for lock in self._read(conn) if _is_within(full_path, lock['path'])])
+
+dav_locks = DavLockManager()
+
+def _dav_tag(tag, value=''):
+    # Serializa uma propriedade em notação {namespace}nome
+    if tag.startswith('{DAV:}'):
+        name, attrs = 'D:' + tag[6:], ''
+    elif tag.startswith('{'):
+        namespace, local = tag[1:].split('}', 1)
+        name, attrs = 'X:' + local, f' xmlns:X="{xml_escape(namespace)}"'
+    else:
+        name, attrs = tag, ' xmlns=""'
+    if not value:
+        return f'<{name}{attrs}/>'
+    return f'<{name}{attrs}>{value}</{name}>'
+
+def _dav_propstat(props, status):
+    return (f'<D:propstat><D:prop>{"".join(_dav_tag(t, v) for t, v in props)}</D:prop>'
+            f'<D:status>HTTP/1.1 {status}</D:status></D:propstat>')
+
+def dav_lock_xml(lock):
+    return (f'<D:activelock><D:locktype><D:write/></D:locktype>'
+            f'<D:lockscope><D:{lock["scope"]}/></D:lockscope>'
+            f'<D:depth>{lock["depth"]}</D:depth>{lock["owner"]}'
+            f'<D:timeout>Second-{lock["timeout"]}</D:timeout>'
+            f'<D:locktoken><D:href>{lock["token"]}</D:href></D:locktoken>'
+            f'<D:lockroot><D:href>{xml_escape(lock["href"])}</D:href></D:lockroot></D:activelock>')
+
+def dav_properties(entry, full_path):
+    """Propriedades vivas de um item, em notação {namespace}nome."""
+    props = {
+        '{DAV:}displayname': xml_escape(entry['name']),
+        '{DAV:}resourcetype': '<D:collection/>' if entry['is_dir'] else '',
+        '{DAV:}getlastmodified': formatdate(entry['mtime'], usegmt=True),
+        '{DAV:}creationdate': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(entry['ctime'])),
+        '{DAV:}supportedlock': _SUPPORTED_LOCK,
+        '{DAV:}lockdiscovery': ''.join(dav_lock_xml(lock) for lock in dav_locks.locks_for(full_path)),
+    }
+    if not entry['is_dir']:
+        props['{DAV:}getcontentlength'] = str(entry['size'])
+        props['{DAV:}getcontenttype'] = mimetypes.guess_type(entry['name'])[0] or 'application/octet-stream'
+        props['{DAV:}getetag'] = f'"{dav_etag(entry)}"'
+    return props
+
+def dav_response_xml(href, entry, full_path, requested):
+    """
+    Bloco <D:response> de um item. requested é None (allprop), 'propname' ou
+    a lista de propriedades pedidas.
+    """
+    props = dav_properties(entry, full_path)
+    if requested is None:
+        body = _dav_propstat(props.items(), '200 OK')
+    elif requested == 'propname':
+        body = _dav_propstat([(tag, '') for tag in props], '200 OK')
+    else:
+        found = [(tag, props[tag]) for tag in requested if tag in props]
+        missing = [(tag, '') for tag in requested if tag not in props]
+        body = (_dav_propstat(found, '200 OK') if found else '') + \
+               (_dav_propstat(missing, '404 Not Found') if missing else '')
+    return f'<D:response><D:href>{xml_escape(href)}</D:href>{body}</D:response>'
+
+def dav_multistatus(responses):
+    """Gera o XML de um multistatus em blocos, sem montar o documento inteiro na memória."""
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:">'
+    batch = []
+    for response in responses:
+        batch.append(response)
+        if len(batch) >= DAV_XML_BATCH:
+            yield ''.join(batch)
+            batch = []
+    yield ''.join(batch) + '</D:multistatus>'
+
+def dav_request_xml():
+    """Lê e interpreta o corpo XML da requisição (None se vazio)."""
+    body = request.stream.read(DAV_MAX_BODY + 1)
+    if len(body) > DAV_MAX_BODY:
+        abort(413)
+    if not body.strip():
+        return None
+    try:
+        return ET.fromstring(body)
+    except ET.ParseError:
+        abort(400, 'XML inválido')
+
+def dav_submitted_tokens():
+    # Tokens de trava enviados no cabeçalho If (ex: (<opaquelocktoken:...>))
+    return set(re.findall(r'<([^>]+)>', request.headers.get('If', '')))
+
+def dav_timeout():
+    for part in request.headers.get('Timeout', '').split(','):
+        part = part.strip()
+        if part.lower() == 'infinite':
+            return DAV_LOCK_MAX_TIMEOUT
+        if part.lower().startswith('second-') and part[7:].isdigit():
+            return max(1, min(int(part[7:]), DAV_LOCK_MAX_TIMEOUT))
+    return DAV_LOCK_TIMEOUT
+
+# --- SINCRONIZAÇÃO DELTA ---
+
+# Formato da assinatura (little-endian):
+#   cabeçalho 'VXS1', tamanho do bloco (u32), tamanho do arquivo (u64), mtime_ns (u64)
+#   e, para cada bloco, adler32 (u32, soma "rolante") + blake2b de 16 bytes.
+# Formato do patch: sequência de operações terminada por 'E'
+#   'C' índice (u64) quantidade (u32)  -> copia blocos do arquivo atual
+#   'L' tamanho (u32) + dados          -> dados novos
+#   'E' sha256 (32 bytes)              -> fim; hash do arquivo reconstruído
+DELTA_MIN_BLOCK = 2 * 1024
+DELTA_MAX_BLOCK = 128 * 1024
+DELTA_COPY_CHUNK = 1024 * 1024
+DELTA_MAX_OPS = 1024 * 1024   # Operações C/L aceitas num único patch
+DELTA_HEADER = struct.Struct('<4sIQQ')
+DELTA_BLOCK = struct.Struct('<I16s')
+
+_delta_slots = threading.BoundedSemaphore(2)
+
+def delta_block_size(file_size, requested=None):
+    """Bloco de ~sqrt(tamanho), como no rsync, dentro dos limites; ou o pedido pelo cliente."""
+    if requested:
+        return min(max(int(requested), DELTA_MIN_BLOCK), DELTA_MAX_BLOCK)
+    size = int(file_size ** 0.5) // 1024 * 1024
+    return min(max(size, DELTA_MIN_BLOCK), DELTA_MAX_BLOCK)
+
+def delta_signature(full_path, block_size):
+    """
+    Gera (ou reaproveita do cache) a assinatura em blocos do arquivo. Um arquivo
+    frio é lido descomprimido e continua frio: só o patch o devolve à forma normal.
+    """
+    st = os.stat(full_path)
+    target = cache_file_path('delta', full_path, st, block_size, ext='.sig')
+    if os.path.exists(target):
+        return target
+
+    with _delta_slots:
+        if os.path.exists(target):
+            return target
+
+        tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open_cold(full_path) if cold_suffix(full_path) else open(full_path, 'rb') as src, \
+                    open(tmp_path, 'wb') as out:
+                out.write(DELTA_HEADER.pack(b'VXS1', block_size, 0, st.st_mtime_ns))
+                size = 0
+                while True:
+                    block = src.read(block_size)
+                    while block and len(block) < block_size:
+                        # O fluxo descomprimido pode entregar menos que o pedido
+                        more = src.read(block_size - len(block))
+                        if not more:
+                            break
+                        block += more
+                    if not block:
+                        break
+                    size += len(block)
+                    out.write(DELTA_BLOCK.pack(zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest()))
+                # O tamanho (lógico, no caso do arquivo frio) só é conhecido no fim
+                out.seek(0)
+                out.write(DELTA_HEADER.pack(b'VXS1', block_size, size, st.st_mtime_ns))
+            os.replace(tmp_path, target)
+        except BaseException:
+            _remove_path(tmp_path)
+            raise
+
+    return target
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise ValueError('Patch incompleto')
+        data += more
+    return data
+
+def apply_delta(full_path, stream, block_size, base_mtime_ns, base_size, target_size):
+    """
+    Reconstrói o arquivo a partir do atual e do patch recebido, num temporário
+    ao lado do original, e troca os dois com os.replace. Levanta FileExistsError
+    se o arquivo mudou desde a assinatura usada pelo cliente e ValueError se o
+    resultado não tiver exatamente target_size bytes (conferidos antes contra a
+    cota e o espaço livre) ou passar de DELTA_MAX_OPS operações (um patch
+    pequeno pode repetir o mesmo bloco indefinidamente).
+    """
+    st = os.stat(full_path)
+    if st.st_mtime_ns != base_mtime_ns or st.st_size != base_size:
+        raise FileExistsError('O arquivo mudou desde a assinatura')
+
+    temp_path = os.path.join(os.path.dirname(full_path), f'.{os.path.basename(full_path)}.{uuid.uuid4().hex[:8]}.parcial')
+    digest = hashlib.sha256()
+    written = 0
+    ops = 0
+    try:
+        with open(full_path, 'rb') as base, open(temp_path, 'wb') as out:
+            while True:
+                op = _read_exact(stream, 1)
+                if op in (b'C', b'L'):
+                    ops += 1
+                    if ops > DELTA_MAX_OPS:
+                        raise ValueError('Patch com operações demais')
+                if op == b'C':
+                    index, count = struct.unpack('<QI', _read_exact(stream, 12))
+                    start = index * block_size
+                    remaining = min(count * block_size, base_size - start)
+                    if start >= base_size or remaining <= 0:
+                        raise ValueError('Bloco fora do arquivo')
+                    written += remaining
+                    if written > target_size:
+                        raise ValueError('Arquivo reconstruído maior que o declarado')
+                    base.seek(start)
+                    while remaining > 0:
+                        data = base.read(min(remaining, DELTA_COPY_CHUNK))
+                        out.write(data)
+                        digest.update(data)
+                        remaining -= len(data)
+                elif op == b'L':
+                    remaining, = struct.unpack('<I', _read_exact(stream, 4))
+                    written += remaining
+                    if written > target_size:
+                        raise ValueError('Arquivo reconstruído maior que o declarado')
+                    while remaining > 0:
+                        data = _read_exact(stream, min(remaining, DELTA_COPY_CHUNK))
+                        out.write(data)
+                        digest.update(data)
+                        remaining -= len(data)
+                elif op == b'E':
+                    if written != target_size:
+                        raise ValueError('Arquivo reconstruído menor que o declarado')
+                    if _read_exact(stream, 32) != digest.digest():
+                        raise ValueError('Hash do arquivo reconstruído não confere')
+                    break
+                else:
+                    raise ValueError('Operação de patch inválida')
+
+        shutil.copymode(full_path, temp_path)
+        # Confere de novo: alguém pode ter gravado no original durante a reconstrução
+        with path_lock(full_path):
+            st = os.stat(full_path)
+            if st.st_mtime_ns != base_mtime_ns or st.st_size != base_size:
+                raise FileExistsError('O arquivo mudou durante a reconstrução')
+            os.replace(temp_path, full_path)
+    except BaseException:
+        _remove_path(temp_path)
+        raise
+
+    forget_listing(os.path.dirname(full_path))
+
+# --- REPLICAÇÃO ---
+
+# Diário append-only das alterações feitas na pasta DADOS (uma linha JSON por
+# operação) e um worker que as repete numa segunda instância pelo WebDAV dela,
+# retomando do último deslocamento confirmado. Requisições vindas de uma réplica
+# trazem REPLICA_HEADER e não entram no diário (evita ecos entre duas instâncias);
+# o cabeçalho só vale com o segredo combinado ou vindo do endereço da réplica.
+# O diário guarda nomes lógicos: arquivos frios são enviados já descomprimidos.
+REPLICATION_FOLDER = os.path.join(STATE_FOLDER, 'replicacao')
+REPLICATION_JOURNAL = os.path.join(REPLICATION_FOLDER, 'diario.jsonl')
+REPLICATION_STATE = os.path.join(REPLICATION_FOLDER, 'estado.json')
+REPLICATION_WORKERS = 4                    # Arquivos enviados em paralelo
+REPLICATION_BATCH = 500                    # Linhas do diário lidas por vez
+REPLICATION_JOURNAL_MAX = 8 * 1024 * 1024  # Tamanho a partir do qual o diário já enviado é zerado
+REPLICATION_RETRY = 30                     # Segundos de espera quando a réplica não responde
+REPLICATION_ATTEMPTS = 3                   # Vezes que um envio recusado é repetido antes de ser pulado
+REPLICATION_TIMEOUT = 60
+REPLICATION_BLOCK = 256 * 1024
+REPLICA_HEADER = 'X-Vyrex-Replica'
+REPLICATION_SETTINGS = {'peer': None, 'insecure': False,
+                        'secret': os.environ.get('VYREX_REPLICA_SEGREDO') or None}
+
+_journal_lock = threading.Lock()
+_journal_event = threading.Event()
+_peer_addresses = {'at': 0.0, 'addresses': set()}
+replication_status = {'state': 'desativada'}
+
+class PeerUnavailable(Exception):
+    """A réplica não respondeu (rede ou erro 5xx); a operação deve ser repetida depois."""
+
+def peer_addresses():
+    """IPs da réplica configurada, resolvidos de novo a cada REPLICATION_RETRY segundos."""
+    now = time.monotonic()
+    if now - _peer_addresses['at'] > REPLICATION_RETRY:
+        addresses = set()
+        try:
+            for info in socket.getaddrinfo(urlsplit(REPLICATION_SETTINGS['peer']).hostname, None):
+                addresses.add(info[4][0])
+        except (OSError, UnicodeError):
+            pass
+        _peer_addresses.update(at=now, addresses=addresses)
+    return _peer_addresses['addresses']
+
+def replica_request():
+    """A requisição atual veio de uma réplica (segredo correto ou endereço da réplica configurada)."""
+    value = request.headers.get(REPLICA_HEADER)
+    if not value:
+        return False
+    if REPLICATION_SETTINGS['secret']:
+        return hmac.compare_digest(value.encode(), REPLICATION_SETTINGS['secret'].encode())
+    if not REPLICATION_SETTINGS['peer']:
+        return False
+    address = (request.remote_addr or '').removeprefix('::ffff:')
+    return address in peer_addresses()
+
+def journal_path(rel):
+    """Caminho do diário: separador '/' e o nome lógico no lugar do arquivo frio."""
+    rel = rel.replace('\\', '/').strip('/')
+    return cold_logical_name(rel) or rel
+
+def journal_change(root, op, rel, dest=None):
+    """Registra no diário uma alteração feita em DADOS (sem efeito se não houver réplica)."""
+    if not REPLICATION_SETTINGS['peer'] or root != resolve_drive('DADOS'):
+        return
+    if has_request_context() and replica_request():
+        return
+    entry = {'op': op, 'path': journal_path(rel), 'at': time.time()}
+    if dest is not None:
+        entry['dest'] = journal_path(dest)
+    line = json.dumps(entry, ensure_ascii=False) + '\n'
+    with _journal_lock:
+        with open(REPLICATION_JOURNAL, 'a', encoding='utf-8') as f:
+            f.write(line)
+    _journal_event.set()
+
+def read_journal(offset, limit=REPLICATION_BATCH):
+    """Lê até limit entradas completas a partir de offset. Retorna [(entrada, offset seguinte)]."""
+    entries = []
+    try:
+        with open(REPLICATION_JOURNAL, 'rb') as f:
+            f.seek(offset)
+            while len(entries) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break  # Linha ainda sendo escrita
+                offset += len(line)
+                try:
+                    entries.append((json.loads(line), offset))
+                except ValueError:
+                    print(f"Linha inválida no diário de replicação: {line[:200]!r}")
+    except FileNotFoundError:
+        pass
+    return entries
+
+class ReplicationPeer:
+    """Cliente HTTP da instância réplica (uma conexão keep-alive por thread)."""
+
+    def __init__(self, url, insecure=False):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'Endereço de réplica inválido: {url}')
+        self.url = url.rstrip('/')
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base = parts.path.rstrip('/')
+        self.insecure = insecure
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.scheme == 'https':
+                context = ssl.create_default_context()
+                if self.insecure:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                conn = http.client.HTTPSConnection(self.host, self.port, timeout=REPLICATION_TIMEOUT,
+                                                   context=context, blocksize=REPLICATION_BLOCK)
+            else:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=REPLICATION_TIMEOUT,
+                                                  blocksize=REPLICATION_BLOCK)
+            self._local.conn = conn
+        return conn
+
+    def dav_url(self, rel):
+        return f"{self.base}{DAV_PREFIX}/DADOS/{quote(rel)}"
+
+    def request(self, method, path, body=None, headers=None, attempts=2):
+        """
+        Faz uma requisição e retorna (status, cabeçalhos, corpo). Erros de rede e
+        5xx viram PeerUnavailable. Um corpo em arquivo é passado como função que o
+        abre: cada tentativa lê de um arquivo novo (o fluxo de um arquivo frio não
+        volta ao começo).
+        """
+        headers = {REPLICA_HEADER: REPLICATION_SETTINGS['secret'] or '1', **(headers or {})}
+        for attempt in range(attempts):
+            conn = self._connection()
+            with body() if callable(body) else contextlib.nullcontext(body) as source:
+                try:
+                    conn.request(method, path, body=source, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (OSError, http.client.HTTPException) as e:
+                    # Conexão keep-alive encerrada pela réplica: tenta de novo numa nova
+                    conn.close()
+                    self._local.conn = None
+                    if attempt == attempts - 1:
+                        raise PeerUnavailable(f'{method} {path}: {e}')
+                    continue
+            if response.status >= 500 and response.status != 507:
+                raise PeerUnavailable(f'{method} {path}: HTTP {response.status}')
+            return response.status, response.headers, data
+
+class ReplicationWorker:
+    """Envia à réplica as alterações do diário, na ordem, confirmando o deslocamento a cada etapa."""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.root = resolve_drive('DADOS')
+        self.offset = 0
+        self._stuck = (None, 0)  # (deslocamento, tentativas) do envio que está sendo recusado
+        self._pool = ThreadPoolExecutor(max_workers=REPLICATION_WORKERS, thread_name_prefix='replicacao')
+
+    def load_state(self):
+        """Retoma do deslocamento salvo; réplica nova (ou trocada) recebe uma cópia completa."""
+        os.makedirs(REPLICATION_FOLDER, exist_ok=True)
+        try:
+            with open(REPLICATION_STATE, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if state.get('peer') == self.peer.url:
+            self.offset = state.get('offset', 0)
+            return
+        with _journal_lock:
+            self.offset = os.path.getsize(REPLICATION_JOURNAL) if os.path.exists(REPLICATION_JOURNAL) else 0
+        self.save_state()
+        journal_change(self.root, 'put', '')
+
+    def save_state(self):
+        _write_json_atomic(REPLICATION_STATE, {'peer': self.peer.url, 'offset': self.offset})
+
+    def ack(self, offset):
+        self.offset = offset
+        with _journal_lock:
+            # Tudo enviado e o diário grande: recomeça do zero
+            if (os.path.getsize(REPLICATION_JOURNAL) == offset and offset > REPLICATION_JOURNAL_MAX):
+                open(REPLICATION_JOURNAL, 'w').close()
+                self.offset = 0
+            self.save_state()
+        replication_status.update(offset=self.offset, last_sync=time.time())
+
+    def run(self):
+        self.load_state()
+        replication_status.update(state='ativa', peer=self.peer.url, offset=self.offset,
+                                  sent_files=0, sent_bytes=0, skipped=0, failed=0)
+        while True:
+            _journal_event.clear()
+            entries = read_journal(self.offset)
+            if not entries:
+                _journal_event.wait(REPLICATION_RETRY)
+                continue
+            try:
+                self.apply(entries)
+                replication_status.update(state='ativa', error=None)
+            except PeerUnavailable as e:
+                print(f"Réplica indisponível: {e}")
+                replication_status.update(state='aguardando réplica', error=str(e))
+                time.sleep(REPLICATION_RETRY)
+            except Exception as e:
+                print(f"Erro na replicação: {e}")
+                replication_status.update(state='erro', error=str(e))
+                time.sleep(REPLICATION_RETRY)
+
+    def apply(self, entries):
+        """
+        Arquivos enviados em sequência no diário seguem em paralelo; operações de
+        estrutura (pasta, mover, apagar) são barreiras executadas na ordem.
+        """
+        pending = []
+        for entry, offset in entries:
+            if entry.get('op') == 'put' and entry['path'] and self.is_file(entry['path']):
+                pending.append((entry['path'], offset))
+                continue
+            self.flush(pending)
+            pending = []
+            self.guarded(self.apply_one, entry)
+            self.ack(offset)
+        self.flush(pending)
+
+    def flush(self, pending):
+        if not pending:
+            return
+        paths = list(dict.fromkeys(path for path, _ in pending))
+        sent = dict(zip(paths, self._pool.map(lambda path: self.guarded(self.put_file, path), paths)))
+
+        # Só avança o diário até o último envio confirmado; o resto é repetido
+        # depois, e pulado se continuar sendo recusado
+        done = None
+        for path, offset in pending:
+            if sent[path] is False:
+                break
+            done = offset
+        if done == pending[-1][1]:
+            self._stuck = (None, 0)
+            self.ack(done)
+            return
+        if done is not None:
+            self.ack(done)
+        attempts = self._stuck[1] + 1 if self._stuck[0] == self.offset else 1
+        if attempts < REPLICATION_ATTEMPTS:
+            self._stuck = (self.offset, attempts)
+            failed = sum(1 for ok in sent.values() if ok is False)
+            raise RuntimeError(f'{failed} arquivo(s) recusados pela réplica; nova tentativa em {REPLICATION_RETRY}s')
+        print(f"Envios recusados {attempts} vezes; pulando para o deslocamento {pending[-1][1]}")
+        self._stuck = (None, 0)
+        self.ack(pending[-1][1])
+
+    def guarded(self, action, *args):
+        """
+        Executa uma etapa; só a réplica fora do ar interrompe o envio, os demais
+        erros são registrados e pulados. Retorna False se a etapa falhou.
+        """
+        try:
+            return action(*args)
+        except PeerUnavailable:
+            raise
+        except Exception as e:
+            print(f"Erro ao replicar {args[0]}: {e}")
+            replication_status['failed'] = replication_status.get('failed', 0) + 1
+            return False
+
+    def local_path(self, rel):
+        return resolve_path(self.root, rel)
+
+    def is_file(self, rel):
+        full_path = self.local_path(rel)
+        return os.path.isfile(full_path) or cold_copy(full_path) is not None
+
+    def apply_one(self, entry):
+        op, rel = entry.get('op'), entry.get('path', '')
+        if op == 'put':
+            if os.path.isdir(self.local_path(rel)):
+                self.mirror_tree(rel)
+            return  # Arquivo que já não existe: o diário terá o apagar/mover correspondente
+        if op == 'mkdir':
+            self.ensure_dir(rel)
+        elif op == 'delete':
+            status, _, _ = self.peer.request('DELETE', self.peer.dav_url(rel))
+            if status not in (204, 404):
+                self.failed('DELETE', rel, status)
+        elif op in ('move', 'copy'):
+            dest = entry.get('dest', '')
+            self.ensure_dir(posixpath.dirname(dest))
+            status, _, _ = self.peer.request(op.upper(), self.peer.dav_url(rel), headers={
+                'Destination': self.peer.url + self.peer.dav_url(dest)[len(self.peer.base):],
+                'Overwrite': 'T', 'Depth': 'infinity'})
+            if status not in (201, 204):
+                # Origem ausente na réplica: envia o destino inteiro
+                self.put_any(dest)
+        else:
+            print(f"Operação desconhecida no diário de replicação: {entry}")
+
+    def put_any(self, rel):
+        full_path = self.local_path(rel)
+        if os.path.isdir(full_path):
+            self.mirror_tree(rel)
+        elif self.is_file(rel):
+            self.put_file(rel)
+
+    def failed(self, method, rel, status):
+        print(f"Réplica recusou {method} {rel}: HTTP {status}")
+        replication_status['failed'] = replication_status.get('failed', 0) + 1
+
+    def ensure_dir(self, rel):
+        """Cria a pasta (e as pastas pai) na réplica."""
+        parts = [p for p in rel.split('/') if p]
+        for i in range(len(parts)):
+            path = '/'.join(parts[:i + 1])
+            status, _, _ = self.peer.request('MKCOL', self.peer.dav_url(path) + '/')
+            if status not in (201, 405):
+                self.failed('MKCOL', path, status)
+                return
+
+    def put_file(self, rel, known=None):
+        """
+        Envia um arquivo, a menos que a réplica já tenha o mesmo tamanho e mtime.
+        Um arquivo frio vai descomprimido, com o nome e o tamanho originais.
+        Retorna False se a réplica recusou o envio.
+        """
+        full_path = self.local_path(rel)
+        cold = cold_copy(full_path)
+        try:
+            st = os.stat(cold or full_path)
+        except FileNotFoundError:
+            return True  # O diário terá o apagar/mover correspondente
+        size = cold_logical_size(cold) if cold else st.st_size
+        if known is None:
+            status, headers, _ = self.peer.request('HEAD', self.peer.dav_url(rel))
+            if status == 200:
+                known = (int(headers.get('Content-Length', -1)), headers.get('ETag', '').strip('"'))
+        local_etag = dav_etag({'mtime_ns': st.st_mtime_ns, 'size': st.st_size if size is None else size})
+        if known is not None and known[0] == size and known[1] == local_etag:
+            replication_status['skipped'] = replication_status.get('skipped', 0) + 1
+            return True
+
+        # Sem o tamanho original (gzip corrompido, zstd sem cabeçalho) o envio é chunked
+        headers = {'X-Vyrex-Mtime': str(st.st_mtime_ns)}
+        if size is not None:
+            headers['Content-Length'] = str(size)
+        source = (lambda: open_cold(cold)) if cold else (lambda: open(full_path, 'rb'))
+        status, _, _ = self.peer.request('PUT', self.peer.dav_url(rel), body=source, headers=headers)
+        if status == 409:
+            self.ensure_dir(posixpath.dirname(rel))
+            status, _, _ = self.peer.request('PUT', self.peer.dav_url(rel), body=source, headers=headers)
+        if status in (201, 204):
+            replication_status['sent_files'] = replication_status.get('sent_files', 0) + 1
+            replication_status['sent_bytes'] = replication_status.get('sent_bytes', 0) + (size or 0)
+            return True
+        self.failed('PUT', rel, status)
+        return False
+
+    def mirror_tree(self, rel):
+        """Envia uma pasta inteira, comparando com a listagem recursiva da réplica."""
+        status, _, data = self.peer.request(
+            'GET', f"{self.peer.base}/api/list?drive=DADOS&recursive=1&path={quote(rel)}")
+        remote = {}
+        if status == 200:
+            for line in data.splitlines():
+                path, is_dir, size, mtime_ns = json.loads(line)[:4]
+                remote[path] = (is_dir, size, mtime_ns)
+        elif rel:
+            self.ensure_dir(rel)
+
+        # Dos dois lados a comparação usa nomes e tamanhos lógicos (arquivos frios
+        # aparecem como o original), como na listagem da réplica
+        changed = []
+        stack = [('', self.local_path(rel))]
+        while stack:
+            sub, directory = stack.pop()
+            try:
+                entries = logical_entries(list_directory(directory))
+            except OSError:
+                continue
+            for entry in sorted(entries, key=lambda entry: entry['name']):
+                if entry['name'].startswith('.') or entry['is_link']:
+                    continue
+                child = f"{sub}/{entry['name']}" if sub else entry['name']
+                if entry['is_dir']:
+                    if not remote.get(child, (False,))[0]:
+                        self.ensure_dir(f"{rel}/{child}" if rel else child)
+                    stack.append((child, os.path.join(directory, entry['name'])))
+                elif remote.get(child) != (False, entry['size'], entry['mtime_ns']):
+                    changed.append(f"{rel}/{child}" if rel else child)
+        # A listagem já mostrou que diferem: dispensa o HEAD de cada um
+        list(self._pool.map(lambda path: self.guarded(self.put_file, path, (-1, '')), changed))
+
+def start_replication():
+    """Inicia o worker que envia as alterações do diário para a réplica configurada."""
+    os.makedirs(REPLICATION_FOLDER, exist_ok=True)
+    worker = ReplicationWorker(ReplicationPeer(REPLICATION_SETTINGS['peer'], REPLICATION_SETTINGS['insecure']))
+    threading.Thread(target=worker.run, name='replicacao', daemon=True).start()
+    return worker
+
+def replication_report():
+    report = dict(replication_status)
+    try:
+        report['journal_size'] = os.path.getsize(REPLICATION_JOURNAL)
+        report['pending_bytes'] = report['journal_size'] - report.get('offset', 0)
+    except OSError:
+        pass
+    return report
+
+# --- CONTROLE DE BANDA ---
+
+# Limites em bytes/s (0 = sem limite). Podem ser alterados em tempo real via /admin/bandwidth.
+BANDWIDTH_SETTINGS = {
+    'global_rate': 0,            # Soma de todas as transferências
+    'client_rate': 0,            # Por cliente (IP)
+    'interactive_reserve': 0.3,  # Fração da banda global liberada enquanto há navegação em andamento
+    'weights': {'download': 1.0, 'preview': 2.0, 'upload': 1.0},
+}
+
+# Endpoints de transferência pesada; todo o resto é tratado como interativo
+BULK_ENDPOINTS = {'download_file': 'download', 'preview_file': 'preview', 'upload_file': 'upload',
+                  'delta_signature_file': 'download', 'delta_patch': 'upload'}
+DAV_TRANSFER_KINDS = {'GET': 'download', 'PUT': 'upload'}
+THROTTLE_CHUNK = 64 * 1024
+THROTTLE_BURST = 0.25  # Segundos de crédito que uma transferência ociosa pode acumular
+
+def transfer_kind():
+    """Tipo de transferência pesada da requisição atual, ou None se for interativa."""
+    if request.endpoint == 'webdav':
+        return DAV_TRANSFER_KINDS.get(request.method)
+    return BULK_ENDPOINTS.get(request.endpoint)
+
+class _Transfer:
+    __slots__ = ('client', 'kind', 'weight', 'rate', 'next_time', 'bytes', 'started')
+
+    def __init__(self, client, kind, weight):
+        self.client = client
+        self.kind = kind
+        self.weight = weight
+        self.rate = 0
+        self.next_time = time.monotonic()
+        self.bytes = 0
+        self.started = time.time()
+
+class TransferScheduler:
+    """
+    Divide a banda entre as transferências ativas de forma justa e ponderada:
+    cada cliente tem seu teto (dividido entre as transferências dele) e a banda
+    global é distribuída por peso, repassando a sobra de quem já está no teto
+    (water-filling). Enquanto houver requisições interativas (listagens,
+    miniaturas) em andamento, as transferências usam só parte da banda global.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._transfers = []
+        self._interactive = 0
+
+    def update(self, **changes):
+        with self._lock:
+            for key, value in changes.items():
+                if key == 'weights':
+                    self.settings['weights'].update({k: float(v) for k, v in value.items()})
+                elif key in self.settings:
+                    self.settings[key] = float(value) if key == 'interactive_reserve' else int(value)
+            self._reallocate()
+
+    def register(self, client, kind):
+        transfer = _Transfer(client, kind, self.settings['weights'].get(kind, 1.0))
+        with self._lock:
+            self._transfers.append(transfer)
+            self._reallocate()
+        return transfer
+
+    def unregister(self, transfer):
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+                self._reallocate()
+
+    def begin_interactive(self):
+        with self._lock:
+            self._interactive += 1
+            if self._interactive == 1:
+                self._reallocate()
+
+    def end_interactive(self):
+        with self._lock:
+            self._interactive -= 1
+            if self._interactive == 0:
+                self._reallocate()
+
+    def interactive_busy(self):
+        """Há requisições interativas em andamento (tarefas de fundo devem recuar)."""
+        return self._interactive > 0
+
+    def _reallocate(self):
+        """Recalcula a taxa de cada transferência. Deve ser chamado com o lock."""
+        settings = self.settings
+        transfers = self._transfers
+
+        caps = {}
+        client_rate = settings['client_rate']
+        client_weights = {}
+        for t in transfers:
+            client_weights[t.client] = client_weights.get(t.client, 0) + t.weight
+        for t in transfers:
+            caps[t] = client_rate * t.weight / client_weights[t.client] if client_rate > 0 else float('inf')
+
+        remaining = settings['global_rate']
+        if remaining > 0 and self._interactive:
+            remaining *= 1 - settings['interactive_reserve']
+
+        if remaining <= 0:
+            for t in transfers:
+                t.rate = 0 if caps[t] == float('inf') else caps[t]
+            return
+
+        pending = list(transfers)
+        while pending:
+            weight_sum = sum(t.weight for t in pending)
+            capped = [t for t in pending if caps[t] <= remaining * t.weight / weight_sum]
+            if not capped:
+                for t in pending:
+                    t.rate = remaining * t.weight / weight_sum
+                break
+            for t in capped:
+                t.rate = caps[t]
+                remaining -= caps[t]
+                pending.remove(t)
+
+    def pace(self, transfer, nbytes):
+        """Espera o tempo necessário para enviar nbytes dentro da taxa da transferência."""
+        transfer.bytes += nbytes
+        rate = transfer.rate
+        if not rate:
+            return
+        now = time.monotonic()
+        transfer.next_time = max(transfer.next_time, now - THROTTLE_BURST) + nbytes / rate
+        delay = transfer.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self, iterable, client, kind):
+        """Envolve o corpo de uma resposta, entregando-o no ritmo do escalonador."""
+        transfer = None
+        try:
+            # Registra só ao começar a enviar: respostas nunca iteradas não ficam penduradas
+            transfer = self.register(client, kind)
+            for chunk in iterable:
+                view = memoryview(chunk)
+                for start in range(0, len(view), THROTTLE_CHUNK):
+                    piece = view[start:start + THROTTLE_CHUNK]
+                    self.pace(transfer, len(piece))
+                    yield bytes(piece)
+        finally:
+            if transfer is not None:
+                self.unregister(transfer)
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'settings': json.loads(json.dumps(self.settings)),
+                'interactive': self._interactive,
+                'transfers': [{
+                    'client': t.client,
+                    'kind': t.kind,
+                    'rate': round(t.rate),
+                    'bytes': t.bytes,
+                    'started': t.started,
+                } for t in self._transfers],
+            }
+
+class ThrottledInput:
+    """Envolve o wsgi.input de um upload para que ele também respeite o escalonador."""
+
+    def __init__(self, stream, scheduler, transfer):
+        self._stream = stream
+        self._scheduler = scheduler
+        self._transfer = transfer
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._scheduler.pace(self._transfer, len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        self._scheduler.pace(self._transfer, len(data))
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+transfer_scheduler = TransferScheduler(BANDWIDTH_SETTINGS)
+
+def require_local_admin():
+    """Rotas administrativas só respondem para a própria máquina do servidor."""
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+# --- CONTROLE DE ADMISSÃO ---
+
+# Limita quantas requisições pesadas rodam ao mesmo tempo, por classe. As que
+# passarem do limite esperam numa fila por até queue_timeout segundos; com a
+# fila cheia ou o tempo esgotado, a resposta é 503 com Retry-After, em vez de
+# o processo acumular trabalho até ficar sem memória. A vaga fica ocupada até o
+# fim do envio da resposta (downloads em streaming inclusive). Ajustável em
+# /admin/admission. Com vários processos (Gunicorn com -w N), as vagas ficam em
+# ADMISSION_DB e o limite vale para todos juntos; a fila e o orçamento de
+# memória continuam por processo.
+ADMISSION_SETTINGS = {
+    'limits': {'preview': 4, 'documento': 4, 'miniatura': 16, 'upload': 4, 'disco': 2, 'download': 16},
+    'queue_max': 32,                       # Requisições esperando por classe
+    'queue_timeout': 15.0,                 # Segundos na fila antes do 503
+    'memory_budget': 512 * 1024 * 1024,    # Bytes que os previews podem ocupar juntos
+}
+
+ADMISSION_ENDPOINTS = {
+    'preview_file': 'preview',
+    'preview_document': 'documento', 'preview_document_page': 'documento',
+    'rendition': 'miniatura', 'gallery_sprite': 'miniatura',
+    'video_poster': 'miniatura', 'video_sprite': 'miniatura',
+    'upload_file': 'upload', 'delta_patch': 'upload',
+    'download_file': 'download',
+    'delete': 'disco', 'trash_empty': 'disco', 'batch': 'disco', 'duplicates_resolve': 'disco',
+}
+DAV_ADMISSION = {'PUT': 'upload', 'DELETE': 'disco', 'COPY': 'disco', 'MOVE': 'disco'}
+# O /preview lê o arquivo inteiro e ainda monta o base64 e o JSON da resposta
+PREVIEW_MEMORY_FACTOR = 4
+RETRY_AFTER_MAX = 60
+ADMISSION_DB = os.path.join(STATE_FOLDER, 'admissao.db')
+# Vagas liberadas em outro processo não acordam quem espera: a fila confere o banco nesse intervalo
+ADMISSION_POLL_INTERVAL = 0.05
+
+def admission_class():
+    """Classe de admissão da requisição atual, ou None se ela não é limitada."""
+    if request.endpoint == 'webdav':
+        return DAV_ADMISSION.get(request.method)
+    return ADMISSION_ENDPOINTS.get(request.endpoint)
+
+class _AdmissionStats:
+    __slots__ = ('active', 'waiting', 'admitted', 'rejected', 'timed_out', 'wait_time', 'service_time', 'served')
+
+    def __init__(self):
+        self.active = self.waiting = 0
+        self.admitted = self.rejected = self.timed_out = self.served = 0
+        self.wait_time = self.service_time = 0.0
+
+def _admission_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS slots (
+        token TEXT PRIMARY KEY, kind TEXT NOT NULL, pid INTEGER NOT NULL, started REAL NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS slots_kind ON slots (kind)')
+
+# Vagas perdidas numa queda de energia não importam: quem as ocupava morreu junto
+_admission_connections = SQLitePool(lambda: ADMISSION_DB, _admission_schema, ('PRAGMA synchronous=OFF',),
+                                    timeout=5, isolation_level=None)
+
+class AdmissionController:
+    """
+    Vagas por classe de requisição e um orçamento global de memória, com fila
+    limitada. Um único Condition atende tudo: quem libera uma vaga ou memória
+    acorda os que esperam para conferirem de novo. Depois de share(), as vagas
+    são contadas em ADMISSION_DB, somando todos os processos.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._cond = threading.Condition()
+        self._stats = {}
+        self._memory_used = 0
+        self._memory_waiting = 0
+        self._memory_rejected = 0
+        self._shared = False
+
+    def _class_stats(self, kind):
+        stats = self._stats.get(kind)
+        if stats is None:
+            stats = self._stats[kind] = _AdmissionStats()
+        return stats
+
+    def update(self, **changes):
+        with self._cond:
+            for key, value in changes.items():
+                if key == 'limits':
+                    self.settings['limits'].update({k: max(1, int(v)) for k, v in value.items()})
+                elif key == 'queue_timeout':
+                    self.settings[key] = max(0.0, float(value))
+                elif key in self.settings:
+                    self.settings[key] = max(0, int(value))
+            self._cond.notify_all()
+
+    def share(self):
+        """Passa a contar as vagas em ADMISSION_DB, junto com os outros processos (Gunicorn com -w N)."""
+        with _admission_connections.connection() as conn:
+            # Vagas de um processo anterior que teve o mesmo pid
+            conn.execute('DELETE FROM slots WHERE pid = ?', (os.getpid(),))
+        self._shared = True
+
+    def _try_slot(self, kind, stats):
+        # Chamado com self._cond ocupado. Token da vaga, ou None se a classe está cheia
+        limit = self.settings['limits'].get(kind)
+        token = uuid.uuid4().hex
+        if limit is None:
+            return token
+        if not self._shared:
+            return token if stats.active < limit else None
+        try:
+            with _admission_connections.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                if conn.execute('SELECT count(*) FROM slots WHERE kind = ?', (kind,)).fetchone()[0] >= limit:
+                    # Cheia: descarta as vagas de processos que morreram e confere de novo
+                    dead = [(pid,) for (pid,) in conn.execute('SELECT DISTINCT pid FROM slots WHERE kind = ?', (kind,))
+                            if pid != os.getpid() and not psutil.pid_exists(pid)]
+                    conn.executemany('DELETE FROM slots WHERE pid = ?', dead)
+                    if not dead or conn.execute('SELECT count(*) FROM slots WHERE kind = ?',
+                                                (kind,)).fetchone()[0] >= limit:
+                        conn.execute('COMMIT')
+                        return None
+                conn.execute('INSERT INTO slots VALUES (?, ?, ?, ?)', (token, kind, os.getpid(), time.time()))
+                conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            print(f"Erro ao ocupar vaga compartilhada: {e}")
+            return token if stats.active < limit else None  # Só o limite deste processo
+        return token
+
+    def acquire(self, kind):
+        """
+        Ocupa uma vaga da classe, esperando na fila se preciso. Retorna o token
+        da vaga (para release), ou None para recusar com 503.
+        """
+        with self._cond:
+            stats = self._class_stats(kind)
+            token = self._try_slot(kind, stats)
+            if token is None:
+                if stats.waiting >= self.settings['queue_max']:
+                    stats.rejected += 1
+                    return None
+                stats.waiting += 1
+                start = time.monotonic()
+                deadline = start + self.settings['queue_timeout']
+                try:
+                    while token is None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(min(remaining, ADMISSION_POLL_INTERVAL) if self._shared else remaining)
+                        token = self._try_slot(kind, stats)
+                finally:
+                    stats.waiting -= 1
+                    stats.wait_time += time.monotonic() - start
+                if token is None:
+                    stats.timed_out += 1
+                    return None
+            stats.active += 1
+            stats.admitted += 1
+            return token
+
+    def release(self, kind, elapsed, token):
+        if self._shared:
+            try:
+                with _admission_connections.connection() as conn:
+                    conn.execute('DELETE FROM slots WHERE token = ?', (token,))
+            except sqlite3.Error as e:
+                print(f"Erro ao liberar vaga compartilhada: {e}")
+        with self._cond:
+            stats = self._class_stats(kind)
+            stats.active -= 1
+            stats.served += 1
+            stats.service_time += elapsed
+            self._cond.notify_all()
+
+    def reserve_memory(self, nbytes):
+        """Reserva nbytes do orçamento de memória, esperando até queue_timeout. False = recusar."""
+        budget = self.settings['memory_budget']
+        with self._cond:
+            if nbytes > budget or self._memory_waiting >= self.settings['queue_max']:
+                self._memory_rejected += 1
+                return False
+            self._memory_waiting += 1
+            try:
+                admitted = self._cond.wait_for(
+                    lambda: self._memory_used + nbytes <= self.settings['memory_budget'],
+                    timeout=self.settings['queue_timeout'])
+            finally:
+                self._memory_waiting -= 1
+            if not admitted:
+                self._memory_rejected += 1
+                return False
+            self._memory_used += nbytes
+            return True
+
+    def release_memory(self, nbytes):
+        with self._cond:
+            self._memory_used -= nbytes
+            self._cond.notify_all()
+
+    def retry_after(self, kind):
+        """Segundos sugeridos ao cliente: a fila atual dividida pelas vagas, no ritmo médio de atendimento."""
+        with self._cond:
+            stats = self._class_stats(kind)
+            limit = self.settings['limits'].get(kind, 1)
+            average = stats.service_time / stats.served if stats.served else 1.0
+            estimate = average * (stats.waiting + 1) / limit
+        return max(1, min(RETRY_AFTER_MAX, int(estimate + 0.999)))
+
+    def snapshot(self):
+        totals = {}
+        if self._shared:
+            try:
+                with _admission_connections.connection() as conn:
+                    totals = dict(conn.execute('SELECT kind, count(*) FROM slots GROUP BY kind'))
+            except sqlite3.Error as e:
+                print(f"Erro ao ler as vagas compartilhadas: {e}")
+        with self._cond:
+            classes = {}
+            for kind in sorted(set(self.settings['limits']) | set(self._stats)):
+                stats = self._class_stats(kind)
+                classes[kind] = {
+                    'limit': self.settings['limits'].get(kind),
+                    'active': stats.active,
+                    'active_all_processes': totals.get(kind, 0) if self._shared else stats.active,
+                    'queued': stats.waiting,
+                    'admitted': stats.admitted,
+                    'rejected': stats.rejected,
+                    'timed_out': stats.timed_out,
+                    'avg_wait_ms': round(stats.wait_time * 1000 / max(1, stats.admitted + stats.timed_out), 1),
+                    'avg_service_ms': round(stats.service_time * 1000 / stats.served, 1) if stats.served else None,
+                }
+            return {
+                'settings': json.loads(json.dumps(self.settings)),
+                'classes': classes,
+                'memory': {
+                    'budget': self.settings['memory_budget'],
+                    'used': self._memory_used,
+                    'queued': self._memory_waiting,
+                    'rejected': self._memory_rejected,
+                },
+            }
+
+admission_controller = AdmissionController(ADMISSION_SETTINGS)
+
+def overloaded_response(kind):
+    """503 com Retry-After; texto puro para clientes WebDAV, JSON para o resto."""
+    headers = {'Retry-After': str(admission_controller.retry_after(kind))}
+    message = 'Servidor ocupado, tente novamente em instantes'
+    if request.endpoint == 'webdav':
+        return message, 503, headers
+    return jsonify({'error': message}), 503, headers
+
+# --- SOMAS DE VERIFICAÇÃO ---
+
+# SHA-256 e BLAKE2b de cada arquivo, calculados numa única leitura por um pool de
+# baixa prioridade e guardados em SQLite por dispositivo+inode (sobrevivem a
+# renomear e mover); valem enquanto tamanho e mtime não mudarem. A verificação
+# periódica relê os arquivos já conhecidos para detectar bitrot nos discos.
+CHECKSUM_DB = os.path.join(STATE_FOLDER, 'checksums.db')
+CHECKSUM_WORKERS = 1
+CHECKSUM_READ_CHUNK = 1024 * 1024
+CHECKSUM_SCRUB_INTERVAL = 6 * 3600  # Segundos entre passadas da verificação periódica
+CHECKSUM_CORRUPT_LIST = 100         # Máximo de arquivos corrompidos listados em /admin/checksums
+# Podem ser alterados em tempo real via /admin/checksums
+CHECKSUM_SETTINGS = {
+    'rate': 32 * 1024 * 1024,        # Bytes/s lidos pelo pool de cálculo (0 = sem limite)
+    'scrub_rate': 16 * 1024 * 1024,  # Bytes/s lidos pela verificação periódica
+    'scrub_age_days': 30,            # Arquivos verificados há mais tempo que isso são relidos
+    'drives': ['DADOS'],             # Drives cobertos pela verificação periódica
+}
+IO_YIELD_STEP = 0.05   # Pausa das leituras de fundo enquanto há requisições interativas
+IO_YIELD_MAX = 2.0     # Espera máxima antes de seguir mesmo com navegação em andamento
+
+class ReadThrottle:
+    """
+    Limita a taxa de leitura de uma tarefa de fundo e a pausa enquanto há
+    navegação. rate pode ser um número ou uma função (lida a cada bloco).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def consume(self, nbytes):
+        waited = 0.0
+        while transfer_scheduler.interactive_busy() and waited < IO_YIELD_MAX:
+            time.sleep(IO_YIELD_STEP)
+            waited += IO_YIELD_STEP
+        rate = self.rate() if callable(self.rate) else self.rate
+        with self._lock:
+            self.bytes += nbytes
+            if not rate:
+                return
+            now = time.monotonic()
+            self._next_time = max(self._next_time, now - THROTTLE_BURST) + nbytes / rate
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self, f, size):
+        data = f.read(size)
+        self.consume(len(data))
+        return data
+
+def _lower_thread_priority():
+    """Inicializador do pool: no Linux a prioridade (nice) vale por thread."""
+    if sys.platform.startswith('linux'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except OSError:
+            pass
+
+_checksum_pool = ThreadPoolExecutor(max_workers=CHECKSUM_WORKERS, thread_name_prefix='checksums',
+                                    initializer=_lower_thread_priority)
+_checksum_pending = set()
+_checksum_pending_lock = threading.Lock()
+_checksum_throttle = ReadThrottle(lambda: CHECKSUM_SETTINGS['rate'])
+_scrub_lock = threading.Lock()
+scrub_status = {'state': 'idle'}
+
+def _checksum_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS checksums (
+        dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+        sha256 TEXT, blake2b TEXT, path TEXT, computed_at REAL,
+        verified_at REAL, corrupt INTEGER DEFAULT 0,
+        PRIMARY KEY (dev, ino))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS checksums_path ON checksums(path)')
+    conn.commit()
+
+_checksum_connections = SQLitePool(lambda: CHECKSUM_DB, _checksum_schema, ('PRAGMA synchronous=NORMAL',),
+                                   timeout=30)
+
+def checksum_db():
+    """Conexão do pool, para usar num bloco with."""
+    return _checksum_connections.connection()
+
+def read_checksums(full_path, throttle):
+    """
+    Lê o arquivo uma vez calculando SHA-256 e BLAKE2b. Retorna (sha256, blake2b, stat)
+    ou None se o arquivo foi alterado durante a leitura.
+    """
+    before = os.stat(full_path)
+    sha256 = hashlib.sha256()
+    blake2b = hashlib.blake2b()
+    with open(full_path, 'rb') as f:
+        while True:
+            chunk = throttle.read(f, CHECKSUM_READ_CHUNK)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            blake2b.update(chunk)
+    after = os.stat(full_path)
+    if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+        return None
+    return sha256.hexdigest(), blake2b.hexdigest(), before
+
+def _checksum_row(st):
+    with checksum_db() as conn:
+        row = conn.execute(
+            'SELECT size, mtime_ns, sha256, blake2b, corrupt FROM checksums WHERE dev = ? AND ino = ?',
+            (st.st_dev, st.st_ino)).fetchone()
+    if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+        return None
+    return {'sha256': row[2], 'blake2b': row[3], 'corrupt': bool(row[4])}
+
+def store_checksums(full_path, throttle=None):
+    """Somas do arquivo, do cache ou calculadas e gravadas agora. None se ele mudou durante a leitura."""
+    known = _checksum_row(os.stat(full_path))
+    if known is not None:
+        return known
+    result = read_checksums(full_path, throttle or _checksum_throttle)
+    if result is None:
+        return None
+    sha256, blake2b, st = result
+    now = time.time()
+    with checksum_db() as conn:
+        conn.execute(
+            '''INSERT OR REPLACE INTO checksums (dev, ino, size, mtime_ns, sha256, blake2b, path,
+                                                 computed_at, verified_at, corrupt)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)''',
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, sha256, blake2b, full_path, now, now))
+        conn.commit()
+    return {'sha256': sha256, 'blake2b': blake2b, 'corrupt': False}
+
+def _checksum_job(full_path):
+    try:
+        store_checksums(full_path)
+    except Exception as e:
+        print(f"Erro ao calcular somas de {full_path}: {e}")
+    finally:
+        with _checksum_pending_lock:
+            _checksum_pending.discard(full_path)
+
+def schedule_checksums(full_paths):
+    """Enfileira o cálculo no pool de baixa prioridade, sem duplicar arquivos já na fila."""
+    with _checksum_pending_lock:
+        for full_path in full_paths:
+            if full_path not in _checksum_pending:
+                _checksum_pending.add(full_path)
+                _checksum_pool.submit(_checksum_job, full_path)
+
+def file_checksums(full_path, st=None):
+    """Somas já conhecidas do arquivo, ou None (e o cálculo vai para a fila)."""
+    known = _checksum_row(st or os.stat(full_path))
+    if known is None:
+        schedule_checksums([full_path])
+    return known
+
+def checksum_headers(checksums):
+    """Cabeçalhos de integridade de um download (RFC 9530 e o antigo RFC 3230)."""
+    if checksums['corrupt']:
+        # A soma guardada é a do conteúdo original, não a do que está no disco
+        return {'X-Vyrex-Integrity': 'corrompido'}
+    encoded = b64encode(bytes.fromhex(checksums['sha256'])).decode('ascii')
+    return {'Repr-Digest': f'sha-256=:{encoded}:', 'Digest': f'SHA-256={encoded}'}
+
+def scrub_tree(root, throttle):
+    """
+    Percorre um drive calculando as somas que faltam e relendo as que passaram do
+    prazo. Conteúdo diferente com tamanho e mtime iguais é marcado como corrompido.
+    """
+    with checksum_db() as conn:
+        max_age = CHECKSUM_SETTINGS['scrub_age_days'] * 86400
+        root_dev = os.stat(root).st_dev
+        seen = set()
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    # os.stat em vez de entry.stat(): no Windows só ele traz o inode
+                    st = os.stat(entry.path, follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        if st.st_dev == root_dev:
+                            stack.append(entry.path)
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                    row = conn.execute(
+                        'SELECT size, mtime_ns, sha256, verified_at FROM checksums WHERE dev = ? AND ino = ?',
+                        (st.st_dev, st.st_ino)).fetchone()
+                    if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+                        # Arquivo novo ou alterado normalmente: só registra as somas
+                        store_checksums(entry.path, throttle)
+                        scrub_status['hashed'] += 1
+                    elif time.time() - row[3] >= max_age:
+                        result = read_checksums(entry.path, throttle)
+                        if result is None:
+                            continue
+                        corrupt = result[0] != row[2]
+                        if corrupt:
+                            print(f"Bitrot detectado: {entry.path} não confere com a soma registrada")
+                            scrub_status['corrupt'] += 1
+                        conn.execute('UPDATE checksums SET verified_at = ?, corrupt = ?, path = ? WHERE dev = ? AND ino = ?',
+                                     (time.time(), int(corrupt), entry.path, st.st_dev, st.st_ino))
+                        conn.commit()
+                        scrub_status['verified'] += 1
+                except OSError as e:
+                    print(f"Erro ao verificar {entry.path}: {e}")
+            scrub_status['bytes_read'] = throttle.bytes
+
+        # Remove as somas de arquivos que não existem mais neste drive
+        prefix = root.rstrip(os.sep) + os.sep
+        stale = [(dev, ino) for dev, ino in conn.execute(
+            'SELECT dev, ino FROM checksums WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+            if (dev, ino) not in seen]
+        conn.executemany('DELETE FROM checksums WHERE dev = ? AND ino = ?', stale)
+        conn.commit()
+
+def run_scrub():
+    """Uma passada da verificação sobre os drives configurados. False se já houver uma em andamento."""
+    if not _scrub_lock.acquire(blocking=False):
+        return False
+    try:
+        throttle = ReadThrottle(lambda: CHECKSUM_SETTINGS['scrub_rate'])
+        scrub_status.clear()
+        scrub_status.update(state='running', started_at=time.time(), hashed=0, verified=0,
+                            corrupt=0, bytes_read=0)
+        for raw_drive in list(CHECKSUM_SETTINGS['drives']):
+            root = resolve_drive(raw_drive)
+            if root is None:
+                continue
+            scrub_status['drive'] = raw_drive
+            scrub_tree(root, throttle)
+        scrub_status.update(state='done', finished_at=time.time())
+    except Exception as e:
+        print(f"Erro na verificação de integridade: {e}")
+        scrub_status.update(state='error', error=str(e), finished_at=time.time())
+    finally:
+        _scrub_lock.release()
+    return True
+
+def checksum_report():
+    with checksum_db() as conn:
+        total, corrupt = conn.execute('SELECT COUNT(*), COALESCE(SUM(corrupt), 0) FROM checksums').fetchone()
+        corrupt_files = [{'path': path, 'size': size, 'verified_at': verified_at}
+                         for path, size, verified_at in conn.execute(
+                             'SELECT path, size, verified_at FROM checksums WHERE corrupt = 1 ORDER BY verified_at DESC LIMIT ?',
+                             (CHECKSUM_CORRUPT_LIST,))]
+    with _checksum_pending_lock:
+        pending = len(_checksum_pending)
+    return {'files': total, 'corrupt': corrupt, 'corrupt_files': corrupt_files,
+            'pending': pending, 'scrub': dict(scrub_status)}
+
+def checksum_scrubber_loop():
+    while True:
+        run_scrub()
+        time.sleep(CHECKSUM_SCRUB_INTERVAL)
+
+# --- ARQUIVOS DUPLICADOS ---
+
+# Busca em etapas: agrupa por tamanho, compara o começo e o fim dos arquivos
+# empatados e só lê por inteiro os que continuam empatados (usando o cache de
+# somas de verificação). Toda leitura passa pelo ReadThrottle.
+DUPLICATE_MIN_SIZE = 1024 * 1024         # Arquivos menores não entram na busca
+DUPLICATE_EDGE_BYTES = 64 * 1024         # Trecho lido do começo e do fim na segunda etapa
+DUPLICATE_WORKERS = 2
+DUPLICATE_READ_RATE = 64 * 1024 * 1024   # Bytes/s lidos do disco pela busca (0 = sem limite)
+DUPLICATE_REPORT_FILE = os.path.join(STATE_FOLDER, 'duplicados.json')
+DUPLICATE_ACTIONS = ('hardlink', 'delete')
+
+def hash_file_edges(full_path, size, throttle):
+    """Hash do começo e do fim do arquivo (o arquivo inteiro, se for pequeno)."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(full_path, 'rb') as f:
+        digest.update(throttle.read(f, DUPLICATE_EDGE_BYTES))
+        if size > DUPLICATE_EDGE_BYTES:
+            f.seek(max(size - DUPLICATE_EDGE_BYTES, DUPLICATE_EDGE_BYTES))
+            digest.update(throttle.read(f, DUPLICATE_EDGE_BYTES))
+    return digest.hexdigest()
+
+class DuplicateScanner:
+    """
+    Varredura de duplicados em segundo plano sobre DADOS e os drives. Cada
+    arquivo físico (dispositivo+inode) entra uma vez só: hardlinks já existentes
+    aparecem em 'links' e não contam como cópia.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.status = {'state': 'idle'}
+        self.groups = []
+        self._loaded = False
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            try:
+                with open(DUPLICATE_REPORT_FILE, encoding='utf-8') as f:
+                    saved = json.load(f)
+                self.status = saved['status']
+                self.groups = saved['groups']
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def save(self):
+        with self._lock:
+            data = {'status': self.status, 'groups': self.groups}
+        try:
+            _write_json_atomic(DUPLICATE_REPORT_FILE, data)
+        except OSError as e:
+            print(f"Erro ao salvar relatório de duplicados: {e}")
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, drives, min_size=DUPLICATE_MIN_SIZE):
+        """Inicia uma varredura; retorna False se já houver uma em andamento."""
+        self.load()
+        with self._lock:
+            if self.running():
+                return False
+            self.status = {'state': 'running', 'phase': 'listando', 'drives': list(drives),
+                           'min_size': min_size, 'files': 0, 'candidates': 0, 'checked': 0,
+                           'bytes_read': 0, 'started_at': time.time()}
+            self._thread = threading.Thread(target=self._run, args=(list(drives), min_size),
+                                            name='duplicados', daemon=True)
+            self._thread.start()
+        return True
+
+    def _run(self, drives, min_size):
+        throttle = ReadThrottle(DUPLICATE_READ_RATE)
+        try:
+            by_size = self._collect(drives, min_size)
+            groups = [files for files in by_size.values() if len(files) > 1]
+            groups = self._split(groups, 'comparando trechos', throttle,
+                                 lambda r: hash_file_edges(r['full_path'], r['size'], throttle))
+            # Arquivos pequenos já foram lidos por inteiro na etapa anterior
+            small = [files for files in groups if files[0]['size'] <= 2 * DUPLICATE_EDGE_BYTES]
+            large = [files for files in groups if files[0]['size'] > 2 * DUPLICATE_EDGE_BYTES]
+            # Conteúdo completo pelo cache de somas: buscas repetidas não releem o disco
+            groups = small + self._split(large, 'comparando conteúdo', throttle,
+                                         lambda r: (store_checksums(r['full_path'], throttle) or {}).get('blake2b'))
+
+            report = [{
+                'size': files[0]['size'],
+                'hash': files[0]['hash'],
+                'wasted': files[0]['size'] * (len(files) - 1),
+                'files': files,
+            } for files in groups]
+            report.sort(key=lambda group: -group['wasted'])
+            with self._lock:
+                self.groups = report
+                self.status.update(state='done', phase=None, finished_at=time.time(),
+                                   bytes_read=throttle.bytes)
+        except Exception as e:
+            print(f"Erro na busca de duplicados: {e}")
+            with self._lock:
+                self.status.update(state='error', error=str(e), finished_at=time.time())
+        self.save()
+
+    def _collect(self, drives, min_size):
+        """Primeira etapa: agrupa os arquivos por tamanho, sem ler conteúdo."""
+        roots = {}
+        for raw_drive in drives:
+            root = resolve_drive(raw_drive)
+            if root is not None:
+                roots.setdefault(root, raw_drive)
+
+        by_size = {}
+        seen = {}
+        for root, raw_drive in roots.items():
+            # Drives dentro de outros drives são percorridos uma vez só, pela própria raiz
+            nested = {other for other in roots if other != root and _is_within(root, other)}
+            try:
+                root_dev = os.stat(root).st_dev
+            except OSError:
+                continue
+            stack = [root]
+            while stack:
+                directory = stack.pop()
+                try:
+                    with os.scandir(directory) as it:
+                        entries = list(it)
+                except OSError:
+                    continue
+                for entry in entries:
+                    # Ignora a lixeira, o estado do servidor e pastas ocultas
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        # Não atravessa pontos de montagem (/proc, outros discos)
+                        if st.st_dev == root_dev and entry.path not in nested:
+                            stack.append(entry.path)
+                        continue
+                    if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+                        continue
+                    rel_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                    known = seen.get((st.st_dev, st.st_ino))
+                    if known is not None:
+                        known['links'].append({'drive': raw_drive, 'path': rel_path})
+                        continue
+                    record = {'drive': raw_drive, 'path': rel_path, 'full_path': entry.path,
+                              'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                              'dev': st.st_dev, 'ino': st.st_ino, 'links': []}
+                    seen[(st.st_dev, st.st_ino)] = record
+                    by_size.setdefault(st.st_size, []).append(record)
+                with self._lock:
+                    self.status['files'] = len(seen)
+        return by_size
+
+    def _split(self, groups, phase, throttle, key):
+        """Subdivide os grupos pela chave calculada no pool, descartando os que sobram sozinhos."""
+        records = [record for files in groups for record in files]
+        with self._lock:
+            self.status.update(phase=phase, candidates=len(records), checked=0)
+
+        def compute(record):
+            try:
+                record['hash'] = key(record)
+            except OSError as e:
+                print(f"Erro ao ler {record['full_path']}: {e}")
+                record['hash'] = None
+            with self._lock:
+                self.status['checked'] += 1
+                self.status['bytes_read'] = throttle.bytes
+
+        with ThreadPoolExecutor(max_workers=DUPLICATE_WORKERS, thread_name_prefix='duplicados') as pool:
+            list(pool.map(compute, records))
+
+        result = []
+        for files in groups:
+            by_hash = {}
+            for record in files:
+                if record['hash'] is not None:
+                    by_hash.setdefault(record['hash'], []).append(record)
+            result.extend(same for same in by_hash.values() if len(same) > 1)
+        return result
+
+    def report(self, limit=None):
+        self.load()
+        with self._lock:
+            groups = self.groups[:limit] if limit else list(self.groups)
+            return {
+                'status': dict(self.status),
+                'total_groups': len(self.groups),
+                'wasted': sum(group['wasted'] for group in self.groups),
+                'groups': [{
+                    'size': group['size'],
+                    'hash': group['hash'],
+                    'wasted': group['wasted'],
+                    'files': [{k: record[k] for k in ('drive', 'path', 'mtime_ns', 'links')}
+                              for record in group['files']],
+                } for group in groups],
+            }
+
+    def _find(self, group_hash, ref):
+        for group in self.groups:
+            if group['hash'] == group_hash:
+                for record in group['files']:
+                    if record['drive'] == ref.get('drive') and record['path'] == ref.get('path'):
+                        return group, record
+                return group, None
+        return None, None
+
+    def resolve(self, group_hash, keep_ref, remove_refs, action):
+        """
+        Remove cópias de um grupo: 'delete' manda para a lixeira, 'hardlink' troca
+        cada cópia por um hardlink do arquivo mantido. Retorna o resultado por item.
+        """
+        self.load()
+        if action not in DUPLICATE_ACTIONS:
+            raise ValueError('Ação inválida')
+        if self.running():
+            raise ValueError('Aguarde o fim da busca em andamento')
+        with self._lock:
+            group, keep = self._find(group_hash, keep_ref)
+        if keep is None:
+            raise ValueError('Grupo não encontrado; faça uma nova busca')
+        keep_full = self._current_path(keep)
+
+        results = []
+        touched = []
+        for ref in remove_refs:
+            outcome = {'drive': ref.get('drive'), 'path': ref.get('path'), 'success': False}
+            results.append(outcome)
+            try:
+                with self._lock:
+                    _, record = self._find(group_hash, ref)
+                if record is None or record is keep:
+                    raise ValueError('Arquivo não pertence a este grupo')
+                full_path = self._current_path(record)
+                if action == 'delete':
+                    drive_root = drive_root_or_abort(record['drive'])
+                    move_to_trash(drive_root, full_path, record['path'])
+                    journal_change(drive_root, 'delete', record['path'])
+                else:
+                    if os.stat(full_path).st_dev != os.stat(keep_full).st_dev:
+                        raise ValueError('Os arquivos estão em discos diferentes; use apagar')
+                    tmp_path = f"{full_path}.{uuid.uuid4().hex[:8]}.tmp"
+                    os.link(keep_full, tmp_path)
+                    quota_tracker.removed(full_path)
+                    try:
+                        os.replace(tmp_path, full_path)
+                    except OSError:
+                        os.remove(tmp_path)
+                        raise
+                    finally:
+                        quota_tracker.added(full_path)
+                    journal_change(drive_root_or_abort(record['drive']), 'put', record['path'])
+                touched.append(full_path)
+                with self._lock:
+                    group['files'].remove(record)
+                    if action == 'hardlink':
+                        keep['links'].append({'drive': record['drive'], 'path': record['path']})
+                outcome['success'] = True
+            except (OSError, ValueError) as e:
+                outcome['error'] = str(e)
+
+        with self._lock:
+            group['wasted'] = group['size'] * (len(group['files']) - 1)
+            if len(group['files']) < 2:
+                self.groups.remove(group)
+        if touched:
+            forget_resolved_paths(*touched)
+        self.save()
+        return results
+
+    @staticmethod
+    def _current_path(record):
+        """Caminho do arquivo, conferindo que ele não mudou desde a varredura."""
+        full_path = resolve_path(drive_root_or_abort(record['drive']), record['path'])
+        st = os.stat(full_path, follow_symlinks=False)
+        if (st.st_size, st.st_mtime_ns, st.st_ino) != (record['size'], record['mtime_ns'], record['ino']):
+            raise ValueError(f"{record['path']} mudou desde a busca; faça uma nova busca")
+        return full_path
+
+duplicate_scanner = DuplicateScanner()
+
+# --- ARMAZENAMENTO FRIO ---
+
+# Arquivos não acessados há COLD_STORAGE_SETTINGS['days'] dias são comprimidos no
+# lugar (nome.txt -> nome.txt.vyrex.zst, ou .vyrex.gz sem o zstandard) por um pool
+# de baixa prioridade. A interface continua mostrando o nome e o tamanho originais,
+# downloads e previews descomprimem em streaming e qualquer gravação devolve o
+# arquivo ao formato normal. O último acesso vem de ACCESS_DB, gravado pelas rotas
+# de leitura: o atime não serve, já que as tarefas de fundo (somas de verificação,
+# duplicados, metadados) também leem os arquivos.
+COLD_SUFFIXES = ('.vyrex.zst', '.vyrex.gz')
+COLD_MIN_SIZE = 64 * 1024            # Arquivos menores não compensam
+COLD_GZIP_MAX_SIZE = 4 * 1024 ** 3   # O gzip guarda o tamanho original em 32 bits
+COLD_SAMPLE_BYTES = 256 * 1024       # Trecho comprimido para testar se vale a pena
+COLD_MIN_SAVING = 0.2                # Economia mínima no trecho de teste
+COLD_CHUNK = 1024 * 1024
+COLD_ZSTD_LEVEL = 10
+COLD_GZIP_LEVEL = 6
+COLD_SCAN_INTERVAL = 24 * 3600       # Segundos entre passadas
+COLD_PATH_LOCKS = 64                 # Travas por caminho (distribuídas pelo hash do nome)
+COLD_PATH_LOCKS_FOLDER = os.path.join(STATE_FOLDER, 'travas')
+COLD_ACCESS_STEP = 24 * 3600         # Um acesso só é regravado se o anterior for mais velho que isso
+ACCESS_DB = os.path.join(STATE_FOLDER, 'acessos.db')
+# Podem ser alterados em tempo real via /admin/cold-storage
+COLD_STORAGE_SETTINGS = {
+    'days': 0,                       # Dias sem acesso até comprimir (0 = desativado)
+    'extensions': ['txt', 'log', 'csv', 'xml', 'json', 'sql', 'doc', 'xls', 'bmp'],
+    'rate': 16 * 1024 * 1024,        # Bytes/s lidos pelo pool (0 = sem limite)
+    'drives': ['DADOS'],
+}
+
+_cold_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='armazenamento-frio',
+                                initializer=_lower_thread_priority)
+_cold_lock = threading.Lock()
+cold_status = {'state': 'idle'}
+
+class _PathLock:
+    """
+    Trava reentrante entre threads que, onde há fcntl, também vale entre
+    processos: a aquisição mais externa de cada thread faz flock num arquivo
+    de COLD_PATH_LOCKS_FOLDER (a compressão roda num processo, os uploads em
+    qualquer um).
+    """
+
+    def __init__(self, index):
+        self._index = index
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        self._depth += 1
+        if self._depth == 1 and fcntl is not None:
+            try:
+                if self._file is None:
+                    os.makedirs(COLD_PATH_LOCKS_FOLDER, exist_ok=True)
+                    self._file = open(os.path.join(COLD_PATH_LOCKS_FOLDER, f'{self._index}.lock'), 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except OSError as e:
+                # Sem o arquivo, a trava ainda vale entre as threads deste processo
+                print(f"Erro ao travar {COLD_PATH_LOCKS_FOLDER}: {e}")
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and self._file is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+        finally:
+            self._rlock.release()
+
+_path_locks = [_PathLock(index) for index in range(COLD_PATH_LOCKS)]
+
+def path_lock(full_path):
+    """
+    Trava do nome lógico (a mesma para nome.txt e nome.txt.vyrex.zst). Quem grava
+    um arquivo (upload, PUT, patch delta) a segura durante a troca do conteúdo, e
+    a compressão durante a conferência final e a remoção do original.
+    """
+    logical = cold_logical_name(full_path) or full_path
+    # crc32, e não hash(): a faixa precisa ser a mesma em todos os processos
+    return _path_locks[zlib.crc32(logical.encode('utf-8', 'surrogateescape')) % COLD_PATH_LOCKS]
+
+def _access_schema(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS access (path TEXT PRIMARY KEY, at REAL NOT NULL)')
+
+_access_connections = SQLitePool(lambda: ACCESS_DB, _access_schema, ('PRAGMA synchronous=NORMAL',),
+                                 timeout=30, isolation_level=None)
+
+def access_db():
+    """Conexão do pool, para usar num bloco with."""
+    return _access_connections.connection()
+
+def cold_suffix(name):
+    """Sufixo de armazenamento frio do nome ('' se for um arquivo normal)."""
+    for suffix in COLD_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return ''
+
+def cold_logical_name(name):
+    """Nome original de um arquivo frio (ou None se não for um)."""
+    suffix = cold_suffix(name)
+    return name[:-len(suffix)] if suffix else None
+
+def cold_copy(full_path):
+    """Cópia comprimida de um arquivo que não existe mais na forma normal (ou None)."""
+    if os.path.lexists(full_path):
+        return None
+    for suffix in COLD_SUFFIXES:
+        if os.path.isfile(full_path + suffix):
+            return full_path + suffix
+    return None
+
+def cold_twins(full_path):
+    """Outros itens com o mesmo nome lógico (a versão normal e as comprimidas)."""
+    logical = full_path[:-len(cold_suffix(full_path))] if cold_suffix(full_path) else full_path
+    return [path for path in [logical] + [logical + suffix for suffix in COLD_SUFFIXES]
+            if path != full_path and os.path.lexists(path)]
+
+def drop_cold_copies(full_path):
+    """Apaga as cópias comprimidas de um arquivo que acabou de ser gravado na forma normal."""
+    for suffix in COLD_SUFFIXES:
+        if os.path.isfile(full_path + suffix):
+            quota_tracker.removed(full_path + suffix)
+            os.remove(full_path + suffix)
+
+def cold_logical_size(cold_path):
+    """Tamanho original guardado no arquivo comprimido (None se não der para saber)."""
+    try:
+        with open(cold_path, 'rb') as f:
+            if cold_path.endswith('.vyrex.gz'):
+                f.seek(-4, os.SEEK_END)
+                return struct.unpack('<I', f.read(4))[0]
+            if zstandard is not None:
+                size = zstandard.frame_content_size(f.read(18))
+                return size if size >= 0 else None
+    except Exception:  # Arquivo truncado ou cabeçalho inválido
+        pass
+    return None
+
+def open_cold(cold_path):
+    """Abre um arquivo frio para leitura já descomprimida, em streaming."""
+    if cold_path.endswith('.vyrex.gz'):
+        return gzip.open(cold_path, 'rb')
+    if zstandard is None:
+        raise RuntimeError('Instale o zstandard (pip install zstandard) para ler arquivos .vyrex.zst')
+    return zstandard.ZstdDecompressor().stream_reader(open(cold_path, 'rb'), closefd=True)
+
+def logical_entries(entries):
+    """
+    Entradas de list_directory com os arquivos frios sob o nome e o tamanho
+    originais. Se a versão normal também existir, ela prevalece.
+    """
+    names = {entry['name'] for entry in entries if 'logical_size' not in entry}
+    result = []
+    for entry in entries:
+        if 'logical_size' in entry:
+            name = cold_logical_name(entry['name'])
+            if name in names:
+                continue
+            names.add(name)
+            size = entry['size'] if entry['logical_size'] is None else entry['logical_size']
+            entry = dict(entry, name=name, size=size, cold=True)
+        result.append(entry)
+    return result
+
+def send_cold_file(cold_path, as_attachment=True):
+    """Resposta com um arquivo frio descomprimido em streaming (sem Range)."""
+    st = os.stat(cold_path)
+    name = os.path.basename(cold_logical_name(cold_path))
+    size = cold_logical_size(cold_path)
+    etag = dav_etag({'mtime_ns': st.st_mtime_ns, 'size': st.st_size if size is None else size})
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    source = open_cold(cold_path)
+    mime, headers = download_headers(name, as_attachment)
+    response = app.response_class(FileWrapper(source, COLD_CHUNK),
+                                  mimetype=mime, direct_passthrough=True)
+    if size is not None:
+        response.headers['Content-Length'] = str(size)
+    response.headers['Accept-Ranges'] = 'none'
+    response.headers.update(headers)
+    response.set_etag(etag)
+    response.last_modified = st.st_mtime
+    return response
+
+def note_access(full_path):
+    """
+    Registra em ACCESS_DB que um arquivo foi lido pela interface ou pelo WebDAV,
+    para que ele não esfrie. Só grava uma vez por COLD_ACCESS_STEP. Grava mesmo
+    com o armazenamento frio desligado: ao ligá-lo, o histórico já existe.
+    """
+    now = time.time()
+    try:
+        with access_db() as conn:
+            conn.execute('''INSERT INTO access VALUES (?, ?)
+                            ON CONFLICT (path) DO UPDATE SET at = excluded.at WHERE at < ?''',
+                         (full_path, now, now - COLD_ACCESS_STEP))
+    except sqlite3.Error as e:
+        print(f"Erro ao registrar acesso a {full_path}: {e}")
+
+def move_access(old_path, new_path):
+    """Leva o histórico de acesso de um arquivo ou pasta renomeado/movido para o novo caminho."""
+    old_path = cold_logical_name(old_path) or old_path
+    new_path = cold_logical_name(new_path) or new_path
+    prefix = old_path.rstrip(os.sep) + os.sep
+    try:
+        with access_db() as conn:
+            conn.execute('''UPDATE OR REPLACE access SET path = ? || substr(path, ?)
+                            WHERE path = ? OR substr(path, 1, ?) = ?''',
+                         (new_path, len(old_path) + 1, old_path, len(prefix), prefix))
+    except sqlite3.Error as e:
+        print(f"Erro ao mover acessos de {old_path}: {e}")
+
+def last_access(full_path):
+    """Último acesso registrado por note_access (0 se nunca foi lido)."""
+    with access_db() as conn:
+        row = conn.execute('SELECT at FROM access WHERE path = ?', (full_path,)).fetchone()
+    return row[0] if row else 0
+
+def rehydrate(cold_path):
+    """Devolve um arquivo frio à forma normal (antes de gravar nele). Retorna o caminho normal."""
+    full_path = cold_path[:-len(cold_suffix(cold_path))]
+    parent = os.path.dirname(full_path)
+    with path_lock(cold_path):
+        if not os.path.isfile(cold_path):
+            return full_path
+        st = os.stat(cold_path)
+        temp_path = os.path.join(parent, f'.{os.path.basename(full_path)}.{uuid.uuid4().hex[:8]}.parcial')
+        try:
+            with open_cold(cold_path) as src, open(temp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COLD_CHUNK)
+            shutil.copymode(cold_path, temp_path)
+            os.utime(temp_path, ns=(time.time_ns(), st.st_mtime_ns))
+            os.replace(temp_path, full_path)
+        except BaseException:
+            _remove_path(temp_path)
+            raise
+        quota_tracker.removed(cold_path)
+        os.remove(cold_path)
+        quota_tracker.added(full_path)
+    # O conteúdo lógico não mudou: nada a enviar para a réplica
+    forget_listing(parent)
+    return full_path
+
+def compress_cold_file(full_path, st, throttle):
+    """
+    Comprime um arquivo frio no lugar. Retorna os bytes liberados (0 se o
+    arquivo não comprime bem ou mudou durante a compressão).
+    """
+    parent = os.path.dirname(full_path)
+    suffix = '.vyrex.zst' if zstandard is not None else '.vyrex.gz'
+    target = full_path + suffix
+    temp_path = os.path.join(parent, f'.{os.path.basename(target)}.{uuid.uuid4().hex[:8]}.parcial')
+
+    with open(full_path, 'rb') as src:
+        sample = throttle.read(src, COLD_SAMPLE_BYTES)
+        if len(zlib.compress(sample, 1)) > len(sample) * (1 - COLD_MIN_SAVING):
+            return 0
+        src.seek(0)
+        try:
+            with open(temp_path, 'wb') as raw:
+                if zstandard is not None:
+                    writer = zstandard.ZstdCompressor(level=COLD_ZSTD_LEVEL).stream_writer(
+                        raw, size=st.st_size, closefd=False)
+                else:
+                    writer = gzip.GzipFile(os.path.basename(full_path), 'wb', COLD_GZIP_LEVEL, raw,
+                                           mtime=int(st.st_mtime))
+                with writer:
+                    for chunk in iter(lambda: throttle.read(src, COLD_CHUNK), b''):
+                        writer.write(chunk)
+                raw.flush()
+                os.fsync(raw.fileno())
+
+            # Com a trava, nenhum upload/PUT/patch troca o arquivo entre a
+            # conferência e a remoção do original
+            with path_lock(full_path):
+                current = os.stat(full_path)
+                if (current.st_ino, current.st_size, current.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns) \
+                        or os.path.lexists(target):
+                    _remove_path(temp_path)
+                    return 0
+                shutil.copymode(full_path, temp_path)
+                os.utime(temp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.replace(temp_path, target)
+                quota_tracker.removed(full_path)
+                os.remove(full_path)
+                quota_tracker.added(target)
+        except BaseException:
+            _remove_path(temp_path)
+            raise
+
+    forget_listing(parent)
+    return st.st_size - os.path.getsize(target)
+
+def scan_cold_tree(root, cutoff, throttle):
+    """Percorre um drive comprimindo os arquivos sem acesso desde cutoff."""
+    extensions = {ext.lower().lstrip('.') for ext in COLD_STORAGE_SETTINGS['extensions']}
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d != TRASH_DIRNAME and not d.startswith('.')]
+        names = set(files)
+        for name in files:
+            if name.startswith('.') or cold_suffix(name) or '.' not in name \
+                    or name.rsplit('.', 1)[-1].lower() not in extensions \
+                    or any(name + suffix in names for suffix in COLD_SUFFIXES):
+                continue
+            full_path = os.path.join(directory, name)
+            try:
+                st = os.lstat(full_path)
+                # Hardlinks (ex: duplicados unidos) perderiam o compartilhamento
+                if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1 or st.st_size < COLD_MIN_SIZE \
+                        or st.st_mtime >= cutoff or last_access(full_path) >= cutoff:
+                    continue
+                if zstandard is None and st.st_size >= COLD_GZIP_MAX_SIZE:
+                    continue
+                saved = compress_cold_file(full_path, st, throttle)
+            except OSError as e:
+                print(f"Erro ao comprimir {full_path}: {e}")
+                continue
+            if saved:
+                cold_status['compressed'] += 1
+                cold_status['saved'] += saved
+            cold_status['bytes_read'] = throttle.bytes
+
+    # Remove os acessos de arquivos que não existem mais neste drive
+    prefix = root.rstrip(os.sep) + os.sep
+    with access_db() as conn:
+        stale = [(path,) for (path,) in conn.execute(
+            'SELECT path FROM access WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+            if not os.path.exists(path) and cold_copy(path) is None]
+        conn.executemany('DELETE FROM access WHERE path = ?', stale)
+
+def run_cold_storage():
+    """Uma passada do armazenamento frio. False se já houver uma em andamento."""
+    if not _cold_lock.acquire(blocking=False):
+        return False
+    try:
+        days = COLD_STORAGE_SETTINGS['days']
+        if not days:
+            return True
+        throttle = ReadThrottle(lambda: COLD_STORAGE_SETTINGS['rate'])
+        cold_status.clear()
+        cold_status.update(state='running', started_at=time.time(), compressed=0, saved=0, bytes_read=0)
+        for raw_drive in list(COLD_STORAGE_SETTINGS['drives']):
+            root = resolve_drive(raw_drive)
+            if root is None:
+                continue
+            cold_status['drive'] = raw_drive
+            scan_cold_tree(root, time.time() - days * 86400, throttle)
+        cold_status.update(state='done', finished_at=time.time())
+    except Exception as e:
+        print(f"Erro no armazenamento frio: {e}")
+        cold_status.update(state='error', error=str(e), finished_at=time.time())
+    finally:
+        _cold_lock.release()
+    return True
+
+def cold_storage_loop():
+    while True:
+        _cold_pool.submit(run_cold_storage).result()
+        time.sleep(COLD_SCAN_INTERVAL)
+
+# --- PERFIL DE REQUISIÇÕES ---
+
+# Perfis de requisições lentas, exportados no formato "collapsed" (flamegraph.pl,
+# inferno) e no JSON do speedscope (https://www.speedscope.app)
+PROFILE_FOLDER = os.path.join(STATE_FOLDER, 'perfis')
+PROFILE_SETTINGS = {
+    'sample_rate': 0.0,  # Fração das requisições perfiladas automaticamente (0 = só sob demanda)
+    'interval': 0.005,   # Segundos entre amostras da pilha
+}
+PROFILE_MAX_FILES = 200
+PROFILE_HEADER = 'X-Vyrex-Profile'
+
+class StackSampler:
+    """
+    Amostrador de pilha para uma única thread: uma thread auxiliar lê o frame
+    atual da thread alvo em intervalos fixos. O custo fica restrito à requisição
+    perfilada, sem o overhead de rastrear cada chamada como o cProfile.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = []
+        self.started = time.perf_counter()
+        self.finished = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='perfil', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.finished = time.perf_counter()
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append((tuple(stack), now - last))
+            last = now
+
+def _frame_label(frame):
+    name, filename, line = frame
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(';', ':')
+
+def write_profile(sampler, name):
+    """Grava o perfil em .folded e .speedscope.json. Retorna o nome base."""
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+
+    collapsed = {}
+    for stack, _ in sampler.samples:
+        key = ';'.join(_frame_label(f) for f in stack)
+        collapsed[key] = collapsed.get(key, 0) + 1
+    with open(os.path.join(PROFILE_FOLDER, name + '.folded'), 'w', encoding='utf-8') as f:
+        for key, count in sorted(collapsed.items()):
+            f.write(f"{key} {count}\n")
+
+    frames = []
+    frame_index = {}
+    samples = []
+    for stack, _ in sampler.samples:
+        indexes = []
+        for frame in stack:
+            if frame not in frame_index:
+                frame_index[frame] = len(frames)
+                frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+            indexes.append(frame_index[frame])
+        samples.append(indexes)
+
+    duration = sampler.finished - sampler.started
+    speedscope = {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'vyrex-box',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': duration,
+            'samples': samples,
+            'weights': [weight for _, weight in sampler.samples],
+        }],
+    }
+    with open(os.path.join(PROFILE_FOLDER, name + '.speedscope.json'), 'w', encoding='utf-8') as f:
+        json.dump(speedscope, f)
+
+    prune_profiles()
+    return name
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_FOLDER):
+        return []
+    names = {n.split('.', 1)[0] for n in os.listdir(PROFILE_FOLDER)}
+    return sorted(names, reverse=True)
+
+def prune_profiles():
+    for name in list_profiles()[PROFILE_MAX_FILES:]:
+        for ext in ('.folded', '.speedscope.json'):
+            try:
+                os.remove(os.path.join(PROFILE_FOLDER, name + ext))
+            except OSError:
+                pass
+
+def profiling_requested():
+    """Perfila quando pedido pelo cabeçalho/parâmetro _profile ou pela amostragem aleatória."""
+    if request.headers.get(PROFILE_HEADER) == '1' or request.args.get('_profile') == '1':
+        return True
+    rate = PROFILE_SETTINGS['sample_rate']
+    return rate > 0 and random.random() < rate
+
+# --- TEMPLATE HTML ---
+
+HTML_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Gerenciamento Local - {{ current_path if current_path else 'Raiz' }}</title>
+    <link rel="manifest" href="/manifest.webmanifest">
+    <link rel="icon" href="/icon.svg" type="image/svg+xml">
+    <meta name="theme-color" content="#0061ff">
+    <style>
+        :root {
+            --bg-color: #1a1a1a;
+            --text-color: #ffffff;
+            --secondary-text: #a0a0a0;
+            --accent-color: #0061ff;
+            --card-bg: #2a2a2a;
+            --border-color: #404040;
+            --hover-bg: #3a3a3a;
+        }
+        
+        body.light {
+            --bg-color: #f0f4f8;
+            --text-color: #1e293b;
+            --secondary-text: #64748b;
+            --accent-color: #0061ff;
+            --card-bg: #ffffff;
+            --border-color: #e2e8f0;
+            --hover-bg: #f8fafc;
+        }
+        
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
+            background: var(--bg-color);
+            color: var(--text-color);
             min-height: 100vh;
             padding: 20px;
         }
         
-        .container {
-            max-width: 1400px;
-            margin: 0 auto;
-            background: var(--card-bg);
-            border-radius: 16px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            overflow: hidden;
+        .container {
+            max-width: 1400px;
+            margin: 0 auto;
+            background: var(--card-bg);
+            border-radius: 16px;
+            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
+            overflow: hidden;
+        }
+        
+        .header {
+            background: linear-gradient(135deg, #0061ff 0%, #004aad 100%);
+            color: white;
+            padding: 20px;
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            flex-wrap: wrap;
+            gap: 10px;
+        }
+        
+        .header h1 {
+            font-size: 24px;
+            font-weight: 600;
+        }
+        
+        .header-controls {
+            display: flex;
+            gap: 10px;
+            align-items: center;
+        }
+        
+        .storage-card {
+            background: rgba(255,255,255,0.15);
+            backdrop-filter: blur(10px);
+            border-radius: 12px;
+            padding: 15px;
+            min-width: 250px;
+        }
+        
+        .storage-title {
+            font-size: 13px;
+            opacity: 0.9;
+            margin-bottom: 8px;
+        }
+        
+        .storage-bar {
+            background: rgba(255,255,255,0.2);
+            border-radius: 8px;
+            height: 10px;
+            overflow: hidden;
+            margin-bottom: 8px;
+        }
+        
+        .storage-fill {
+            background: linear-gradient(90deg, #4ade80 0%, #22c55e 100%);
+            height: 100%;
+            transition: width 0.3s ease;
+            border-radius: 8px;
+        }
+        
+        .storage-fill.warning { background: linear-gradient(90deg, #fbbf24 0%, #f59e0b 100%); }
+        .storage-fill.danger { background: linear-gradient(90deg, #f87171 0%, #ef4444 100%); }
+        
+        .storage-info {
+            display: flex;
+            justify-content: space-between;
+            font-size: 12px;
+            opacity: 0.9;
+        }
+        
+        .breadcrumb {
+            padding: 15px 20px;
+            background: var(--hover-bg);
+            border-bottom: 1px solid var(--border-color);
+            display: flex;
+            align-items: center;
+            gap: 8px;
+            flex-wrap: wrap;
+        }
+        
+        .breadcrumb a, .breadcrumb button {
+            color: var(--accent-color);
+            text-decoration: none;
+            padding: 6px 12px;
+            border-radius: 6px;
+            transition: background 0.2s;
+            background: transparent;
+            border: 1px solid var(--border-color);
+            cursor: pointer;
+            font-size: 14px;
+        }
+        
+        .breadcrumb a:hover, .breadcrumb button:hover {
+            background: var(--border-color);
+        }
+        
+        .breadcrumb span {
+            color: var(--secondary-text);
+        }
+        
+        .toolbar {
+            padding: 15px 20px;
+            background: var(--card-bg);
+            border-bottom: 1px solid var(--border-color);
+            display: flex;
+            gap: 8px;
+            flex-wrap: wrap;
+        }
+        
+        .btn {
+            padding: 8px 16px;
+            border: none;
+            border-radius: 8px;
+            font-size: 13px;
+            font-weight: 500;
+            cursor: pointer;
+            transition: all 0.2s;
+            display: inline-flex;
+            align-items: center;
+            gap: 6px;
+        }
+        
+        .btn-primary {
+            background: var(--accent-color);
+            color: white;
+        }
+        
+        .btn-primary:hover {
+            background: #0052d9;
+            transform: translateY(-1px);
+            box-shadow: 0 4px 12px rgba(0,97,255,0.3);
+        }
+        
+        .btn-secondary {
+            background: var(--hover-bg);
+            color: var(--text-color);
+            border: 1px solid var(--border-color);
+        }
+        
+        .btn-secondary:hover {
+            background: var(--border-color);
+        }
+        
+        .btn-danger {
+            background: #ef4444;
+            color: white;
+        }
+        
+        .btn-danger:hover {
+            background: #dc2626;
+        }
+        
+        input[type="text"], input[type="file"], select {
+            padding: 8px 12px;
+            border: 2px solid var(--border-color);
+            border-radius: 8px;
+            font-size: 13px;
+            transition: border 0.2s;
+            background: var(--card-bg);
+            color: var(--text-color);
+        }
+        
+        input[type="text"]:focus, select:focus {
+            outline: none;
+            border-color: var(--accent-color);
+        }
+        
+        select {
+            cursor: pointer;
+        }
+        
+        .drop-zone {
+            margin: 15px 20px;
+            padding: 30px;
+            border: 3px dashed var(--border-color);
+            border-radius: 12px;
+            text-align: center;
+            background: var(--hover-bg);
+            transition: all 0.3s;
+            cursor: pointer;
+        }
+        
+        .drop-zone.dragover {
+            border-color: var(--accent-color);
+            background: var(--border-color);
+            transform: scale(1.02);
+        }
+        
+        .drop-zone-text {
+            color: var(--secondary-text);
+            font-size: 14px;
+            margin-top: 8px;
+        }
+        
+        .app-notice {
+            display: none;
+            margin-bottom: 12px;
+            padding: 10px 14px;
+            border-radius: 8px;
+            background: var(--card-bg);
+            border: 1px solid var(--accent-color);
+            cursor: pointer;
+            font-size: 14px;
+        }
+        
+        .upload-progress {
+            display: none;
+            margin: 15px 20px;
+            padding: 15px;
+            background: var(--hover-bg);
+            border-radius: 12px;
+        }
+        
+        .progress-bar-container {
+            background: var(--border-color);
+            border-radius: 8px;
+            height: 6px;
+            overflow: hidden;
+            margin: 8px 0;
+        }
+        
+        .progress-bar {
+            background: linear-gradient(90deg, var(--accent-color) 0%, #004aad 100%);
+            height: 100%;
+            width: 0%;
+            transition: width 0.3s;
+        }
+        
+        .progress-info {
+            display: flex;
+            justify-content: space-between;
+            color: var(--secondary-text);
+            font-size: 12px;
+            margin-top: 6px;
+        }
+        
+        .file-list {
+            padding: 0 20px 20px;
+        }
+        
+        .file-table {
+            width: 100%;
+            border-collapse: collapse;
+        }
+        
+        .file-table th {
+            text-align: left;
+            padding: 10px;
+            background: var(--hover-bg);
+            color: var(--text-color);
+            font-weight: 600;
+            font-size: 12px;
+            text-transform: uppercase;
+            letter-spacing: 0.5px;
+        }
+        
+        .file-table td {
+            padding: 12px 10px;
+            border-bottom: 1px solid var(--border-color);
+        }
+        
+        .file-table tr:hover {
+            background: var(--hover-bg);
+        }
+        
+        .file-name {
+            display: flex;
+            align-items: center;
+            gap: 10px;
+            color: var(--text-color);
+            text-decoration: none;
+            font-weight: 500;
+            cursor: pointer;
+        }
+        
+        .file-name:hover {
+            color: var(--accent-color);
+        }
+        
+        .file-icon {
+            font-size: 20px;
+        }
+        
+        .file-icon.video-poster {
+            display: inline-block;
+            width: 64px;
+            height: 36px;
+            border-radius: 4px;
+            background-color: #000;
+            background-size: cover;
+            background-position: center;
+            flex-shrink: 0;
+        }
+        
+        .taken-at {
+            font-size: 11px;
+            color: var(--secondary-text);
+        }
+        
+        .file-actions {
+            display: flex;
+            gap: 6px;
+            flex-wrap: wrap;
+        }
+        
+        .action-btn {
+            padding: 4px 10px;
+            border: 1px solid var(--border-color);
+            border-radius: 6px;
+            background: var(--card-bg);
+            color: var(--secondary-text);
+            font-size: 11px;
+            cursor: pointer;
+            transition: all 0.2s;
+            text-decoration: none;
+            display: inline-block;
+        }
+        
+        .action-btn:hover {
+            border-color: var(--accent-color);
+            color: var(--accent-color);
+        }
+        
+        .checkbox {
+            width: 16px;
+            height: 16px;
+            cursor: pointer;
+        }
+        
+        .empty-state {
+            text-align: center;
+            padding: 50px 15px;
+            color: var(--secondary-text);
+        }
+        
+        .empty-state-icon {
+            font-size: 48px;
+            margin-bottom: 12px;
+        }
+        
+        .modal {
+            display: none;
+            position: fixed;
+            top: 0;
+            left: 0;
+            width: 100%;
+            height: 100%;
+            background: rgba(0,0,0,0.7);
+            z-index: 1000;
+            align-items: center;
+            justify-content: center;
+            padding: 20px;
+        }
+        
+        .modal.active {
+            display: flex;
+        }
+        
+        .tree-sidebar {
+            position: fixed;
+            top: 0;
+            left: 0;
+            bottom: 0;
+            width: 300px;
+            max-width: 85vw;
+            background: var(--card-bg);
+            border-right: 1px solid var(--border-color);
+            box-shadow: 2px 0 12px rgba(0,0,0,0.3);
+            padding: 20px 15px;
+            overflow: auto;
+            z-index: 900;
+            transform: translateX(-105%);
+            transition: transform 0.2s;
+        }
+        
+        .tree-sidebar.open {
+            transform: none;
+        }
+        
+        .tree-sidebar-header {
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            font-weight: 600;
+            margin-bottom: 10px;
+        }
+        
+        .folder-tree ul {
+            list-style: none;
+            margin: 0;
+            padding-left: 16px;
+        }
+        
+        .folder-tree > ul {
+            padding-left: 0;
+        }
+        
+        .folder-tree li:not(.open) > ul {
+            display: none;
+        }
+        
+        .folder-tree li {
+            white-space: nowrap;
+        }
+        
+        .tree-toggle {
+            display: inline-block;
+            width: 18px;
+            cursor: pointer;
+            color: var(--secondary-text);
+        }
+        
+        .tree-label {
+            cursor: pointer;
+            padding: 2px 6px;
+            border-radius: 4px;
+        }
+        
+        .tree-label:hover {
+            background: var(--hover-bg);
+        }
+        
+        .folder-tree li.current > .tree-label,
+        .folder-tree li.selected > .tree-label {
+            background: var(--accent-color);
+            color: #fff;
+        }
+        
+        .move-tree {
+            max-height: 300px;
+            overflow: auto;
+            border: 1px solid var(--border-color);
+            border-radius: 8px;
+            padding: 8px;
+            margin-bottom: 15px;
+        }
+        
+        .modal-content {
+            background: var(--card-bg);
+            border-radius: 12px;
+            padding: 25px;
+            max-width: 500px;
+            width: 100%;
+            color: var(--text-color);
+            max-height: 90vh;
+            overflow: auto;
+        }
+        
+        .modal-header {
+            font-size: 18px;
+            font-weight: 600;
+            margin-bottom: 15px;
+        }
+        
+        .preview-modal .modal-content {
+            max-width: 90%;
+        }
+        
+        .duplicates-modal .modal-content {
+            max-width: 800px;
+        }
+        
+        .duplicate-group {
+            border: 1px solid var(--border-color);
+            border-radius: 8px;
+            padding: 12px;
+            margin-bottom: 12px;
+        }
+        
+        .duplicate-title {
+            font-weight: 600;
+            margin-bottom: 8px;
+        }
+        
+        .duplicate-file {
+            display: block;
+            font-size: 14px;
+            padding: 3px 0;
+            word-break: break-all;
+        }
+        
+        .duplicate-actions {
+            display: flex;
+            gap: 8px;
+            justify-content: flex-end;
+            margin-top: 8px;
+        }
+        
+        .preview-content {
+            max-width: 100%;
+            max-height: 70vh;
+            object-fit: contain;
+        }
+        
+        .preview-text {
+            max-height: 70vh;
+            overflow: auto;
+            white-space: pre-wrap;
+            word-break: break-word;
+            font-family: Consolas, 'Courier New', monospace;
+            font-size: 13px;
+            background: var(--hover-bg);
+            padding: 15px;
+            border-radius: 8px;
+        }
+        
+        @media (max-width: 768px) {
+            .header { flex-direction: column; }
+            .header-controls { flex-direction: column; width: 100%; }
+            .storage-card { width: 100%; }
+            .toolbar { flex-direction: column; }
+            .file-table { font-size: 12px; }
+            .file-table th, .file-table td { padding: 8px 4px; }
+        }
+    </style>
+</head>
+<body class="dark">
+    <aside class="tree-sidebar" id="tree-sidebar">
+        <div class="tree-sidebar-header">
+            <span>🌳 Pastas</span>
+            <button class="btn btn-secondary" onclick="toggleTreeSidebar()">✕</button>
+        </div>
+        <div class="folder-tree" id="sidebar-tree"></div>
+    </aside>
+    
+    <div class="container">
+        <div class="header">
+            <h1>📦 Vyrex Local</h1>
+            <div class="header-controls">
+                <select id="drive-select" onchange="changeDrive(this.value)">
+                    {% for drive in drives %}
+                        <option value="{{ drive }}" {% if current_drive_for_url == drive %}selected{% endif %}>💾 {{ drive }}</option>
+                    {% endfor %}
+                    <option value="DADOS" {% if current_drive_for_url == 'DADOS' %}selected{% endif %}>📁 DADOS (Local)</option>
+                </select>
+                <button class="btn btn-secondary" onclick="toggleTheme()">🌙/☀️</button>
+            </div>
+            <div class="storage-card">
+                <div class="storage-title">💾 {{ current_drive_for_url }}</div>
+                <div class="storage-bar">
+                    <div class="storage-fill {% if usage_percent > 90 %}danger{% elif usage_percent > 70 %}warning{% endif %}" 
+                         style="width: {{ usage_percent }}%"></div>
+                </div>
+                <div class="storage-info">
+                    <span>{{ "%.2f"|format(used_gb) }} GB</span>
+                    <span>{{ "%.2f"|format(free_gb) }} GB livre</span>
+                </div>
+            </div>
+        </div>
+        
+        <div class="breadcrumb">
+            <a href="{{ url_for('index', drive=current_drive_for_url) }}">🏠 Raiz</a>
+            {% if current_path %}
+                {% set parts = current_path.split('/') %}
+                {% for i in range(parts|length) %}
+                    {% if parts[i] %}
+                        <span>›</span>
+                        {% set path = '/'.join(parts[:i+1]) %}
+                        <a href="{{ url_for('index', drive=current_drive_for_url, path=path) }}">{{ parts[i] }}</a>
+                    {% endif %}
+                {% endfor %}
+            {% endif %}
+        </div>
+        
+        <div class="toolbar">
+            <button class="btn btn-secondary" onclick="toggleTreeSidebar()">
+                🌳 Pastas
+            </button>
+            
+            {% if not in_archive %}
+            <button class="btn btn-primary" onclick="document.getElementById('file-input').click()">
+                📤 Upload
+            </button>
+            {% endif %}
+            <input type="file" id="file-input" multiple style="display: none;">
+            
+            {% if not in_archive %}
+            <button class="btn btn-secondary" onclick="showCreateFolder()">
+                📁 Nova Pasta
+            </button>
+            {% endif %}
+            
+            <button class="btn btn-secondary" onclick="downloadSelected()">
+                ⬇️ Baixar
+            </button>
+            
+            {% if not in_archive %}
+            <button class="btn btn-danger" onclick="deleteSelected()">
+                🗑️ Apagar
+            </button>
+            
+            <button class="btn btn-secondary" onclick="showMoveModal()">
+                📋 Mover
+            </button>
+            {% endif %}
+            
+            <button class="btn btn-secondary" onclick="showTrash()">
+                ♻️ Lixeira
+            </button>
+            
+            <button class="btn btn-secondary" onclick="openGallery()">
+                🖼️ Galeria
+            </button>
+            
+            <button class="btn btn-secondary" onclick="showDuplicates()">
+                🧬 Duplicados
+            </button>
+            
+            <select id="sort-select" onchange="changeSort(this.value)">
+                <option value="name" {% if sort == 'name' %}selected{% endif %}>🔤 Nome</option>
+                <option value="mtime" {% if sort == 'mtime' %}selected{% endif %}>🕒 Modificação</option>
+                <option value="capture" {% if sort == 'capture' %}selected{% endif %}>📷 Data de captura</option>
+            </select>
+        </div>
+        
+        <div class="drop-zone" id="drop-zone" {% if in_archive %}style="display: none;"{% endif %}>
+            <div style="font-size: 40px;">📤</div>
+            <div class="drop-zone-text">Arraste arquivos aqui ou clique em Upload</div>
+        </div>
+        
+        <div class="app-notice" id="app-notice" onclick="location.reload()"></div>
+        <div class="app-notice" id="queue-notice"></div>
+        
+        <div class="upload-progress" id="upload-progress">
+            <div style="font-weight: 600; margin-bottom: 8px;">Enviando...</div>
+            <div class="progress-bar-container">
+                <div class="progress-bar" id="progress-bar"></div>
+            </div>
+            <div class="progress-info">
+                <span id="progress-percent">0%</span>
+                <span id="progress-speed">0 KB/s</span>
+            </div>
+        </div>
+        
+        <div class="file-list">
+            {% if items %}
+            <table class="file-table">
+                <thead>
+                    <tr>
+                        <th style="width: 40px;">
+                            <input type="checkbox" class="checkbox" id="select-all">
+                        </th>
+                        <th>Nome</th>
+                        <th style="width: 100px;">Tamanho</th>
+                        <th style="width: 140px;">Modificado</th>
+                        <th style="width: 180px;">Ações</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {% for item in items %}
+                    <tr>
+                        <td>
+                            <input type="checkbox" class="checkbox item-checkbox" value="{{ item.path }}">
+                        </td>
+                        <td>
+                            {% if item.is_dir or item.is_archive %}
+                                <a href="{{ url_for('index', drive=current_drive_for_url, path=item.path) }}" class="file-name">
+                                    <span class="file-icon">{{ item.icon }}</span>
+                                    <span>{{ item.name }}</span>
+                                </a>
+                            {% else %}
+                                <div class="file-name" onclick="previewFile('{{ item.path }}', {{ item.is_image|lower }}, {{ item.is_video|lower }}, {{ item.is_document|lower }})">
+                                    {% if item.is_video and not in_archive %}
+                                    <span class="file-icon" data-video="{{ item.path }}">{{ item.icon }}</span>
+                                    {% else %}
+                                    <span class="file-icon">{{ item.icon }}</span>
+                                    {% endif %}
+                                    <span>{{ item.name }}</span>
+                                </div>
+                            {% endif %}
+                        </td>
+                        <td>{{ item.size_str }}</td>
+                        <td>
+                            {{ item.mtime }}
+                            {% if item.taken_str %}<div class="taken-at" title="Data de captura">📷 {{ item.taken_str }}</div>{% endif %}
+                        </td>
+                        <td>
+                            <div class="file-actions">
+                                {% if not in_archive %}
+                                <button class="action-btn" onclick="renameItem('{{ item.path }}', '{{ item.name }}')">
+                                    ✏️
+                                </button>
+                                {% endif %}
+                                {% if not item.is_dir %}
+                                    <a href="{{ url_for('download_file', filename=item.path, drive=current_drive_for_url) }}" class="action-btn" download>
+                                        ⬇️
+                                    </a>
+                                {% endif %}
+                            </div>
+                        </td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
+            {% else %}
+            <div class="empty-state">
+                <div class="empty-state-icon">📭</div>
+                <div style="font-size: 16px; margin-bottom: 8px;">Pasta vazia</div>
+                <div>Faça upload de arquivos ou crie pastas</div>
+            </div>
+            {% endif %}
+        </div>
+    </div>
+    
+    <!-- Modal Nova Pasta -->
+    <div class="modal" id="folder-modal">
+        <div class="modal-content">
+            <div class="modal-header">📁 Nova Pasta</div>
+            <form id="folder-form" onsubmit="createFolder(event)">
+                <input type="text" id="folder-name" placeholder="Nome da pasta" style="width: 100%; margin-bottom: 20px;" required>
+                <div style="display: flex; gap: 10px; justify-content: flex-end;">
+                    <button type="button" class="btn btn-secondary" onclick="closeModal('folder-modal')">Cancelar</button>
+                    <button type="submit" class="btn btn-primary">Criar</button>
+                </div>
+            </form>
+        </div>
+    </div>
+    
+    <!-- Modal Mover -->
+    <div class="modal" id="move-modal">
+        <div class="modal-content">
+            <div class="modal-header">📋 Mover Itens</div>
+            <form id="move-form" onsubmit="moveItems(event)">
+                <div class="folder-tree move-tree" id="move-tree"></div>
+                <input type="text" id="target-folder" placeholder="Pasta destino (escolha acima ou digite, ex: docs/2024)" style="width: 100%; margin-bottom: 20px;" required>
+                <div style="display: flex; gap: 10px; justify-content: flex-end;">
+                    <button type="button" class="btn btn-secondary" onclick="closeModal('move-modal')">Cancelar</button>
+                    <button type="submit" class="btn btn-primary">Mover</button>
+                </div>
+            </form>
+        </div>
+    </div>
+    
+    <!-- Modal Lixeira -->
+    <div class="modal" id="trash-modal">
+        <div class="modal-content">
+            <div class="modal-header">♻️ Lixeira</div>
+            <div id="trash-container"></div>
+            <div style="display: flex; gap: 10px; justify-content: flex-end; margin-top: 20px;">
+                <button type="button" class="btn btn-danger" onclick="emptyTrash()">Esvaziar</button>
+                <button type="button" class="btn btn-primary" onclick="restoreSelected()">Restaurar</button>
+                <button type="button" class="btn btn-secondary" onclick="closeModal('trash-modal')">Fechar</button>
+            </div>
+        </div>
+    </div>
+    
+    <!-- Modal Duplicados -->
+    <div class="modal duplicates-modal" id="duplicates-modal">
+        <div class="modal-content">
+            <div class="modal-header">🧬 Arquivos Duplicados</div>
+            <p id="duplicates-status"></p>
+            <div id="duplicates-container"></div>
+            <div style="display: flex; gap: 10px; justify-content: flex-end; margin-top: 20px;">
+                <button type="button" class="btn btn-primary" onclick="startDuplicateScan()">Procurar</button>
+                <button type="button" class="btn btn-secondary" onclick="closeDuplicates()">Fechar</button>
+            </div>
+        </div>
+    </div>
+    
+    <!-- Modal Preview -->
+    <div class="modal preview-modal" id="preview-modal">
+        <div class="modal-content">
+            <div class="modal-header">Visualização</div>
+            <div id="preview-container"></div>
+            <div style="display: flex; justify-content: flex-end; margin-top: 20px;">
+                <button type="button" class="btn btn-secondary" onclick="closeModal('preview-modal')">Fechar</button>
+            </div>
+        </div>
+    </div>
+    
+    <script>
+        const currentPath = '{{ current_path }}';
+        const currentDrive = '{{ current_drive_for_url }}';
+        const inArchive = {{ 'true' if in_archive else 'false' }};
+        const videoFrames = {{ video_frames }};
+        
+        // Tema
+        const savedTheme = localStorage.getItem('theme') || 'dark';
+        document.body.className = savedTheme;
+        
+        function toggleTheme() {
+            const newTheme = document.body.className === 'dark' ? 'light' : 'dark';
+            document.body.className = newTheme;
+            localStorage.setItem('theme', newTheme);
+        }
+        
+        function changeDrive(drive) {
+            window.location.href = '/?drive=' + encodeURIComponent(drive);
+        }
+        
+        function openGallery() {
+            window.location.href = '/gallery?drive=' + encodeURIComponent(currentDrive) + '&path=' + encodeURIComponent(currentPath);
+        }
+        
+        function changeSort(sort) {
+            const params = new URLSearchParams(window.location.search);
+            params.set('sort', sort);
+            window.location.search = params.toString();
+        }
+        
+        // Select All
+        document.getElementById('select-all').addEventListener('change', function() {
+            document.querySelectorAll('.item-checkbox').forEach(cb => cb.checked = this.checked);
+        });
+        
+        // Drag and Drop
+        const dropZone = document.getElementById('drop-zone');
+        
+        ['dragenter', 'dragover', 'dragleave', 'drop'].forEach(eventName => {
+            dropZone.addEventListener(eventName, e => {
+                e.preventDefault();
+                e.stopPropagation();
+            });
+        });
+        
+        ['dragenter', 'dragover'].forEach(eventName => {
+            dropZone.addEventListener(eventName, () => dropZone.classList.add('dragover'));
+        });
+        
+        ['dragleave', 'drop'].forEach(eventName => {
+            dropZone.addEventListener(eventName, () => dropZone.classList.remove('dragover'));
+        });
+        
+        dropZone.addEventListener('drop', e => uploadFiles(e.dataTransfer.files));
+        dropZone.addEventListener('click', () => document.getElementById('file-input').click());
+        
+        document.getElementById('file-input').addEventListener('change', function() {
+            uploadFiles(this.files);
+        });
+        
+        // Upload
+        function uploadFiles(files) {
+            if (!files || files.length === 0 || inArchive) return;
+            if (!navigator.onLine && queueUploads(files)) return;
+            
+            const progressDiv = document.getElementById('upload-progress');
+            const progressBar = document.getElementById('progress-bar');
+            const progressPercent = document.getElementById('progress-percent');
+            const progressSpeed = document.getElementById('progress-speed');
+            
+            progressDiv.style.display = 'block';
+            
+            const formData = new FormData();
+            Array.from(files).forEach(file => formData.append('files[]', file));
+            
+            const startTime = Date.now();
+            const xhr = new XMLHttpRequest();
+            
+            xhr.upload.addEventListener('progress', e => {
+                if (e.lengthComputable) {
+                    const percent = (e.loaded / e.total) * 100;
+                    progressBar.style.width = percent + '%';
+                    progressPercent.textContent = Math.round(percent) + '%';
+                    
+                    const elapsed = (Date.now() - startTime) / 1000;
+                    const speed = e.loaded / elapsed;
+                    progressSpeed.textContent = formatSize(speed) + '/s';
+                }
+            });
+            
+            xhr.addEventListener('load', () => {
+                if (xhr.status === 200) {
+                    setTimeout(refreshListing, 500);
+                } else if (xhr.status === 507) {
+                    alert(JSON.parse(xhr.responseText).error);
+                    progressDiv.style.display = 'none';
+                } else {
+                    alert('Erro no upload!');
+                    progressDiv.style.display = 'none';
+                }
+            });
+            
+            xhr.addEventListener('error', () => {
+                progressDiv.style.display = 'none';
+                // Sem rede: com o service worker ativo, os arquivos esperam na fila
+                if (!queueUploads(files)) alert('Erro na conexão!');
+            });
+            
+            // Drive e pasta na URL: o servidor confere a cota antes de receber os arquivos
+            xhr.open('POST', '/upload?drive=' + encodeURIComponent(currentDrive) + '&path=' + encodeURIComponent(currentPath));
+            xhr.send(formData);
+        }
+        
+        function formatSize(bytes) {
+            const units = ['B', 'KB', 'MB', 'GB'];
+            let i = 0;
+            while (bytes >= 1024 && i < units.length - 1) {
+                bytes /= 1024;
+                i++;
+            }
+            return bytes.toFixed(2) + ' ' + units[i];
+        }
+        
+        // Preview
+        function previewFile(path, isImage, isVideo, isDocument) {
+            if (!isImage && !isVideo && !isDocument) return;
+            
+            const container = document.getElementById('preview-container');
+            container.innerHTML = '<p>Carregando...</p>';
+            
+            if (inArchive) {
+                previewArchiveMember(path, isImage, isVideo, container);
+                return;
+            }
+            
+            if (isDocument) {
+                previewDocument(path, container);
+                return;
+            }
+            
+            if (isImage) {
+                // Pede uma versão do tamanho da tela em vez do arquivo original
+                const width = Math.round(Math.min(window.innerWidth, 2560) * (window.devicePixelRatio || 1));
+                const img = new Image();
+                img.className = 'preview-content';
+                img.alt = 'Preview';
+                img.onload = () => {
+                    container.innerHTML = '';
+                    container.appendChild(img);
+                };
+                img.onerror = () => {
+                    alert('Erro ao carregar a imagem');
+                    container.innerHTML = '';
+                };
+                img.src = '/rendition?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive) + '&w=' + width;
+                document.getElementById('preview-modal').classList.add('active');
+                return;
+            }
+            
+            fetch('/preview?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive))
+                .then(response => response.json())
+                .then(data => {
+                    if (isVideo) {
+                        container.innerHTML = `<video controls class="preview-content">
+                            <source src="data:${data.mime};base64,${data.base64}" type="${data.mime}">
+                        </video>`;
+                    }
+                    document.getElementById('preview-modal').classList.add('active');
+                })
+                .catch(error => {
+                    alert('Erro ao carregar: ' + error);
+                    container.innerHTML = '';
+                });
+        }
+        
+        // Membros de .zip vêm direto do arquivo, sem miniaturas nem conversão
+        function previewArchiveMember(path, isImage, isVideo, container) {
+            const url = '/download?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive) + '&inline=1';
+            if (!isImage && !isVideo) {
+                window.open(url, '_blank');
+                return;
+            }
+            const media = document.createElement(isImage ? 'img' : 'video');
+            media.className = 'preview-content';
+            media.src = url;
+            if (isVideo) media.controls = true;
+            container.innerHTML = '';
+            container.appendChild(media);
+            document.getElementById('preview-modal').classList.add('active');
+        }
+        
+        function previewDocument(path, container) {
+            document.getElementById('preview-modal').classList.add('active');
+            
+            fetch('/document_preview?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive))
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) {
+                        container.innerHTML = '';
+                        container.textContent = 'Erro: ' + data.error;
+                    } else if (data.kind === 'image') {
+                        container.innerHTML = `<img src="${data.url}" class="preview-content" alt="Primeira página">`;
+                    } else {
+                        const pre = document.createElement('pre');
+                        pre.className = 'preview-text';
+                        pre.textContent = data.text + (data.truncated ? '\\n\\n[... ' + formatSize(data.size) + ' no total]' : '');
+                        container.innerHTML = '';
+                        if (data.viewer) {
+                            // O resto do arquivo é lido por trechos no visualizador de texto
+                            const link = document.createElement('a');
+                            link.href = data.viewer;
+                            link.target = '_blank';
+                            link.className = 'btn btn-primary';
+                            link.textContent = '📄 Abrir o arquivo inteiro no visualizador';
+                            container.appendChild(link);
+                        }
+                        container.appendChild(pre);
+                    }
+                })
+                .catch(error => {
+                    alert('Erro ao carregar: ' + error);
+                    container.innerHTML = '';
+                });
+        }
+        
+        // Vídeos: pôster no lugar do ícone e, com o mouse por cima, quadros ao longo
+        // do vídeo (uma tira com videoFrames quadros, alguns KB no total)
+        function videoImage(kind, path, attempt = 0) {
+            const url = `/video/${kind}?drive=${encodeURIComponent(currentDrive)}&filename=${encodeURIComponent(path)}`;
+            return fetch(url).then(response => {
+                if (response.status === 202 && attempt < 20) {
+                    // Ainda na fila do ffmpeg: espera um pouco mais a cada tentativa
+                    const delay = Math.min(10000, 2000 * (attempt + 1));
+                    return new Promise(resolve => setTimeout(resolve, delay)).then(() => videoImage(kind, path, attempt + 1));
+                }
+                if (!response.ok) throw response.status;
+                return response.blob().then(blob => URL.createObjectURL(blob));
+            });
+        }
+        
+        function loadVideoPoster(icon) {
+            videoImage('poster', icon.dataset.video).then(url => {
+                icon.textContent = '';
+                icon.classList.add('video-poster');
+                icon.style.backgroundImage = `url("${url}")`;
+                icon.addEventListener('mouseenter', () => startVideoScrub(icon, url), {once: true});
+            }).catch(() => {});
+        }
+        
+        function startVideoScrub(icon, posterUrl) {
+            videoImage('sprite', icon.dataset.video).then(spriteUrl => {
+                const showFrame = e => {
+                    const rect = icon.getBoundingClientRect();
+                    const frame = Math.min(videoFrames - 1, Math.max(0, Math.floor((e.clientX - rect.left) / rect.width * videoFrames)));
+                    icon.style.backgroundImage = `url("${spriteUrl}")`;
+                    icon.style.backgroundSize = `${videoFrames * 100}% 100%`;
+                    icon.style.backgroundPosition = `${frame / (videoFrames - 1) * 100}% 0`;
+                };
+                icon.addEventListener('mousemove', showFrame);
+                icon.addEventListener('mouseleave', () => {
+                    icon.style.backgroundImage = `url("${posterUrl}")`;
+                    icon.style.backgroundSize = '';
+                    icon.style.backgroundPosition = '';
+                });
+            }).catch(() => {});
+        }
+        
+        const videoIcons = document.querySelectorAll('[data-video]');
+        if ('IntersectionObserver' in window) {
+            // Só pede os pôsteres das linhas que aparecem na tela
+            const posterObserver = new IntersectionObserver(entries => {
+                entries.forEach(entry => {
+                    if (!entry.isIntersecting) return;
+                    posterObserver.unobserve(entry.target);
+                    loadVideoPoster(entry.target);
+                });
+            }, {rootMargin: '200px'});
+            videoIcons.forEach(icon => posterObserver.observe(icon));
+        } else {
+            videoIcons.forEach(loadVideoPoster);
+        }
+        
+        // Modais
+        function showCreateFolder() {
+            document.getElementById('folder-modal').classList.add('active');
+            document.getElementById('folder-name').focus();
+        }
+        
+        function showMoveModal() {
+            const selected = getSelectedItems();
+            if (selected.length === 0) {
+                alert('Selecione itens para mover');
+                return;
+            }
+            document.getElementById('move-modal').classList.add('active');
+            document.getElementById('target-folder').focus();
+            openFolderTree(document.getElementById('move-tree'), '', (path, node) => {
+                document.querySelectorAll('#move-tree li.selected').forEach(li => li.classList.remove('selected'));
+                node.classList.add('selected');
+                document.getElementById('target-folder').value = path;
+            });
+        }
+        
+        // Árvore de pastas: cada nível é um JSON pequeno de /api/tree, pedido ao expandir
+        function loadFolderNodes(parent, path, onSelect) {
+            const url = `/api/tree?drive=${encodeURIComponent(currentDrive)}&path=${encodeURIComponent(path)}&depth=1`;
+            return fetch(url)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) throw new Error(data.error);
+                    const list = document.createElement('ul');
+                    data.folders.forEach(folder => list.appendChild(folderNode(folder, onSelect)));
+                    if (data.truncated) {
+                        const more = document.createElement('li');
+                        more.textContent = '…';
+                        list.appendChild(more);
+                    }
+                    parent.appendChild(list);
+                    if (parent.tagName === 'LI') {
+                        parent.classList.add('open');
+                        parent.querySelector('.tree-toggle').textContent = '▾';
+                    }
+                });
+        }
+        
+        function folderNode(folder, onSelect) {
+            const node = document.createElement('li');
+            node.dataset.path = folder.path;
+            const toggle = document.createElement('span');
+            toggle.className = 'tree-toggle';
+            toggle.textContent = folder.has_children ? '▸' : '';
+            toggle.onclick = () => toggleFolderNode(node, onSelect);
+            const label = document.createElement('span');
+            label.className = 'tree-label';
+            label.textContent = '📁 ' + folder.name;
+            label.title = folder.path;
+            label.onclick = () => onSelect(folder.path, node);
+            node.append(toggle, label);
+            return node;
+        }
+        
+        function toggleFolderNode(node, onSelect) {
+            const toggle = node.querySelector('.tree-toggle');
+            if (!toggle.textContent) return Promise.resolve();
+            if (node.querySelector(':scope > ul')) {
+                toggle.textContent = node.classList.toggle('open') ? '▾' : '▸';
+                return Promise.resolve();
+            }
+            return loadFolderNodes(node, node.dataset.path, onSelect)
+                .catch(error => alert('Erro ao abrir a pasta: ' + error.message));
+        }
+        
+        // Monta a árvore a partir da raiz e abre, um nível por vez, os ancestrais de reveal
+        function openFolderTree(container, reveal, onSelect) {
+            container.innerHTML = '';
+            const parts = reveal ? reveal.split('/') : [];
+            let chain = loadFolderNodes(container, '', onSelect);
+            parts.forEach((part, i) => {
+                const path = parts.slice(0, i + 1).join('/');
+                chain = chain.then(() => {
+                    const node = Array.from(container.querySelectorAll('li')).find(li => li.dataset.path === path);
+                    if (!node) return;
+                    if (i === parts.length - 1) {
+                        node.classList.add('current');
+                        node.scrollIntoView({block: 'nearest'});
+                    } else if (!node.classList.contains('open')) {
+                        return toggleFolderNode(node, onSelect);
+                    }
+                });
+            });
+            return chain.catch(error => {
+                container.textContent = 'Erro ao carregar as pastas: ' + error.message;
+            });
+        }
+        
+        function toggleTreeSidebar() {
+            const sidebar = document.getElementById('tree-sidebar');
+            const open = sidebar.classList.toggle('open');
+            localStorage.setItem('treeSidebar', open ? 'open' : 'closed');
+            if (open && !document.getElementById('sidebar-tree').hasChildNodes()) {
+                openFolderTree(document.getElementById('sidebar-tree'), currentPath, path => {
+                    window.location.href = `/?drive=${encodeURIComponent(currentDrive)}&path=${encodeURIComponent(path)}`;
+                });
+            }
+        }
+        
+        if (localStorage.getItem('treeSidebar') === 'open') {
+            toggleTreeSidebar();
+        }
+        
+        function closeModal(id) {
+            document.getElementById(id).classList.remove('active');
+        }
+        
+        // Criar pasta
+        function createFolder(e) {
+            e.preventDefault();
+            const folderName = document.getElementById('folder-name').value.trim();
+            if (!folderName) return;
+            
+            fetch('/create_folder', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    path: currentPath,
+                    folder_name: folderName,
+                    drive: currentDrive
+                })
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    refreshListing();
+                } else {
+                    alert('Erro: ' + (data.error || 'Desconhecido'));
+                }
+            })
+            .catch(error => alert('Erro ao criar pasta: ' + error));
+        }
+        
+        // Mover itens
+        function moveItems(e) {
+            e.preventDefault();
+            const targetFolder = document.getElementById('target-folder').value.trim();
+            const selected = getSelectedItems();
+            
+            if (!targetFolder || selected.length === 0) return;
+            
+            const operations = selected.map(path => ({op: 'move', path: path, target: targetFolder}));
+            runBatch(operations)
+                .then(data => {
+                    closeModal('move-modal');
+                    applyBatchResults(data, 'mover');
+                })
+                .catch(error => alert('Erro ao mover: ' + error));
+        }
+        
+        // Renomear
+        function renameItem(path, oldName) {
+            const newName = prompt('Novo nome:', oldName);
+            if (!newName || newName === oldName) return;
+            
+            fetch('/rename', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    old_path: path,
+                    new_name: newName,
+                    drive: currentDrive
+                })
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    refreshListing();
+                } else {
+                    alert('Erro: ' + (data.error || 'Desconhecido'));
+                }
+            })
+            .catch(error => alert('Erro ao renomear: ' + error));
+        }
+        
+        // Download múltiplo
+        function downloadSelected() {
+            const selected = getSelectedItems();
+            if (selected.length === 0) {
+                alert('Selecione itens para baixar');
+                return;
+            }
+            selected.forEach(path => {
+                const url = '/download?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive);
+                window.open(url, '_blank');
+            });
+        }
+        
+        // Apagar
+        function deleteSelected() {
+            const selected = getSelectedItems();
+            if (selected.length === 0) {
+                alert('Selecione itens para apagar');
+                return;
+            }
+            if (!confirm(`Mover ${selected.length} item(ns) para a lixeira?`)) return;
+            
+            const operations = selected.map(path => ({op: 'delete', path: path}));
+            runBatch(operations)
+                .then(data => applyBatchResults(data, 'apagar'))
+                .catch(error => alert('Erro ao apagar: ' + error));
+        }
+        
+        // Lixeira
+        function showTrash() {
+            const container = document.getElementById('trash-container');
+            container.innerHTML = '<p>Carregando...</p>';
+            document.getElementById('trash-modal').classList.add('active');
+            
+            fetch('/trash?drive=' + encodeURIComponent(currentDrive))
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        container.innerHTML = '<p>Erro: ' + (data.error || 'Desconhecido') + '</p>';
+                        return;
+                    }
+                    if (data.items.length === 0) {
+                        container.innerHTML = '<div class="empty-state"><div class="empty-state-icon">♻️</div>Lixeira vazia</div>';
+                        return;
+                    }
+                    const table = document.createElement('table');
+                    table.className = 'file-table';
+                    data.items.forEach(item => {
+                        const row = table.insertRow();
+                        const check = document.createElement('input');
+                        check.type = 'checkbox';
+                        check.className = 'checkbox trash-checkbox';
+                        check.value = item.id;
+                        row.insertCell().appendChild(check);
+                        row.insertCell().textContent = item.icon + ' ' + item.original_path;
+                        row.insertCell().textContent = item.size_str;
+                        row.insertCell().textContent = item.deleted_at_str;
+                    });
+                    container.innerHTML = '';
+                    container.appendChild(table);
+                })
+                .catch(error => {
+                    container.innerHTML = '<p>Erro ao carregar: ' + error + '</p>';
+                });
+        }
+        
+        function getSelectedTrashItems() {
+            return Array.from(document.querySelectorAll('.trash-checkbox:checked')).map(cb => cb.value);
+        }
+        
+        function restoreSelected() {
+            const ids = getSelectedTrashItems();
+            if (ids.length === 0) {
+                alert('Selecione itens para restaurar');
+                return;
+            }
+            
+            fetch('/trash/restore', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ids: ids, drive: currentDrive})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    alert('Erro: ' + (data.error || data.errors.map(e => e.error).join(', ')));
+                }
+                refreshListing();
+            })
+            .catch(error => alert('Erro ao restaurar: ' + error));
+        }
+        
+        function emptyTrash() {
+            const ids = getSelectedTrashItems();
+            const message = ids.length ? `Apagar definitivamente ${ids.length} item(ns)?` : 'Esvaziar a lixeira inteira?';
+            if (!confirm(message)) return;
+            
+            fetch('/trash/empty', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(ids.length ? {ids: ids, drive: currentDrive} : {drive: currentDrive})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    showTrash();
+                } else {
+                    alert('Erro: ' + (data.error || 'Desconhecido'));
+                }
+            })
+            .catch(error => alert('Erro ao esvaziar: ' + error));
+        }
+        
+        // Duplicados
+        let duplicatesTimer = null;
+        
+        function showDuplicates() {
+            document.getElementById('duplicates-modal').classList.add('active');
+            loadDuplicates();
+        }
+        
+        function closeDuplicates() {
+            clearTimeout(duplicatesTimer);
+            closeModal('duplicates-modal');
+        }
+        
+        function startDuplicateScan() {
+            fetch('/duplicates/scan', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) alert('Erro: ' + data.error);
+                loadDuplicates();
+            })
+            .catch(error => alert('Erro ao iniciar a busca: ' + error));
+        }
+        
+        function loadDuplicates() {
+            const status = document.getElementById('duplicates-status');
+            const container = document.getElementById('duplicates-container');
+            clearTimeout(duplicatesTimer);
+            
+            fetch('/duplicates')
+                .then(response => response.json())
+                .then(data => {
+                    const s = data.status;
+                    if (s.state === 'running') {
+                        const progress = s.candidates ? ` ${s.checked}/${s.candidates}` : '';
+                        status.textContent = `🔎 ${s.files} arquivos analisados — ${s.phase}${progress}`;
+                        duplicatesTimer = setTimeout(loadDuplicates, 2000);
+                    } else if (s.state === 'done') {
+                        const when = new Date(s.finished_at * 1000).toLocaleString();
+                        status.textContent = `${data.total_groups} grupo(s) de duplicados, ${data.wasted_str} recuperáveis (busca de ${when})`;
+                    } else if (s.state === 'error') {
+                        status.textContent = 'Erro na busca: ' + s.error;
+                    } else {
+                        status.textContent = 'Nenhuma busca feita ainda.';
+                    }
+                    renderDuplicateGroups(container, data.groups);
+                })
+                .catch(error => { status.textContent = 'Erro ao carregar: ' + error; });
+        }
+        
+        function renderDuplicateGroups(container, groups) {
+            container.innerHTML = '';
+            groups.forEach((group, index) => {
+                const box = document.createElement('div');
+                box.className = 'duplicate-group';
+                const title = document.createElement('div');
+                title.className = 'duplicate-title';
+                title.textContent = `${group.files.length} cópias de ${group.size_str} — ${group.wasted_str} desperdiçados`;
+                box.appendChild(title);
+                
+                group.files.forEach((file, i) => {
+                    const label = document.createElement('label');
+                    label.className = 'duplicate-file';
+                    const radio = document.createElement('input');
+                    radio.type = 'radio';
+                    radio.name = 'keep-' + index;
+                    radio.checked = i === 0;
+                    radio.value = i;
+                    label.appendChild(radio);
+                    const links = file.links.length ? ` (+${file.links.length} hardlink)` : '';
+                    label.appendChild(document.createTextNode(` ${file.drive}: ${file.path}${links}`));
+                    box.appendChild(label);
+                });
+                
+                const actions = document.createElement('div');
+                actions.className = 'duplicate-actions';
+                [['hardlink', '🔗 Trocar cópias por hardlink', 'btn-secondary'],
+                 ['delete', '🗑️ Apagar cópias', 'btn-danger']].forEach(([action, text, style]) => {
+                    const button = document.createElement('button');
+                    button.className = 'btn ' + style;
+                    button.textContent = text;
+                    button.onclick = () => resolveDuplicates(group, index, action);
+                    actions.appendChild(button);
+                });
+                box.appendChild(actions);
+                container.appendChild(box);
+            });
+        }
+        
+        function resolveDuplicates(group, index, action) {
+            const keepIndex = Number(document.querySelector(`input[name="keep-${index}"]:checked`).value);
+            const keep = group.files[keepIndex];
+            const remove = group.files.filter((_, i) => i !== keepIndex).map(f => ({drive: f.drive, path: f.path}));
+            const message = action === 'delete'
+                ? `Mover ${remove.length} cópia(s) para a lixeira e manter ${keep.path}?`
+                : `Trocar ${remove.length} cópia(s) por hardlinks de ${keep.path}?`;
+            if (!confirm(message)) return;
+            
+            fetch('/duplicates/resolve', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({hash: group.hash, keep: {drive: keep.drive, path: keep.path}, remove: remove, action: action})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) {
+                    alert('Erro: ' + data.error);
+                } else if (data.failed) {
+                    alert(data.results.filter(r => !r.success).map(r => r.path + ': ' + r.error).join('\\n'));
+                }
+                forgetListings();
+                loadDuplicates();
+            })
+            .catch(error => alert('Erro: ' + error));
+        }
+        
+        // Lote: uma requisição para todos os itens, com resultado por item
+        function runBatch(operations) {
+            return fetch('/batch', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({operations: operations, drive: currentDrive})
+            }).then(response => {
+                forgetListings();
+                return response.json();
+            });
+        }
+        
+        function applyBatchResults(data, action) {
+            if (!data.results) {
+                alert('Erro: ' + (data.error || 'Desconhecido'));
+                return;
+            }
+            // Itens que saíram da pasta atual somem da lista sem recarregar a página
+            const parentOf = p => p.includes('/') ? p.slice(0, p.lastIndexOf('/')) : '';
+            const done = new Set(data.results
+                .filter(r => r.success && (!r.new_path || parentOf(r.new_path) !== currentPath))
+                .map(r => r.path));
+            document.querySelectorAll('.item-checkbox').forEach(cb => {
+                if (done.has(cb.value)) cb.closest('tr').remove();
+                cb.checked = false;
+            });
+            if (data.failed) {
+                const errors = data.results.filter(r => !r.success).map(r => r.path + ': ' + r.error);
+                alert(`Não foi possível ${action} ${data.failed} item(ns):\\n` + errors.join('\\n'));
+            }
+        }
+        
+        function getSelectedItems() {
+            return Array.from(document.querySelectorAll('.item-checkbox:checked')).map(cb => cb.value);
+        }
+        
+        // Fechar modal ao clicar fora
+        document.querySelectorAll('.modal').forEach(modal => {
+            modal.addEventListener('click', function(e) {
+                if (e.target === this) {
+                    this.classList.remove('active');
+                }
+            });
+        });
+        
+        // --- App instalável (service worker) ---
+        // A listagem sai do cache na hora e é revalidada em segundo plano;
+        // depois de uma alteração, a cópia guardada é descartada antes de recarregar.
+        function forgetListings() {
+            return window.caches ? caches.delete('vyrex-listagens').catch(() => {}) : Promise.resolve();
+        }
+        
+        function refreshListing() {
+            forgetListings().then(() => location.reload());
+        }
+        
+        function queueUploads(files) {
+            const worker = navigator.serviceWorker && navigator.serviceWorker.controller;
+            if (!worker) return false;
+            worker.postMessage({type: 'enfileirar', drive: currentDrive, path: currentPath, files: Array.from(files)});
+            return true;
+        }
+        
+        function showNotice(id, text) {
+            const notice = document.getElementById(id);
+            notice.textContent = text;
+            notice.style.display = text ? 'block' : 'none';
+        }
+        
+        if ('serviceWorker' in navigator) {
+            navigator.serviceWorker.register('/sw.js').catch(error => console.log('Service worker indisponível:', error));
+            
+            navigator.serviceWorker.addEventListener('message', event => {
+                const data = event.data || {};
+                if (data.type === 'listagem-atualizada' && data.url.split('#')[0] === location.href.split('#')[0]) {
+                    showNotice('app-notice', '🔄 Esta pasta mudou. Clique para atualizar.');
+                } else if (data.type === 'fila') {
+                    showNotice('queue-notice', data.pending ? `⏳ ${data.pending} arquivo(s) aguardando conexão para enviar` : '');
+                } else if (data.type === 'enviados') {
+                    showNotice('app-notice', `✅ ${data.count} arquivo(s) da fila enviados. Clique para atualizar.`);
+                } else if (data.type === 'falha-upload') {
+                    alert(`Não foi possível enviar ${data.name}: ${data.error}`);
+                }
+            });
+            
+            // Navegadores sem Background Sync: a própria página esvazia a fila
+            const sendQueue = () => navigator.serviceWorker.ready.then(reg => reg.active && reg.active.postMessage({type: 'enviar-fila'}));
+            window.addEventListener('online', sendQueue);
+            sendQueue();
+        }
+    </script>
+</body>
+</html>
+'''
+
+GALLERY_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Galeria - {{ current_drive_for_url }}</title>
+    <link rel="manifest" href="/manifest.webmanifest">
+    <link rel="icon" href="/icon.svg" type="image/svg+xml">
+    <meta name="theme-color" content="#0061ff">
+    <style>
+        :root {
+            --bg-color: #1a1a1a;
+            --text-color: #ffffff;
+            --secondary-text: #a0a0a0;
+            --accent-color: #0061ff;
+            --card-bg: #2a2a2a;
+            --border-color: #404040;
+            --hover-bg: #3a3a3a;
+            --tile: 120px;
+        }
+        
+        body.light {
+            --bg-color: #f0f4f8;
+            --text-color: #1e293b;
+            --secondary-text: #64748b;
+            --card-bg: #ffffff;
+            --border-color: #e2e8f0;
+            --hover-bg: #f8fafc;
+        }
+        
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
+            background: var(--bg-color);
+            color: var(--text-color);
+            min-height: 100vh;
         }
         
         .header {
+            position: sticky;
+            top: 0;
+            z-index: 10;
             background: linear-gradient(135deg, #0061ff 0%, #004aad 100%);
             color: white;
-            padding: 20px;
+            padding: 12px 20px;
             display: flex;
             justify-content: space-between;
             align-items: center;
-            flex-wrap: wrap;
             gap: 10px;
+            flex-wrap: wrap;
         }
         
-        .header h1 {
-            font-size: 24px;
-            font-weight: 600;
+        .header a, .header button, .header select {
+            color: white;
+            background: rgba(255,255,255,0.15);
+            border: none;
+            border-radius: 8px;
+            padding: 6px 12px;
+            text-decoration: none;
+            font-size: 13px;
+            cursor: pointer;
         }
         
-        .header-controls {
-            display: flex;
-            gap: 10px;
-            align-items: center;
-        }
+        .header select option { color: #1e293b; }
         
-        .storage-card {
-            background: rgba(255,255,255,0.15);
-            backdrop-filter: blur(10px);
-            border-radius: 12px;
-            padding: 15px;
-            min-width: 250px;
+        .group-title {
+            padding: 18px 20px 8px;
+            font-weight: 600;
+            color: var(--secondary-text);
         }
         
-        .storage-title {
-            font-size: 13px;
-            opacity: 0.9;
-            margin-bottom: 8px;
+        .grid {
+            display: grid;
+            grid-template-columns: repeat(auto-fill, var(--tile));
+            gap: 4px;
+            padding: 0 20px;
         }
         
-        .storage-bar {
-            background: rgba(255,255,255,0.2);
-            border-radius: 8px;
-            height: 10px;
+        .tile {
+            width: var(--tile);
+            height: var(--tile);
+            background-color: var(--card-bg);
+            background-repeat: no-repeat;
+            border-radius: 4px;
+            cursor: pointer;
+            position: relative;
             overflow: hidden;
-            margin-bottom: 8px;
         }
         
-        .storage-fill {
-            background: linear-gradient(90deg, #4ade80 0%, #22c55e 100%);
+        .tile img {
+            width: 100%;
             height: 100%;
-            transition: width 0.3s ease;
-            border-radius: 8px;
+            object-fit: cover;
         }
         
-        .storage-fill.warning { background: linear-gradient(90deg, #fbbf24 0%, #f59e0b 100%); }
-        .storage-fill.danger { background: linear-gradient(90deg, #f87171 0%, #ef4444 100%); }
-        
-        .storage-info {
-            display: flex;
-            justify-content: space-between;
+        .tile .badge {
+            position: absolute;
+            right: 4px;
+            bottom: 4px;
             font-size: 12px;
-            opacity: 0.9;
+            background: rgba(0,0,0,0.6);
+            color: white;
+            border-radius: 4px;
+            padding: 1px 5px;
         }
         
-        .breadcrumb {
-            padding: 15px 20px;
-            background: var(--hover-bg);
-            border-bottom: 1px solid var(--border-color);
-            display: flex;
-            align-items: center;
-            gap: 8px;
-            flex-wrap: wrap;
+        .status {
+            text-align: center;
+            padding: 30px;
+            color: var(--secondary-text);
         }
         
-        .breadcrumb a, .breadcrumb button {
-            color: var(--accent-color);
-            text-decoration: none;
-            padding: 6px 12px;
-            border-radius: 6px;
-            transition: background 0.2s;
-            background: transparent;
-            border: 1px solid var(--border-color);
-            cursor: pointer;
-            font-size: 14px;
+        .lightbox {
+            display: none;
+            position: fixed;
+            inset: 0;
+            background: rgba(0,0,0,0.92);
+            z-index: 100;
+            align-items: center;
+            justify-content: center;
         }
         
-        .breadcrumb a:hover, .breadcrumb button:hover {
-            background: var(--border-color);
-        }
+        .lightbox.active { display: flex; }
         
-        .breadcrumb span {
-            color: var(--secondary-text);
+        .lightbox img, .lightbox video {
+            max-width: 100%;
+            max-height: 100%;
+            object-fit: contain;
         }
         
-        .toolbar {
-            padding: 15px 20px;
-            background: var(--card-bg);
-            border-bottom: 1px solid var(--border-color);
-            display: flex;
-            gap: 8px;
-            flex-wrap: wrap;
+        @media (max-width: 768px) {
+            :root { --tile: 31vw; }
+            .grid { padding: 0 4px; gap: 2px; }
         }
+    </style>
+</head>
+<body class="dark">
+    <div class="header">
+        <strong>🖼️ Galeria · {{ current_drive_for_url }}{% if current_path %}/{{ current_path }}{% endif %}</strong>
+        <div style="display: flex; gap: 8px;">
+            <select id="group-select" onchange="reloadGallery()">
+                <option value="day">Por dia</option>
+                <option value="month">Por mês</option>
+            </select>
+            <button onclick="scanFolder()">🔄 Indexar</button>
+            <a href="{{ url_for('index', drive=current_drive_for_url, path=current_path) }}">📁 Pastas</a>
+        </div>
+    </div>
+    
+    <div id="gallery"></div>
+    <div class="status" id="status">Carregando...</div>
+    <div id="sentinel" style="height: 1px;"></div>
+    
+    <div class="lightbox" id="lightbox" onclick="closeLightbox(event)"></div>
+    
+    <script>
+        const currentPath = '{{ current_path }}';
+        const currentDrive = '{{ current_drive_for_url }}';
+        document.body.className = localStorage.getItem('theme') || 'dark';
         
-        .btn {
-            padding: 8px 16px;
-            border: none;
-            border-radius: 8px;
-            font-size: 13px;
-            font-weight: 500;
-            cursor: pointer;
-            transition: all 0.2s;
-            display: inline-flex;
-            align-items: center;
-            gap: 6px;
+        let cursor = null;
+        let loading = false;
+        let finished = false;
+        let lastGroup = null;
+        let lastGrid = null;
+        
+        function tileSize() {
+            return parseFloat(getComputedStyle(document.querySelector('.tile') || document.body).width) || 120;
         }
         
-        .btn-primary {
-            background: var(--accent-color);
-            color: white;
+        function apiUrl() {
+            const params = new URLSearchParams({
+                drive: currentDrive,
+                path: currentPath,
+                group: document.getElementById('group-select').value
+            });
+            if (cursor) {
+                params.set('before', cursor.before);
+                params.set('before_path', cursor.before_path);
+            }
+            return '/gallery/api?' + params.toString();
         }
         
-        .btn-primary:hover {
-            background: #0052d9;
-            transform: translateY(-1px);
-            box-shadow: 0 4px 12px rgba(0,97,255,0.3);
+        function loadMore() {
+            if (loading || finished) return;
+            loading = true;
+            
+            fetch(apiUrl())
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) throw data.error;
+                    renderPage(data);
+                    cursor = data.next;
+                    finished = !data.next;
+                    document.getElementById('status').textContent = finished
+                        ? (lastGrid ? '' : 'Nenhuma foto ou vídeo indexado ainda. Use "Indexar".')
+                        : 'Carregando...';
+                    loading = false;
+                    // Se a página ainda não encheu a tela, continua carregando
+                    if (!finished && document.body.scrollHeight <= window.innerHeight * 1.5) loadMore();
+                })
+                .catch(error => {
+                    document.getElementById('status').textContent = 'Erro ao carregar: ' + error;
+                    loading = false;
+                });
         }
         
-        .btn-secondary {
-            background: var(--hover-bg);
-            color: var(--text-color);
-            border: 1px solid var(--border-color);
+        function renderPage(data) {
+            const gallery = document.getElementById('gallery');
+            data.groups.forEach(group => {
+                if (group.key !== lastGroup) {
+                    const title = document.createElement('div');
+                    title.className = 'group-title';
+                    title.textContent = group.label;
+                    gallery.appendChild(title);
+                    lastGrid = document.createElement('div');
+                    lastGrid.className = 'grid';
+                    gallery.appendChild(lastGrid);
+                    lastGroup = group.key;
+                }
+                group.items.forEach(item => lastGrid.appendChild(makeTile(item, data.sprite)));
+            });
         }
         
-        .btn-secondary:hover {
-            background: var(--border-color);
+        function makeTile(item, sprite) {
+            const tile = document.createElement('div');
+            tile.className = 'tile';
+            tile.onclick = () => openItem(item);
+            
+            if (sprite) {
+                // Uma única imagem (sprite) para a página inteira de miniaturas
+                const size = 'var(--tile)';
+                const col = item.sprite_index % sprite.columns;
+                const row = Math.floor(item.sprite_index / sprite.columns);
+                tile.style.backgroundImage = `url("${sprite.url}")`;
+                tile.style.backgroundSize = `calc(${size} * ${sprite.columns}) auto`;
+                tile.style.backgroundPosition = `calc(${size} * -${col}) calc(${size} * -${row})`;
+            } else if (item.kind === 'image') {
+                const img = document.createElement('img');
+                img.loading = 'lazy';
+                img.src = '/rendition?w=320&drive=' + encodeURIComponent(currentDrive) + '&filename=' + encodeURIComponent(item.path);
+                tile.appendChild(img);
+            }
+            
+            if (item.kind === 'video') {
+                const badge = document.createElement('span');
+                badge.className = 'badge';
+                badge.textContent = '▶ ' + formatDuration(item.duration);
+                tile.appendChild(badge);
+            }
+            return tile;
         }
         
-        .btn-danger {
-            background: #ef4444;
-            color: white;
+        function formatDuration(seconds) {
+            if (!seconds) return '';
+            const m = Math.floor(seconds / 60);
+            const s = Math.floor(seconds % 60).toString().padStart(2, '0');
+            return m + ':' + s;
         }
         
-        .btn-danger:hover {
-            background: #dc2626;
+        function openItem(item) {
+            const box = document.getElementById('lightbox');
+            const query = 'drive=' + encodeURIComponent(currentDrive) + '&filename=' + encodeURIComponent(item.path);
+            if (item.kind === 'video') {
+                box.innerHTML = `<video controls autoplay src="/download?${query}"></video>`;
+            } else {
+                const width = Math.round(Math.min(window.innerWidth, 2560) * (window.devicePixelRatio || 1));
+                box.innerHTML = `<img src="/rendition?w=${width}&${query}" alt="">`;
+            }
+            box.classList.add('active');
         }
         
-        input[type="text"], input[type="file"], select {
-            padding: 8px 12px;
-            border: 2px solid var(--border-color);
-            border-radius: 8px;
-            font-size: 13px;
-            transition: border 0.2s;
-            background: var(--card-bg);
-            color: var(--text-color);
+        function closeLightbox(e) {
+            if (e.target.tagName === 'VIDEO') return;
+            const box = document.getElementById('lightbox');
+            box.classList.remove('active');
+            box.innerHTML = '';
         }
         
-        input[type="text"]:focus, select:focus {
-            outline: none;
-            border-color: var(--accent-color);
+        function reloadGallery() {
+            cursor = null;
+            finished = false;
+            lastGroup = null;
+            lastGrid = null;
+            document.getElementById('gallery').innerHTML = '';
+            loadMore();
         }
         
-        select {
-            cursor: pointer;
+        function scanFolder() {
+            fetch('/media/scan', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({drive: currentDrive, path: currentPath})
+            })
+            .then(response => response.json())
+            .then(data => alert(data.success ? 'Indexação iniciada. Recarregue em alguns instantes.' : 'Erro: ' + data.error))
+            .catch(error => alert('Erro: ' + error));
         }
         
-        .drop-zone {
-            margin: 15px 20px;
-            padding: 30px;
-            border: 3px dashed var(--border-color);
-            border-radius: 12px;
-            text-align: center;
-            background: var(--hover-bg);
-            transition: all 0.3s;
-            cursor: pointer;
+        new IntersectionObserver(entries => {
+            if (entries[0].isIntersecting) loadMore();
+        }, {rootMargin: '1000px'}).observe(document.getElementById('sentinel'));
+        
+        loadMore();
+    </script>
+</body>
+</html>
+'''
+
+# Service worker do app (PWA). __VERSION__ é trocado pela versão dos templates,
+# então qualquer mudança na interface instala um service worker novo.
+TEXT_VIEWER_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{{ name }} - Vyrex-Box</title>
+    <link rel="manifest" href="/manifest.webmanifest">
+    <link rel="icon" href="/icon.svg" type="image/svg+xml">
+    <meta name="theme-color" content="#0061ff">
+    <style>
+        :root {
+            --bg-color: #1a1a1a;
+            --text-color: #ffffff;
+            --secondary-text: #a0a0a0;
+            --accent-color: #0061ff;
+            --card-bg: #2a2a2a;
+            --border-color: #404040;
+            --hit-bg: #5c4a00;
         }
         
-        .drop-zone.dragover {
-            border-color: var(--accent-color);
-            background: var(--border-color);
-            transform: scale(1.02);
+        body.light {
+            --bg-color: #f0f4f8;
+            --text-color: #1e293b;
+            --secondary-text: #64748b;
+            --card-bg: #ffffff;
+            --border-color: #e2e8f0;
+            --hit-bg: #fff3b0;
         }
         
-        .drop-zone-text {
-            color: var(--secondary-text);
-            font-size: 14px;
-            margin-top: 8px;
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
+            background: var(--bg-color);
+            color: var(--text-color);
+            height: 100vh;
+            display: flex;
+            flex-direction: column;
         }
         
-        .upload-progress {
-            display: none;
-            margin: 15px 20px;
-            padding: 15px;
-            background: var(--hover-bg);
-            border-radius: 12px;
+        .header {
+            background: linear-gradient(135deg, #0061ff 0%, #004aad 100%);
+            color: white;
+            padding: 10px 20px;
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            gap: 10px;
+            flex-wrap: wrap;
         }
         
-        .progress-bar-container {
-            background: var(--border-color);
+        .header a, .toolbar button {
+            color: white;
+            background: rgba(255,255,255,0.15);
+            border: none;
             border-radius: 8px;
-            height: 6px;
-            overflow: hidden;
-            margin: 8px 0;
+            padding: 6px 12px;
+            text-decoration: none;
+            font-size: 13px;
+            cursor: pointer;
         }
         
-        .progress-bar {
-            background: linear-gradient(90deg, var(--accent-color) 0%, #004aad 100%);
-            height: 100%;
-            width: 0%;
-            transition: width 0.3s;
+        .toolbar {
+            display: flex;
+            gap: 8px;
+            align-items: center;
+            flex-wrap: wrap;
+            padding: 8px 20px;
+            background: var(--card-bg);
+            border-bottom: 1px solid var(--border-color);
+            font-size: 13px;
+        }
+        
+        .toolbar button { background: var(--accent-color); }
+        
+        .toolbar input[type=number], .toolbar input[type=search] {
+            background: var(--bg-color);
+            color: var(--text-color);
+            border: 1px solid var(--border-color);
+            border-radius: 6px;
+            padding: 5px 8px;
         }
         
-        .progress-info {
-            display: flex;
-            justify-content: space-between;
-            color: var(--secondary-text);
-            font-size: 12px;
-            margin-top: 6px;
-        }
+        .toolbar input[type=number] { width: 120px; }
+        .toolbar input[type=search] { width: 220px; }
+        .toolbar form { display: flex; gap: 6px; align-items: center; }
+        .status { color: var(--secondary-text); margin-left: auto; }
         
-        .file-list {
-            padding: 0 20px 20px;
+        .main { flex: 1; display: flex; min-height: 0; }
+        
+        #text {
+            flex: 1;
+            overflow: auto;
+            font-family: Consolas, 'Courier New', monospace;
+            font-size: 13px;
+            line-height: 1.45;
+            padding: 6px 0;
         }
         
-        .file-table {
-            width: 100%;
-            border-collapse: collapse;
+        .ln { display: flex; white-space: pre; }
+        .ln.hit { background: var(--hit-bg); }
+        
+        .ln .no {
+            flex: 0 0 auto;
+            min-width: 90px;
+            padding: 0 12px 0 8px;
+            text-align: right;
+            color: var(--secondary-text);
+            user-select: none;
         }
         
-        .file-table th {
-            text-align: left;
-            padding: 10px;
-            background: var(--hover-bg);
-            color: var(--text-color);
-            font-weight: 600;
+        #results {
+            display: none;
+            width: 360px;
+            overflow: auto;
+            border-left: 1px solid var(--border-color);
+            background: var(--card-bg);
             font-size: 12px;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
         }
         
-        .file-table td {
-            padding: 12px 10px;
+        #results.active { display: block; }
+        
+        #results .result {
+            padding: 6px 10px;
             border-bottom: 1px solid var(--border-color);
+            cursor: pointer;
+            font-family: Consolas, 'Courier New', monospace;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
         }
         
-        .file-table tr:hover {
-            background: var(--hover-bg);
-        }
+        #results .result b { color: var(--accent-color); margin-right: 6px; }
+        #results .summary { padding: 8px 10px; color: var(--secondary-text); }
         
-        .file-name {
-            display: flex;
-            align-items: center;
-            gap: 10px;
-            color: var(--text-color);
-            text-decoration: none;
-            font-weight: 500;
-            cursor: pointer;
+        @media (max-width: 768px) {
+            #results { position: fixed; inset: auto 0 0 0; width: auto; height: 40vh; border-left: none; border-top: 1px solid var(--border-color); }
         }
+    </style>
+</head>
+<body class="dark">
+    <div class="header">
+        <strong>📄 {{ name }} <span style="opacity: 0.8; font-weight: normal;">· {{ size }}</span></strong>
+        <div style="display: flex; gap: 8px;">
+            <a href="{{ url_for('download_file', drive=current_drive_for_url, filename=filename) }}">⬇️ Baixar</a>
+            <a href="{{ url_for('index', drive=current_drive_for_url, path=parent) }}">📁 Pasta</a>
+        </div>
+    </div>
+    
+    <div class="toolbar">
+        <form onsubmit="event.preventDefault(); goToLine(parseInt(document.getElementById('line-input').value, 10) || 1)">
+            <input type="number" id="line-input" min="1" placeholder="Ir para linha">
+            <button type="submit">Ir</button>
+        </form>
+        <button onclick="showStart()">⏮ Início</button>
+        <button onclick="showEnd()">⏭ Fim</button>
+        <label><input type="checkbox" id="follow" onchange="toggleFollow()"> Acompanhar</label>
+        <form onsubmit="startSearch(event, 1)">
+            <input type="search" id="search-input" placeholder="Buscar no arquivo">
+            <label><input type="checkbox" id="search-case"> Aa</label>
+            <button type="submit">🔍</button>
+        </form>
+        <span class="status" id="status">Indexando...</span>
+    </div>
+    
+    <div class="main">
+        <div id="text"></div>
+        <div id="results"></div>
+    </div>
+    
+    <script>
+        const drive = {{ current_drive_for_url|tojson }};
+        const filename = {{ filename|tojson }};
+        const PAGE = 500;
+        const MAX_ROWS = 3000;
+        document.body.className = localStorage.getItem('theme') || 'dark';
         
-        .file-name:hover {
-            color: var(--accent-color);
-        }
+        const view = document.getElementById('text');
+        let first = 0, last = 0, total = 0, partial = false;
+        let loading = false;
+        let followTimer = null;
+        let searchAbort = null;
         
-        .file-icon {
-            font-size: 20px;
+        function api(path, params) {
+            return path + '?' + new URLSearchParams(Object.assign({drive, filename}, params)).toString();
         }
         
-        .file-actions {
-            display: flex;
-            gap: 6px;
-            flex-wrap: wrap;
+        function load(path, params) {
+            return fetch(api(path, params))
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) throw data.error;
+                    total = data.total_lines;
+                    partial = data.partial;
+                    return data;
+                });
         }
         
-        .action-btn {
-            padding: 4px 10px;
-            border: 1px solid var(--border-color);
-            border-radius: 6px;
-            background: var(--card-bg);
-            color: var(--secondary-text);
-            font-size: 11px;
-            cursor: pointer;
-            transition: all 0.2s;
-            text-decoration: none;
-            display: inline-block;
+        function row(number, text) {
+            const div = document.createElement('div');
+            div.className = 'ln';
+            div.dataset.line = number;
+            const no = document.createElement('span');
+            no.className = 'no';
+            no.textContent = number.toLocaleString('pt-BR');
+            const content = document.createElement('span');
+            content.textContent = text;
+            div.append(no, content);
+            return div;
         }
         
-        .action-btn:hover {
-            border-color: var(--accent-color);
-            color: var(--accent-color);
+        function updateStatus() {
+            const range = last ? `linhas ${first.toLocaleString('pt-BR')}–${last.toLocaleString('pt-BR')} de ` : '';
+            document.getElementById('status').textContent = range + total.toLocaleString('pt-BR') + ' linhas';
         }
         
-        .checkbox {
-            width: 16px;
-            height: 16px;
-            cursor: pointer;
+        function showError(error) {
+            document.getElementById('status').textContent = 'Erro: ' + error;
         }
         
-        .empty-state {
-            text-align: center;
-            padding: 50px 15px;
-            color: var(--secondary-text);
+        // Substitui a janela visível pelas linhas a partir de start
+        function render(data) {
+            view.innerHTML = '';
+            const fragment = document.createDocumentFragment();
+            data.lines.forEach((text, i) => fragment.appendChild(row(data.start + i, text)));
+            view.appendChild(fragment);
+            first = data.start;
+            last = data.lines.length ? data.start + data.lines.length - 1 : 0;
+            updateStatus();
         }
         
-        .empty-state-icon {
-            font-size: 48px;
-            margin-bottom: 12px;
+        function showStart() {
+            stopFollow();
+            loading = true;
+            load('/text/lines', {start: 1, count: PAGE})
+                .then(data => { render(data); view.scrollTop = 0; })
+                .catch(showError)
+                .finally(() => loading = false);
         }
         
-        .modal {
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            background: rgba(0,0,0,0.7);
-            z-index: 1000;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
+        function showEnd() {
+            loading = true;
+            return load('/text/tail', {count: PAGE})
+                .then(data => { render(data); view.scrollTop = view.scrollHeight; })
+                .catch(showError)
+                .finally(() => loading = false);
         }
         
-        .modal.active {
-            display: flex;
+        function goToLine(line) {
+            stopFollow();
+            loading = true;
+            load('/text/lines', {start: Math.max(1, line - 100), count: PAGE})
+                .then(data => {
+                    render(data);
+                    const target = view.querySelector(`[data-line="${Math.min(line, last)}"]`);
+                    if (target) {
+                        target.classList.add('hit');
+                        target.scrollIntoView({block: 'center'});
+                    }
+                })
+                .catch(showError)
+                .finally(() => loading = false);
         }
         
-        .modal-content {
-            background: var(--card-bg);
-            border-radius: 12px;
-            padding: 25px;
-            max-width: 500px;
-            width: 100%;
-            color: var(--text-color);
-            max-height: 90vh;
-            overflow: auto;
+        // Linhas novas no fim; a última linha sem quebra pode ter crescido e é lida de novo
+        function appendNext() {
+            if (partial && last && view.lastChild) {
+                view.lastChild.remove();
+                last -= 1;
+            }
+            loading = true;
+            return load('/text/lines', {start: last + 1, count: PAGE})
+                .then(data => {
+                    data.lines.forEach((text, i) => {
+                        const number = data.start + i;
+                        if (number > last) view.appendChild(row(number, text));
+                    });
+                    last = Math.max(last, data.start + data.lines.length - 1);
+                    if (!first) first = data.start;
+                    let removed = 0;
+                    while (view.childElementCount > MAX_ROWS) {
+                        removed += view.firstChild.offsetHeight;
+                        view.firstChild.remove();
+                        first += 1;
+                    }
+                    view.scrollTop -= removed;
+                    updateStatus();
+                })
+                .catch(showError)
+                .finally(() => loading = false);
         }
         
-        .modal-header {
-            font-size: 18px;
-            font-weight: 600;
-            margin-bottom: 15px;
+        function prependPrevious() {
+            const start = Math.max(1, first - PAGE);
+            loading = true;
+            load('/text/lines', {start, count: first - start})
+                .then(data => {
+                    const height = view.scrollHeight;
+                    const fragment = document.createDocumentFragment();
+                    data.lines.forEach((text, i) => fragment.appendChild(row(data.start + i, text)));
+                    view.insertBefore(fragment, view.firstChild);
+                    first = data.start;
+                    view.scrollTop += view.scrollHeight - height;
+                    while (view.childElementCount > MAX_ROWS) {
+                        view.lastChild.remove();
+                        last -= 1;
+                    }
+                    updateStatus();
+                })
+                .catch(showError)
+                .finally(() => loading = false);
         }
         
-        .preview-modal .modal-content {
-            max-width: 90%;
-        }
+        view.addEventListener('scroll', () => {
+            if (loading) return;
+            if (view.scrollTop + view.clientHeight > view.scrollHeight - 400 && last < total) {
+                if (!followTimer) appendNext();
+            } else if (view.scrollTop < 400 && first > 1) {
+                prependPrevious();
+            }
+        });
         
-        .preview-content {
-            max-width: 100%;
-            max-height: 70vh;
-            object-fit: contain;
+        // Modo "tail -f": mostra o fim e busca as linhas novas a cada 2 segundos
+        function toggleFollow() {
+            if (!document.getElementById('follow').checked) {
+                stopFollow();
+                return;
+            }
+            showEnd().then(() => {
+                followTimer = setInterval(() => {
+                    if (loading) return;
+                    const atBottom = view.scrollTop + view.clientHeight > view.scrollHeight - 40;
+                    appendNext().then(() => { if (atBottom) view.scrollTop = view.scrollHeight; });
+                }, 2000);
+            });
         }
         
-        @media (max-width: 768px) {
-            .header { flex-direction: column; }
-            .header-controls { flex-direction: column; width: 100%; }
-            .storage-card { width: 100%; }
-            .toolbar { flex-direction: column; }
-            .file-table { font-size: 12px; }
-            .file-table th, .file-table td { padding: 8px 4px; }
+        function stopFollow() {
+            clearInterval(followTimer);
+            followTimer = null;
+            document.getElementById('follow').checked = false;
         }
-    </style>
-</head>
-<body class="dark">
-    <div class="container">
-        <div class="header">
-            <h1>📦 Vyrex Local</h1>
-            <div class="header-controls">
-                <select id="drive-select" onchange="changeDrive(this.value)">
-                    {% for drive in drives %}
-                        <option value="{{ drive }}" {% if current_drive_for_url == drive %}selected{% endif %}>💾 {{ drive }}</option>
-                    {% endfor %}
-                    <option value="DADOS" {% if current_drive_for_url == 'DADOS' %}selected{% endif %}>📁 DADOS (Local)</option>
-                </select>
-                <button class="btn btn-secondary" onclick="toggleTheme()">🌙/☀️</button>
-            </div>
-            <div class="storage-card">
-                <div class="storage-title">💾 {{ current_drive_for_url }}</div>
-                <div class="storage-bar">
-                    <div class="storage-fill {% if usage_percent > 90 %}danger{% elif usage_percent > 70 %}warning{% endif %}" 
-                         style="width: {{ usage_percent }}%"></div>
-                </div>
-                <div class="storage-info">
-                    <span>{{ "%.2f"|format(used_gb) }} GB</span>
-                    <span>{{ "%.2f"|format(free_gb) }} GB livre</span>
-                </div>
-            </div>
-        </div>
-        
-        <div class="breadcrumb">
-            <a href="{{ url_for('index', drive=current_drive_for_url) }}">🏠 Raiz</a>
-            {% if current_path %}
-                {% set parts = current_path.split('/') %}
-                {% for i in range(parts|length) %}
-                    {% if parts[i] %}
-                        <span>›</span>
-                        {% set path = '/'.join(parts[:i+1]) %}
-                        <a href="{{ url_for('index', drive=current_drive_for_url, path=path) }}">{{ parts[i] }}</a>
-                    {% endif %}
-                {% endfor %}
-            {% endif %}
-        </div>
         
-        <div class="toolbar">
-            <button class="btn btn-primary" onclick="document.getElementById('file-input').click()">
-                📤 Upload
-            </button>
-            <input type="file" id="file-input" multiple style="display: none;">
+        // Busca em fluxo: os resultados aparecem enquanto o arquivo é percorrido
+        function startSearch(e, start) {
+            if (e) e.preventDefault();
+            const query = document.getElementById('search-input').value;
+            if (!query) return;
+            if (searchAbort) searchAbort.abort();
+            searchAbort = new AbortController();
             
-            <button class="btn btn-secondary" onclick="showCreateFolder()">
-                📁 Nova Pasta
-            </button>
+            const results = document.getElementById('results');
+            results.classList.add('active');
+            if (start === 1) results.innerHTML = '';
+            const summary = document.createElement('div');
+            summary.className = 'summary';
+            summary.textContent = 'Buscando...';
+            results.appendChild(summary);
             
-            <button class="btn btn-secondary" onclick="downloadSelected()">
-                ⬇️ Baixar
-            </button>
+            const params = {q: query, start};
+            if (document.getElementById('search-case').checked) params.case = '1';
+            
+            let found = 0;
+            const handle = item => {
+                if (item.error) {
+                    summary.textContent = 'Erro: ' + item.error;
+                } else if (item.line) {
+                    found += 1;
+                    const div = document.createElement('div');
+                    div.className = 'result';
+                    const no = document.createElement('b');
+                    no.textContent = item.line.toLocaleString('pt-BR');
+                    div.append(no, item.text);
+                    div.title = item.text;
+                    div.onclick = () => goToLine(item.line);
+                    results.insertBefore(div, summary);
+                } else if (item.progress !== undefined) {
+                    summary.textContent = `Buscando... ${Math.round(item.progress * 100)}% (${found} resultado(s))`;
+                } else if (item.done) {
+                    summary.textContent = `${found} resultado(s)`;
+                    if (item.next_line) {
+                        const more = document.createElement('button');
+                        more.textContent = 'Continuar buscando';
+                        more.style.marginLeft = '8px';
+                        more.onclick = () => { summary.remove(); startSearch(null, item.next_line); };
+                        summary.appendChild(more);
+                    }
+                }
+            };
+            
+            fetch(api('/text/grep', params), {signal: searchAbort.signal})
+                .then(response => {
+                    if (!response.ok) return response.json().then(data => { throw data.error; });
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    const pump = () => reader.read().then(({done, value}) => {
+                        if (done) return;
+                        buffer += decoder.decode(value, {stream: true});
+                        const parts = buffer.split('\\n');
+                        buffer = parts.pop();
+                        parts.forEach(part => part && handle(JSON.parse(part)));
+                        return pump();
+                    });
+                    return pump();
+                })
+                .catch(error => { if (error.name !== 'AbortError') summary.textContent = 'Erro: ' + error; });
+        }
+        
+        showStart();
+    </script>
+</body>
+</html>
+'''
+
+SERVICE_WORKER_JS = r"""
+const VERSION = '__VERSION__';
+const SHELL_CACHE = 'vyrex-shell-' + VERSION;
+const LIST_CACHE = 'vyrex-listagens';
+const MEDIA_CACHE = 'vyrex-miniaturas';
+const LIST_MAX = 60;
+const MEDIA_MAX = 800;
+const SHELL = ['/manifest.webmanifest', '/icon.svg'];
+const SYNC_TAG = 'vyrex-uploads';
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.addAll(SHELL)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(caches.keys()
+        .then(keys => Promise.all(keys
+            .filter(key => key.startsWith('vyrex-shell-') && key !== SHELL_CACHE)
+            .map(key => caches.delete(key))))
+        .then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    // Escritas, downloads e o WebDAV vão direto para a rede
+    if (request.method !== 'GET' || url.origin !== location.origin) return;
+
+    if (request.mode === 'navigate' && url.pathname === '/') {
+        event.respondWith(staleWhileRevalidate(event, LIST_CACHE, LIST_MAX, true));
+    } else if (url.pathname === '/api/list' || url.pathname === '/api/tree' || url.pathname === '/gallery/api') {
+        event.respondWith(staleWhileRevalidate(event, LIST_CACHE, LIST_MAX, false));
+    } else if (url.pathname === '/rendition' || url.pathname === '/gallery/sprite') {
+        event.respondWith(staleWhileRevalidate(event, MEDIA_CACHE, MEDIA_MAX, false));
+    } else if (SHELL.includes(url.pathname)) {
+        event.respondWith(caches.match(request).then(cached => cached || fetch(request)));
+    }
+});
+
+// Responde na hora com a cópia em cache e atualiza em segundo plano
+async function staleWhileRevalidate(event, cacheName, maxEntries, notify) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(event.request);
+
+    const network = fetch(event.request).then(async response => {
+        if (response.ok) {
+            const before = cached && cached.headers.get('X-Vyrex-Listing');
+            if (notify && before && before !== response.headers.get('X-Vyrex-Listing')) {
+                broadcast({type: 'listagem-atualizada', url: event.request.url});
+            }
+            await cache.put(event.request, response.clone());
+            trimCache(cache, maxEntries);
+        }
+        return response;
+    });
+
+    if (cached) {
+        event.waitUntil(network.catch(() => {}));
+        return cached;
+    }
+    return network.catch(() => event.request.mode === 'navigate'
+        ? new Response('<meta name="viewport" content="width=device-width"><h3 style="font-family:sans-serif">' +
+                       '📡 Sem conexão com o Vyrex-Box e esta pasta ainda não foi aberta neste aparelho.</h3>',
+                       {status: 503, headers: {'Content-Type': 'text/html; charset=utf-8'}})
+        : Response.error());
+}
+
+async function trimCache(cache, maxEntries) {
+    const keys = await cache.keys();
+    // cache.keys() segue a ordem de inserção: os mais antigos saem primeiro
+    for (const key of keys.slice(0, Math.max(0, keys.length - maxEntries))) {
+        await cache.delete(key);
+    }
+}
+
+async function broadcast(message) {
+    const clients = await self.clients.matchAll({includeUncontrolled: true});
+    clients.forEach(client => client.postMessage(message));
+}
+
+// --- Fila de uploads (IndexedDB) ---
+
+function openQueue() {
+    return new Promise((resolve, reject) => {
+        const request = indexedDB.open('vyrex', 1);
+        request.onupgradeneeded = () => request.result.createObjectStore('uploads', {keyPath: 'id', autoIncrement: true});
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+async function queueTransaction(mode, action) {
+    const db = await openQueue();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction('uploads', mode);
+        const request = action(tx.objectStore('uploads'));
+        tx.oncomplete = () => resolve(request ? request.result : undefined);
+        tx.onerror = () => reject(tx.error);
+    });
+}
+
+async function reportQueue() {
+    const pending = await queueTransaction('readonly', store => store.count());
+    broadcast({type: 'fila', pending: pending});
+}
+
+let flushing = null;
+
+function flushUploads() {
+    if (!flushing) {
+        flushing = sendQueued().finally(() => { flushing = null; });
+    }
+    return flushing;
+}
+
+async function sendQueued() {
+    const items = await queueTransaction('readonly', store => store.getAll());
+    let sent = 0;
+    for (const item of items) {
+        const form = new FormData();
+        form.append('files[]', item.file, item.name);
+        const query = 'drive=' + encodeURIComponent(item.drive) + '&path=' + encodeURIComponent(item.path);
+        let response;
+        try {
+            response = await fetch('/upload?' + query, {method: 'POST', body: form});
+        } catch (e) {
+            break;  // Ainda sem conexão: tenta de novo no próximo sync/online
+        }
+        if (response.status >= 500) break;
+        if (response.ok) {
+            sent++;
+        } else {
+            // Erro definitivo (cota, tipo de arquivo): não adianta repetir
+            const data = await response.json().catch(() => ({}));
+            broadcast({type: 'falha-upload', name: item.name, error: data.error || response.status});
+        }
+        await queueTransaction('readwrite', store => store.delete(item.id));
+    }
+    if (sent) {
+        await caches.delete(LIST_CACHE);
+        broadcast({type: 'enviados', count: sent});
+    }
+    await reportQueue();
+}
+
+self.addEventListener('message', event => {
+    const data = event.data || {};
+    if (data.type === 'enfileirar') {
+        event.waitUntil((async () => {
+            for (const file of data.files) {
+                await queueTransaction('readwrite', store => store.add({
+                    drive: data.drive, path: data.path, name: file.name, file: file, queued_at: Date.now()
+                }));
+            }
+            await reportQueue();
+            if (self.registration.sync) {
+                await self.registration.sync.register(SYNC_TAG).catch(() => {});
+            }
+        })());
+    } else if (data.type === 'enviar-fila') {
+        event.waitUntil(flushUploads());
+    }
+});
+
+// Background Sync (Chrome/Android): o navegador chama quando a rede volta,
+// mesmo com o app fechado. Nos demais, a página pede 'enviar-fila' ao ficar online.
+self.addEventListener('sync', event => {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(flushUploads());
+    }
+});
+"""
+
+APP_ICON_SVG = '''<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 512 512">
+<defs><linearGradient id="g" x1="0" y1="0" x2="1" y2="1"><stop offset="0" stop-color="#0061ff"/><stop offset="1" stop-color="#004aad"/></linearGradient></defs>
+<rect width="512" height="512" rx="96" fill="url(#g)"/>
+<path d="M128 176l128-64 128 64v160l-128 64-128-64z" fill="none" stroke="#fff" stroke-width="28" stroke-linejoin="round"/>
+<path d="M128 176l128 64 128-64M256 240v160" fill="none" stroke="#fff" stroke-width="28" stroke-linejoin="round"/>
+</svg>
+'''
+
+SW_VERSION = hashlib.sha1((SERVICE_WORKER_JS + HTML_TEMPLATE + GALLERY_TEMPLATE).encode('utf-8')).hexdigest()[:12]
+
+# --- ROTAS DA APLICAÇÃO WEB ---
+
+@app.route('/')
+def index():
+    raw_drive = request.args.get('drive', 'DADOS')
+    
+    # Identificador desconhecido volta para a pasta DADOS
+    current_drive = resolve_drive(raw_drive)
+    if current_drive is None:
+        current_drive = resolve_drive('DADOS')
+        raw_drive = 'DADOS'
+
+    current_path = request.args.get('path', '').strip('/').strip('\\')
+    sort = request.args.get('sort', 'name')
+    
+    try:
+        full_path = resolve_path(current_drive, current_path)
+        
+        # Caminho dentro de um .zip: lista o diretório central em vez da pasta
+        archive = None if os.path.isdir(full_path) else split_archive_path(current_drive, full_path)
+        if archive:
+            entries = archive_listing(*archive)
+            if entries is None:
+                return "Pasta não encontrada no arquivo", 404
+        else:
+            # Listagem em cache, compartilhada com o WebDAV; arquivos frios aparecem como os originais
+            entries = logical_entries(list_directory(full_path))
+        
+        items = []
+        for entry in entries:
+            item = entry['name']
+            if not current_path and item == TRASH_DIRNAME:
+                continue
+            is_dir = entry['is_dir']
             
-            <button class="btn btn-danger" onclick="deleteSelected()">
-                🗑️ Apagar
-            </button>
+            # O caminho relativo para a URL deve sempre usar '/'
+            rel_item_path = f"{current_path}/{item}".replace('\\', '/') if current_path else item
             
-            <button class="btn btn-secondary" onclick="showMoveModal()">
-                📋 Mover
-            </button>
-        </div>
+            items.append({
+                'name': item,
+                'path': rel_item_path,
+                'is_dir': is_dir,
+                'size': entry['size'],
+                'size_str': '-' if is_dir else format_size(entry['size']),
+                'mtime': datetime.fromtimestamp(entry['mtime']).strftime('%d/%m/%Y %H:%M'),
+                'mtime_ts': entry['mtime'],
+                'mtime_ns': entry['mtime_ns'],
+                'icon': get_file_icon(item, is_dir),
+                'is_image': is_image(item),
+                'is_video': is_video(item),
+                'is_document': is_document(item),
+                'is_archive': not is_dir and not archive and is_archive(item),
+                'is_cold': entry.get('cold', False)
+            })
         
-        <div class="drop-zone" id="drop-zone">
-            <div style="font-size: 40px;">📤</div>
-            <div class="drop-zone-text">Arraste arquivos aqui ou clique em Upload</div>
-        </div>
+        # Data de captura das fotos/vídeos já indexados; os demais entram na fila
+        media = {} if archive else media_metadata_for_dir(
+            full_path, [(i['name'], i['mtime_ns']) for i in items
+                        if not i['is_dir'] and not i['is_cold'] and (i['is_image'] or i['is_video'])])
+        for item in items:
+            taken_at = media.get(item['name'], {}).get('taken_at')
+            item['taken_at'] = taken_at
+            item['taken_str'] = datetime.fromtimestamp(taken_at).strftime('%d/%m/%Y %H:%M') if taken_at else ''
         
-        <div class="upload-progress" id="upload-progress">
-            <div style="font-weight: 600; margin-bottom: 8px;">Enviando...</div>
-            <div class="progress-bar-container">
-                <div class="progress-bar" id="progress-bar"></div>
-            </div>
-            <div class="progress-info">
-                <span id="progress-percent">0%</span>
-                <span id="progress-speed">0 KB/s</span>
-            </div>
-        </div>
+        if sort == 'capture':
+            items.sort(key=lambda x: (not x['is_dir'], -(x['taken_at'] or x['mtime_ts'])))
+        elif sort == 'mtime':
+            items.sort(key=lambda x: (not x['is_dir'], -x['mtime_ts']))
+        else:
+            items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
         
-        <div class="file-list">
-            {% if items %}
-            <table class="file-table">
-                <thead>
-                    <tr>
-                        <th style="width: 40px;">
-                            <input type="checkbox" class="checkbox" id="select-all">
-                        </th>
-                        <th>Nome</th>
-                        <th style="width: 100px;">Tamanho</th>
-                        <th style="width: 140px;">Modificado</th>
-                        <th style="width: 180px;">Ações</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {% for item in items %}
-                    <tr>
-                        <td>
-                            <input type="checkbox" class="checkbox item-checkbox" value="{{ item.path }}">
-                        </td>
-                        <td>
-                            {% if item.is_dir %}
-                                <a href="{{ url_for('index', drive=current_drive_for_url, path=item.path) }}" class="file-name">
-                                    <span class="file-icon">{{ item.icon }}</span>
-                                    <span>{{ item.name }}</span>
-                                </a>
-                            {% else %}
-                                <div class="file-name" onclick="previewFile('{{ item.path }}', {{ item.is_image|lower }}, {{ item.is_video|lower }})">
-                                    <span class="file-icon">{{ item.icon }}</span>
-                                    <span>{{ item.name }}</span>
-                                </div>
-                            {% endif %}
-                        </td>
-                        <td>{{ item.size_str }}</td>
-                        <td>{{ item.mtime }}</td>
-                        <td>
-                            <div class="file-actions">
-                                <button class="action-btn" onclick="renameItem('{{ item.path }}', '{{ item.name }}')">
-                                    ✏️
-                                </button>
-                                {% if not item.is_dir %}
-                                    <a href="{{ url_for('download_file', filename=item.path, drive=current_drive_for_url) }}" class="action-btn" download>
-                                        ⬇️
-                                    </a>
-                                {% endif %}
-                            </div>
-                        </td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
-            </table>
-            {% else %}
-            <div class="empty-state">
-                <div class="empty-state-icon">📭</div>
-                <div style="font-size: 16px; margin-bottom: 8px;">Pasta vazia</div>
-                <div>Faça upload de arquivos ou crie pastas</div>
-            </div>
-            {% endif %}
-        </div>
-    </div>
+    except PermissionError:
+        return "Sem permissão para acessar esta pasta", 403
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao listar: {e}")
+        import traceback
+        traceback.print_exc()
+        return f"Erro ao listar arquivos: {e}", 500
     
-    <!-- Modal Nova Pasta -->
-    <div class="modal" id="folder-modal">
-        <div class="modal-content">
-            <div class="modal-header">📁 Nova Pasta</div>
-            <form id="folder-form" onsubmit="createFolder(event)">
-                <input type="text" id="folder-name" placeholder="Nome da pasta" style="width: 100%; margin-bottom: 20px;" required>
-                <div style="display: flex; gap: 10px; justify-content: flex-end;">
-                    <button type="button" class="btn btn-secondary" onclick="closeModal('folder-modal')">Cancelar</button>
-                    <button type="submit" class="btn btn-primary">Criar</button>
-                </div>
-            </form>
-        </div>
-    </div>
+    # Info do disco (ou da cota do drive, se houver)
+    try:
+        disk = psutil.disk_usage(current_drive)
+        total, used = disk.total, disk.used
+        quota_limit = quota_tracker.limit(current_drive)
+        if quota_limit:
+            total, used = quota_limit, quota_tracker.used(current_drive)
+        total_gb = total / (1024**3)
+        used_gb = used / (1024**3)
+        free_gb = min(max(total - used, 0), disk.free) / (1024**3)
+        usage_percent = (used_gb / total_gb) * 100
+    except Exception:
+        total_gb = used_gb = free_gb = usage_percent = 0
     
-    <!-- Modal Mover -->
-    <div class="modal" id="move-modal">
-        <div class="modal-content">
-            <div class="modal-header">📋 Mover Itens</div>
-            <form id="move-form" onsubmit="moveItems(event)">
-                <input type="text" id="target-folder" placeholder="Pasta destino (ex: docs/2024)" style="width: 100%; margin-bottom: 20px;" required>
-                <div style="display: flex; gap: 10px; justify-content: flex-end;">
-                    <button type="button" class="btn btn-secondary" onclick="closeModal('move-modal')">Cancelar</button>
-                    <button type="submit" class="btn btn-primary">Mover</button>
-                </div>
-            </form>
-        </div>
-    </div>
+    # Prepara as variáveis para o template
+    template_drives = [d.rstrip(os.sep) or d for d in available_drives()]
+    current_drive_for_url = raw_drive # Usa o identificador 'DADOS' ou 'C:'
     
-    <!-- Modal Preview -->
-    <div class="modal preview-modal" id="preview-modal">
-        <div class="modal-content">
-            <div class="modal-header">Visualização</div>
-            <div id="preview-container"></div>
-            <div style="display: flex; justify-content: flex-end; margin-top: 20px;">
-                <button type="button" class="btn btn-secondary" onclick="closeModal('preview-modal')">Fechar</button>
-            </div>
-        </div>
-    </div>
+    # Assinatura da listagem: o service worker compara com a cópia em cache
+    # para avisar a página quando a pasta mudou desde a última visita
+    listing_version = hashlib.sha1(json.dumps(
+        [raw_drive, current_path, sort, [(i['name'], i['size'], i['mtime_ns']) for i in items]]
+    ).encode('utf-8')).hexdigest()
     
-    <script>
-        const currentPath = '{{ current_path }}';
-        const currentDrive = '{{ current_drive_for_url }}';
+    page = render_template_string(
+        HTML_TEMPLATE,
+        items=items,
+        current_path=current_path,
+        in_archive=bool(archive),
+        sort=sort,
+        current_drive=current_drive,           # Caminho completo (C:\) para lógica do JS
+        current_drive_for_url=current_drive_for_url, # Drive limpo (C:) para as URLs
+        drives=template_drives,                # Lista limpa (C:, D:) para o dropdown
+        data_folder=DATA_FOLDER,
+        total_gb=total_gb,
+        used_gb=used_gb,
+        free_gb=free_gb,
+        usage_percent=usage_percent,
+        video_frames=VIDEO_SPRITE_FRAMES
+    )
+    return page, 200, {'X-Vyrex-Listing': listing_version}
+
+def send_archive_member(zip_path, inner, as_attachment=True):
+    """Resposta com um membro do .zip, com ETag, 304 e Range (só para entradas armazenadas)."""
+    member = archive_index(zip_path)['members'].get(inner)
+    if member is None:
+        return "Arquivo não encontrado", 404
+    if member['encrypted']:
+        return "Arquivo protegido por senha", 415
+
+    etag = f"{os.stat(zip_path).st_mtime_ns:x}-{member['offset']:x}-{member['crc']:x}"
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    size = member['size']
+    start, stop, status = 0, size, 200
+    seekable = member['method'] == zipfile.ZIP_STORED
+    if_range = request.headers.get('If-Range')
+    if seekable and request.range and (not if_range or if_range.strip('"') == etag):
+        bounds = request.range.range_for_length(size)
+        if bounds is None:
+            return '', 416, {'Content-Range': f'bytes */{size}'}
+        start, stop = bounds
+        status = 206
+
+    mime, headers = download_headers(member['name'], as_attachment)
+    response = app.response_class(stream_archive_member(zip_path, member, start, stop),
+                                  status=status, mimetype=mime, direct_passthrough=True)
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes' if seekable else 'none'
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.headers.update(headers)
+    response.set_etag(etag)
+    if member['mtime']:
+        response.last_modified = member['mtime']
+    return response
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    # Drive e pasta vêm na URL para que a cota seja conferida antes de ler o corpo;
+    # o formulário continua aceito para clientes antigos
+    current_drive = drive_root_or_abort(request.args.get('drive') or request.form.get('drive', 'DADOS'))
+
+    try:
+        current_path = (request.args.get('path') if 'drive' in request.args
+                        else request.form.get('path', '')).strip('/').strip('\\')
         
-        // Tema
-        const savedTheme = localStorage.getItem('theme') || 'dark';
-        document.body.className = savedTheme;
+        full_path = resolve_path(current_drive, current_path)
         
-        function toggleTheme() {
-            const newTheme = document.body.className === 'dark' ? 'light' : 'dark';
-            document.body.className = newTheme;
-            localStorage.setItem('theme', newTheme);
-        }
+        # Nome fictício dentro da pasta: só importa em qual cota ela cai (a reserva
+        # é feita arquivo por arquivo, abaixo)
+        quota_error = quota_tracker.check(os.path.join(full_path, '_'), request.content_length or 0, reserve=False)
+        if quota_error:
+            return jsonify({'error': quota_error}), 507
         
-        function changeDrive(drive) {
-            window.location.href = '/?drive=' + encodeURIComponent(drive);
-        }
+        if 'files[]' not in request.files:
+            return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
         
-        // Select All
-        document.getElementById('select-all').addEventListener('change', function() {
-            document.querySelectorAll('.item-checkbox').forEach(cb => cb.checked = this.checked);
-        });
+        files = request.files.getlist('files[]')
+        saved_count = 0
         
-        // Drag and Drop
-        const dropZone = document.getElementById('drop-zone');
+        for file in files:
+            if file.filename and allowed_file(file.filename):
+                filename = secure_filename(file.filename)
+                target_path = os.path.join(full_path, filename)
+                
+                # Tamanho real de cada arquivo (o Content-Length pode faltar em uploads chunked)
+                file.stream.seek(0, os.SEEK_END)
+                old_size = os.path.getsize(target_path) if os.path.isfile(target_path) else 0
+                quota_error = quota_tracker.check(target_path, file.stream.tell() - old_size)
+                if quota_error:
+                    forget_listing(full_path)
+                    return jsonify({'error': quota_error, 'saved': saved_count}), 507
+                file.stream.seek(0)
+                
+                with path_lock(target_path):
+                    file.save(target_path)
+                    drop_cold_copies(target_path)
+                quota_tracker.added(target_path, old_size)
+                schedule_checksums([target_path])
+                journal_change(current_drive, 'put', os.path.relpath(target_path, current_drive))
+                saved_count += 1
         
-        ['dragenter', 'dragover', 'dragleave', 'drop'].forEach(eventName => {
-            dropZone.addEventListener(eventName, e => {
-                e.preventDefault();
-                e.stopPropagation();
-            });
-        });
+        # Sobrescrever um arquivo não muda o mtime da pasta
+        forget_listing(full_path)
+        
+        if saved_count == 0:
+            return jsonify({'error': 'Nenhum arquivo válido para upload'}), 400
+        
+        return jsonify({'success': True, 'saved': saved_count})
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro no upload: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/create_folder', methods=['POST'])
+def create_folder():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        current_path = data.get('path', '').strip('/').strip('\\')
+        folder_name = secure_filename(data.get('folder_name', '').strip())
+
+        if not folder_name:
+            return jsonify({'error': 'Nome de pasta inválido'}), 400
+
+        full_current_path = resolve_path(current_drive, current_path)
+        new_folder_path = os.path.join(full_current_path, folder_name)
+
+        os.makedirs(new_folder_path, exist_ok=True)
+        journal_change(current_drive, 'mkdir', os.path.relpath(new_folder_path, current_drive))
+        print(f"Pasta criada com sucesso: {new_folder_path}")
+
+        return jsonify({'success': True})
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao criar pasta: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/rename', methods=['POST'])
+def rename():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        old_path = data.get('old_path', '').strip('/').strip('\\')
+        new_name = secure_filename(data.get('new_name', '').strip())
+
+        if not new_name:
+            return jsonify({'error': 'Nome inválido'}), 400
+        new_rel = posixpath.join(posixpath.dirname(old_path.replace('\\', '/')), new_name)
+        if not old_path or is_trash_path(old_path) or is_trash_path(new_rel):
+            return jsonify({'error': 'Caminho inválido'}), 400
+
+        full_old_path = resolve_path(current_drive, old_path)
+        # Arquivo frio: renomeia a cópia comprimida, mantendo o sufixo
+        cold = cold_copy(full_old_path)
+        if cold:
+            full_old_path, new_name = cold, new_name + cold_suffix(cold)
+        
+        if not os.path.exists(full_old_path):
+            return jsonify({'error': 'Arquivo ou pasta não encontrado'}), 404
+
+        parent_directory = os.path.dirname(full_old_path)
+        full_new_path = os.path.join(parent_directory, new_name)
+        
+        if os.path.exists(full_new_path) or cold_twins(full_new_path):
+            return jsonify({'error': 'Já existe um item com este nome'}), 400
+
+        shutil.move(full_old_path, full_new_path)
+        quota_tracker.moved(full_old_path, full_new_path)
+        move_access(full_old_path, full_new_path)
+        journal_change(current_drive, 'move', os.path.relpath(full_old_path, current_drive),
+                       os.path.relpath(full_new_path, current_drive))
+        forget_resolved_paths(full_old_path, full_new_path)
+        return jsonify({'success': True})
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao renomear: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/delete', methods=['POST'])
+def delete():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        paths = [path.strip('/').strip('\\') for path in data.get('selected', [])]
+        paths = [path for path in paths if path and not is_trash_path(path)]
         
-        ['dragenter', 'dragover'].forEach(eventName => {
-            dropZone.addEventListener(eventName, () => dropZone.classList.add('dragover'));
-        });
+        deleted = []
+        for path, full_path in zip(paths, resolve_paths(current_drive, paths)):
+            cold = cold_copy(full_path)
+            if cold:
+                path, full_path = path + cold_suffix(cold), cold
+            if os.path.lexists(full_path):
+                # Vai para a lixeira; a remoção física fica com o limpador
+                move_to_trash(current_drive, full_path, path)
+                journal_change(current_drive, 'delete', path)
+                deleted.append(full_path)
         
-        ['dragleave', 'drop'].forEach(eventName => {
-            dropZone.addEventListener(eventName, () => dropZone.classList.remove('dragover'));
-        });
+        if deleted:
+            forget_resolved_paths(*deleted)
+        return jsonify({'success': True, 'deleted': len(deleted)})
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao apagar: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/move', methods=['POST'])
+def move():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        target_rel = data.get('target_path', '').strip('/').strip('\\')
+        paths = data.get('selected', [])
         
-        dropZone.addEventListener('drop', e => uploadFiles(e.dataTransfer.files));
-        dropZone.addEventListener('click', () => document.getElementById('file-input').click());
+        if not target_rel or is_trash_path(target_rel):
+            return jsonify({'error': 'Destino inválido'}), 400
         
-        document.getElementById('file-input').addEventListener('change', function() {
-            uploadFiles(this.files);
-        });
+        target_full = resolve_path(current_drive, target_rel)
         
-        // Upload
-        function uploadFiles(files) {
-            if (!files || files.length === 0) return;
-            
-            const progressDiv = document.getElementById('upload-progress');
-            const progressBar = document.getElementById('progress-bar');
-            const progressPercent = document.getElementById('progress-percent');
-            const progressSpeed = document.getElementById('progress-speed');
-            
-            progressDiv.style.display = 'block';
-            
-            const formData = new FormData();
-            formData.append('path', currentPath);
-            formData.append('drive', currentDrive);
-            Array.from(files).forEach(file => formData.append('files[]', file));
-            
-            const startTime = Date.now();
-            const xhr = new XMLHttpRequest();
-            
-            xhr.upload.addEventListener('progress', e => {
-                if (e.lengthComputable) {
-                    const percent = (e.loaded / e.total) * 100;
-                    progressBar.style.width = percent + '%';
-                    progressPercent.textContent = Math.round(percent) + '%';
-                    
-                    const elapsed = (Date.now() - startTime) / 1000;
-                    const speed = e.loaded / elapsed;
-                    progressSpeed.textContent = formatSize(speed) + '/s';
-                }
-            });
-            
-            xhr.addEventListener('load', () => {
-                if (xhr.status === 200) {
-                    setTimeout(() => location.reload(), 500);
-                } else {
-                    alert('Erro no upload!');
-                    progressDiv.style.display = 'none';
-                }
-            });
-            
-            xhr.addEventListener('error', () => {
-                alert('Erro na conexão!');
-                progressDiv.style.display = 'none';
-            });
-            
-            xhr.open('POST', '/upload');
-            xhr.send(formData);
-        }
+        if not os.path.exists(target_full):
+            os.makedirs(target_full, exist_ok=True)
         
-        function formatSize(bytes) {
-            const units = ['B', 'KB', 'MB', 'GB'];
-            let i = 0;
-            while (bytes >= 1024 && i < units.length - 1) {
-                bytes /= 1024;
-                i++;
-            }
-            return bytes.toFixed(2) + ' ' + units[i];
-        }
+        paths = [path.strip('/').strip('\\') for path in paths]
+        paths = [path for path in paths if path and not is_trash_path(path)]
         
-        // Preview
-        function previewFile(path, isImage, isVideo) {
-            if (!isImage && !isVideo) return;
+        moved = 0
+        touched = []
+        for full_old in resolve_paths(current_drive, paths):
+            full_old = cold_copy(full_old) or full_old
+            if not os.path.exists(full_old):
+                continue
             
-            const container = document.getElementById('preview-container');
-            container.innerHTML = '<p>Carregando...</p>';
+            basename = os.path.basename(full_old)
+            full_new = os.path.join(target_full, basename)
             
-            fetch('/preview?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive))
-                .then(response => response.json())
-                .then(data => {
-                    if (isImage) {
-                        container.innerHTML = `<img src="data:${data.mime};base64,${data.base64}" class="preview-content" alt="Preview">`;
-                    } else if (isVideo) {
-                        container.innerHTML = `<video controls class="preview-content">
-                            <source src="data:${data.mime};base64,${data.base64}" type="${data.mime}">
-                        </video>`;
-                    }
-                    document.getElementById('preview-modal').classList.add('active');
-                })
-                .catch(error => {
-                    alert('Erro ao carregar: ' + error);
-                    container.innerHTML = '';
-                });
-        }
-        
-        // Modais
-        function showCreateFolder() {
-            document.getElementById('folder-modal').classList.add('active');
-            document.getElementById('folder-name').focus();
-        }
-        
-        function showMoveModal() {
-            const selected = getSelectedItems();
-            if (selected.length === 0) {
-                alert('Selecione itens para mover');
-                return;
-            }
-            document.getElementById('move-modal').classList.add('active');
-            document.getElementById('target-folder').focus();
-        }
-        
-        function closeModal(id) {
-            document.getElementById(id).classList.remove('active');
-        }
+            if full_old != full_new and not os.path.exists(full_new) and not cold_twins(full_new):
+                quota_error = quota_tracker.check_copy(full_old, full_new, move=True)
+                if quota_error:
+                    if touched:
+                        forget_resolved_paths(*touched)
+                    return jsonify({'error': quota_error, 'moved': moved}), 507
+                shutil.move(full_old, full_new)
+                quota_tracker.moved(full_old, full_new)
+                move_access(full_old, full_new)
+                journal_change(current_drive, 'move', os.path.relpath(full_old, current_drive),
+                               os.path.relpath(full_new, current_drive))
+                touched += [full_old, full_new]
+                moved += 1
         
-        // Criar pasta
-        function createFolder(e) {
-            e.preventDefault();
-            const folderName = document.getElementById('folder-name').value.trim();
-            if (!folderName) return;
-            
-            fetch('/create_folder', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    path: currentPath,
-                    folder_name: folderName,
-                    drive: currentDrive
-                })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    location.reload();
-                } else {
-                    alert('Erro: ' + (data.error || 'Desconhecido'));
-                }
-            })
-            .catch(error => alert('Erro ao criar pasta: ' + error));
-        }
+        if touched:
+            forget_resolved_paths(*touched)
+        return jsonify({'success': True, 'moved': moved})
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao mover: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        operations = data.get('operations', [])
+        if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+            return jsonify({'error': 'Lista de operações inválida'}), 400
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            return jsonify({'error': f'Máximo de {BATCH_MAX_OPERATIONS} operações por lote'}), 400
+
+        results = run_batch(current_drive, operations)
+        failed = sum(1 for r in results if not r['success'])
+        return jsonify({'success': failed == 0, 'failed': failed, 'results': results})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro no lote: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/download')
+def download_file():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
         
-        // Mover itens
-        function moveItems(e) {
-            e.preventDefault();
-            const targetFolder = document.getElementById('target-folder').value.trim();
-            const selected = getSelectedItems();
-            
-            if (!targetFolder || selected.length === 0) return;
-            
-            fetch('/move', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    path: currentPath,
-                    target_path: targetFolder,
-                    selected: selected,
-                    drive: currentDrive
-                })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    location.reload();
-                } else {
-                    alert('Erro: ' + (data.error || 'Desconhecido'));
-                }
-            })
-            .catch(error => alert('Erro ao mover: ' + error));
-        }
+        if os.path.exists(full_path) and not os.path.isdir(full_path):
+            note_access(full_path)
+            # Com a soma já conhecida, ela vira o ETag forte e o cabeçalho de integridade
+            checksums = file_checksums(full_path)
+            if checksums is None:
+                return send_file(full_path, as_attachment=True)
+            response = send_file(full_path, as_attachment=True,
+                                 etag=True if checksums['corrupt'] else checksums['sha256'])
+            response.headers.update(checksum_headers(checksums))
+            return response
         
-        // Renomear
-        function renameItem(path, oldName) {
-            const newName = prompt('Novo nome:', oldName);
-            if (!newName || newName === oldName) return;
-            
-            fetch('/rename', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    old_path: path,
-                    new_name: newName,
-                    drive: currentDrive
-                })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    location.reload();
-                } else {
-                    alert('Erro: ' + (data.error || 'Desconhecido'));
-                }
-            })
-            .catch(error => alert('Erro ao renomear: ' + error));
-        }
+        # Arquivo no armazenamento frio: descomprimido durante o envio
+        cold = cold_copy(full_path)
+        if cold:
+            return send_cold_file(cold, as_attachment=request.args.get('inline') != '1')
         
-        // Download múltiplo
-        function downloadSelected() {
-            const selected = getSelectedItems();
-            if (selected.length === 0) {
-                alert('Selecione itens para baixar');
-                return;
-            }
-            selected.forEach(path => {
-                const url = '/download?filename=' + encodeURIComponent(path) + '&drive=' + encodeURIComponent(currentDrive);
-                window.open(url, '_blank');
-            });
-        }
+        # Membro de um .zip: enviado direto do arquivo, sem extrair
+        archive = split_archive_path(current_drive, full_path)
+        if archive and archive[1]:
+            return send_archive_member(*archive, as_attachment=request.args.get('inline') != '1')
         
-        // Apagar
-        function deleteSelected() {
-            const selected = getSelectedItems();
-            if (selected.length === 0) {
-                alert('Selecione itens para apagar');
-                return;
-            }
-            if (!confirm(`Apagar ${selected.length} item(ns)?`)) return;
-            
-            fetch('/delete', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    path: currentPath,
-                    selected: selected,
-                    drive: currentDrive
-                })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    location.reload();
-                } else {
-                    alert('Erro: ' + (data.error || 'Desconhecido'));
-                }
-            })
-            .catch(error => alert('Erro ao apagar: ' + error));
-        }
+        return "Arquivo não encontrado", 404
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro no download: {e}")
+        return str(e), 500
+
+@app.route('/preview')
+def preview_file():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+        source = cold_copy(full_path)
         
-        function getSelectedItems() {
-            return Array.from(document.querySelectorAll('.item-checkbox:checked')).map(cb => cb.value);
-        }
+        if source is None and (not os.path.exists(full_path) or os.path.isdir(full_path)):
+            return jsonify({'error': 'Arquivo não encontrado'}), 404
         
-        // Fechar modal ao clicar fora
-        document.querySelectorAll('.modal').forEach(modal => {
-            modal.addEventListener('click', function(e) {
-                if (e.target === this) {
-                    this.classList.remove('active');
-                }
-            });
-        });
-    </script>
-</body>
-</html>
-'''
+        if source is None:
+            source = full_path
+            size = os.path.getsize(full_path)
+            note_access(full_path)
+        else:
+            size = cold_logical_size(source)
+            if size is None:
+                return jsonify({'error': 'Arquivo comprimido corrompido'}), 415
+        if size > 50 * 1024 * 1024:
+            return jsonify({'error': 'Arquivo muito grande para preview'}), 400
+        
+        # O arquivo, o base64 e o JSON ficam em memória até a resposta ser enviada
+        cost = size * PREVIEW_MEMORY_FACTOR
+        if not admission_controller.reserve_memory(cost):
+            return overloaded_response('preview')
+        try:
+            with (open_cold(source) if source != full_path else open(full_path, 'rb')) as f:
+                data = f.read()
+            
+            mime = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+            base64_data = b64encode(data).decode('utf-8')
+            del data
+            
+            response = jsonify({'base64': base64_data, 'mime': mime})
+        except BaseException:
+            admission_controller.release_memory(cost)
+            raise
+        response.call_on_close(lambda: admission_controller.release_memory(cost))
+        return response
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro no preview: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/rendition')
+def rendition():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+
+        cold = cold_copy(full_path)
+        if cold and is_image(full_path):
+            # Imagem no armazenamento frio: vai o original descomprimido, sem miniatura
+            return send_cold_file(cold, as_attachment=False)
+        if not os.path.isfile(full_path) or not is_image(full_path):
+            return jsonify({'error': 'Imagem não encontrada'}), 404
+
+        try:
+            requested = int(request.args.get('w', 1280))
+        except ValueError:
+            return jsonify({'error': 'Largura inválida'}), 400
+
+        fmt = choose_rendition_format(request.headers.get('Accept'))
+
+        # GIF pode ser animado; sem Pillow não há como redimensionar
+        if fmt is None or full_path.lower().endswith('.gif'):
+            return send_file(full_path, conditional=True, max_age=3600)
+
+        try:
+            target = render_image(full_path, choose_rendition_width(requested), fmt)
+        except Exception as e:
+            print(f"Erro ao gerar miniatura de {full_path}: {e}")
+            return send_file(full_path, conditional=True, max_age=3600)
+
+        response = send_file(target, mimetype=RENDITION_MIMES[fmt], conditional=True, max_age=86400)
+        response.headers['Vary'] = 'Accept'
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro na miniatura: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/document_preview')
+def preview_document():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+        cold = cold_copy(full_path)
+
+        if not cold and not os.path.isfile(full_path):
+            return jsonify({'error': 'Arquivo não encontrado'}), 404
+        if not is_document(full_path):
+            return jsonify({'error': 'Tipo de arquivo sem preview'}), 415
+        if cold:
+            # Só o começo é descomprimido; o visualizador descomprime o resto se for aberto
+            result = document_preview(cold)
+        else:
+            note_access(full_path)
+
+            if full_path.lower().endswith('.pdf'):
+                if not pdf_renderer_available():
+                    return jsonify({'error': 'Instale o poppler (pdftoppm) ou o PyMuPDF para ver PDFs'}), 415
+                page_url = url_for('preview_document_page', drive=request.args.get('drive', 'DADOS'), filename=filename)
+                return jsonify({'kind': 'image', 'url': page_url, 'size': os.path.getsize(full_path)})
+
+            result = document_preview(full_path)
+        if result.get('truncated') and is_text(full_path):
+            # Arquivo grande: o visualizador lê qualquer trecho sob demanda
+            result = dict(result, viewer=url_for('text_viewer', drive=request.args.get('drive', 'DADOS'), filename=filename))
+        return jsonify(result)
+
+    except (zipfile.BadZipFile, KeyError, ET.ParseError):
+        return jsonify({'error': 'Documento corrompido ou em formato não suportado'}), 415
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro no preview de documento: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/document_preview/page')
+def preview_document_page():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+
+        if not os.path.isfile(full_path) or not full_path.lower().endswith('.pdf'):
+            return "Arquivo não encontrado", 404
+
+        try:
+            target = render_pdf_first_page(full_path)
+        except subprocess.TimeoutExpired:
+            return "Tempo esgotado ao renderizar o PDF", 504
+        except subprocess.CalledProcessError:
+            return "Não foi possível renderizar o PDF", 415
+
+        return send_file(target, mimetype='image/png', conditional=True, max_age=86400)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao renderizar PDF: {e}")
+        return str(e), 500
+
+@app.route('/text')
+def text_viewer():
+    raw_drive = request.args.get('drive', 'DADOS')
+    current_drive = drive_root_or_abort(raw_drive)
+    filename = request.args.get('filename', '').strip('/').strip('\\')
+    full_path = resolve_path(current_drive, filename)
+    cold = cold_copy(full_path)
+    if cold:
+        size = cold_logical_size(cold) or os.path.getsize(cold)
+    elif os.path.isfile(full_path):
+        size = os.path.getsize(full_path)
+        note_access(full_path)
+    else:
+        return "Arquivo não encontrado", 404
+    return render_template_string(TEXT_VIEWER_TEMPLATE, current_drive_for_url=raw_drive, filename=filename,
+                                  name=os.path.basename(full_path), parent=posixpath.dirname(filename.replace('\\', '/')),
+                                  size=format_size(size))
+
+@app.route('/text/lines')
+@app.route('/text/tail', endpoint='text_tail')
+def text_lines():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+        source = text_file_source(full_path)
+        if source is None:
+            return jsonify({'error': 'Arquivo não encontrado'}), 404
+
+        try:
+            start = int(request.args.get('start', 1))
+            count = int(request.args.get('count', 500))
+        except ValueError:
+            return jsonify({'error': 'Parâmetros inválidos'}), 400
+
+        result = read_text_lines(source, start, count, tail=request.endpoint == 'text_tail')
+        if result is None:
+            return jsonify({'error': 'Arquivo binário ou em codificação não suportada'}), 415
+        return jsonify(result)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao ler linhas: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/text/grep')
+def text_grep():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+        source = text_file_source(full_path)
+        if source is None:
+            return jsonify({'error': 'Arquivo não encontrado'}), 404
+
+        query = request.args.get('q', '')
+        if not query:
+            return jsonify({'error': 'Busca vazia'}), 400
+        ignore_case = request.args.get('case') != '1'
+        try:
+            start = int(request.args.get('start', 1))
+            limit = min(int(request.args.get('max', TEXT_GREP_MAX)), TEXT_GREP_MAX)
+        except ValueError:
+            return jsonify({'error': 'Parâmetros inválidos'}), 400
+
+        def generate():
+            # Uma linha JSON por resultado ({line, text}), com {progress} entre os blocos e {done} no fim
+            for item in grep_text(source, query, ignore_case, start, limit):
+                yield json.dumps(item, ensure_ascii=False) + '\n'
+
+        return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro na busca em texto: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/video/poster')
+@app.route('/video/sprite', endpoint='video_sprite')
+def video_poster():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        filename = request.args.get('filename', '').strip('/').strip('\\')
+        full_path = resolve_path(current_drive, filename)
+
+        if not os.path.isfile(full_path) or not is_video(full_path):
+            return jsonify({'error': 'Vídeo não encontrado'}), 404
+
+        poster, sprite, failed = video_preview_paths(full_path, os.stat(full_path))
+        target = sprite if request.endpoint == 'video_sprite' else poster
+        if os.path.exists(target):
+            return send_file(target, mimetype='image/jpeg', conditional=True, max_age=86400)
+        if os.path.exists(failed):
+            return jsonify({'error': 'Não foi possível extrair quadros deste vídeo'}), 415
+        if not video_previews_available():
+            return jsonify({'error': 'Instale o ffmpeg para ver prévias de vídeos'}), 415
+
+        # Ainda não extraído: a interface tenta de novo em instantes
+        schedule_video_previews(full_path)
+        return jsonify({'pending': True}), 202, {'Retry-After': '2'}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro na prévia de vídeo: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/media/search')
+def media_search():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        base = resolve_path(current_drive, request.args.get('path', ''))
+        prefix = base.rstrip(os.sep) + os.sep
+        query = 'SELECT path, kind, taken_at, width, height, duration, lat, lon FROM media WHERE substr(path, 1, ?) = ?'
+        params = [len(prefix), prefix]
+
+        # Datas no formato AAAA-MM-DD; o fim do intervalo inclui o dia inteiro
+        if request.args.get('from'):
+            query += ' AND taken_at >= ?'
+            params.append(datetime.strptime(request.args['from'], '%Y-%m-%d').timestamp())
+        if request.args.get('to'):
+            query += ' AND taken_at < ?'
+            params.append(datetime.strptime(request.args['to'], '%Y-%m-%d').timestamp() + 24 * 3600)
+        if request.args.get('kind') in ('image', 'video'):
+            query += ' AND kind = ?'
+            params.append(request.args['kind'])
+        if request.args.get('q'):
+            query += " AND name LIKE ? ESCAPE '\\'"
+            term = request.args['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f"%{term}%")
+
+        limit = min(int(request.args.get('limit', 500)), 5000)
+        query += ' ORDER BY taken_at DESC LIMIT ?'
+        params.append(limit)
+
+        with metadata_db() as conn:
+            rows = conn.execute(query, params).fetchall()
+        results = []
+        for row in rows:
+            item = dict(zip(('path', 'kind', 'taken_at', 'width', 'height', 'duration', 'lat', 'lon'), row))
+            item['path'] = os.path.relpath(item['path'], current_drive).replace(os.sep, '/')
+            results.append(item)
+
+        return jsonify({'success': True, 'items': results})
+
+    except ValueError:
+        return jsonify({'error': 'Parâmetros inválidos'}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro na busca de mídia: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/media/scan', methods=['POST'])
+def media_scan():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        full_path = resolve_path(current_drive, data.get('path', ''))
+        if not os.path.isdir(full_path):
+            return jsonify({'error': 'Pasta não encontrada'}), 404
+
+        threading.Thread(target=scan_media_tree, args=(full_path,), name='metadados-scan', daemon=True).start()
+        return jsonify({'success': True}), 202
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao iniciar varredura: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/manifest.webmanifest')
+def web_manifest():
+    manifest = {
+        'name': 'Vyrex-Box',
+        'short_name': 'Vyrex',
+        'start_url': '/',
+        'scope': '/',
+        'display': 'standalone',
+        'background_color': '#1a1a1a',
+        'theme_color': '#0061ff',
+        'icons': [{'src': '/icon.svg', 'sizes': 'any', 'type': 'image/svg+xml', 'purpose': 'any maskable'}],
+    }
+    return app.response_class(json.dumps(manifest), mimetype='application/manifest+json')
+
+@app.route('/icon.svg')
+def app_icon():
+    return app.response_class(APP_ICON_SVG, mimetype='image/svg+xml', headers={'Cache-Control': 'max-age=86400'})
+
+@app.route('/sw.js')
+def service_worker():
+    # Sem cache HTTP: o navegador precisa enxergar versões novas do service worker
+    return app.response_class(SERVICE_WORKER_JS.replace('__VERSION__', SW_VERSION),
+                              mimetype='application/javascript',
+                              headers={'Cache-Control': 'no-cache', 'Service-Worker-Allowed': '/'})
+
+@app.route('/gallery')
+def gallery():
+    raw_drive = request.args.get('drive', 'DADOS')
+    if resolve_drive(raw_drive) is None:
+        raw_drive = 'DADOS'
+    current_path = request.args.get('path', '').strip('/').strip('\\')
+    return render_template_string(GALLERY_TEMPLATE, current_drive_for_url=raw_drive, current_path=current_path)
+
+@app.route('/gallery/api')
+def gallery_api():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        base = resolve_path(current_drive, request.args.get('path', ''))
+        cursor = None
+        if request.args.get('before'):
+            cursor = (float(request.args['before']),
+                      _join_relative(current_drive, request.args.get('before_path', '')))
+        limit = min(int(request.args.get('limit', GALLERY_PAGE_SIZE)), GALLERY_PAGE_SIZE)
+        by_month = request.args.get('group') == 'month'
+
+        rows = gallery_page(base, cursor, limit)
+        groups = []
+        for index, (rowid, path, kind, sort_at, taken_at, width, height, duration, mtime_ns) in enumerate(rows):
+            when = datetime.fromtimestamp(sort_at)
+            key = when.strftime('%Y-%m' if by_month else '%Y-%m-%d')
+            if not groups or groups[-1]['key'] != key:
+                groups.append({'key': key, 'label': when.strftime('%m/%Y' if by_month else '%d/%m/%Y'), 'items': []})
+            groups[-1]['items'].append({
+                'id': rowid,
+                'path': os.path.relpath(path, current_drive).replace(os.sep, '/'),
+                'kind': kind,
+                'sort_at': sort_at,
+                'has_capture_date': taken_at is not None,
+                'width': width,
+                'height': height,
+                'duration': duration,
+                'sprite_index': index,
+            })
+
+        sprite = None
+        if rows and Image is not None:
+            sprite = {
+                'url': url_for('gallery_sprite', drive=request.args.get('drive', 'DADOS'),
+                               ids=','.join(str(row[0]) for row in rows), tile=GALLERY_TILE),
+                'tile': GALLERY_TILE,
+                'columns': min(SPRITE_COLUMNS, len(rows)),
+            }
+
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = {'before': last[3], 'before_path': os.path.relpath(last[1], current_drive).replace(os.sep, '/')}
+
+        return jsonify({'success': True, 'groups': groups, 'sprite': sprite, 'next': next_cursor})
+
+    except ValueError:
+        return jsonify({'error': 'Parâmetros inválidos'}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro na galeria: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/gallery/sprite')
+def gallery_sprite():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        if Image is None:
+            return "Pillow não instalado", 501
+
+        ids = [int(x) for x in request.args.get('ids', '').split(',') if x][:GALLERY_PAGE_SIZE]
+        tile = min(max(int(request.args.get('tile', GALLERY_TILE)), 64), 320)
+        if not ids:
+            return "Nenhum item", 400
+
+        placeholders = ','.join('?' * len(ids))
+        with metadata_db() as conn:
+            found = {row[0]: row[1:] for row in conn.execute(
+                f'SELECT rowid, path, mtime_ns, kind FROM media WHERE rowid IN ({placeholders})', ids)}
+
+        # Itens removidos do índice viram espaços vazios, mantendo as posições
+        rows = []
+        for rowid in ids:
+            path, mtime_ns, kind = found.get(rowid, (None, 0, 'missing'))
+            if path is not None and not _is_within(current_drive, path):
+                abort(403)
+            rows.append((path, mtime_ns, kind))
+
+        target = render_sprite(rows, tile)
+        return send_file(target, mimetype='image/jpeg', conditional=True, max_age=86400)
+
+    except ValueError:
+        return "Parâmetros inválidos", 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro no sprite: {e}")
+        return str(e), 500
+
+@app.route('/trash')
+def trash_list():
+    current_drive = drive_root_or_abort(request.args.get('drive', 'DADOS'))
+
+    try:
+        items = list_trash(current_drive)
+        for item in items:
+            item['deleted_at_str'] = datetime.fromtimestamp(item['deleted_at']).strftime('%d/%m/%Y %H:%M')
+            item['size_str'] = '-' if item.get('size') is None else format_size(item['size'])
+            item['icon'] = get_file_icon(item['name'], item['is_dir'])
+
+        return jsonify({'success': True, 'items': items})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao listar lixeira: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/trash/restore', methods=['POST'])
+def trash_restore():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        restored = []
+        errors = []
+        for trash_id in data.get('ids', []):
+            try:
+                restored.append(restore_from_trash(current_drive, trash_id))
+                journal_change(current_drive, 'put', restored[-1])
+            except (OSError, ValueError) as e:
+                errors.append({'id': trash_id, 'error': str(e)})
+
+        return jsonify({'success': not errors, 'restored': restored, 'errors': errors})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao restaurar: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/trash/empty', methods=['POST'])
+def trash_empty():
+    data = request.get_json(silent=True) or {}
+    current_drive = drive_root_or_abort(data.get('drive', 'DADOS'))
+
+    try:
+        # Sem ids, esvazia a lixeira inteira
+        ids = data.get('ids')
+        if ids is None:
+            ids = [item['id'] for item in list_trash(current_drive)]
+
+        discarded = discard_from_trash(current_drive, ids)
+        return jsonify({'success': True, 'discarded': discarded})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao esvaziar lixeira: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/duplicates')
+def duplicates_report():
+    try:
+        limit = request.args.get('limit', 200, type=int)
+        report = duplicate_scanner.report(limit)
+        for group in report['groups']:
+            group['size_str'] = format_size(group['size'])
+            group['wasted_str'] = format_size(group['wasted'])
+        return jsonify({'success': True, 'wasted_str': format_size(report['wasted']), **report})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao ler relatório de duplicados: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/duplicates/scan', methods=['POST'])
+def duplicates_scan():
+    data = request.get_json(silent=True) or {}
+
+    try:
+        # Sem lista, procura em DADOS e em todos os drives
+        drives = data.get('drives') or ['DADOS'] + [d.rstrip(os.sep) or d for d in available_drives()]
+        for raw_drive in drives:
+            drive_root_or_abort(raw_drive)
+        min_size = parse_size(data['min_size']) if data.get('min_size') else DUPLICATE_MIN_SIZE
+
+        if not duplicate_scanner.start(drives, min_size):
+            return jsonify({'error': 'Já existe uma busca em andamento'}), 409
+        return jsonify({'success': True, 'status': duplicate_scanner.status}), 202
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao iniciar busca de duplicados: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/duplicates/resolve', methods=['POST'])
+def duplicates_resolve():
+    data = request.get_json(silent=True) or {}
+
+    try:
+        results = duplicate_scanner.resolve(data.get('hash'), data.get('keep') or {},
+                                            data.get('remove', []), data.get('action'))
+        failed = sum(1 for r in results if not r['success'])
+        return jsonify({'success': not failed, 'failed': failed, 'results': results})
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao resolver duplicados: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/list')
+def api_list():
+    # Aceita também o nome do drive usado no WebDAV (ex: 'C' para 'C:')
+    raw_drive = request.args.get('drive', 'DADOS')
+    current_drive = drive_root_or_abort(dav_drives().get(raw_drive, raw_drive))
+
+    try:
+        base_rel = request.args.get('path', '').strip('/').strip('\\')
+        base = resolve_path(current_drive, base_rel)
+        if not os.path.isdir(base):
+            return jsonify({'error': 'Pasta não encontrada'}), 404
+        recursive = request.args.get('recursive') == '1'
+        with_checksums = request.args.get('checksums') == '1'
+
+        def generate():
+            # Uma linha JSON por item: [caminho relativo, é pasta, tamanho, mtime_ns];
+            # com checksums=1, o SHA-256 vem em quinto (null enquanto não foi calculado)
+            stack = [('', base)]
+            while stack:
+                rel, directory = stack.pop()
+                try:
+                    entries = logical_entries(list_directory(directory))
+                except OSError:
+                    continue
+                lines = []
+                for entry in entries:
+                    if not rel and not base_rel and entry['name'] == TRASH_DIRNAME:
+                        continue
+                    child = f"{rel}/{entry['name']}" if rel else entry['name']
+                    row = [child, entry['is_dir'], entry['size'], entry['mtime_ns']]
+                    if with_checksums:
+                        checksums = None
+                        if not entry['is_dir'] and not entry['is_link'] and not entry.get('cold'):
+                            try:
+                                checksums = file_checksums(os.path.join(directory, entry['name']))
+                            except OSError:
+                                pass
+                        row.append(checksums['sha256'] if checksums else None)
+                    lines.append(json.dumps(row) + '\n')
+                    # Symlinks aparecem na lista mas não são percorridos (podem sair do drive)
+                    if recursive and entry['is_dir'] and not entry['is_link']:
+                        stack.append((child, os.path.join(directory, entry['name'])))
+                yield ''.join(lines)
+
+        return app.response_class(generate(), mimetype='application/x-ndjson')
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao listar (API): {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/tree')
+def api_tree():
+    raw_drive = request.args.get('drive', 'DADOS')
+    current_drive = drive_root_or_abort(dav_drives().get(raw_drive, raw_drive))
+
+    try:
+        base_rel = request.args.get('path', '').strip('/').strip('\\').replace('\\', '/')
+        base = resolve_path(current_drive, base_rel)
+        if not os.path.isdir(base):
+            return jsonify({'error': 'Pasta não encontrada'}), 404
+        try:
+            depth = min(max(int(request.args.get('depth', 1)), 1), TREE_MAX_DEPTH)
+        except ValueError:
+            return jsonify({'error': 'Profundidade inválida'}), 400
+
+        def folders(rel, directory, levels):
+            names = list_subdirectories(directory)
+            if not rel:
+                names = [name for name in names if name != TRASH_DIRNAME]
+            result = []
+            for name in names[:TREE_MAX_FOLDERS]:
+                child_rel = f"{rel}/{name}" if rel else name
+                child = os.path.join(directory, name)
+                node = {'name': name, 'path': child_rel}
+                try:
+                    if levels > 1:
+                        node['children'], node['truncated'] = folders(child_rel, child, levels - 1)
+                        node['has_children'] = bool(node['children'])
+                    else:
+                        # A seta de expandir só aparece se houver o que abrir
+                        node['has_children'] = bool(list_subdirectories(child))
+                except OSError:
+                    node['has_children'] = False
+                result.append(node)
+            return result, len(names) > TREE_MAX_FOLDERS
+
+        result, truncated = folders(base_rel, base, depth)
+        return jsonify({'path': base_rel, 'folders': result, 'truncated': truncated})
+
+    except PermissionError:
+        return jsonify({'error': 'Sem permissão para acessar esta pasta'}), 403
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao montar a árvore de pastas: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/delta/signature')
+def delta_signature_file():
+    # O cliente de sincronização usa o nome do drive no WebDAV (ex: 'C' para 'C:')
+    raw_drive = request.args.get('drive', 'DADOS')
+    current_drive = drive_root_or_abort(dav_drives().get(raw_drive, raw_drive))
+
+    try:
+        full_path = resolve_path(current_drive, request.args.get('path', ''))
+        # Arquivo frio: a assinatura sai do conteúdo descomprimido, sem reidratar
+        # (só o patch, se vier, devolve o arquivo à forma normal)
+        source = full_path if os.path.isfile(full_path) else cold_copy(full_path)
+        if source is None:
+            return jsonify({'error': 'Arquivo não encontrado'}), 404
+
+        size = os.path.getsize(source) if source == full_path else cold_logical_size(source)
+        if size is None:
+            return jsonify({'error': 'Arquivo comprimido corrompido'}), 415
+        block_size = delta_block_size(size, request.args.get('block'))
+        target = delta_signature(source, block_size)
+        return send_file(target, mimetype='application/octet-stream', conditional=True)
+
+    except ValueError:
+        return jsonify({'error': 'Tamanho de bloco inválido'}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro na assinatura delta: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/delta/patch', methods=['POST'])
+def delta_patch():
+    # O limite de upload não se aplica: o tamanho final é conferido abaixo contra
+    # a cota e o espaço livre (None voltaria ao MAX_CONTENT_LENGTH do app)
+    request.max_content_length = sys.maxsize
+    raw_drive = request.args.get('drive', 'DADOS')
+    current_drive = drive_root_or_abort(dav_drives().get(raw_drive, raw_drive))
+
+    try:
+        full_path = resolve_path(current_drive, request.args.get('path', ''))
+        cold = cold_copy(full_path)
+        if cold:
+            rehydrate(cold)
+        if not os.path.isfile(full_path):
+            return jsonify({'error': 'Arquivo não encontrado'}), 404
+
+        try:
+            block_size = int(request.args['block'])
+            base_mtime_ns = int(request.args['base_mtime_ns'])
+            base_size = int(request.args['base_size'])
+            target_size = int(request.args['target_size'])
+        except (KeyError, ValueError):
+            return jsonify({'error': 'Parâmetros block, base_mtime_ns, base_size e target_size são obrigatórios'}), 400
+        if block_size != delta_block_size(base_size, block_size):
+            return jsonify({'error': 'Tamanho de bloco inválido'}), 400
+        if target_size < 0:
+            return jsonify({'error': 'Tamanho final inválido'}), 400
+
+        # A cota e o disco são conferidos pelo tamanho final declarado antes de gravar
+        # qualquer byte (o temporário convive com o original até a troca);
+        # apply_delta recusa o patch se o resultado fugir dele
+        quota_error = quota_tracker.check(full_path, target_size - base_size) \
+            or disk_space_error(full_path, target_size)
+        if quota_error:
+            return jsonify({'error': quota_error}), 507
+
+        apply_delta(full_path, request.stream, block_size, base_mtime_ns, base_size, target_size)
+        quota_tracker.added(full_path, base_size)
+        apply_client_mtime(full_path)
+        journal_change(current_drive, 'put', os.path.relpath(full_path, current_drive))
+        st = os.stat(full_path)
+        return jsonify({'success': True, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+
+    except FileExistsError as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao aplicar patch: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def apply_client_mtime(full_path):
+    """Aplica o mtime (em ns) enviado pelo cliente de sincronização no X-Vyrex-Mtime."""
+    value = request.headers.get('X-Vyrex-Mtime', '')
+    if value.isdigit():
+        os.utime(full_path, ns=(int(value), int(value)))
+
+def dav_error(status, condition):
+    body = f'<?xml version="1.0" encoding="utf-8"?>\n<D:error xmlns:D="DAV:"><D:{condition}/></D:error>'
+    return body, status, {'Content-Type': 'application/xml; charset=utf-8'}
+
+def dav_locked(full_path, descendants=False):
+    return not dav_locks.allows(full_path, dav_submitted_tokens(), descendants)
+
+def dav_requested_props(xml):
+    if xml is None:
+        return None
+    if xml.find('{DAV:}propname') is not None:
+        return 'propname'
+    prop = xml.find('{DAV:}prop')
+    return None if prop is None else [child.tag for child in prop]
+
+def dav_multistatus_response(responses):
+    return app.response_class(stream_with_context(dav_multistatus(responses)), status=207,
+                              content_type='application/xml; charset=utf-8')
+
+def dav_propfind_drives():
+    depth = request.headers.get('Depth', 'infinity')
+    if depth not in ('0', '1'):
+        return dav_error(403, 'propfind-finite-depth')
+    requested = dav_requested_props(dav_request_xml())
+
+    now = time.time()
+    responses = [dav_response_xml(dav_href(None), {'name': 'dav', 'is_dir': True, 'size': 0, 'mtime': now,
+                                                   'mtime_ns': 0, 'ctime': now}, '', requested)]
+    if depth == '1':
+        for label, raw in dav_drives().items():
+            root = resolve_drive(raw)
+            try:
+                entry = _entry_info(label, os.stat(root))
+            except (OSError, TypeError):
+                continue
+            responses.append(dav_response_xml(dav_href(label, '', True), entry, root, requested))
+    return dav_multistatus_response(responses)
+
+def dav_propfind(label, root, rel, full_path):
+    depth = request.headers.get('Depth', 'infinity')
+    if depth not in ('0', '1'):
+        # Depth infinity percorreria o drive inteiro numa única resposta
+        return dav_error(403, 'propfind-finite-depth')
+    requested = dav_requested_props(dav_request_xml())
+
+    cold = cold_copy(full_path) if rel else None
+    if cold:
+        entry = logical_entries([dict(_entry_info(os.path.basename(cold), os.stat(cold)),
+                                      logical_size=cold_logical_size(cold))])[0]
+    else:
+        entry = _entry_info(os.path.basename(full_path) if rel else label, os.stat(full_path))
+    children = []
+    if entry['is_dir'] and depth == '1':
+        children = [child for child in logical_entries(list_directory(full_path))
+                    if rel or child['name'] != TRASH_DIRNAME]
+
+    def responses():
+        yield dav_response_xml(dav_href(label, rel, entry['is_dir']), entry, full_path, requested)
+        for child in children:
+            yield dav_response_xml(dav_href(label, posixpath.join(rel, child['name']), child['is_dir']),
+                                   child, os.path.join(full_path, child['name']), requested)
+
+    return dav_multistatus_response(responses())
+
+def dav_proppatch(label, root, rel, full_path):
+    st = os.stat(full_path)
+    if dav_locked(full_path):
+        return dav_error(423, 'lock-token-submitted')
+    xml = dav_request_xml()
+    if xml is None:
+        return 'Corpo XML obrigatório', 400
+
+    updates = []
+    for action in xml:
+        if action.tag not in ('{DAV:}set', '{DAV:}remove'):
+            continue
+        for prop in action.findall('{DAV:}prop'):
+            for child in prop:
+                updates.append((child.tag, child.text if action.tag == '{DAV:}set' else None))
+
+    # Propriedades DAV: são calculadas pelo servidor; as demais não são guardadas,
+    # exceto a data de modificação enviada pelo Windows
+    protected = [tag for tag, _ in updates if tag.startswith('{DAV:}')]
+    if protected:
+        propstats = _dav_propstat([(tag, '') for tag in protected], '403 Forbidden')
+        others = [(tag, '') for tag, _ in updates if not tag.startswith('{DAV:}')]
+        if others:
+            propstats += _dav_propstat(others, '424 Failed Dependency')
+    else:
+        for tag, value in updates:
+            if tag == f'{{{MS_NAMESPACE}}}Win32LastModifiedTime' and value:
+                try:
+                    os.utime(full_path, (st.st_atime, parsedate_to_datetime(value).timestamp()))
+                    forget_listing(os.path.dirname(full_path))
+                    journal_change(root, 'put', rel)
+                except (TypeError, ValueError):
+                    pass
+        propstats = _dav_propstat([(tag, '') for tag, _ in updates], '200 OK')
+
+    href = dav_href(label, rel, stat.S_ISDIR(st.st_mode))
+    return dav_multistatus_response([f'<D:response><D:href>{xml_escape(href)}</D:href>{propstats}</D:response>'])
+
+def dav_name_error(full_path, is_dir=False):
+    """
+    Mesma regra do /upload para o que é gravado pelo WebDAV: o nome precisa já
+    estar higienizado (secure_filename) e arquivos só com extensões permitidas.
+    """
+    name = os.path.basename(full_path)
+    if secure_filename(name) != name:
+        return 'Nome não permitido', 403
+    if not is_dir and not allowed_file(name):
+        return 'Tipo de arquivo não permitido', 415
+    return None
+
+def dav_mkcol(label, root, rel, full_path):
+    if request.content_length:
+        return 'MKCOL com corpo não suportado', 415
+    if os.path.lexists(full_path):
+        return 'Já existe', 405
+    name_error = dav_name_error(full_path, is_dir=True)
+    if name_error:
+        return name_error
+    parent = os.path.dirname(full_path)
+    if not os.path.isdir(parent):
+        return 'Pasta pai não existe', 409
+    if dav_locked(full_path):
+        return dav_error(423, 'lock-token-submitted')
+
+    os.mkdir(full_path)
+    forget_listing(parent)
+    journal_change(root, 'mkdir', rel)
+    return '', 201
+
+def dav_get(label, root, rel, full_path):
+    st = os.stat(full_path)
+    if stat.S_ISDIR(st.st_mode):
+        # Navegador abrindo uma pasta: mostra a interface normal
+        return redirect(url_for('index', drive=dav_drives()[label], path=rel))
+    entry = _entry_info(os.path.basename(full_path), st)
+    note_access(full_path)
+    response = send_file(full_path, conditional=True, etag=dav_etag(entry), last_modified=st.st_mtime)
+    checksums = file_checksums(full_path, st)
+    if checksums is not None:
+        response.headers.update(checksum_headers(checksums))
+    return response
+
+def dav_put(label, root, rel, full_path):
+    # Sincronização e replicação mandam arquivos de qualquer tamanho por aqui;
+    # o limite é a cota e o espaço livre, conferidos antes e depois de receber
+    request.max_content_length = sys.maxsize
+    if os.path.isdir(full_path):
+        return 'Destino é uma pasta', 405
+    name_error = dav_name_error(full_path)
+    if name_error:
+        return name_error
+    parent = os.path.dirname(full_path)
+    if not os.path.isdir(parent):
+        return 'Pasta pai não existe', 409
+    if 'Content-Range' in request.headers:
+        return 'PUT parcial não suportado', 400
+    if dav_locked(full_path):
+        return dav_error(423, 'lock-token-submitted')
+
+    existed = os.path.exists(full_path)
+    old_size = os.path.getsize(full_path) if existed else 0
+    quota_error = quota_tracker.check(full_path, (request.content_length or 0) - old_size) \
+        or disk_space_error(full_path, request.content_length or 0)
+    if quota_error:
+        return quota_error, 507
+    # Grava num temporário na mesma pasta e troca de uma vez: leitores nunca
+    # veem um arquivo pela metade e um upload interrompido não estraga o original
+    temp_path = os.path.join(parent, f'.{os.path.basename(full_path)}.{uuid.uuid4().hex[:8]}.parcial')
+    try:
+        with open(temp_path, 'wb') as f:
+            shutil.copyfileobj(request.stream, f, DAV_PUT_CHUNK)
+        if request.content_length is None:
+            # Upload chunked: o tamanho só é conhecido agora
+            quota_error = quota_tracker.check(full_path, os.path.getsize(temp_path) - old_size)
+            if quota_error:
+                _remove_path(temp_path)
+                return quota_error, 507
+        with path_lock(full_path):
+            os.replace(temp_path, full_path)
+            drop_cold_copies(full_path)
+    except BaseException:
+        _remove_path(temp_path)
+        raise
+
+    quota_tracker.added(full_path, old_size)
+    apply_client_mtime(full_path)
+    schedule_checksums([full_path])
+    journal_change(root, 'put', rel)
+    forget_listing(parent)
+    entry = _entry_info(os.path.basename(full_path), os.stat(full_path))
+    return '', 204 if existed else 201, {'ETag': f'"{dav_etag(entry)}"'}
+
+def dav_delete(label, root, rel, full_path):
+    if not rel:
+        return 'Não é possível apagar a raiz do drive', 403
+    if not os.path.lexists(full_path):
+        return 'Não encontrado', 404
+    if dav_locked(full_path, descendants=True):
+        return dav_error(423, 'lock-token-submitted')
+
+    move_to_trash(root, full_path, rel)
+    dav_locks.drop_tree(full_path)
+    journal_change(root, 'delete', rel)
+    forget_resolved_paths(full_path)
+    return '', 204
+
+def dav_copy_move(label, root, rel, full_path):
+    destination = request.headers.get('Destination')
+    if not destination:
+        return 'Cabeçalho Destination ausente', 400
+    prefix = request.script_root + DAV_PREFIX + '/'
+    dest_path = unquote(urlsplit(destination).path)
+    if not dest_path.startswith(prefix):
+        return 'Destino fora deste servidor', 502
+
+    dest_label, _, dest_rel = dest_path[len(prefix):].strip('/').partition('/')
+    dest_rel = dest_rel.strip('/')
+    dest_raw = dav_drives().get(dest_label)
+    if dest_raw is None or not dest_rel or is_trash_path(dest_rel) or not rel:
+        return 'Destino inválido', 403
+    dest_root = drive_root_or_abort(dest_raw)
+    dest_full = resolve_path(dest_root, dest_rel)
 
-# --- ROTAS DA APLICAÇÃO WEB ---
+    if not os.path.lexists(full_path):
+        return 'Não encontrado', 404
+    name_error = dav_name_error(dest_full, is_dir=os.path.isdir(full_path))
+    if name_error:
+        return name_error
+    if cold_suffix(full_path):
+        dest_full, dest_rel = dest_full + cold_suffix(full_path), dest_rel + cold_suffix(full_path)
+    if _is_within(full_path, dest_full):
+        return 'Destino dentro da origem', 403
+    if not os.path.isdir(os.path.dirname(dest_full)):
+        return 'Pasta de destino não existe', 409
 
-@app.route('/')
-def index():
-    raw_drive = request.args.get('drive', 'DADOS')
-    
-    # Se o drive for o identificador 'DADOS', usa o caminho completo da pasta DADOS
-    if raw_drive == 'DADOS':
-        current_drive = DATA_FOLDER
-    # Se for um drive de disco (ex: 'C:'), normaliza para 'C:\'
-    elif len(raw_drive) == 2 and raw_drive[1] == ':':
-        current_drive = raw_drive + os.sep
-    # Caso contrário, usa o valor recebido (não deveria acontecer, mas é seguro)
+    is_move = request.method == 'MOVE'
+    overwrite = request.headers.get('Overwrite', 'T').upper() != 'F'
+    replaced = [path for path in [dest_full] + cold_twins(dest_full) if path != full_path and os.path.lexists(path)]
+    dest_exists = bool(replaced)
+    if dest_exists and not overwrite:
+        return dav_error(412, 'no-overwrite')
+    if dav_locked(dest_full, descendants=True) or (is_move and dav_locked(full_path, descendants=True)):
+        return dav_error(423, 'lock-token-submitted')
+
+    quota_error = quota_tracker.check_copy(full_path, dest_full, move=is_move)
+    if quota_error:
+        return quota_error, 507
+
+    for path in replaced:
+        # O item substituído (e suas versões frias) vai para a lixeira, como no DELETE
+        move_to_trash(dest_root, path, os.path.relpath(path, dest_root).replace(os.sep, '/'))
+        dav_locks.drop_tree(path)
+
+    if is_move:
+        shutil.move(full_path, dest_full)
+        dav_locks.drop_tree(full_path)
+        quota_tracker.moved(full_path, dest_full)
+        move_access(full_path, dest_full)
     else:
-        current_drive = raw_drive
+        if os.path.isdir(full_path):
+            if request.headers.get('Depth') == '0':
+                os.mkdir(dest_full)
+            else:
+                shutil.copytree(full_path, dest_full, symlinks=True)
+        else:
+            shutil.copy2(full_path, dest_full)
+        quota_tracker.added(dest_full)
 
-    # Valida se o drive normalizado existe ou se é a pasta DADOS
-    all_possible_drives = get_drives()
-    if current_drive not in all_possible_drives and current_drive != DATA_FOLDER:
-        current_drive = DATA_FOLDER
-        raw_drive = 'DADOS'
+    if dest_root == root:
+        journal_change(root, 'move' if is_move else 'copy', rel, dest_rel)
+    else:
+        # Entre drives diferentes: só o lado que é a pasta DADOS interessa à réplica
+        if is_move:
+            journal_change(root, 'delete', rel)
+        journal_change(dest_root, 'put', dest_rel)
+    forget_resolved_paths(full_path, dest_full, *replaced)
+    return '', 204 if dest_exists else 201
+
+def dav_lock(label, root, rel, full_path):
+    xml = dav_request_xml()
+    timeout = dav_timeout()
+
+    if xml is None:
+        # LOCK sem corpo renova uma trava existente
+        lock = dav_locks.refresh(full_path, dav_submitted_tokens(), timeout)
+        if lock is None:
+            return dav_error(412, 'lock-token-matches-request-uri')
+        created = False
+    else:
+        scope = 'shared' if xml.find('{DAV:}lockscope/{DAV:}shared') is not None else 'exclusive'
+        owner = xml.find('{DAV:}owner')
+        owner = ET.tostring(owner, encoding='unicode') if owner is not None else ''
+        depth = '0' if request.headers.get('Depth') == '0' else 'infinity'
+
+        created = not os.path.lexists(full_path)
+        if created and not os.path.isdir(os.path.dirname(full_path)):
+            return 'Pasta pai não existe', 409
+
+        lock = dav_locks.acquire(full_path, dav_href(label, rel, os.path.isdir(full_path)), scope, depth, owner, timeout)
+        if lock is None:
+            return dav_error(423, 'no-conflicting-lock')
+        if created:
+            # Travar um nome livre cria um arquivo vazio (RFC 4918, 9.10.4)
+            open(full_path, 'ab').close()
+            forget_listing(os.path.dirname(full_path))
+
+    body = (f'<?xml version="1.0" encoding="utf-8"?>\n<D:prop xmlns:D="DAV:">'
+            f'<D:lockdiscovery>{dav_lock_xml(lock)}</D:lockdiscovery></D:prop>')
+    return body, 201 if created else 200, {'Lock-Token': f'<{lock["token"]}>',
+                                            'Content-Type': 'application/xml; charset=utf-8'}
+
+def dav_unlock(label, root, rel, full_path):
+    token = request.headers.get('Lock-Token', '').strip().strip('<>')
+    if not dav_locks.release(full_path, token):
+        return dav_error(409, 'lock-token-matches-request-uri')
+    return '', 204
+
+_DAV_HANDLERS = {
+    'PROPFIND': dav_propfind,
+    'PROPPATCH': dav_proppatch,
+    'MKCOL': dav_mkcol,
+    'GET': dav_get,
+    'HEAD': dav_get,
+    'PUT': dav_put,
+    'DELETE': dav_delete,
+    'COPY': dav_copy_move,
+    'MOVE': dav_copy_move,
+    'LOCK': dav_lock,
+    'UNLOCK': dav_unlock,
+}
+
+@app.route(DAV_PREFIX + '/', defaults={'path': ''}, methods=DAV_METHODS)
+@app.route(DAV_PREFIX + '/<path:path>', methods=DAV_METHODS)
+def webdav(path):
+    if request.method == 'OPTIONS':
+        return '', 200, {'DAV': '1, 2', 'MS-Author-Via': 'DAV', 'Allow': ', '.join(DAV_METHODS)}
+
+    label, _, rel = path.strip('/').partition('/')
+    rel = rel.strip('/')
+    if not label:
+        # Raiz do WebDAV: cada drive aparece como uma pasta
+        if request.method == 'PROPFIND':
+            return dav_propfind_drives()
+        if request.method in ('GET', 'HEAD'):
+            return redirect(url_for('index'))
+        return 'Operação não permitida na raiz', 405
+
+    raw_drive = dav_drives().get(label)
+    if raw_drive is None:
+        return 'Drive não encontrado', 404
+    current_drive = drive_root_or_abort(raw_drive)
+    if is_trash_path(rel):
+        # A lixeira só é acessível pelas rotas /trash
+        return 'Não encontrado', 404
 
-    current_path = request.args.get('path', '').strip('/').strip('\\')
-    
     try:
-        full_path = safe_path(current_drive, current_path)
-        
-        items = []
-        for item in os.listdir(full_path):
-            try:
-                item_path = os.path.join(full_path, item)
-                is_dir = os.path.isdir(item_path)
-                size = os.path.getsize(item_path) if not is_dir else 0
-                mtime = datetime.fromtimestamp(os.path.getmtime(item_path)).strftime('%d/%m/%Y %H:%M')
-                
-                # O caminho relativo para a URL deve sempre usar '/'
-                rel_item_path = f"{current_path}/{item}".replace('\\', '/') if current_path else item
-                
-                items.append({
-                    'name': item,
-                    'path': rel_item_path,
-                    'is_dir': is_dir,
-                    'size': size,
-                    'size_str': '-' if is_dir else format_size(size),
-                    'mtime': mtime,
-                    'icon': get_file_icon(item, is_dir),
-                    'is_image': is_image(item),
-                    'is_video': is_video(item)
-                })
-            except Exception as e:
-                print(f"Erro ao processar {item}: {e}")
-                continue
-        
-        items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
-        
+        full_path = resolve_path(current_drive, rel)
+        cold = cold_copy(full_path) if rel else None
+        if cold and request.method in ('GET', 'HEAD'):
+            return send_cold_file(cold, as_attachment=False)
+        if cold and request.method in ('DELETE', 'COPY', 'MOVE', 'PROPPATCH'):
+            # Arquivo frio: a operação vale para a cópia comprimida
+            full_path, rel = cold, rel + cold_suffix(cold)
+        return _DAV_HANDLERS[request.method](label, current_drive, rel, full_path)
+
+    except FileNotFoundError:
+        return 'Não encontrado', 404
     except PermissionError:
-        return "Sem permissão para acessar esta pasta", 403
+        return 'Sem permissão', 403
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro ao listar: {e}")
-        import traceback
-        traceback.print_exc()
-        return f"Erro ao listar arquivos: {e}", 500
-    
-    # Info do disco
-    try:
-        disk = psutil.disk_usage(current_drive)
-        total_gb = disk.total / (1024**3)
-        used_gb = disk.used / (1024**3)
-        free_gb = disk.free / (1024**3)
-        usage_percent = (used_gb / total_gb) * 100
-    except Exception:
-        total_gb = used_gb = free_gb = usage_percent = 0
-    
-    # Prepara as variáveis para o template
-    template_drives = [d.rstrip(os.sep) for d in get_drives()]
-    current_drive_for_url = raw_drive # Usa o identificador 'DADOS' ou 'C:'
-    
-    return render_template_string(
-        HTML_TEMPLATE,
-        items=items,
-        current_path=current_path,
-        current_drive=current_drive,           # Caminho completo (C:\) para lógica do JS
-        current_drive_for_url=current_drive_for_url, # Drive limpo (C:) para as URLs
-        drives=template_drives,                # Lista limpa (C:, D:) para o dropdown
-        data_folder=DATA_FOLDER,
-        total_gb=total_gb,
-        used_gb=used_gb,
-        free_gb=free_gb,
-        usage_percent=usage_percent
-    )
+        print(f"Erro no WebDAV ({request.method} {path}): {e}")
+        return str(e), 500
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    try:
-        raw_drive = request.form.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
-        else:
-            current_drive = raw_drive
+@app.before_request
+def admit_request():
+    kind = admission_class()
+    if kind is None:
+        return None
+    token = admission_controller.acquire(kind)
+    if token is None:
+        return overloaded_response(kind)
+    g.admission = (kind, time.monotonic(), token)
+    return None
 
-        current_path = request.form.get('path', '').strip('/').strip('\\')
-        
-        full_path = safe_path(current_drive, current_path)
-        
-        if 'files[]' not in request.files:
-            return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
-        
-        files = request.files.getlist('files[]')
-        saved_count = 0
-        
-        for file in files:
-            if file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                target_path = os.path.join(full_path, filename)
-                file.save(target_path)
-                saved_count += 1
-        
-        if saved_count == 0:
-            return jsonify({'error': 'Nenhum arquivo válido para upload'}), 400
-        
-        return jsonify({'success': True, 'saved': saved_count})
-    
-    except Exception as e:
-        print(f"Erro no upload: {e}")
-        return jsonify({'error': str(e)}), 500
+def _release_admission(admission):
+    kind, started, token = admission
+    admission_controller.release(kind, time.monotonic() - started, token)
 
-@app.route('/create_folder', methods=['POST'])
-def create_folder():
-    try:
-        data = request.get_json()
-        
-        raw_drive = data.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
+@app.after_request
+def hold_admission(response):
+    # A vaga só é liberada depois que o corpo foi enviado: o teardown roda antes
+    # de uma resposta em streaming (download, arquivo frio, zip) começar a sair
+    admission = g.pop('admission', None)
+    if admission is not None:
+        release = lambda: _release_admission(admission)
+        if response.direct_passthrough:
+            # Corpo repassado direto (send_file): o servidor fecha só ele, não a resposta
+            response.response = ClosingIterator(response.response, release)
         else:
-            current_drive = raw_drive
+            response.call_on_close(release)
+    return response
 
-        current_path = data.get('path', '').strip('/').strip('\\')
-        folder_name = secure_filename(data.get('folder_name', '').strip())
+@app.teardown_request
+def finish_admission(exc):
+    # Sem resposta (erro antes do after_request): libera aqui
+    admission = g.pop('admission', None)
+    if admission is not None:
+        _release_admission(admission)
 
-        if not folder_name:
-            return jsonify({'error': 'Nome de pasta inválido'}), 400
+@app.before_request
+def start_transfer_shaping():
+    kind = transfer_kind()
+    if kind is None:
+        transfer_scheduler.begin_interactive()
+        g.interactive_request = True
+    elif kind == 'upload':
+        transfer = transfer_scheduler.register(request.remote_addr, kind)
+        request.environ['wsgi.input'] = ThrottledInput(request.environ['wsgi.input'], transfer_scheduler, transfer)
+        g.upload_transfer = transfer
 
-        full_current_path = safe_path(current_drive, current_path)
-        new_folder_path = os.path.join(full_current_path, folder_name)
+@app.after_request
+def shape_transfer_response(response):
+    kind = transfer_kind()
+    if kind in ('download', 'preview'):
+        response.response = transfer_scheduler.throttle(response.response, request.remote_addr, kind)
+    return response
 
-        os.makedirs(new_folder_path, exist_ok=True)
-        print(f"Pasta criada com sucesso: {new_folder_path}")
+@app.teardown_request
+def finish_transfer_shaping(exc):
+    if g.pop('interactive_request', False):
+        transfer_scheduler.end_interactive()
+    transfer = g.pop('upload_transfer', None)
+    if transfer is not None:
+        transfer_scheduler.unregister(transfer)
 
-        return jsonify({'success': True})
-    
-    except Exception as e:
-        print(f"Erro ao criar pasta: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.before_request
+def start_profiling():
+    if request.endpoint and request.endpoint.startswith('admin_'):
+        return
+    if profiling_requested():
+        g.profiler = StackSampler(threading.get_ident(), PROFILE_SETTINGS['interval'])
+        g.profile_name = f"{datetime.now():%Y%m%d-%H%M%S}-{request.endpoint or 'desconhecido'}-{uuid.uuid4().hex[:6]}"
+        g.profiler.start()
 
-@app.route('/rename', methods=['POST'])
-def rename():
+@app.after_request
+def tag_profiled_response(response):
+    if 'profiler' in g:
+        response.headers['X-Vyrex-Profile-Id'] = g.profile_name
+    return response
+
+@app.teardown_request
+def finish_profiling(exc):
+    # Cobre a execução da view; o envio de respostas em streaming acontece depois
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        try:
+            write_profile(profiler, g.pop('profile_name'))
+        except Exception as e:
+            print(f"Erro ao gravar perfil: {e}")
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    require_local_admin()
     try:
-        data = request.get_json()
-        
-        raw_drive = data.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
-        else:
-            current_drive = raw_drive
-            
-        old_path = data.get('old_path', '').strip('/').strip('\\')
-        new_name = secure_filename(data.get('new_name', '').strip())
+        if request.method == 'POST':
+            data = request.get_json()
+            if 'sample_rate' in data:
+                PROFILE_SETTINGS['sample_rate'] = min(1.0, max(0.0, float(data['sample_rate'])))
+            if 'interval' in data:
+                PROFILE_SETTINGS['interval'] = max(0.001, float(data['interval']))
+        return jsonify({'success': True, 'settings': PROFILE_SETTINGS, 'profiles': list_profiles()})
 
-        if not new_name:
-            return jsonify({'error': 'Nome inválido'}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao ajustar perfil: {e}")
+        return jsonify({'error': str(e)}), 400
 
-        full_old_path = safe_path(current_drive, old_path)
-        
-        if not os.path.exists(full_old_path):
-            return jsonify({'error': 'Arquivo ou pasta não encontrado'}), 404
+@app.route('/admin/profiling/<name>')
+def admin_profiling_file(name):
+    require_local_admin()
+    fmt = request.args.get('format', 'speedscope')
+    ext = '.folded' if fmt == 'folded' else '.speedscope.json'
+    path = os.path.join(PROFILE_FOLDER, secure_filename(name) + ext)
+    if not os.path.exists(path):
+        return "Perfil não encontrado", 404
+    return send_file(path, as_attachment=True)
 
-        parent_directory = os.path.dirname(full_old_path)
-        full_new_path = os.path.join(parent_directory, new_name)
-        
-        if os.path.exists(full_new_path):
-            return jsonify({'error': 'Já existe um item com este nome'}), 400
+@app.route('/admin/bandwidth', methods=['GET', 'POST'])
+def admin_bandwidth():
+    require_local_admin()
+    try:
+        if request.method == 'POST':
+            data = request.get_json()
+            allowed = {k: v for k, v in data.items() if k in BANDWIDTH_SETTINGS}
+            transfer_scheduler.update(**allowed)
+        return jsonify({'success': True, **transfer_scheduler.snapshot()})
 
-        shutil.move(full_old_path, full_new_path)
-        return jsonify({'success': True})
-    
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro ao renomear: {e}")
-        return jsonify({'error': str(e)}), 500
+        print(f"Erro ao ajustar banda: {e}")
+        return jsonify({'error': str(e)}), 400
 
-@app.route('/delete', methods=['POST'])
-def delete():
+@app.route('/admin/admission', methods=['GET', 'POST'])
+def admin_admission():
+    require_local_admin()
     try:
-        data = request.get_json()
-        
-        raw_drive = data.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
-        else:
-            current_drive = raw_drive
-            
-        paths = data.get('selected', [])
-        
-        deleted = 0
-        for path in paths:
-            path = path.strip('/').strip('\\')
-            full_path = safe_path(current_drive, path)
-            
-            if os.path.exists(full_path):
-                if os.path.isdir(full_path):
-                    shutil.rmtree(full_path)
-                else:
-                    os.remove(full_path)
-                deleted += 1
-        
-        return jsonify({'success': True, 'deleted': deleted})
-    
+        if request.method == 'POST':
+            data = request.get_json()
+            allowed = {k: v for k, v in data.items() if k in ADMISSION_SETTINGS}
+            admission_controller.update(**allowed)
+        return jsonify({'success': True, **admission_controller.snapshot()})
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro ao apagar: {e}")
+        print(f"Erro ao ajustar admissão: {e}")
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/admin/quotas', methods=['GET', 'POST'])
+def admin_quotas():
+    require_local_admin()
+    try:
+        if request.method == 'POST':
+            config = request.get_json()
+            if not isinstance(config, dict):
+                return jsonify({'error': 'Configuração inválida'}), 400
+            quota_tracker.apply_config(config)
+            _write_json_atomic(QUOTAS_FILE, config)
+            quota_tracker.reload(force=True)
+        return jsonify({'success': True, 'config': quota_tracker.config(), 'usage': quota_tracker.report()})
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao ajustar cotas: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/move', methods=['POST'])
-def move():
+@app.route('/admin/checksums', methods=['GET', 'POST'])
+def admin_checksums():
+    require_local_admin()
     try:
-        data = request.get_json()
-        
-        raw_drive = data.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
-        else:
-            current_drive = raw_drive
-            
-        target_rel = data.get('target_path', '').strip('/').strip('\\')
-        paths = data.get('selected', [])
-        
-        if not target_rel:
-            return jsonify({'error': 'Destino inválido'}), 400
-        
-        target_full = safe_path(current_drive, target_rel)
-        
-        if not os.path.exists(target_full):
-            os.makedirs(target_full, exist_ok=True)
-        
-        moved = 0
-        for path in paths:
-            path = path.strip('/').strip('\\')
-            full_old = safe_path(current_drive, path)
-            
-            if not os.path.exists(full_old):
-                continue
-            
-            basename = os.path.basename(full_old)
-            full_new = os.path.join(target_full, basename)
-            
-            if full_old != full_new and not os.path.exists(full_new):
-                shutil.move(full_old, full_new)
-                moved += 1
-        
-        return jsonify({'success': True, 'moved': moved})
-    
+        if request.method == 'POST':
+            data = request.get_json() or {}
+            for key in ('rate', 'scrub_rate', 'scrub_age_days'):
+                if key in data:
+                    CHECKSUM_SETTINGS[key] = max(0, int(data[key]))
+            if 'drives' in data:
+                for raw_drive in data['drives']:
+                    drive_root_or_abort(raw_drive)
+                CHECKSUM_SETTINGS['drives'] = list(data['drives'])
+            if data.get('scrub_now'):
+                threading.Thread(target=run_scrub, name='verificacao-manual', daemon=True).start()
+        return jsonify({'success': True, 'settings': CHECKSUM_SETTINGS, **checksum_report()})
+
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro ao mover: {e}")
+        print(f"Erro ao consultar somas de verificação: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/download')
-def download_file():
+@app.route('/admin/cold-storage', methods=['GET', 'POST'])
+def admin_cold_storage():
+    require_local_admin()
     try:
-        raw_drive = request.args.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
-        else:
-            current_drive = raw_drive
+        if request.method == 'POST':
+            data = request.get_json() or {}
+            for key in ('days', 'rate'):
+                if key in data:
+                    COLD_STORAGE_SETTINGS[key] = max(0, int(data[key]))
+            if 'extensions' in data:
+                COLD_STORAGE_SETTINGS['extensions'] = [str(ext).lower().lstrip('.') for ext in data['extensions']]
+            if 'drives' in data:
+                for raw_drive in data['drives']:
+                    drive_root_or_abort(raw_drive)
+                COLD_STORAGE_SETTINGS['drives'] = list(data['drives'])
+            if data.get('run_now'):
+                _cold_pool.submit(run_cold_storage)
+        return jsonify({'success': True, 'settings': COLD_STORAGE_SETTINGS,
+                        'codec': 'zstd' if zstandard is not None else 'gzip', 'status': dict(cold_status)})
 
-        filename = request.args.get('filename', '').strip('/').strip('\\')
-        full_path = safe_path(current_drive, filename)
-        
-        if os.path.exists(full_path) and not os.path.isdir(full_path):
-            return send_file(full_path, as_attachment=True)
-        
-        return "Arquivo não encontrado", 404
-    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro no download: {e}")
-        return str(e), 500
+        print(f"Erro ao configurar o armazenamento frio: {e}")
+        return jsonify({'error': str(e)}), 500
 
-@app.route('/preview')
-def preview_file():
+@app.route('/admin/replication', methods=['GET', 'POST'])
+def admin_replication():
+    require_local_admin()
     try:
-        raw_drive = request.args.get('drive', 'DADOS')
-        if raw_drive == 'DADOS':
-            current_drive = DATA_FOLDER
-        elif len(raw_drive) == 2 and raw_drive[1] == ':':
-            current_drive = raw_drive + os.sep
-        else:
-            current_drive = raw_drive
-            
-        filename = request.args.get('filename', '').strip('/').strip('\\')
-        full_path = safe_path(current_drive, filename)
-        
-        if not os.path.exists(full_path) or os.path.isdir(full_path):
-            return jsonify({'error': 'Arquivo não encontrado'}), 404
-        
-        if os.path.getsize(full_path) > 50 * 1024 * 1024:
-            return jsonify({'error': 'Arquivo muito grande para preview'}), 400
-        
-        with open(full_path, 'rb') as f:
-            data = f.read()
-        
-        mime = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
-        base64_data = b64encode(data).decode('utf-8')
-        
-        return jsonify({'base64': base64_data, 'mime': mime})
-    
+        if not REPLICATION_SETTINGS['peer']:
+            return jsonify({'error': 'Replicação desativada (inicie com --peer)'}), 400
+        if request.method == 'POST' and (request.get_json(silent=True) or {}).get('resync'):
+            # Compara a pasta DADOS inteira com a réplica e envia o que estiver diferente
+            journal_change(resolve_drive('DADOS'), 'put', '')
+        return jsonify({'success': True, **replication_report()})
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro no preview: {e}")
+        print(f"Erro ao consultar replicação: {e}")
         return jsonify({'error': str(e)}), 500
 
+# --- HTTPS E HTTP/2 ---
+
+TLS_FOLDER = os.path.join(STATE_FOLDER, 'tls')
+TLS_CERT_FILE = os.path.join(TLS_FOLDER, 'cert.pem')
+TLS_KEY_FILE = os.path.join(TLS_FOLDER, 'key.pem')
+TLS_CERT_DAYS = 825  # Máximo aceito por iOS/macOS para certificados de servidor
+
+def local_addresses():
+    """Nomes e IPs pelos quais o servidor pode ser acessado na rede local."""
+    names = {'localhost', socket.gethostname()}
+    ips = {'127.0.0.1'}
+    for addresses in psutil.net_if_addrs().values():
+        for address in addresses:
+            if address.family == socket.AF_INET:
+                ips.add(address.address)
+    return sorted(names), sorted(ips)
+
+def _generate_certificate_cryptography(names, ips):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    import datetime as dt
+    import ipaddress
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Vyrex-Box')])
+    alt_names = [x509.DNSName(n) for n in names] + [x509.IPAddress(ipaddress.ip_address(ip)) for ip in ips]
+    now = dt.datetime.now(dt.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - dt.timedelta(days=1))
+            .not_valid_after(now + dt.timedelta(days=TLS_CERT_DAYS))
+            .add_extension(x509.SubjectAlternativeName(alt_names), critical=False)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+
+    with open(TLS_KEY_FILE, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(TLS_CERT_FILE, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+def _generate_certificate_openssl(openssl, names, ips):
+    alt_names = ','.join([f'DNS:{n}' for n in names] + [f'IP:{ip}' for ip in ips])
+    subprocess.run([openssl, 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-keyout', TLS_KEY_FILE, '-out', TLS_CERT_FILE, '-days', str(TLS_CERT_DAYS),
+                    '-subj', '/CN=Vyrex-Box', '-addext', f'subjectAltName={alt_names}'],
+                   check=True, capture_output=True)
+
+def ensure_certificate():
+    """
+    Gera na primeira execução (e quando estiver perto de expirar) um certificado
+    autoassinado para os nomes e IPs locais. Usa o pacote cryptography se
+    estiver instalado, senão o comando openssl.
+    """
+    try:
+        age_days = (time.time() - os.path.getmtime(TLS_CERT_FILE)) / 86400
+        if age_days < TLS_CERT_DAYS - 30 and os.path.exists(TLS_KEY_FILE):
+            return TLS_CERT_FILE, TLS_KEY_FILE
+    except OSError:
+        pass
+
+    os.makedirs(TLS_FOLDER, exist_ok=True)
+    names, ips = local_addresses()
+    if importlib.util.find_spec('cryptography') is not None:
+        _generate_certificate_cryptography(names, ips)
+    elif shutil.which('openssl'):
+        _generate_certificate_openssl(shutil.which('openssl'), names, ips)
+    else:
+        raise RuntimeError('Para usar HTTPS instale o pacote cryptography (pip install cryptography) ou o OpenSSL')
+    if os.name == 'posix':
+        os.chmod(TLS_KEY_FILE, 0o600)
+    print(f"🔐 Certificado autoassinado gerado para: {', '.join(names + ips)}")
+    return TLS_CERT_FILE, TLS_KEY_FILE
+
+def certificate_fingerprint(cert_file):
+    with open(cert_file, encoding='ascii') as f:
+        der = ssl.PEM_cert_to_DER_cert(f.read())
+    digest = hashlib.sha256(der).hexdigest().upper()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+HTTP2_THREADS = 64   # Requisições WSGI atendidas ao mesmo tempo no modo --https
+
+class ASGIBodyStream:
+    """
+    wsgi.input que busca o corpo no servidor ASGI conforme o app lê, em vez de
+    juntá-lo inteiro na memória antes (como faz o modo WSGI do hypercorn).
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._done = False
+
+    def _fill(self):
+        if self._done:
+            return False
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            # Cliente desconectou: o app vê um corpo curto, como no servidor de desenvolvimento
+            self._done = True
+            return False
+        self._buffer += message.get('body', b'')
+        self._done = not message.get('more_body', False)
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            data, self._buffer = self._buffer, b''
+            return data
+        while len(self._buffer) < size and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+class StreamingWSGIApp:
+    """
+    Adaptador ASGI -> WSGI com corpo e resposta em streaming. Cada requisição
+    roda numa thread; o corpo chega ao app aos poucos (ASGIBodyStream) e cada
+    pedaço da resposta só é lido do app depois que o anterior foi entregue ao
+    servidor, então nem uploads nem downloads ficam inteiros na memória.
+    """
+
+    def __init__(self, wsgi_app, threads=HTTP2_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http2')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, ASGIBodyStream(receive, loop))
+
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        await loop.run_in_executor(self.executor, self.run, environ, send_sync)
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            # O HTTP/2 não exige Content-Length: o app lê o corpo até o fim
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin1')
+            key = {'content-length': 'CONTENT_LENGTH', 'content-type': 'CONTENT_TYPE'}.get(
+                name, 'HTTP_' + name.upper().replace('-', '_'))
+            value = raw_value.decode('latin1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def run(self, environ, send):
+        started = {'sent': False}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+        def begin():
+            if not started['sent']:
+                send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+                started['sent'] = True
+
+        body = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in body:
+                begin()
+                if chunk:
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            begin()
+            send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+def serve_http2(port, cert_file, key_file):
+    """
+    Serve o app com o hypercorn: HTTP/2 sobre TLS (com fallback para HTTP/1.1),
+    vários pedidos multiplexados na mesma conexão. O app continua WSGI, servido
+    por StreamingWSGIApp para que uploads não sejam lidos inteiros na memória.
+    """
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f'0.0.0.0:{port}']
+    config.certfile = cert_file
+    config.keyfile = key_file
+    config.alpn_protocols = ['h2', 'http/1.1']
+    config.accesslog = '-'
+    asyncio.run(serve(StreamingWSGIApp(app), config, mode='asgi'))
+
+# --- TAREFAS EM SEGUNDO PLANO ---
+
+WORKERS_LOCK_FILE = os.path.join(STATE_FOLDER, 'tarefas.lock')
+_workers_lock = {'file': None}
+
+def start_background_workers():
+    """
+    Inicia as tarefas que rodam em segundo plano enquanto o servidor estiver no ar.
+    Com vários processos (ex: Gunicorn), só o que conseguir a trava de
+    WORKERS_LOCK_FILE as inicia; se ele terminar, a trava fica livre para o
+    processo que o substituir. Retorna True se as tarefas subiram neste processo.
+    """
+    if _workers_lock['file'] is not None:
+        return False
+    if fcntl is not None:
+        os.makedirs(STATE_FOLDER, exist_ok=True)
+        lock_file = open(WORKERS_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        _workers_lock['file'] = lock_file  # Aberto até o processo terminar
+    else:
+        _workers_lock['file'] = True
+    threading.Thread(target=trash_purger_loop, name='lixeira', daemon=True).start()
+    threading.Thread(target=cache_pruner_loop, name='cache', daemon=True).start()
+    threading.Thread(target=metadata_scanner_loop, name='metadados', daemon=True).start()
+    threading.Thread(target=quota_reconciler_loop, name='cotas', daemon=True).start()
+    threading.Thread(target=checksum_scrubber_loop, name='verificacao', daemon=True).start()
+    threading.Thread(target=cold_storage_loop, name='armazenamento-frio', daemon=True).start()
+    if REPLICATION_SETTINGS['peer']:
+        start_replication()
+    return True
+
 # --- INICIALIZAÇÃO DO SERVIDOR ---
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor Vyrex-Box')
+    parser.add_argument('--porta', type=int, default=5000, help='Porta do servidor (padrão: 5000)')
+    parser.add_argument('--https', action='store_true',
+                        help='Serve com TLS (certificado autoassinado) e HTTP/2, se o hypercorn estiver instalado')
+    parser.add_argument('--peer', metavar='URL',
+                        help='Outra instância que recebe uma cópia das alterações da pasta DADOS (ex: http://192.168.0.20:5000)')
+    parser.add_argument('--peer-inseguro', action='store_true',
+                        help='Aceita o certificado autoassinado da réplica (--https do outro lado)')
+    parser.add_argument('--replica-segredo', metavar='SEGREDO', default=REPLICATION_SETTINGS['secret'],
+                        help='Segredo combinado entre as instâncias que replicam (padrão: VYREX_REPLICA_SEGREDO)')
+    parser.add_argument('--arquivar-apos', type=int, metavar='DIAS', default=0,
+                        help='Comprime arquivos (txt, doc, xls, bmp...) sem acesso há DIAS dias (padrão: desativado)')
+    args = parser.parse_args()
+    scheme = 'https' if args.https else 'http'
+    if args.peer:
+        ReplicationPeer(args.peer)  # Valida o endereço antes de subir o servidor
+        REPLICATION_SETTINGS.update(peer=args.peer, insecure=args.peer_inseguro)
+    REPLICATION_SETTINGS['secret'] = args.replica_segredo or None
+    COLD_STORAGE_SETTINGS['days'] = max(0, args.arquivar_apos)
+
     print("\n" + "="*60)
     print("🚀 VYREX-BOX LOCAL INICIADO COM SUCESSO!")
     print("="*60)
     print(f"📁 Pasta DADOS: {DATA_FOLDER}")
-    print(f"🌐 Acesse: http://localhost:5000")
-    print(f"📱 No celular (mesma rede): http://SEU_IP_LOCAL:5000")
+    if args.peer:
+        print(f"🔁 Replicando alterações para: {args.peer}")
+    if args.arquivar_apos > 0:
+        print(f"🧊 Comprimindo arquivos sem acesso há {args.arquivar_apos} dias")
+    print(f"🌐 Acesse: {scheme}://localhost:{args.porta}")
+    print(f"📱 No celular (mesma rede): {scheme}://SEU_IP_LOCAL:{args.porta}")
     print("\n💡 Dica: Use 'ipconfig' (Windows) ou 'ifconfig' (Linux/Mac)")
     print("   para descobrir seu IP local")
     print("="*60 + "\n")
+
+    if args.https:
+        cert_file, key_file = ensure_certificate()
+        print(f"🔐 Impressão digital SHA-256 do certificado (confira no navegador):\n   {certificate_fingerprint(cert_file)}\n")
+        if importlib.util.find_spec('hypercorn') is not None:
+            # Sem reloader aqui: um único processo, então as tarefas sobem direto
+            start_background_workers()
+            serve_http2(args.porta, cert_file, key_file)
+            sys.exit(0)
+        print("⚠️  HTTP/2 indisponível (pip install hypercorn); usando HTTPS com HTTP/1.1\n")
+
+    # Com debug=True o reloader roda o script duas vezes; as tarefas em
+    # segundo plano só devem subir no processo que atende as requisições
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     # Em produção, use um servidor WSGI como Gunicorn ou uWSGI e desative o debug
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=args.porta,
+            ssl_context=(cert_file, key_file) if args.https else None)
@@ -0,0 +1,569 @@
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import ssl
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tempfile import SpooledTemporaryFile
+from urllib.parse import quote, urlencode, urlsplit
+
+# --- CONFIGURAÇÃO ---
+
+STATE_FILENAME = '.vyrex-sync.db'   # Estado local, guardado na própria pasta sincronizada
+IO_CHUNK = 1024 * 1024
+HTTP_TIMEOUT = 120
+DELTA_MIN_SIZE = 4 * 1024 * 1024    # Abaixo disso é mais barato reenviar o arquivo inteiro
+DELTA_LITERAL_FLUSH = 4 * 1024 * 1024
+DELTA_MAX_BACKOFF = 64              # Blocos pulados sem busca byte a byte em trechos novos
+DELTA_HEADER = struct.Struct('<4sIQQ')
+DELTA_BLOCK = struct.Struct('<I16s')
+ADLER_MOD = 65521
+
+def is_ignored(name):
+    # Estado do cliente e temporários de uploads/downloads em andamento
+    return name.startswith(STATE_FILENAME) or name.endswith('.parcial')
+
+# --- CONEXÃO COM O SERVIDOR ---
+
+class ServerClient:
+    """
+    Acesso ao Vyrex-Box com uma conexão HTTP persistente (keep-alive) por
+    thread, reaproveitada entre as transferências.
+    """
+
+    def __init__(self, base_url, drive, remote_root, insecure=False):
+        parts = urlsplit(base_url if '://' in base_url else 'http://' + base_url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.drive = drive
+        self.remote_root = remote_root.strip('/')
+        self.context = ssl._create_unverified_context() if insecure else None
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.https:
+                conn = http.client.HTTPSConnection(self.host, timeout=HTTP_TIMEOUT, context=self.context)
+            else:
+                conn = http.client.HTTPConnection(self.host, timeout=HTTP_TIMEOUT)
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def remote_path(self, rel):
+        return f"{self.remote_root}/{rel}".strip('/') if rel else self.remote_root
+
+    def dav_url(self, rel):
+        return f"{self.prefix}/dav/{quote(self.drive)}/{quote(self.remote_path(rel))}"
+
+    def api_url(self, route, **params):
+        return f"{self.prefix}{route}?{urlencode(dict(drive=self.drive, **params))}"
+
+    def request(self, method, url, body=None, headers=None, sink=None):
+        """
+        Faz uma requisição e retorna (status, cabeçalhos, corpo). Com sink, o
+        corpo é copiado em blocos para sink(dados) em vez de ficar na memória.
+        Uma conexão derrubada pelo servidor (keep-alive expirado) é refeita uma vez.
+        """
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, url, body=body() if callable(body) else body, headers=headers or {})
+                response = conn.getresponse()
+                if sink is not None and response.status < 300:
+                    while True:
+                        chunk = response.read(IO_CHUNK)
+                        if not chunk:
+                            break
+                        sink(chunk)
+                    data = b''
+                else:
+                    data = response.read()
+                if response.will_close:
+                    self._drop_connection()
+                return response.status, response.headers, data
+            except (http.client.HTTPException, ConnectionError):
+                self._drop_connection()
+                # Só repete se o corpo puder ser gerado de novo
+                if attempt or (body is not None and not callable(body) and not isinstance(body, bytes)):
+                    raise
+            except OSError:
+                self._drop_connection()
+                raise
+
+    def list_remote(self):
+        """Listagem recursiva da pasta remota: {caminho: (é pasta, tamanho, mtime_ns)}."""
+        status, _, data = self.request('GET', self.api_url('/api/list', path=self.remote_root, recursive='1'))
+        if status == 404:
+            return None
+        if status != 200:
+            raise RuntimeError(f"Erro ao listar o servidor ({status}): {data[:200]!r}")
+        entries = {}
+        for line in data.splitlines():
+            if line:
+                path, is_dir, size, mtime_ns = json.loads(line)
+                entries[path] = (is_dir, size, mtime_ns)
+        return entries
+
+# --- ESTADO LOCAL ---
+
+class SyncState:
+    """
+    Último estado sincronizado de cada arquivo: tamanho, mtime e hash locais e
+    tamanho/mtime no servidor. Só arquivos cujo stat mudou são relidos.
+    """
+
+    def __init__(self, folder, identity):
+        self.db = sqlite3.connect(os.path.join(folder, STATE_FILENAME))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT,
+            remote_size INTEGER, remote_mtime_ns INTEGER)''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)')
+        row = self.db.execute("SELECT value FROM config WHERE key = 'remote'").fetchone()
+        if row is None or row[0] != identity:
+            # Outro servidor ou pasta remota: o estado anterior não vale mais
+            self.db.execute('DELETE FROM files')
+            self.db.execute("INSERT OR REPLACE INTO config VALUES ('remote', ?)", (identity,))
+        self.db.commit()
+
+    def load(self):
+        return {row[0]: row[1:] for row in self.db.execute('SELECT * FROM files')}
+
+    def save(self, path, size, mtime_ns, sha256, remote_size, remote_mtime_ns):
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, size, mtime_ns, sha256, remote_size, remote_mtime_ns))
+
+    def forget(self, path):
+        self.db.execute('DELETE FROM files WHERE path = ? OR path LIKE ?', (path, path + '/%'))
+
+    def commit(self):
+        self.db.commit()
+
+def scan_local(folder):
+    """Percorre a pasta local com scandir: {caminho: (é pasta, tamanho, mtime_ns)}."""
+    entries = {}
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        try:
+            with os.scandir(os.path.join(folder, rel)) as it:
+                for entry in it:
+                    if is_ignored(entry.name) or entry.is_symlink():
+                        continue
+                    child = f"{rel}/{entry.name}" if rel else entry.name
+                    st = entry.stat()
+                    is_dir = entry.is_dir()
+                    entries[child] = (is_dir, 0 if is_dir else st.st_size, st.st_mtime_ns)
+                    if is_dir:
+                        stack.append(child)
+        except OSError as e:
+            print(f"⚠️  Não foi possível ler {rel or '.'}: {e}")
+    return entries
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(IO_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# --- DELTA ---
+
+def make_patch(src, out, signature):
+    """
+    Compara o arquivo local com a assinatura do servidor e grava em out o
+    patch no formato de /delta/patch. Blocos iguais são achados mesmo fora
+    do alinhamento (soma adler32 rolante); em trechos longos sem nenhum
+    acerto a busca byte a byte é espaçada para não custar um laço Python
+    por byte do arquivo inteiro.
+    """
+    _, block_size, base_size, _ = DELTA_HEADER.unpack_from(signature)
+    count = (len(signature) - DELTA_HEADER.size) // DELTA_BLOCK.size
+    last_len = base_size - (count - 1) * block_size if count else 0
+    table = {}
+    for index in range(count):
+        weak, strong = DELTA_BLOCK.unpack_from(signature, DELTA_HEADER.size + index * DELTA_BLOCK.size)
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    digest = hashlib.sha256()
+    literal = bytearray()
+    run = []
+
+    def flush():
+        if literal:
+            out.write(b'L' + struct.pack('<I', len(literal)) + literal)
+            digest.update(literal)
+            literal.clear()
+        if run:
+            out.write(b'C' + struct.pack('<QI', run[0], run[1]))
+            run.clear()
+
+    def lookup(window, weak):
+        candidates = table.get(weak)
+        if not candidates:
+            return None
+        index = candidates.get(hashlib.blake2b(window, digest_size=16).digest())
+        if index is None or len(window) != (last_len if index == count - 1 else block_size):
+            return None
+        return index
+
+    buf = bytearray()
+    pos = 0
+    eof = False
+    a = b = None
+    rolled = skip = 0
+    backoff = 1
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            del buf[:pos]
+            pos = 0
+            chunk = src.read(IO_CHUNK * 4)
+            eof = not chunk
+            buf += chunk
+            continue
+
+        window = bytes(buf[pos:pos + block_size])
+        if not window:
+            break
+        if a is None:
+            weak = zlib.adler32(window)
+            a, b = weak & 0xffff, weak >> 16
+
+        index = lookup(window, (b << 16) | a)
+        if index is not None:
+            if literal:
+                flush()
+            if run and run[0] + run[1] == index:
+                run[1] += 1
+            else:
+                flush()
+                run.extend([index, 1])
+            digest.update(window)
+            pos += len(window)
+            a = None
+            rolled = skip = 0
+            backoff = 1
+            continue
+
+        if run:
+            flush()
+        if len(window) < block_size:
+            # Final do arquivo sem correspondência
+            literal += window
+            pos += len(window)
+        elif skip or rolled >= block_size:
+            if not skip:
+                skip = backoff
+                backoff = min(backoff * 2, DELTA_MAX_BACKOFF)
+            skip -= 1
+            rolled = 0
+            literal += window
+            pos += block_size
+            a = None
+        elif pos + block_size < len(buf):
+            # Desliza a janela um byte (mesma recorrência do adler32)
+            old, new = buf[pos], buf[pos + block_size]
+            a = (a - old + new) % ADLER_MOD
+            b = (b - block_size * old + a - 1) % ADLER_MOD
+            literal.append(old)
+            pos += 1
+            rolled += 1
+        else:
+            # Não há o próximo byte: avança sem rolar
+            literal.append(buf[pos])
+            pos += 1
+            a = None
+        if len(literal) >= DELTA_LITERAL_FLUSH:
+            flush()
+
+    flush()
+    out.write(b'E' + digest.digest())
+
+# --- TRANSFERÊNCIAS ---
+
+def _etag_mtime(headers, fallback):
+    # O ETag do WebDAV é "<mtime_ns em hex>-<tamanho em hex>"
+    try:
+        return int(headers.get('ETag', '').strip('"').split('-')[0], 16)
+    except ValueError:
+        return fallback
+
+def upload_file(client, folder, rel, size, mtime_ns, remote):
+    """Envia um arquivo (por delta se já existir uma versão grande no servidor)."""
+    path = os.path.join(folder, rel)
+    if remote and not remote[0] and size >= DELTA_MIN_SIZE and remote[1] >= DELTA_MIN_SIZE:
+        result = upload_delta(client, path, rel, mtime_ns, remote)
+        if result is not None:
+            return result
+
+    digest = [None]
+
+    def body():
+        # Gerado de novo a cada tentativa, junto com o hash
+        digest[0] = hashlib.sha256()
+
+        def chunks():
+            with open(path, 'rb') as f:
+                remaining = size
+                while remaining > 0:
+                    chunk = f.read(min(IO_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    digest[0].update(chunk)
+                    remaining -= len(chunk)
+                    yield chunk
+        return chunks()
+
+    status, headers, data = client.request('PUT', client.dav_url(rel), body=body,
+                                           headers={'Content-Length': str(size), 'X-Vyrex-Mtime': str(mtime_ns)})
+    if status not in (200, 201, 204):
+        raise RuntimeError(f"PUT {rel}: {status} {data[:200]!r}")
+    return 'enviado', size, digest[0].hexdigest(), size, _etag_mtime(headers, mtime_ns)
+
+def upload_delta(client, path, rel, mtime_ns, remote):
+    status, _, signature = client.request('GET', client.api_url('/delta/signature', path=client.remote_path(rel)))
+    if status != 200:
+        return None
+    _, block_size, base_size, base_mtime_ns = DELTA_HEADER.unpack_from(signature)
+
+    with open(path, 'rb') as src, SpooledTemporaryFile(max_size=64 * 1024 * 1024) as patch:
+        make_patch(src, patch, signature)
+        patch_size = patch.tell()
+
+        def body():
+            patch.seek(0)
+            return iter(lambda: patch.read(IO_CHUNK), b'')
+
+        url = client.api_url('/delta/patch', path=client.remote_path(rel), block=block_size,
+                             base_mtime_ns=base_mtime_ns, base_size=base_size,
+                             target_size=os.fstat(src.fileno()).st_size)
+        status, _, data = client.request('POST', url, body=body,
+                                         headers={'Content-Length': str(patch_size), 'X-Vyrex-Mtime': str(mtime_ns)})
+    if status != 200:
+        # Arquivo mudou no servidor ou patch recusado: envia inteiro
+        return None
+    result = json.loads(data)
+    return 'delta', patch_size, file_sha256(path), result['size'], result['mtime_ns']
+
+def download_file(client, folder, rel, size, mtime_ns):
+    path = os.path.join(folder, rel)
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.parcial")
+    digest = hashlib.sha256()
+    try:
+        with open(temp_path, 'wb') as f:
+            def sink(chunk):
+                f.write(chunk)
+                digest.update(chunk)
+            status, _, data = client.request('GET', client.dav_url(rel), sink=sink)
+        if status != 200:
+            raise RuntimeError(f"GET {rel}: {status} {data[:200]!r}")
+        os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    st = os.stat(path)
+    return 'recebido', size, digest.hexdigest(), st.st_size, st.st_mtime_ns
+
+# --- PLANEJAMENTO ---
+
+def changed_sides(rel, local, remote, state):
+    """Retorna (local mudou, remoto mudou) desde a última sincronização."""
+    row = state.get(rel)
+    if row is None:
+        return True, True
+    local_changed = local is None or (local[1], local[2]) != (row[0], row[1])
+    remote_changed = remote is None or (remote[1], remote[2]) != (row[3], row[4])
+    return local_changed, remote_changed
+
+def sync(args):
+    folder = os.path.abspath(args.pasta)
+    client = ServerClient(args.servidor, args.drive, args.remoto, args.inseguro)
+    state_db = SyncState(folder, f"{args.servidor.rstrip('/')}|{args.drive}|{client.remote_root}")
+    state = state_db.load()
+    started = time.time()
+
+    local = scan_local(folder)
+    remote = client.list_remote()
+    if remote is None:
+        if args.modo == 'receber':
+            raise RuntimeError('A pasta remota não existe')
+        remote = {}
+        if not args.simular:
+            # Cria a pasta remota, componente por componente
+            parts = client.remote_root.split('/') if client.remote_root else []
+            for i in range(len(parts)):
+                url = f"{client.prefix}/dav/{quote(client.drive)}/{quote('/'.join(parts[:i + 1]))}"
+                client.request('MKCOL', url)
+
+    pushing = args.modo == 'enviar'
+    source, target = (local, remote) if pushing else (remote, local)
+    tasks = []
+    folders = []
+    conflicts = []
+    unchanged = 0
+
+    for rel, (is_dir, size, mtime_ns) in source.items():
+        other = target.get(rel)
+        if is_dir:
+            if other is None:
+                folders.append(rel)
+            elif not other[0]:
+                conflicts.append(rel)
+            continue
+        if other is not None and other[0]:
+            conflicts.append(rel)
+            continue
+
+        local_changed, remote_changed = changed_sides(rel, local.get(rel), remote.get(rel), state)
+        source_changed, target_changed = (local_changed, remote_changed) if pushing else (remote_changed, local_changed)
+        if not local_changed and not remote_changed:
+            unchanged += 1
+            continue
+        if other is not None and (other[1], other[2]) == (size, mtime_ns):
+            # Mesmo arquivo dos dois lados (primeira sincronização, por exemplo)
+            state_db.save(rel, size, mtime_ns, None, size, mtime_ns)
+            unchanged += 1
+            continue
+        if pushing and not remote_changed and rel in state:
+            # Stat mudou mas o conteúdo pode ser o mesmo (ex: arquivo apenas "tocado")
+            sha = file_sha256(os.path.join(folder, rel))
+            if sha == state[rel][2]:
+                state_db.save(rel, size, mtime_ns, sha, *state[rel][3:])
+                unchanged += 1
+                continue
+        if source_changed and target_changed and rel in state and other is not None:
+            conflicts.append(rel)
+            continue
+        tasks.append((rel, size, mtime_ns))
+
+    deletions = []
+    if args.apagar:
+        for rel, (is_dir, size, mtime_ns) in target.items():
+            if rel in source:
+                continue
+            parent = rel.rpartition('/')[0]
+            if pushing and parent and parent not in source:
+                continue  # No servidor a pasta pai inteira vai para a lixeira
+            if not pushing and not is_dir and changed_sides(rel, target[rel], None, state)[0]:
+                continue  # Arquivo local nunca sincronizado ou alterado: não apaga
+            deletions.append(rel)
+        # Localmente as pastas só são removidas vazias, então o conteúdo vem antes
+        deletions.sort(key=lambda p: -p.count('/'))
+
+    print(f"📋 {len(tasks)} para {'enviar' if pushing else 'receber'}, {len(folders)} pastas novas, "
+          f"{len(deletions)} para apagar, {unchanged} sem mudanças, {len(conflicts)} conflitos")
+    for rel in conflicts:
+        print(f"⚠️  Conflito (alterado dos dois lados ou tipo diferente), ignorado: {rel}")
+    if args.simular:
+        for rel, size, _ in tasks:
+            print(f"   {'↑' if pushing else '↓'} {rel} ({size} bytes)")
+        for rel in deletions:
+            print(f"   ✖ {rel}")
+        state_db.commit()
+        return 0
+
+    # Pastas primeiro, em ordem, para que os arquivos tenham onde cair
+    for rel in sorted(folders, key=lambda p: p.count('/')):
+        if pushing:
+            status, _, data = client.request('MKCOL', client.dav_url(rel))
+            if status not in (201, 405):
+                print(f"❌ Erro ao criar pasta {rel}: {status}")
+        else:
+            os.makedirs(os.path.join(folder, rel), exist_ok=True)
+
+    errors = 0
+    transferred = 0
+    with ThreadPoolExecutor(max_workers=args.paralelo) as pool:
+        futures = {}
+        for rel, size, mtime_ns in tasks:
+            if pushing:
+                future = pool.submit(upload_file, client, folder, rel, size, mtime_ns, remote.get(rel))
+            else:
+                future = pool.submit(download_file, client, folder, rel, size, mtime_ns)
+            futures[future] = (rel, size, mtime_ns)
+
+        for done, future in enumerate(as_completed(futures), 1):
+            rel, size, mtime_ns = futures[future]
+            try:
+                action, sent, sha, remote_size, remote_mtime_ns = future.result()
+            except Exception as e:
+                errors += 1
+                print(f"❌ {rel}: {e}")
+                continue
+            transferred += sent
+            if pushing:
+                state_db.save(rel, size, mtime_ns, sha, remote_size, remote_mtime_ns)
+            else:
+                state_db.save(rel, remote_size, remote_mtime_ns, sha, size, mtime_ns)
+            print(f"✅ [{done}/{len(tasks)}] {action}: {rel}")
+            if done % 500 == 0:
+                state_db.commit()
+
+    for rel in deletions:
+        try:
+            if pushing:
+                status, _, _ = client.request('DELETE', client.dav_url(rel))
+                if status not in (204, 404):
+                    raise RuntimeError(f"DELETE: {status}")
+            else:
+                path = os.path.join(folder, rel)
+                if os.path.isdir(path):
+                    os.rmdir(path)  # Só pastas vazias; o conteúdo já foi tratado acima
+                else:
+                    os.remove(path)
+            state_db.forget(rel)
+            print(f"🗑️  Apagado: {rel}")
+        except OSError as e:
+            print(f"⚠️  Não apagado {rel}: {e}")
+        except RuntimeError as e:
+            errors += 1
+            print(f"❌ {rel}: {e}")
+
+    state_db.commit()
+    print(f"🏁 Concluído em {time.time() - started:.1f}s: {len(tasks) - errors} transferidos "
+          f"({transferred / (1024 * 1024):.1f} MB na rede), {errors} erros")
+    return 1 if errors else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Sincroniza uma pasta local com o Vyrex-Box.')
+    parser.add_argument('pasta', help='Pasta local')
+    parser.add_argument('servidor', help='Endereço do servidor, ex: http://192.168.0.10:5000')
+    parser.add_argument('--drive', default='DADOS', help='Drive no servidor, como aparece no WebDAV (padrão: DADOS)')
+    parser.add_argument('--remoto', default='', help='Pasta no servidor, relativa ao drive')
+    parser.add_argument('--modo', choices=['enviar', 'receber'], default='enviar',
+                        help='enviar: o servidor espelha a pasta local; receber: o contrário')
+    parser.add_argument('--apagar', action='store_true', help='Apaga no destino o que não existe mais na origem')
+    parser.add_argument('--paralelo', type=int, default=4, help='Transferências simultâneas (padrão: 4)')
+    parser.add_argument('--simular', action='store_true', help='Só mostra o que seria feito')
+    parser.add_argument('--inseguro', action='store_true', help='Aceita certificado HTTPS autoassinado')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.pasta):
+        print(f"❌ Pasta local não encontrada: {args.pasta}")
+        return 2
+    try:
+        return sync(args)
+    except (OSError, RuntimeError, http.client.HTTPException) as e:
+        print(f"❌ Erro: {e}")
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())